@@ -1,27 +1,42 @@
 from data_engineering_pulumi_components.aws import Bucket
 from data_engineering_pulumi_components.utils import Tagger
-from pulumi import ResourceOptions, get_stack, export, Output
-from pulumi_aws.iam import RolePolicy
-from pulumi_aws.s3 import BucketPolicy
+from pulumi import Config, get_stack, export
 
+import data_engineering_exports.planner as planner
 import data_engineering_exports.pull as pull
 import data_engineering_exports.push as push
+import data_engineering_exports.registry as registry
 import data_engineering_exports.utils as utils
 
 
 # PUSH INFRASTRUCTURE
 # When files are added to the export bucket, move or copy them to their target bucket
 stack = get_stack()
+# Every stack config setting the program reads, so the planner can tell when any
+# of them change
+stack_config = planner.program_config(Config().get)
 tagger = Tagger(environment_name=stack)
 export_bucket = Bucket(name="mojap-hub-exports", tagger=tagger)
 export("export_bucket", export_bucket._bucket.arn)
 
 # Load the datasets and build AWS resources from them
 push_config_files = utils.list_yaml_files("push_datasets")
-datasets = push.PushExportDatasets(push_config_files, export_bucket, tagger)
+datasets = push.PushExportDatasets(
+    push_config_files,
+    export_bucket,
+    tagger,
+    index_path=registry.DEFAULT_INDEX_PATH,
+    # Lambda layer with the zstandard package, for datasets with zstd compression
+    zstd_layer=stack_config["zstd_layer_arn"],
+    # Either S3 event notifications (the default) or an EventBridge rule per dataset
+    notifications=stack_config["push_notifications"] or "s3",
+)
 datasets.load_datasets_and_users()
-datasets.build_lambda_functions()
-datasets.build_role_policies()
+# Either one Lambda function per dataset (the default) or a single shared router
+if stack_config["push_engine"] == "router":
+    datasets.build_router_function()
+else:
+    datasets.build_lambda_functions()
 
 # Create combined bucket notification
 # You can only have one BucketNotification per bucket, so create a single combined one
@@ -33,57 +48,25 @@ bucket_notification = push.make_combined_bucket_notification(
 # Let an external role get files from a bucket
 pull_config_files = utils.list_yaml_files("pull_datasets")
 
-# For each config, create a bucket
-for file in pull_config_files:
-    dataset = utils.load_yaml(file)
-
-    name = dataset["name"]
-    pull_arns = dataset["pull_arns"]
-    users = dataset["users"]
-    if "allow_push" in dataset.keys():
-        writable = dataset["allow_push"]
-    else:
-        writable = False
-    if "bucket_versioning" in dataset.keys():
-        bucket_versioning = dataset["bucket_versioning"]
-    else:
-        bucket_versioning = False
-
-    if bucket_versioning:
-        pull_bucket = Bucket(
-            name=f"mojap-{name}",
-            tagger=tagger,
-            versioning={"enabled": True, },
-        )
-    else:
-        pull_bucket = Bucket(
-            name=f"mojap-{name}",
-            tagger=tagger,
-        )
+# Load the datasets, then create a bucket (and any replicas in other regions) for
+# each and one role policy for each user
+pull_datasets = pull.PullExportDatasets(
+    pull_config_files, tagger, index_path=registry.DEFAULT_INDEX_PATH
+)
+pull_datasets.load_datasets_and_users()
+pull_datasets.build_buckets()
+pull_datasets.build_role_policies()
 
-    # Add bucket policy allowing the specified arn to read
-    bucket_policy = Output.all(
-        bucket_arn=pull_bucket.arn,
-        pull_arns=pull_arns,
-        allow_push=writable
-    ).apply(
-        pull.create_pull_bucket_policy
-    )
-    BucketPolicy(
-        resource_name=f"{name}-bucket-policy",
-        bucket=pull_bucket.id,
-        policy=bucket_policy,
-        opts=ResourceOptions(parent=pull_bucket),
-    )
+# Push and pull policies share each user's inline policy limit, so push policies are
+# built once the size of the pull ones is known
+datasets.build_role_policies(pull_datasets.inline_policy_sizes())
 
-    # Add role policy for each user
-    role_policy = Output.all(bucket_arn=pull_bucket.arn).apply(
-        pull.create_read_write_role_policy
-    )
-    for user in users:
-        RolePolicy(
-            resource_name=user + "_" + name + "_exports_pull",
-            policy=role_policy.json,
-            role=user,
-            name=f"hub-exports-pull-{name}",
-        )
+# Record what was deployed, so the next deploy can update only what has changed
+export(
+    planner.DEPLOYED_DATASETS_OUTPUT,
+    planner.dataset_fingerprints(
+        [dataset.config for dataset in datasets.datasets],
+        [dataset.config for dataset in pull_datasets.datasets],
+        planner.program_hash(".", stack_config),
+    ),
+)
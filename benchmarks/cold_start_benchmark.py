@@ -0,0 +1,203 @@
+"""Compare the cold start and warm call latency of the export Lambda handlers.
+
+Times three handlers moving small files between buckets on Localstack:
+- move_object_function - the handler of data-engineering-pulumi-components'
+  MoveObjectFunction, which ExportObjectFunction replaced
+- export - export.handler, deployed by ExportObjectFunction by default
+- lean - lean.handler, deployed with handler: lean
+
+Each cold start is a fresh Python process that only has the handler's folder on its
+path, like a Lambda container. It reports the init duration (importing the handler
+module, which is what Lambda's init phase runs), the first call (where handlers that
+create their client lazily pay for it) and the latency of the warm calls after it.
+Start Localstack with `docker-compose up`, then run from the root of the repository:
+
+    python -m benchmarks.cold_start_benchmark --cold-starts 10 --calls 50
+
+No Pulumi stack is needed - the buckets are created directly and deleted after.
+Localstack runs on the same machine, so the warm call latencies are far lower than
+on AWS. Compare the handlers with each other rather than with production.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+from statistics import median
+from typing import Dict, List, NamedTuple, Optional
+
+import boto3
+import data_engineering_pulumi_components
+
+from benchmarks.load_test import percentile
+from data_engineering_exports.lambda_handlers.export import export
+from data_engineering_exports.utils_for_tests import (
+    empty_buckets,
+    wait_for_localstack,
+    worker_name,
+)
+
+SOURCE_BUCKET = worker_name("cold-start-benchmark-source")
+TARGET_BUCKET = worker_name("cold-start-benchmark-target")
+
+
+class Handler(NamedTuple):
+    """Where a handler's package is, as it would be deployed, and its module."""
+
+    root: Path
+    module: str
+
+
+HANDLERS = {
+    "move_object_function": Handler(
+        Path(data_engineering_pulumi_components.__file__).parent
+        / "aws"
+        / "lambdas"
+        / "lambda_handlers",
+        "move.move",
+    ),
+    "export": Handler(Path(export.__file__).parents[1], "export.export"),
+    "lean": Handler(Path(export.__file__).parents[1], "export.lean"),
+}
+
+# Run in a fresh interpreter, so nothing the benchmark imported is already loaded
+COLD_START = """
+import json
+import sys
+from importlib import import_module
+from time import perf_counter
+
+root, module_name, events_path = sys.argv[1:]
+sys.path.insert(0, root)
+with open(events_path) as f:
+    events = json.load(f)
+started = perf_counter()
+module = import_module(module_name)
+init = perf_counter() - started
+calls = []
+for event in events:
+    started = perf_counter()
+    module.handler(event, None)
+    calls.append(perf_counter() - started)
+print(json.dumps({"init": init, "calls": calls, "boto3": "boto3" in sys.modules}))
+"""
+
+
+def s3_event(bucket: str, key: str, size: int) -> Dict:
+    """An S3 event notification for one new object."""
+    return {
+        "Records": [
+            {
+                "eventSource": "aws:s3",
+                "eventName": "ObjectCreated:Put",
+                "s3": {
+                    "bucket": {"name": bucket},
+                    "object": {"key": key, "size": size},
+                },
+            }
+        ]
+    }
+
+
+def cold_start(
+    handler: Handler, events: List[Dict], environment: Optional[Dict] = None
+) -> Dict:
+    """Start a handler in a new process and send it each event in turn.
+
+    Returns
+    -------
+    Dict
+        The init duration and the duration of each call in seconds, and whether
+        the handler loaded boto3.
+    """
+    with tempfile.TemporaryDirectory() as folder:
+        events_path = Path(folder) / "events.json"
+        events_path.write_text(json.dumps(events))
+        result = subprocess.run(
+            [sys.executable, "-c", COLD_START, str(handler.root), handler.module]
+            + [str(events_path)],
+            capture_output=True,
+            check=True,
+            env={**os.environ, **(environment or {})},
+            text=True,
+        )
+    # Handlers print their own logs first
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def summarise(runs: List[Dict]) -> Dict:
+    """Median init and first call over the cold starts, and percentiles of every
+    warm call, in milliseconds."""
+    warm = [call for run in runs for call in run["calls"][1:]]
+
+    def ms(seconds: Optional[float]) -> Optional[float]:
+        return None if seconds is None else round(seconds * 1000, 1)
+
+    return {
+        "init_ms": ms(median(run["init"] for run in runs)),
+        "first_call_ms": ms(median(run["calls"][0] for run in runs)),
+        "cold_start_ms": ms(median(run["init"] + run["calls"][0] for run in runs)),
+        "warm_p50_ms": ms(percentile(warm, 0.5)),
+        "warm_p95_ms": ms(percentile(warm, 0.95)),
+        "loads_boto3": any(run["boto3"] for run in runs),
+    }
+
+
+def run(
+    cold_starts: int, calls: int, size_kb: int = 100, host: str = "localhost"
+) -> Dict[str, Dict]:
+    wait_for_localstack(f"http://{host}:4566", services=["s3"])
+    environment = {
+        "AWS_ACCESS_KEY_ID": "test_key",
+        "AWS_SECRET_ACCESS_KEY": "test_secret",
+        "AWS_DEFAULT_REGION": "eu-west-1",
+        "LOCALSTACK_HOSTNAME": host,
+        "DESTINATION_BUCKET": TARGET_BUCKET,
+    }
+    client = boto3.Session(
+        region_name="eu-west-1",
+        aws_access_key_id="test_key",
+        aws_secret_access_key="test_secret",
+    ).client("s3", endpoint_url=f"http://{host}:4566")
+    for bucket in (SOURCE_BUCKET, TARGET_BUCKET):
+        client.create_bucket(
+            Bucket=bucket,
+            CreateBucketConfiguration={"LocationConstraint": "eu-west-1"},
+        )
+
+    body = os.urandom(size_kb * 1024)
+    results = {}
+    try:
+        for name, handler in HANDLERS.items():
+            runs = []
+            for start in range(cold_starts):
+                keys = [f"benchmark/{name}/{start}/{n}.bin" for n in range(calls)]
+                for key in keys:
+                    client.put_object(Bucket=SOURCE_BUCKET, Key=key, Body=body)
+                events = [s3_event(SOURCE_BUCKET, key, len(body)) for key in keys]
+                runs.append(cold_start(handler, events, environment))
+            results[name] = summarise(runs)
+    finally:
+        empty_buckets([SOURCE_BUCKET, TARGET_BUCKET], client)
+        for bucket in (SOURCE_BUCKET, TARGET_BUCKET):
+            client.delete_bucket(Bucket=bucket)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument(
+        "--cold-starts", type=int, default=10, help="new processes per handler"
+    )
+    parser.add_argument("--calls", type=int, default=50, help="files per cold start")
+    parser.add_argument("--size", type=int, default=100, help="file size in KB")
+    parser.add_argument("--host", default="localhost", help="Localstack's host")
+    args = parser.parse_args()
+    results = run(args.cold_starts, args.calls, args.size, args.host)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,128 @@
+"""Measure compression ratio and throughput of compressed push exports on Localstack.
+
+Uploads a synthetic CSV to a source bucket on Localstack, then exports it with the
+export handler's copy_object using no compression, gzip and (if the zstandard
+package is installed) zstd. For each it reports the compressed size, the ratio,
+and throughput in MB of the original file per second, both through S3 and for the
+compressor alone. Start Localstack with `docker-compose up`, then run from the root
+of the repository:
+
+    python -m benchmarks.compression_benchmark --size 256
+
+No Pulumi stack is needed - the buckets are created directly and deleted after.
+"""
+import argparse
+import io
+import json
+import random
+from time import perf_counter
+from typing import Dict, List
+
+import boto3
+
+from data_engineering_exports.lambda_handlers.export import compress, transfer
+from data_engineering_exports.utils_for_tests import (
+    LOCALSTACK_ENDPOINT,
+    empty_buckets,
+    wait_for_localstack,
+    worker_name,
+)
+
+SOURCE_BUCKET = worker_name("compression-benchmark-source")
+TARGET_BUCKET = worker_name("compression-benchmark-target")
+KEY = "benchmark/data.csv"
+
+
+def synthetic_csv(size_mb: int, seed: int = 0) -> bytes:
+    """A CSV shaped like a typical extract: ids, dates, codes and free text."""
+    rng = random.Random(seed)
+    words = ["court", "case", "order", "hearing", "release", "review", "appeal"]
+    rows = [b"id,date,code,amount,notes\n"]
+    size = len(rows[0])
+    while size < size_mb * 1024**2:
+        row = (
+            f"{rng.randrange(10**9)},2023-{rng.randint(1, 12):02d}-"
+            f"{rng.randint(1, 28):02d},{rng.choice('ABCDEFGH')}{rng.randrange(1000)},"
+            f"{rng.random() * 1000:.2f},{' '.join(rng.choices(words, k=6))}\n"
+        ).encode()
+        rows.append(row)
+        size += len(row)
+    return b"".join(rows)
+
+
+def codecs() -> List[str]:
+    available = ["gzip"]
+    try:
+        import zstandard  # noqa: F401
+
+        available.append("zstd")
+    except ImportError:
+        print("zstandard isn't installed, so zstd is skipped")
+    return available
+
+
+def compress_only(body: bytes, codec: str) -> float:
+    """Seconds to compress body in memory, without any S3 requests."""
+    start = perf_counter()
+    for _ in compress.compressed_chunks(
+        io.BytesIO(body), compress.CODECS[codec].compressor()
+    ):
+        pass
+    return perf_counter() - start
+
+
+def run(size_mb: int, endpoint: str = LOCALSTACK_ENDPOINT) -> Dict[str, Dict]:
+    wait_for_localstack(endpoint, services=["s3"])
+    client = boto3.Session(
+        region_name="eu-west-1",
+        aws_access_key_id="test_key",
+        aws_secret_access_key="test_secret",
+    ).client("s3", endpoint_url=endpoint)
+    for bucket in (SOURCE_BUCKET, TARGET_BUCKET):
+        client.create_bucket(
+            Bucket=bucket,
+            CreateBucketConfiguration={"LocationConstraint": "eu-west-1"},
+        )
+
+    body = synthetic_csv(size_mb)
+    size = len(body)
+    results = {}
+    try:
+        client.put_object(Bucket=SOURCE_BUCKET, Key=KEY, Body=body)
+        for codec in [None] + codecs():
+            start = perf_counter()
+            transfer.copy_object(client, SOURCE_BUCKET, KEY, TARGET_BUCKET, None, codec)
+            seconds = perf_counter() - start
+            key = compress.compressed_key(KEY, codec) if codec else KEY
+            compressed_size = client.head_object(Bucket=TARGET_BUCKET, Key=key)[
+                "ContentLength"
+            ]
+            result = {
+                "size": size,
+                "compressed_size": compressed_size,
+                "ratio": round(size / compressed_size, 2),
+                "seconds": round(seconds, 3),
+                "mb_per_second": round(size / 2**20 / seconds, 1),
+            }
+            if codec:
+                result["compress_only_mb_per_second"] = round(
+                    size / 2**20 / compress_only(body, codec), 1
+                )
+            results[codec or "none"] = result
+    finally:
+        empty_buckets([SOURCE_BUCKET, TARGET_BUCKET], client)
+        for bucket in (SOURCE_BUCKET, TARGET_BUCKET):
+            client.delete_bucket(Bucket=bucket)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--size", type=int, default=256, help="file size in MB")
+    parser.add_argument("--endpoint", default=LOCALSTACK_ENDPOINT)
+    args = parser.parse_args()
+    print(json.dumps(run(args.size, args.endpoint), indent=2))
+
+
+if __name__ == "__main__":
+    main()
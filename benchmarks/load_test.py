@@ -0,0 +1,351 @@
+"""Load test push exports on Localstack, measuring delivery latency and throughput.
+
+Deploys an export bucket, a target bucket and several push datasets to Localstack,
+then uploads many objects into the datasets' prefixes at once. It polls the target
+bucket until every object arrives, and reports for each dataset the p50, p95 and
+p99 time from upload to delivery, and the objects and bytes delivered per second.
+Start Localstack with `docker-compose up` and log in with `pulumi login --local`,
+then run from the root of the repository:
+
+    python -m benchmarks.load_test --datasets 4 --objects 2000 --rate 500
+
+Object sizes are drawn from --sizes, a list of sizes with weights. Raise --rate
+between runs to find where deliveries start to fall behind. Latency is measured
+from when each upload finishes to the first poll that sees the object, so it is
+only as precise as --interval.
+"""
+import argparse
+import json
+import math
+import random
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from time import monotonic, sleep
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+import boto3
+import yaml
+from data_engineering_pulumi_components.aws import Bucket
+from data_engineering_pulumi_components.utils import Tagger
+
+from data_engineering_exports import push
+from data_engineering_exports.utils import list_yaml_files
+from data_engineering_exports.utils_for_tests import (
+    LOCALSTACK_ENDPOINT,
+    PulumiTestInfrastructure,
+    empty_buckets,
+    mock_alpha_user,
+    worker_name,
+)
+
+REGION = "eu-west-1"
+EXPORT_BUCKET = worker_name("load-test-export-bucket")
+TARGET_BUCKET = worker_name("load-test-target-bucket")
+USER = worker_name("alpha_user_load_test", "_")
+
+SIZE_UNITS = {"B": 1, "KiB": 2**10, "MiB": 2**20, "GiB": 2**30}
+DEFAULT_SIZES = "1KiB=70,100KiB=20,1MiB=9,20MiB=1"
+PERCENTILES = {"p50": 0.5, "p95": 0.95, "p99": 0.99}
+
+
+class Upload(NamedTuple):
+    dataset: str
+    key: str
+    size: int
+
+
+def parse_size(text: str) -> int:
+    """Convert a size like "100KiB" or "5MiB" to bytes. A plain number is bytes."""
+    text = text.strip()
+    for unit, multiplier in sorted(SIZE_UNITS.items(), key=lambda u: -len(u[0])):
+        if text.endswith(unit):
+            return int(float(text[: -len(unit)]) * multiplier)
+    return int(text)
+
+
+def parse_size_distribution(text: str) -> List[Tuple[int, float]]:
+    """Parse a comma-separated list of size=weight pairs, like "1KiB=90,1MiB=10".
+
+    Returns
+    -------
+    List[Tuple[int, float]]
+        Each size in bytes, with its weight.
+    """
+    distribution = []
+    for part in text.split(","):
+        size, _, weight = part.partition("=")
+        distribution.append((parse_size(size), float(weight or 1)))
+    if not distribution or any(weight <= 0 for _, weight in distribution):
+        raise ValueError(f"Sizes need positive weights: {text}")
+    return distribution
+
+
+def percentile(values: List[float], fraction: float) -> Optional[float]:
+    """The nearest-rank percentile of values, or None if there are none."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(1, math.ceil(len(ordered) * fraction))
+    return ordered[rank - 1]
+
+
+def plan_uploads(
+    datasets: List[str],
+    objects: int,
+    distribution: List[Tuple[int, float]],
+    seed: int = 0,
+) -> List[Upload]:
+    """Share objects between the datasets in turn, with sizes drawn from
+    distribution."""
+    rng = random.Random(seed)
+    sizes = rng.choices(
+        [size for size, _ in distribution],
+        weights=[weight for _, weight in distribution],
+        k=objects,
+    )
+    return [
+        Upload(
+            datasets[i % len(datasets)],
+            f"{datasets[i % len(datasets)]}/load_{i:07d}.bin",
+            size,
+        )
+        for i, size in enumerate(sizes)
+    ]
+
+
+def upload_all(
+    s3_client, uploads: List[Upload], workers: int = 32, rate: Optional[float] = None
+) -> Dict[str, float]:
+    """Upload every object to the export bucket from a pool of threads.
+
+    Parameters
+    ----------
+    s3_client
+        Boto3 S3 client - clients are safe to share between threads.
+    uploads : List[Upload]
+        Objects to upload, in order.
+    workers : int
+        Uploads to run at once - defaults to 32.
+    rate : float, optional
+        Most uploads to start per second. If None, uploads start as fast as the
+        workers allow.
+
+    Returns
+    -------
+    Dict[str, float]
+        The monotonic time each key finished uploading.
+    """
+    body = bytes(max(upload.size for upload in uploads))
+    finished = {}
+
+    def send(upload: Upload):
+        s3_client.put_object(
+            Bucket=EXPORT_BUCKET, Key=upload.key, Body=body[: upload.size]
+        )
+        finished[upload.key] = monotonic()
+
+    start = monotonic()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = []
+        for i, upload in enumerate(uploads):
+            if rate:
+                delay = start + i / rate - monotonic()
+                if delay > 0:
+                    sleep(delay)
+            futures.append(pool.submit(send, upload))
+        for future in futures:
+            future.result()
+    return finished
+
+
+def wait_for_deliveries(
+    s3_client,
+    uploads: List[Upload],
+    timeout: float = 600,
+    interval: float = 0.5,
+) -> Dict[str, float]:
+    """Poll the target bucket until every upload has arrived or timeout passes.
+
+    Returns
+    -------
+    Dict[str, float]
+        The monotonic time each key was first seen in the target bucket. Keys that
+        never arrived are left out.
+    """
+    waiting = {upload.key for upload in uploads}
+    prefixes = sorted({f"{upload.dataset}/" for upload in uploads})
+    paginator = s3_client.get_paginator("list_objects_v2")
+    delivered = {}
+    start = monotonic()
+    while waiting and monotonic() - start < timeout:
+        for prefix in prefixes:
+            for page in paginator.paginate(Bucket=TARGET_BUCKET, Prefix=prefix):
+                seen = monotonic()
+                for item in page.get("Contents", []):
+                    if item["Key"] in waiting:
+                        waiting.discard(item["Key"])
+                        delivered[item["Key"]] = seen
+        if waiting:
+            sleep(interval)
+    return delivered
+
+
+def summarise(
+    uploads: Iterable[Upload],
+    started: float,
+    uploaded: Dict[str, float],
+    delivered: Dict[str, float],
+) -> Dict[str, Dict]:
+    """Work out latency percentiles and throughput for each dataset, and overall.
+
+    Parameters
+    ----------
+    uploads : Iterable[Upload]
+        Every object that was uploaded.
+    started : float
+        Monotonic time the first upload started.
+    uploaded, delivered : Dict[str, float]
+        Monotonic times each key finished uploading and reached the target bucket.
+    """
+    groups = {"all": []}
+    for upload in uploads:
+        groups.setdefault(upload.dataset, []).append(upload)
+        groups["all"].append(upload)
+
+    results = {}
+    for name, group in groups.items():
+        arrived = [upload for upload in group if upload.key in delivered]
+        latencies = [delivered[u.key] - uploaded[u.key] for u in arrived]
+        elapsed = max((delivered[u.key] for u in arrived), default=started) - started
+        result = {"objects": len(group), "delivered": len(arrived)}
+        for label, fraction in PERCENTILES.items():
+            value = percentile(latencies, fraction)
+            result[label] = None if value is None else round(value, 3)
+        result["objects_per_second"] = (
+            round(len(arrived) / elapsed, 2) if elapsed else 0
+        )
+        result["bytes_per_second"] = (
+            round(sum(u.size for u in arrived) / elapsed) if elapsed else 0
+        )
+        results[name] = result
+    return results
+
+
+def write_configs(folder: Path, datasets: List[str]) -> None:
+    for dataset in datasets:
+        config = {"name": dataset, "target_bucket": TARGET_BUCKET, "users": [USER]}
+        with open(folder / f"{dataset}.yaml", "w") as f:
+            yaml.safe_dump(config, f)
+
+
+def load_test_program(config_folder: Path):
+    """Make a Pulumi program with the export bucket, target bucket and datasets."""
+
+    def program():
+        tagger = Tagger(environment_name="load-test")
+        export_bucket = Bucket(name=EXPORT_BUCKET, tagger=tagger)
+        Bucket(name=TARGET_BUCKET, tagger=tagger)
+        mock_alpha_user(USER)
+        datasets = push.PushExportDatasets(
+            list_yaml_files(config_folder), export_bucket, tagger
+        )
+        datasets.load_datasets_and_users()
+        datasets.build_lambda_functions()
+        datasets.build_role_policies()
+        push.make_combined_bucket_notification(
+            "load-test-bucket-notification", export_bucket, datasets
+        )
+
+    return program
+
+
+def run(
+    dataset_count: int,
+    objects: int,
+    sizes: str = DEFAULT_SIZES,
+    workers: int = 32,
+    rate: Optional[float] = None,
+    timeout: float = 600,
+    interval: float = 0.5,
+    keep_stack: bool = False,
+) -> Dict:
+    """Deploy the load test stack, upload objects and report how they were
+    delivered."""
+    distribution = parse_size_distribution(sizes)
+    datasets = [worker_name(f"load_test_{i}", "_") for i in range(dataset_count)]
+    uploads = plan_uploads(datasets, objects, distribution)
+
+    with tempfile.TemporaryDirectory() as folder:
+        write_configs(Path(folder), datasets)
+        infrastructure = PulumiTestInfrastructure(
+            load_test_program(Path(folder)),
+            region=REGION,
+            stack_name="loadtest",
+            config_stack="localstack",
+        )
+        infrastructure.up()
+        try:
+            s3_client = boto3.Session(
+                region_name=REGION,
+                aws_access_key_id="test_key",
+                aws_secret_access_key="test_secret",
+            ).client("s3", endpoint_url=LOCALSTACK_ENDPOINT)
+            empty_buckets([EXPORT_BUCKET, TARGET_BUCKET], s3_client)
+
+            started = monotonic()
+            uploaded = upload_all(s3_client, uploads, workers, rate)
+            upload_seconds = monotonic() - started
+            delivered = wait_for_deliveries(s3_client, uploads, timeout, interval)
+        finally:
+            if not keep_stack:
+                infrastructure.destroy()
+
+    return {
+        "datasets": dataset_count,
+        "objects": objects,
+        "sizes": sizes,
+        "workers": workers,
+        "rate": rate,
+        "upload_seconds": round(upload_seconds, 3),
+        "results": summarise(uploads, started, uploaded, delivered),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--datasets", type=int, default=4, help="push datasets")
+    parser.add_argument("--objects", type=int, default=2000, help="objects in total")
+    parser.add_argument(
+        "--sizes",
+        default=DEFAULT_SIZES,
+        help=f"object sizes and their weights - defaults to {DEFAULT_SIZES}",
+    )
+    parser.add_argument("--workers", type=int, default=32, help="upload threads")
+    parser.add_argument("--rate", type=float, help="most uploads to start a second")
+    parser.add_argument("--timeout", type=float, default=600)
+    parser.add_argument("--interval", type=float, default=0.5, help="poll interval")
+    parser.add_argument(
+        "--keep-stack", action="store_true", help="don't destroy the stack after"
+    )
+    parser.add_argument("--output", type=Path, help="file to save results to")
+    args = parser.parse_args()
+
+    results = run(
+        args.datasets,
+        args.objects,
+        args.sizes,
+        args.workers,
+        args.rate,
+        args.timeout,
+        args.interval,
+        args.keep_stack,
+    )
+    output = json.dumps(results, indent=2)
+    if args.output:
+        args.output.write_text(output + "\n")
+    print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,208 @@
+"""Time each phase of building the Pulumi program for a large number of datasets.
+
+Writes synthetic push_datasets and pull_datasets folders, then builds the same
+resources as __main__.py under the Mocks used by the unit tests, so no AWS account
+or Pulumi backend is needed. For each phase it records wall time, peak Python memory
+and how many resources were registered. Run from the root of the repository:
+
+    python -m benchmarks.program_benchmark --push 500 --pull 500 --output results.json
+
+Pass an earlier results file with --compare to see how each phase has changed.
+Memory is traced with tracemalloc, which slows everything down by a similar amount,
+so compare times only with other runs of this script.
+"""
+import argparse
+import collections
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import tracemalloc
+from datetime import datetime, timezone
+from pathlib import Path
+from time import perf_counter
+from typing import Callable, Dict, List, Optional, Tuple
+
+import pulumi
+from data_engineering_pulumi_components.aws import Bucket
+from data_engineering_pulumi_components.utils import Tagger
+
+# Pulumi has no public way to wait for resources to finish registering part way
+# through a program, which is needed to count each phase's resources
+from pulumi.runtime.stack import wait_for_rpcs
+from pulumi.runtime.sync_await import _sync_await
+
+from benchmarks.synthetic import write_synthetic_configs
+from data_engineering_exports import pull, push, utils
+from tests.conftest import Mocks
+
+
+class CountingMocks(Mocks):
+    """The unit test Mocks, also counting the resources registered by type."""
+
+    def __init__(self):
+        self.resources = collections.Counter()
+
+    def new_resource(self, args: pulumi.runtime.MockResourceArgs):
+        self.resources[args.typ] += 1
+        return super().new_resource(args)
+
+
+def program_phases(engine: str) -> List[Tuple[str, Callable[[Dict], None]]]:
+    """The phases of __main__.py, each as a function that adds to a shared state."""
+
+    def load(state):
+        tagger = Tagger(environment_name="benchmark")
+        state["tagger"] = tagger
+        state["export_bucket"] = Bucket(name="mojap-hub-exports", tagger=tagger)
+        state["push"] = push.PushExportDatasets(
+            utils.list_yaml_files("push_datasets"), state["export_bucket"], tagger
+        )
+        state["push"].load_datasets_and_users()
+
+    def build_lambda_functions(state):
+        if engine == "router":
+            state["push"].build_router_function()
+        else:
+            state["push"].build_lambda_functions()
+
+    def build_role_policies(state):
+        state["push"].build_role_policies()
+
+    def bucket_notification(state):
+        push.make_combined_bucket_notification(
+            name="export-bucket-notification",
+            export_bucket=state["export_bucket"],
+            datasets=state["push"],
+        )
+
+    def pull_datasets(state):
+        datasets = pull.PullExportDatasets(
+            utils.list_yaml_files("pull_datasets"), state["tagger"]
+        )
+        datasets.load_datasets_and_users()
+        datasets.build_buckets()
+        datasets.build_role_policies()
+
+    return [
+        ("load", load),
+        ("build_lambda_functions", build_lambda_functions),
+        ("build_role_policies", build_role_policies),
+        ("bucket_notification", bucket_notification),
+        ("pull", pull_datasets),
+    ]
+
+
+def measure_phases(engine: str) -> Dict[str, Dict]:
+    """Run each phase of the program in the current folder, which must contain
+    push_datasets and pull_datasets folders."""
+    mocks = CountingMocks()
+    pulumi.runtime.set_mocks(mocks, preview=False)
+    results = {}
+
+    @pulumi.runtime.test
+    def run():
+        state = {}
+        for name, phase in program_phases(engine):
+            before = sum(mocks.resources.values())
+            tracemalloc.reset_peak()
+            start = perf_counter()
+            phase(state)
+            # Include the time taken to register the phase's resources
+            _sync_await(wait_for_rpcs())
+            results[name] = {
+                "seconds": round(perf_counter() - start, 4),
+                "peak_memory_mb": round(
+                    tracemalloc.get_traced_memory()[1] / 2**20, 2
+                ),
+                "resources": sum(mocks.resources.values()) - before,
+            }
+
+    tracemalloc.start()
+    try:
+        run()
+    finally:
+        tracemalloc.stop()
+    results["total"] = {
+        "seconds": round(sum(phase["seconds"] for phase in results.values()), 4),
+        "peak_memory_mb": max(phase["peak_memory_mb"] for phase in results.values()),
+        "resources": sum(mocks.resources.values()),
+    }
+    return results
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            check=True,
+            text=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(push_count: int, pull_count: int, engine: str = "per-dataset") -> Dict:
+    """Build the program for synthetic datasets and return the results with details
+    of the run, ready to be saved as JSON."""
+    commit = git_commit()
+    original_folder = os.getcwd()
+    with tempfile.TemporaryDirectory() as folder:
+        write_synthetic_configs(folder, push_count, pull_count)
+        os.chdir(folder)
+        try:
+            phases = measure_phases(engine)
+        finally:
+            os.chdir(original_folder)
+    return {
+        "commit": commit,
+        "time": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "push_datasets": push_count,
+        "pull_datasets": pull_count,
+        "engine": engine,
+        "phases": phases,
+    }
+
+
+def compare(results: Dict, previous: Dict) -> str:
+    """Describe how the time and resources for each phase changed since a previous
+    run."""
+    lines = [f"Compared with {previous.get('commit')} at {previous.get('time')}:"]
+    for name, phase in results["phases"].items():
+        old = previous["phases"].get(name)
+        if not old:
+            continue
+        ratio = phase["seconds"] / old["seconds"] if old["seconds"] else float("inf")
+        lines.append(
+            f"  {name}: {old['seconds']}s -> {phase['seconds']}s ({ratio:.2f}x), "
+            f"{old['resources']} -> {phase['resources']} resources"
+        )
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--push", type=int, default=500, help="push datasets")
+    parser.add_argument("--pull", type=int, default=500, help="pull datasets")
+    parser.add_argument(
+        "--engine", choices=["per-dataset", "router"], default="per-dataset"
+    )
+    parser.add_argument("--output", type=Path, help="file to save results to")
+    parser.add_argument("--compare", type=Path, help="earlier results to compare")
+    args = parser.parse_args()
+
+    results = run(args.push, args.pull, args.engine)
+    output = json.dumps(results, indent=2)
+    if args.output:
+        args.output.write_text(output + "\n")
+    print(output)
+    if args.compare:
+        print(compare(results, json.loads(args.compare.read_text())), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+"""Time loading push and pull configs through the registry.
+
+Compares a cold load with no index, a warm load where every config is in the index,
+a load after one file has changed, and the old approach of calling load_yaml on
+each file. Run from the root of the repository:
+
+    python -m benchmarks.registry_benchmark --datasets 500
+"""
+import argparse
+import json
+import tempfile
+from pathlib import Path
+from time import perf_counter
+from typing import Callable, Dict
+
+from benchmarks.synthetic import write_synthetic_configs
+from data_engineering_exports.registry import load_configs
+from data_engineering_exports.utils import list_yaml_files, load_yaml
+
+
+def best_of(repeats: int, function: Callable) -> float:
+    """Return the fastest of several timed runs of function, in seconds."""
+    times = []
+    for _ in range(repeats):
+        start = perf_counter()
+        function()
+        times.append(perf_counter() - start)
+    return min(times)
+
+
+def run(datasets: int, repeats: int = 5) -> Dict[str, float]:
+    """Time each way of loading datasets push and datasets pull configs."""
+    with tempfile.TemporaryDirectory() as folder:
+        write_synthetic_configs(folder, datasets, datasets)
+        push_files = list_yaml_files(Path(folder) / "push_datasets")
+        pull_files = list_yaml_files(Path(folder) / "pull_datasets")
+        index_path = Path(folder) / "index.json"
+
+        def load_all(index=None):
+            load_configs(push_files, "push", index)
+            load_configs(pull_files, "pull", index)
+
+        def cold():
+            index_path.unlink(missing_ok=True)
+            load_all(index_path)
+
+        def one_changed():
+            with open(push_files[0], "a") as f:
+                f.write("# edited\n")
+            load_all(index_path)
+
+        results = {
+            "load_yaml_per_file": best_of(
+                repeats, lambda: [load_yaml(f) for f in push_files + pull_files]
+            ),
+            "registry_no_index": best_of(repeats, load_all),
+            "registry_cold_index": best_of(repeats, cold),
+        }
+        load_all(index_path)
+        results["registry_warm_index"] = best_of(repeats, lambda: load_all(index_path))
+        results["registry_one_changed"] = best_of(repeats, one_changed)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument(
+        "--datasets", type=int, default=500, help="push and pull configs of each"
+    )
+    parser.add_argument("--repeats", type=int, default=5)
+    args = parser.parse_args()
+    results = run(args.datasets, args.repeats)
+    print(json.dumps({k: round(v, 4) for k, v in results.items()}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
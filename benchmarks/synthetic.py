@@ -0,0 +1,69 @@
+"""Generate synthetic push_datasets and pull_datasets folders for benchmarking."""
+import random
+from pathlib import Path
+from typing import Union
+
+import yaml
+
+
+def write_synthetic_configs(
+    folder: Union[str, Path],
+    push_count: int,
+    pull_count: int,
+    users: int = 200,
+    users_per_dataset: int = 5,
+    seed: int = 0,
+) -> Path:
+    """Write push and pull config files shaped like the real ones.
+
+    Parameters
+    ----------
+    folder : Union[str, Path]
+        Where to create the push_datasets and pull_datasets folders.
+    push_count, pull_count : int
+        How many of each kind of dataset to write.
+    users : int
+        Size of the pool of usernames datasets draw from - defaults to 200.
+    users_per_dataset : int
+        How many users each dataset has - defaults to 5.
+    seed : int
+        Random seed, so runs with the same arguments write the same files.
+
+    Returns
+    -------
+    Path
+        The folder the configs were written to.
+    """
+    folder = Path(folder)
+    rng = random.Random(seed)
+    usernames = [f"alpha_user_synthetic_{i}" for i in range(users)]
+
+    push_folder = folder / "push_datasets"
+    push_folder.mkdir(parents=True, exist_ok=True)
+    for i in range(push_count):
+        config = {
+            "name": f"synthetic_push_{i}",
+            "target_bucket": f"synthetic-target-{i % 50}",
+            "keep_files": i % 4 == 0,
+            "users": rng.sample(usernames, users_per_dataset),
+            "paperwork": f"DPIA {i}",
+        }
+        with open(push_folder / f"synthetic_push_{i}.yaml", "w") as f:
+            yaml.safe_dump(config, f)
+
+    pull_folder = folder / "pull_datasets"
+    pull_folder.mkdir(parents=True, exist_ok=True)
+    for i in range(pull_count):
+        config = {
+            "name": f"synthetic-pull-{i}",
+            "pull_arns": [
+                f"arn:aws:iam::{rng.randrange(10**11, 10**12):012d}:role/reader-{j}"
+                for j in range(rng.randint(1, 3))
+            ],
+            "users": rng.sample(usernames, users_per_dataset),
+            "allow_push": [i % 3 == 0],
+            "bucket_versioning": [i % 5 == 0],
+        }
+        with open(pull_folder / f"synthetic_pull_{i}.yaml", "w") as f:
+            yaml.safe_dump(config, f)
+    return folder
@@ -0,0 +1,3 @@
+from data_engineering_exports.cli import main
+
+main()
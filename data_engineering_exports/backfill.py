@@ -0,0 +1,254 @@
+"""Send a push dataset's history to its target bucket with one S3 Batch Operations
+job, instead of one Lambda invocation per object.
+
+backfill lists the objects to send, writes their keys to a CSV manifest in the export
+bucket, under BACKFILL_PREFIX, and submits a job that copies each of them to the
+dataset's target bucket with the same key. The job runs as the dataset's export role,
+which target bucket policies already trust, so nothing needs changing on the
+receiving side. Only datasets with allow_backfill set let Batch Operations assume
+that role. A report of any failed copies is written next to the manifest.
+
+Batch Operations copies objects as they are. It can't compress or bundle them, and
+it never deletes the sources, so run reconcile afterwards to find any to clear up.
+Objects over MAX_COPY_SIZE can't be copied by a job at all, so they're left out of
+the manifest and listed instead.
+"""
+import csv
+import io
+import tempfile
+import uuid
+from datetime import datetime, timezone
+from fnmatch import fnmatchcase
+from time import sleep
+from typing import Callable, Dict, Iterable, List, NamedTuple, Optional
+from urllib.parse import quote
+
+from data_engineering_exports.export_function import BACKFILL_PREFIX
+from data_engineering_exports.lambda_handlers.export.checksums import (
+    DEFAULT_ALGORITHM,
+)
+from data_engineering_exports.reconcile import ObjectInfo
+
+# The largest object a Batch Operations copy can send
+MAX_COPY_SIZE = 5 * 1024**3
+DEFAULT_POLL_INTERVAL_S = 30
+FINISHED = ("Complete", "Failed", "Cancelled")
+
+
+class BackfillError(Exception):
+    pass
+
+
+class Manifest(NamedTuple):
+    bucket: str
+    key: str
+    etag: str
+    objects: int
+    size: int
+    # Objects too large for the job, which have to be exported another way
+    skipped: List[ObjectInfo]
+
+
+class JobProgress(NamedTuple):
+    status: str
+    total: int
+    succeeded: int
+    failed: int
+    elapsed_s: int
+
+    @property
+    def done(self) -> int:
+        return self.succeeded + self.failed
+
+    def objects_per_second(self) -> float:
+        return self.done / self.elapsed_s if self.elapsed_s else 0.0
+
+
+def check_dataset(dataset: Dict, role_arn: Optional[str] = None) -> None:
+    """Raise BackfillError if the dataset changes objects on the way, which a Batch
+    Operations copy can't do, or if the job would run as an export role that
+    doesn't allow backfills."""
+    if role_arn is None and not dataset.get("allow_backfill"):
+        raise BackfillError(
+            f"{dataset['name']} doesn't have allow_backfill set, so a backfill job "
+            "can't run as its export role"
+        )
+    for setting in ("compress", "bundle"):
+        if dataset.get(setting):
+            raise BackfillError(
+                f"{dataset['name']} has {setting} set, but a backfill can only copy "
+                "objects as they are"
+            )
+
+
+def export_role_arn(account_id: str, dataset: Dict) -> str:
+    """The ARN of the role ExportObjectFunction creates for the dataset."""
+    action = "copy" if dataset["keep_files"] else "move"
+    return (
+        f"arn:aws:iam::{account_id}:role/service-role/export_{dataset['name']}-{action}"
+    )
+
+
+def run_prefix(dataset: Dict, started: Optional[datetime] = None) -> str:
+    """Where a backfill's manifest and report are written in the export bucket."""
+    started = started or datetime.now(timezone.utc)
+    return f"{BACKFILL_PREFIX}/{dataset['name']}/{started:%Y%m%dT%H%M%SZ}"
+
+
+def write_manifest(
+    s3_client,
+    objects: Iterable[ObjectInfo],
+    source_bucket: str,
+    manifest_bucket: str,
+    manifest_key: str,
+    exclude_patterns: Iterable[str] = (),
+) -> Manifest:
+    """Write a Batch Operations CSV manifest of the objects to copy.
+
+    Rows are written to a temporary file as the objects are listed, so millions of
+    keys don't have to fit in memory.
+
+    Parameters
+    ----------
+    s3_client
+        Boto3 S3 client.
+    objects : Iterable[ObjectInfo]
+        The objects in source_bucket to copy, such as from reconcile.list_objects.
+    source_bucket : str
+        Name of the bucket the objects are in.
+    manifest_bucket : str
+        Name of the bucket to write the manifest to.
+    manifest_key : str
+        Key to write the manifest to.
+    exclude_patterns : Iterable[str]
+        Wildcard patterns of keys to leave out, as in the dataset's config.
+    """
+    exclude_patterns = list(exclude_patterns)
+    count, size, skipped = 0, 0, []
+    with tempfile.TemporaryFile() as f:
+        text = io.TextIOWrapper(f, encoding="utf-8", newline="")
+        writer = csv.writer(text, lineterminator="\n")
+        for obj in objects:
+            if any(fnmatchcase(obj.key, pattern) for pattern in exclude_patterns):
+                continue
+            if obj.size > MAX_COPY_SIZE:
+                skipped.append(obj)
+                continue
+            # Batch Operations expects keys URL-encoded
+            writer.writerow([source_bucket, quote(obj.key)])
+            count += 1
+            size += obj.size
+        text.flush()
+        f.seek(0)
+        response = s3_client.put_object(
+            Bucket=manifest_bucket,
+            Key=manifest_key,
+            Body=f,
+            ContentType="text/csv",
+            ServerSideEncryption="AES256",
+        )
+        text.detach()
+    return Manifest(
+        manifest_bucket, manifest_key, response["ETag"], count, size, skipped
+    )
+
+
+def submit_job(
+    s3control_client,
+    account_id: str,
+    dataset: Dict,
+    manifest: Manifest,
+    role_arn: str,
+    report_prefix: str,
+) -> str:
+    """Submit a job copying every object in the manifest to the dataset's target
+    bucket, and return its ID.
+
+    Copies are made like the export functions make them: with the same key,
+    encrypted, owned by the target bucket's owner and with a CRC32C checksum.
+    """
+    response = s3control_client.create_job(
+        AccountId=account_id,
+        ConfirmationRequired=False,
+        Operation={
+            "S3PutObjectCopy": {
+                "TargetResource": f"arn:aws:s3:::{dataset['target_bucket']}",
+                "CannedAccessControlList": "bucket-owner-full-control",
+                "NewObjectMetadata": {"SSEAlgorithm": "AES256"},
+                "ChecksumAlgorithm": DEFAULT_ALGORITHM,
+            }
+        },
+        Report={
+            "Bucket": f"arn:aws:s3:::{manifest.bucket}",
+            "Prefix": report_prefix,
+            "Format": "Report_CSV_20180820",
+            "Enabled": True,
+            "ReportScope": "FailedTasksOnly",
+        },
+        ClientRequestToken=str(uuid.uuid4()),
+        Manifest={
+            "Spec": {
+                "Format": "S3BatchOperations_CSV_20180820",
+                "Fields": ["Bucket", "Key"],
+            },
+            "Location": {
+                "ObjectArn": f"arn:aws:s3:::{manifest.bucket}/{manifest.key}",
+                "ETag": manifest.etag,
+            },
+        },
+        Description=f"Backfill {dataset['name']} to {dataset['target_bucket']}",
+        Priority=10,
+        RoleArn=role_arn,
+        Tags=[{"Key": "dataset", "Value": dataset["name"]}],
+    )
+    return response["JobId"]
+
+
+def describe_job(s3control_client, account_id: str, job_id: str) -> JobProgress:
+    job = s3control_client.describe_job(AccountId=account_id, JobId=job_id)["Job"]
+    progress = job.get("ProgressSummary", {})
+    return JobProgress(
+        job["Status"],
+        progress.get("TotalNumberOfTasks", 0),
+        progress.get("NumberOfTasksSucceeded", 0),
+        progress.get("NumberOfTasksFailed", 0),
+        progress.get("Timers", {}).get("ElapsedTimeInActiveSeconds", 0),
+    )
+
+
+def wait_for_job(
+    s3control_client,
+    account_id: str,
+    job_id: str,
+    interval_s: float = DEFAULT_POLL_INTERVAL_S,
+    on_progress: Optional[Callable[[JobProgress], None]] = None,
+) -> JobProgress:
+    """Poll a job until it completes, fails or is cancelled.
+
+    Parameters
+    ----------
+    on_progress : Callable[[JobProgress], None], optional
+        Called with the job's progress after every poll.
+    """
+    while True:
+        progress = describe_job(s3control_client, account_id, job_id)
+        if on_progress:
+            on_progress(progress)
+        if progress.status in FINISHED:
+            return progress
+        sleep(interval_s)
+
+
+def describe_progress(progress: JobProgress, manifest: Manifest) -> str:
+    """One line of a job's progress and throughput. Bytes per second is estimated
+    from the sizes in the manifest, as the job only counts objects."""
+    line = f"{progress.status}: {progress.done} of {progress.total} objects done"
+    if progress.failed:
+        line += f" ({progress.failed} failed)"
+    if progress.elapsed_s and manifest.objects:
+        copied = manifest.size * progress.succeeded / manifest.objects
+        line += (
+            f" in {progress.elapsed_s}s, {progress.objects_per_second():.1f} "
+            f"objects/s, about {copied / progress.elapsed_s / 1024**2:.1f} MiB/s"
+        )
+    return line
@@ -0,0 +1,461 @@
+"""Copy every object under a prefix from one bucket to another, server-side, from the
+machine running the command.
+
+For one-off migrations, like re-pointing a push dataset to a new target_bucket or
+seeding a new pull bucket. Nothing is downloaded: each object is copied with
+CopyObject, or in parts by boto3's managed copy if it's over MULTIPART_THRESHOLD.
+
+The prefix is split into key ranges at its folders, a few levels down, and the ranges
+are listed at the same time in their own threads. The objects they find are copied by
+a bounded pool of threads sharing one boto3 client, whose connection pool is sized to
+match. Listing waits whenever too many copies are queued, so memory use doesn't grow
+with the number of keys. Copies can be held to a number of objects, or MiB, a second.
+
+Progress is appended to a journal as JSON lines. S3 lists each range in key order, so
+the journal only needs to record, for each range, the last key before which every
+object has been copied, along with any objects that failed. A rerun with the same
+journal retries the failures and carries on each range from where it got to, so an
+interrupted copy of millions of keys only repeats the last few seconds of work.
+"""
+import json
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from time import monotonic, sleep
+from typing import Callable, Dict, Iterator, List, Optional, Union
+
+from boto3.s3.transfer import TransferConfig
+
+from data_engineering_exports.lambda_handlers.export.checksums import (
+    ChecksumMismatchError,
+    is_composite,
+)
+from data_engineering_exports.lambda_handlers.export.settings import (
+    DEFAULT_MULTIPART_THRESHOLD,
+)
+from data_engineering_exports.reconcile import ObjectInfo
+
+DEFAULT_WORKERS = 32
+DEFAULT_LIST_WORKERS = 8
+# Parts of one large object to copy at once
+PART_CONCURRENCY = 8
+# Folders deep to look for places to split the listing
+MAX_SPLIT_DEPTH = 3
+# Least time between journal entries for the progress of one range
+JOURNAL_INTERVAL_S = 5.0
+COPY_ARGS = {"ServerSideEncryption": "AES256", "ACL": "bucket-owner-full-control"}
+
+
+class BulkCopyError(Exception):
+    pass
+
+
+class Pacer:
+    """Spaces out work so it runs no faster than rate units a second, shared between
+    threads. A rate of None doesn't slow anything down."""
+
+    def __init__(self, rate: Optional[float]):
+        self.rate = rate
+        self._next_slot = 0.0
+        self._lock = threading.Lock()
+
+    def wait(self, amount: float = 1) -> None:
+        if not self.rate:
+            return
+        with self._lock:
+            now = monotonic()
+            slot = max(now, self._next_slot)
+            self._next_slot = slot + amount / self.rate
+        if slot > now:
+            sleep(slot - now)
+
+
+class CopyStats:
+    """Counts of the objects listed, copied and failed, updated from every thread."""
+
+    def __init__(self):
+        self.listed = 0
+        self.copied = 0
+        self.bytes = 0
+        self.failed = 0
+        self.started = monotonic()
+        self._lock = threading.Lock()
+
+    def add(self, **counts: int) -> None:
+        with self._lock:
+            for name, count in counts.items():
+                setattr(self, name, getattr(self, name) + count)
+
+    def describe(self) -> str:
+        elapsed = max(monotonic() - self.started, 1e-9)
+        line = (
+            f"{self.copied} of {self.listed} objects copied "
+            f"({self.bytes / 1024**2:.1f} MiB) in {elapsed:.0f}s, "
+            f"{self.copied / elapsed:.1f} objects/s, "
+            f"{self.bytes / 1024**2 / elapsed:.1f} MiB/s"
+        )
+        if self.failed:
+            line += f", {self.failed} failed"
+        return line
+
+
+class Journal:
+    """An append-only record of a copy's progress, read back to resume it.
+
+    Each line is one of:
+        {"job": {...}} - what's being copied, always the first line
+        {"range": start, "after": key} - every object in the range up to key copied
+        {"range": start, "done": true} - every object in the range copied
+        {"failed": key, "size": ..., "etag": ..., "error": ...} - a failed object
+        {"retried": key} - a failed object copied since
+    """
+
+    def __init__(self, path: Union[str, Path], job: Dict):
+        self.after: Dict[str, str] = {}
+        self.done = set()
+        self.failed: Dict[str, ObjectInfo] = {}
+        self._lock = threading.Lock()
+        path = Path(path)
+        if path.exists():
+            self._read(path, job)
+            self._file = open(path, "a")
+        else:
+            self._file = open(path, "w")
+            self._write({"job": job})
+
+    def _read(self, path: Path, job: Dict) -> None:
+        with open(path) as f:
+            lines = [json.loads(line) for line in f if line.strip()]
+        if not lines or lines[0].get("job") != job:
+            raise BulkCopyError(
+                f"{path} is the journal of a different copy - use another --journal"
+            )
+        for line in lines[1:]:
+            if "after" in line:
+                self.after[line["range"]] = line["after"]
+            elif line.get("done"):
+                self.done.add(line["range"])
+            elif "failed" in line:
+                self.failed[line["failed"]] = ObjectInfo(
+                    line["failed"], line["size"], line["etag"]
+                )
+            elif "retried" in line:
+                self.failed.pop(line["retried"], None)
+
+    def _write(self, line: Dict) -> None:
+        with self._lock:
+            self._file.write(json.dumps(line) + "\n")
+            self._file.flush()
+
+    def record_progress(self, start: str, after: str) -> None:
+        self._write({"range": start, "after": after})
+
+    def record_done(self, start: str) -> None:
+        self._write({"range": start, "done": True})
+
+    def record_failure(self, obj: ObjectInfo, error: Exception) -> None:
+        self._write(
+            {"failed": obj.key, "size": obj.size, "etag": obj.etag, "error": str(error)}
+        )
+
+    def record_retried(self, key: str) -> None:
+        self._write({"retried": key})
+
+    def close(self) -> None:
+        self._file.close()
+
+
+class RangeProgress:
+    """Tracks which of a range's objects, listed in key order, have all finished, and
+    journals the last key before which they all have."""
+
+    def __init__(self, journal: Journal, start: str):
+        self.journal = journal
+        self.start = start
+        self._waiting = deque()
+        self._finished = set()
+        self._listed_all = False
+        self._done = False
+        self._after: Optional[str] = None
+        self._saved: Optional[str] = None
+        self._saved_at = monotonic()
+        self._lock = threading.Lock()
+
+    def listed(self, key: str) -> None:
+        with self._lock:
+            self._waiting.append(key)
+
+    def finished(self, key: str) -> None:
+        with self._lock:
+            self._finished.add(key)
+            while self._waiting and self._waiting[0] in self._finished:
+                self._after = self._waiting.popleft()
+                self._finished.remove(self._after)
+            self._save()
+
+    def listing_finished(self) -> None:
+        with self._lock:
+            self._listed_all = True
+            self._save()
+
+    def flush(self) -> None:
+        """Journal the latest progress, such as when the copy is interrupted."""
+        with self._lock:
+            if self._after != self._saved and not self._done:
+                self.journal.record_progress(self.start, self._after)
+                self._saved, self._saved_at = self._after, monotonic()
+
+    def _save(self) -> None:
+        if self._listed_all and not self._waiting:
+            self.journal.record_done(self.start)
+            self._done = True
+        elif (
+            self._after != self._saved
+            and monotonic() - self._saved_at > JOURNAL_INTERVAL_S
+        ):
+            self.journal.record_progress(self.start, self._after)
+            self._saved, self._saved_at = self._after, monotonic()
+
+
+def split_points(
+    s3_client, bucket: str, prefix: str, ranges: int, depth: int = MAX_SPLIT_DEPTH
+) -> List[str]:
+    """Folders under the prefix to split its listing at, going deeper until there
+    are at least ranges of them or depth is reached."""
+    folders = [prefix]
+    for _ in range(depth):
+        found = []
+        paginator = s3_client.get_paginator("list_objects_v2")
+        for folder in folders:
+            for page in paginator.paginate(Bucket=bucket, Prefix=folder, Delimiter="/"):
+                found += [p["Prefix"] for p in page.get("CommonPrefixes", [])]
+        if not found:
+            break
+        folders = found
+        if len(folders) >= ranges:
+            break
+    return sorted(set(folders) - {prefix})
+
+
+def list_range(
+    s3_client,
+    bucket: str,
+    prefix: str,
+    start: str,
+    end: Optional[str],
+    after: Optional[str] = None,
+) -> Iterator[ObjectInfo]:
+    """Stream the objects under the prefix from start up to, but not including, end.
+
+    Listing starts just after the key after if given, to resume a range.
+    """
+    # S3 lists keys after StartAfter, so start from the key before start
+    start_after = after or (start[:-1] if start else "")
+    paginator = s3_client.get_paginator("list_objects_v2")
+    for page in paginator.paginate(
+        Bucket=bucket, Prefix=prefix, StartAfter=start_after
+    ):
+        for item in page.get("Contents", []):
+            if end is not None and item["Key"] >= end:
+                return
+            if item["Key"] >= start:
+                yield ObjectInfo(item["Key"], item["Size"], item["ETag"])
+
+
+def copy_object(
+    s3_client,
+    source_bucket: str,
+    destination_bucket: str,
+    obj: ObjectInfo,
+    multipart_threshold: int = DEFAULT_MULTIPART_THRESHOLD,
+) -> None:
+    """Copy one object with the same key, as the export functions would.
+
+    Raises
+    ------
+    ChecksumMismatchError
+        If a single-part copy's ETag doesn't match its source's.
+    """
+    source = {"Bucket": source_bucket, "Key": obj.key}
+    if obj.size > multipart_threshold:
+        s3_client.copy(
+            source,
+            destination_bucket,
+            obj.key,
+            ExtraArgs=COPY_ARGS,
+            Config=TransferConfig(
+                multipart_threshold=multipart_threshold,
+                max_concurrency=PART_CONCURRENCY,
+            ),
+        )
+        return
+    response = s3_client.copy_object(
+        Bucket=destination_bucket, Key=obj.key, CopySource=source, **COPY_ARGS
+    )
+    etag = response["CopyObjectResult"]["ETag"]
+    if obj.etag and not is_composite(obj.etag) and etag != obj.etag:
+        raise ChecksumMismatchError(
+            f"The copy of {obj.key} doesn't match its source: expected {obj.etag}, "
+            f"got {etag}"
+        )
+
+
+class BulkCopy:
+    """Copy every object under a prefix between buckets, journalling progress.
+
+    Parameters
+    ----------
+    s3_client
+        Boto3 S3 client, with a connection pool of at least workers plus
+        PART_CONCURRENCY connections.
+    source_bucket, destination_bucket : str
+        Buckets to copy from and to.
+    prefix : str
+        Only copy keys starting with this.
+    journal : Journal
+        Where to record progress, and read it from to resume.
+    workers : int
+        Objects to copy at once.
+    list_workers : int
+        Key ranges to list at once.
+    max_objects_per_second, max_mib_per_second : Optional[float]
+        Limits on how fast to copy. By default, None, for no limit.
+    multipart_threshold : int
+        Objects larger than this many bytes are copied in parts.
+    """
+
+    def __init__(
+        self,
+        s3_client,
+        source_bucket: str,
+        destination_bucket: str,
+        prefix: str,
+        journal: Journal,
+        workers: int = DEFAULT_WORKERS,
+        list_workers: int = DEFAULT_LIST_WORKERS,
+        max_objects_per_second: Optional[float] = None,
+        max_mib_per_second: Optional[float] = None,
+        multipart_threshold: int = DEFAULT_MULTIPART_THRESHOLD,
+    ):
+        self.s3_client = s3_client
+        self.source_bucket = source_bucket
+        self.destination_bucket = destination_bucket
+        self.prefix = prefix
+        self.journal = journal
+        self.workers = workers
+        self.list_workers = list_workers
+        self.multipart_threshold = multipart_threshold
+        self.stats = CopyStats()
+        self._object_pacer = Pacer(max_objects_per_second)
+        self._byte_pacer = Pacer(max_mib_per_second and max_mib_per_second * 1024**2)
+        # Copies queued or running, so listing can't get far ahead of copying
+        self._slots = threading.BoundedSemaphore(2 * workers)
+        self._stopping = threading.Event()
+        self._finished = threading.Event()
+        self._ranges: List[RangeProgress] = []
+
+    def run(
+        self,
+        on_report: Optional[Callable[[CopyStats], None]] = None,
+        interval_s: float = 10,
+    ) -> CopyStats:
+        """Copy everything not yet journalled as copied, calling on_report with the
+        stats every interval_s seconds and once at the end.
+
+        Returns
+        -------
+        CopyStats
+            Counts of the objects listed, copied and failed by this run.
+        """
+        points = split_points(
+            self.s3_client, self.source_bucket, self.prefix, self.list_workers
+        )
+        starts = [self.prefix] + points
+        ends = points + [None]
+        reporter = threading.Thread(
+            target=self._report, args=(on_report, interval_s), daemon=True
+        )
+        reporter.start()
+        self._copiers = ThreadPoolExecutor(self.workers)
+        listers = ThreadPoolExecutor(self.list_workers)
+        try:
+            futures = [listers.submit(self._retry_failures)] + [
+                listers.submit(self._copy_range, start, end)
+                for start, end in zip(starts, ends)
+                if start not in self.journal.done
+            ]
+            for future in futures:
+                future.result()
+        except BaseException:
+            # Such as a listing error, or Ctrl-C. Let the copies already started
+            # finish, so the journal is as far on as it can be
+            self._stopping.set()
+            raise
+        finally:
+            listers.shutdown()
+            self._copiers.shutdown()
+            for progress in self._ranges:
+                progress.flush()
+            self._finished.set()
+            reporter.join()
+        return self.stats
+
+    def _report(self, on_report, interval_s: float) -> None:
+        while not self._finished.wait(interval_s):
+            if on_report:
+                on_report(self.stats)
+        if on_report:
+            on_report(self.stats)
+
+    def _retry_failures(self) -> None:
+        for obj in list(self.journal.failed.values()):
+            if self._stopping.is_set():
+                return
+            self.stats.add(listed=1)
+            self._submit(obj, self.journal.record_retried, None)
+
+    def _copy_range(self, start: str, end: Optional[str]) -> None:
+        progress = RangeProgress(self.journal, start)
+        self._ranges.append(progress)
+        for obj in list_range(
+            self.s3_client,
+            self.source_bucket,
+            self.prefix,
+            start,
+            end,
+            self.journal.after.get(start),
+        ):
+            if self._stopping.is_set():
+                return
+            self.stats.add(listed=1)
+            progress.listed(obj.key)
+            self._submit(obj, progress.finished, progress.finished)
+        progress.listing_finished()
+
+    def _submit(self, obj: ObjectInfo, on_success, on_failure) -> None:
+        self._slots.acquire()
+        self._object_pacer.wait()
+        self._byte_pacer.wait(obj.size)
+        future = self._copiers.submit(
+            copy_object,
+            self.s3_client,
+            self.source_bucket,
+            self.destination_bucket,
+            obj,
+            self.multipart_threshold,
+        )
+
+        def done(future):
+            self._slots.release()
+            error = future.exception()
+            if error is None:
+                self.stats.add(copied=1, bytes=obj.size)
+                on_success(obj.key)
+                return
+            self.stats.add(failed=1)
+            self.journal.record_failure(obj, error)
+            if on_failure:
+                on_failure(obj.key)
+
+        future.add_done_callback(done)
@@ -0,0 +1,391 @@
+"""Command line tools for running the exports stack.
+
+Run from the project folder, for example:
+
+    python -m data_engineering_exports plan --stack data-engineering-exports
+    python -m data_engineering_exports deploy --stack data-engineering-exports
+    python -m data_engineering_exports reconcile --output problems.jsonl
+    python -m data_engineering_exports backfill --dataset new_project
+    python -m data_engineering_exports copy --dataset moved --source-bucket old-target
+"""
+import argparse
+import json
+import sys
+from collections import Counter
+from datetime import timedelta
+from typing import Dict, List, Optional, Tuple
+
+import boto3
+from botocore.config import Config
+from pulumi import automation as auto
+
+from data_engineering_exports import (
+    backfill,
+    bulk_copy,
+    planner,
+    reconcile,
+    registry,
+    utils,
+)
+
+EXPORT_BUCKET = "mojap-hub-exports"
+
+
+def _select_stack(args: argparse.Namespace) -> auto.Stack:
+    return auto.select_stack(stack_name=args.stack, work_dir=args.project_folder)
+
+
+def plan(args: argparse.Namespace) -> planner.DeployPlan:
+    """Print which datasets have changed and which resources a deploy would update."""
+    deploy_plan = planner.plan_deploy(_select_stack(args), args.project_folder)
+    if deploy_plan.changed:
+        print("Changed datasets:\n  " + "\n  ".join(deploy_plan.changed))
+    if deploy_plan.full:
+        print("Every resource needs updating")
+    elif deploy_plan.targets:
+        print("Resources to update:\n  " + "\n  ".join(deploy_plan.targets))
+    else:
+        print("No datasets have changed")
+    return deploy_plan
+
+
+def deploy(args: argparse.Namespace):
+    """Update the resources of changed datasets, or everything if --full is set."""
+    stack = _select_stack(args)
+    if args.full:
+        deploy_plan = planner.DeployPlan([], None)
+    else:
+        deploy_plan = plan(args)
+    planner.deploy(stack, deploy_plan, parallel=args.parallel)
+
+
+def reconcile_exports(args: argparse.Namespace):
+    """List objects left in the export bucket that are missing from, differ from or
+    were copied to their target bucket without being deleted."""
+    datasets = registry.load_configs(utils.list_yaml_files(args.config_folder), "push")
+    if args.dataset:
+        datasets = [d for d in datasets if d["name"] in args.dataset]
+    problems = reconcile.reconcile(
+        boto3.client("s3"),
+        datasets,
+        args.export_bucket,
+        min_age=timedelta(minutes=args.min_age),
+        workers=args.workers,
+    )
+    counts = Counter()
+    output = open(args.output, "w") if args.output else sys.stdout
+    try:
+        for problem in problems:
+            counts[problem.status] += 1
+            record = {
+                "dataset": problem.dataset,
+                "status": problem.status,
+                "key": problem.key,
+                "size": problem.export_object.size,
+                "etag": problem.export_object.etag,
+            }
+            if problem.target_object:
+                record["target_size"] = problem.target_object.size
+                record["target_etag"] = problem.target_object.etag
+            output.write(json.dumps(record) + "\n")
+    finally:
+        if args.output:
+            output.close()
+    summary = ", ".join(f"{count} {status}" for status, count in sorted(counts.items()))
+    print(
+        f"Checked {len(datasets)} datasets: {summary or 'no problems'}", file=sys.stderr
+    )
+    if counts:
+        sys.exit(1)
+
+
+def _find_dataset(config_folder: str, name: str, kind: str) -> Optional[Dict]:
+    datasets = registry.load_configs(utils.list_yaml_files(config_folder), kind)
+    for dataset in datasets:
+        if dataset["name"] == name:
+            return dataset
+    return None
+
+
+def _load_dataset(config_folder: str, name: str) -> Dict:
+    dataset = _find_dataset(config_folder, name, "push")
+    if dataset is None:
+        sys.exit(f"No push dataset called {name} in {config_folder}")
+    return dataset
+
+
+def backfill_dataset(args: argparse.Namespace):
+    """Copy a push dataset's objects to its target bucket with one S3 Batch
+    Operations job, then follow the job until it finishes."""
+    dataset = _load_dataset(args.config_folder, args.dataset)
+    try:
+        backfill.check_dataset(dataset, args.role_arn)
+    except backfill.BackfillError as e:
+        sys.exit(str(e))
+    s3_client = boto3.client("s3")
+    source_bucket = args.source_bucket or args.export_bucket
+    prefix = backfill.run_prefix(dataset)
+    manifest = backfill.write_manifest(
+        s3_client,
+        reconcile.list_objects(
+            s3_client, source_bucket, args.source_prefix or f"{dataset['name']}/"
+        ),
+        source_bucket,
+        args.export_bucket,
+        f"{prefix}/manifest.csv",
+        dataset["exclude_patterns"],
+    )
+    for obj in manifest.skipped:
+        print(
+            f"Skipped {obj.key}, too large to copy at {obj.size} bytes", file=sys.stderr
+        )
+    if not manifest.objects:
+        print("No objects to backfill", file=sys.stderr)
+        return
+    print(
+        f"Wrote a manifest of {manifest.objects} objects ({manifest.size} bytes) to "
+        f"s3://{manifest.bucket}/{manifest.key}",
+        file=sys.stderr,
+    )
+
+    account_id = boto3.client("sts").get_caller_identity()["Account"]
+    s3control_client = boto3.client("s3control")
+    job_id = backfill.submit_job(
+        s3control_client,
+        account_id,
+        dataset,
+        manifest,
+        args.role_arn or backfill.export_role_arn(account_id, dataset),
+        prefix,
+    )
+    print(job_id)
+    if args.no_wait:
+        return
+    progress = backfill.wait_for_job(
+        s3control_client,
+        account_id,
+        job_id,
+        args.interval,
+        lambda progress: print(
+            backfill.describe_progress(progress, manifest), file=sys.stderr
+        ),
+    )
+    if progress.status != "Complete" or progress.failed:
+        print(f"See the report under s3://{manifest.bucket}/{prefix}/", file=sys.stderr)
+        sys.exit(1)
+
+
+def _copy_destination(args: argparse.Namespace) -> Tuple[str, str]:
+    """The bucket and prefix a dataset's objects are copied to by default: a push
+    dataset's folder of its target bucket, or the whole of a pull dataset's
+    bucket."""
+    dataset = _find_dataset(args.config_folder, args.dataset, "push")
+    if dataset is not None:
+        return dataset["target_bucket"], f"{args.dataset}/"
+    if _find_dataset(args.pull_config_folder, args.dataset, "pull") is not None:
+        return f"mojap-{args.dataset}", ""
+    sys.exit(
+        f"No push dataset called {args.dataset} in {args.config_folder}, or pull "
+        f"dataset in {args.pull_config_folder}"
+    )
+
+
+def copy_dataset(args: argparse.Namespace):
+    """Copy a push dataset's objects from another bucket to its target bucket, such
+    as its old target, or a pull dataset's objects to its bucket, from this machine.
+    Rerun with the same journal to resume."""
+    destination_bucket, prefix = _copy_destination(args)
+    s3_client = boto3.client(
+        "s3",
+        config=Config(
+            max_pool_connections=args.workers + bulk_copy.PART_CONCURRENCY,
+            retries={"mode": "adaptive", "max_attempts": 10},
+        ),
+    )
+    destination_bucket = args.destination_bucket or destination_bucket
+    prefix = prefix if args.prefix is None else args.prefix
+    journal_path = args.journal or f"copy-{args.dataset}.jsonl"
+    try:
+        journal = bulk_copy.Journal(
+            journal_path,
+            {
+                "source": args.source_bucket,
+                "destination": destination_bucket,
+                "prefix": prefix,
+            },
+        )
+    except bulk_copy.BulkCopyError as e:
+        sys.exit(str(e))
+    if journal.after or journal.done or journal.failed:
+        print(f"Resuming the copy in {journal_path}", file=sys.stderr)
+    try:
+        stats = bulk_copy.BulkCopy(
+            s3_client,
+            args.source_bucket,
+            destination_bucket,
+            prefix,
+            journal,
+            args.workers,
+            args.list_workers,
+            args.max_objects_per_second,
+            args.max_mib_per_second,
+        ).run(
+            lambda stats: print(stats.describe(), file=sys.stderr),
+            args.report_interval,
+        )
+    except KeyboardInterrupt:
+        sys.exit(f"Interrupted - rerun with --journal {journal_path} to resume")
+    finally:
+        journal.close()
+    if stats.failed:
+        print(
+            f"{stats.failed} objects failed, listed in {journal_path} - rerun to retry",
+            file=sys.stderr,
+        )
+        sys.exit(1)
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        prog="python -m data_engineering_exports", description=__doc__.split("\n")[0]
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    stack_parser = argparse.ArgumentParser(add_help=False)
+    stack_parser.add_argument("--stack", required=True, help="Pulumi stack name")
+    stack_parser.add_argument(
+        "--project-folder", default=".", help="folder containing Pulumi.yaml"
+    )
+
+    plan_parser = subparsers.add_parser(
+        "plan", parents=[stack_parser], help=plan.__doc__
+    )
+    plan_parser.set_defaults(function=plan)
+
+    deploy_parser = subparsers.add_parser(
+        "deploy", parents=[stack_parser], help=deploy.__doc__
+    )
+    deploy_parser.add_argument(
+        "--full", action="store_true", help="update every resource"
+    )
+    deploy_parser.add_argument(
+        "--parallel", type=int, help="resources to update at once"
+    )
+    deploy_parser.set_defaults(function=deploy)
+
+    reconcile_parser = subparsers.add_parser(
+        "reconcile", help=reconcile_exports.__doc__
+    )
+    reconcile_parser.add_argument("--export-bucket", default=EXPORT_BUCKET)
+    reconcile_parser.add_argument(
+        "--config-folder", default="push_datasets", help="folder of push configs"
+    )
+    reconcile_parser.add_argument(
+        "--dataset", action="append", help="only check this dataset - can repeat"
+    )
+    reconcile_parser.add_argument(
+        "--min-age",
+        type=float,
+        default=reconcile.DEFAULT_MIN_AGE.total_seconds() / 60,
+        help="ignore objects uploaded in the last this many minutes",
+    )
+    reconcile_parser.add_argument(
+        "--workers",
+        type=int,
+        default=reconcile.DEFAULT_WORKERS,
+        help="datasets to list at once",
+    )
+    reconcile_parser.add_argument(
+        "--output", help="file to write problems to, as JSON lines"
+    )
+    reconcile_parser.set_defaults(function=reconcile_exports)
+
+    backfill_parser = subparsers.add_parser("backfill", help=backfill_dataset.__doc__)
+    backfill_parser.add_argument("--dataset", required=True, help="push dataset name")
+    backfill_parser.add_argument(
+        "--export-bucket",
+        default=EXPORT_BUCKET,
+        help="bucket to write the manifest and report to",
+    )
+    backfill_parser.add_argument(
+        "--config-folder", default="push_datasets", help="folder of push configs"
+    )
+    backfill_parser.add_argument(
+        "--source-bucket",
+        help="bucket to copy from, if not the export bucket - must let the role read",
+    )
+    backfill_parser.add_argument(
+        "--source-prefix",
+        help="only copy keys starting with this - defaults to the dataset's folder",
+    )
+    backfill_parser.add_argument(
+        "--role-arn", help="role for the job, if not the dataset's export role"
+    )
+    backfill_parser.add_argument(
+        "--interval",
+        type=float,
+        default=backfill.DEFAULT_POLL_INTERVAL_S,
+        help="seconds between checks on the job",
+    )
+    backfill_parser.add_argument(
+        "--no-wait", action="store_true", help="exit once the job is submitted"
+    )
+    backfill_parser.set_defaults(function=backfill_dataset)
+
+    copy_parser = subparsers.add_parser("copy", help=copy_dataset.__doc__)
+    copy_parser.add_argument(
+        "--dataset", required=True, help="push or pull dataset name"
+    )
+    copy_parser.add_argument(
+        "--source-bucket", required=True, help="bucket to copy from"
+    )
+    copy_parser.add_argument(
+        "--destination-bucket",
+        help="bucket to copy to - defaults to the dataset's target or pull bucket",
+    )
+    copy_parser.add_argument(
+        "--prefix",
+        help="only copy keys starting with this - defaults to a push dataset's "
+        "folder, or all of a pull dataset's bucket",
+    )
+    copy_parser.add_argument(
+        "--config-folder", default="push_datasets", help="folder of push configs"
+    )
+    copy_parser.add_argument(
+        "--pull-config-folder", default="pull_datasets", help="folder of pull configs"
+    )
+    copy_parser.add_argument(
+        "--journal",
+        help="file to record progress in - defaults to copy-<dataset>.jsonl",
+    )
+    copy_parser.add_argument(
+        "--workers",
+        type=int,
+        default=bulk_copy.DEFAULT_WORKERS,
+        help="objects to copy at once",
+    )
+    copy_parser.add_argument(
+        "--list-workers",
+        type=int,
+        default=bulk_copy.DEFAULT_LIST_WORKERS,
+        help="key ranges to list at once",
+    )
+    copy_parser.add_argument(
+        "--max-objects-per-second", type=float, help="limit on objects copied"
+    )
+    copy_parser.add_argument(
+        "--max-mib-per-second", type=float, help="limit on MiB copied"
+    )
+    copy_parser.add_argument(
+        "--report-interval",
+        type=float,
+        default=10,
+        help="seconds between progress reports",
+    )
+    copy_parser.set_defaults(function=copy_dataset)
+    return parser
+
+
+def main(argv: Optional[List[str]] = None):
+    args = build_parser().parse_args(argv)
+    args.function(args)
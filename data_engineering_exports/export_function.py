@@ -0,0 +1,942 @@
+import json
+from pathlib import Path
+from typing import Dict, List, NamedTuple, Optional, Tuple, Union
+
+from data_engineering_pulumi_components.aws import Bucket
+from data_engineering_pulumi_components.utils import Tagger
+from pulumi import (
+    Alias,
+    AssetArchive,
+    ComponentResource,
+    FileArchive,
+    Output,
+    ResourceOptions,
+    StringAsset,
+)
+from pulumi_aws.cloudwatch import EventBus, EventRule, EventTarget
+from pulumi_aws.iam import Role, RolePolicy, RolePolicyAttachment
+from pulumi_aws.lambda_ import Alias as FunctionAlias
+from pulumi_aws.lambda_ import (
+    EventSourceMapping,
+    Function,
+    FunctionEnvironmentArgs,
+    FunctionEventInvokeConfig,
+    FunctionTracingConfigArgs,
+    Permission,
+    ProvisionedConcurrencyConfig,
+)
+from pulumi_aws.sqs import Queue, QueuePolicy
+
+from data_engineering_exports.lambda_handlers.export import export, routing, settings
+
+CHECKPOINT_PREFIX = "_export_checkpoints"
+# Where backfill writes its manifests and reports
+BACKFILL_PREFIX = "_backfill"
+FUNCTION_TIMEOUT = 300
+FUNCTION_MEMORY = 128
+FUNCTION_ARCHITECTURE = "x86_64"
+# Name of the alias that provisioned concurrency is attached to
+LIVE_ALIAS = "live"
+XRAY_WRITE_POLICY = "arn:aws:iam::aws:policy/AWSXRayDaemonWriteAccess"
+# Messages that fail this many times are moved to the dead-letter queue
+MAX_RECEIVE_COUNT = 5
+# Lambda's most retries and longest event age for asynchronous invocations, which
+# are the last resort for copies that have run out of resumes
+ASYNC_RETRY_ATTEMPTS = 2
+MAX_EVENT_AGE_S = 6 * 60 * 60
+ROUTING_TABLE = "routes.json"
+# The Lambda handler for each choice of ExportObjectFunction's handler
+HANDLERS = {"full": "export.export.handler", "lean": "export.lean.handler"}
+# The reason EventBridge gives for each kind of new object
+EVENT_REASONS = {
+    "put": "PutObject",
+    "post": "POST Object",
+    "copy": "CopyObject",
+    "multipart": "CompleteMultipartUpload",
+}
+LAMBDA_ASSUME_ROLE_POLICY = json.dumps(
+    {
+        "Version": "2012-10-17",
+        "Statement": [
+            {
+                "Effect": "Allow",
+                "Principal": {"Service": "lambda.amazonaws.com"},
+                "Action": "sts:AssumeRole",
+            }
+        ],
+    }
+)
+
+
+# Export roles of datasets that allow backfills are also used by S3 Batch Operations
+BACKFILL_ASSUME_ROLE_POLICY = json.dumps(
+    {
+        "Version": "2012-10-17",
+        "Statement": [
+            {
+                "Effect": "Allow",
+                "Principal": {
+                    "Service": [
+                        "lambda.amazonaws.com",
+                        "batchoperations.s3.amazonaws.com",
+                    ]
+                },
+                "Action": "sts:AssumeRole",
+            }
+        ],
+    }
+)
+
+
+class EventFilter(NamedTuple):
+    """Which of a dataset's new objects its EventBridge rule sends to the function.
+
+    include_suffixes - only send keys ending with one of these, if any are given
+    min_size_bytes - only send objects at least this large
+    event_types - only send objects created by these of EVENT_REASONS
+    exclude_patterns - don't send keys matching any of these wildcard patterns
+    """
+
+    include_suffixes: Tuple[str, ...] = ()
+    min_size_bytes: int = 0
+    event_types: Tuple[str, ...] = tuple(EVENT_REASONS)
+    exclude_patterns: Tuple[str, ...] = ()
+
+    def pattern(self, bucket_name: str, prefix: str) -> Dict:
+        """The EventBridge event pattern for a dataset's prefix of the bucket."""
+        if self.include_suffixes:
+            keys = [{"wildcard": f"{prefix}/*{s}"} for s in self.include_suffixes]
+        else:
+            keys = [{"prefix": f"{prefix}/"}]
+        detail = {"bucket": {"name": [bucket_name]}, "object": {"key": keys}}
+        if self.min_size_bytes:
+            detail["object"]["size"] = [{"numeric": [">=", self.min_size_bytes]}]
+        if set(self.event_types) != set(EVENT_REASONS):
+            detail["reason"] = [EVENT_REASONS[t] for t in self.event_types]
+        return {
+            "source": ["aws.s3"],
+            "detail-type": ["Object Created"],
+            "detail": detail,
+        }
+
+    def exclude_pattern(self) -> Optional[Dict]:
+        """The EventBridge event pattern dropping keys that match exclude_patterns,
+        or None if none of them can be written as an EventBridge wildcard.
+
+        EventBridge ORs the conditions on a field, so this can't be added to the
+        pattern's key conditions without matching keys outside the prefix. It's
+        matched by a second rule instead. Patterns using ? or [...] are left to the
+        function.
+        """
+        wildcards = [
+            _event_wildcard(p)
+            for p in self.exclude_patterns
+            if not any(c in p for c in "?[")
+        ]
+        if not wildcards:
+            return None
+        return {
+            "source": ["aws.s3"],
+            "detail-type": ["Object Created"],
+            "detail": {"object": {"key": [{"anything-but": {"wildcard": wildcards}}]}},
+        }
+
+
+def _event_wildcard(pattern: str) -> str:
+    """Write an fnmatch pattern using only * as an EventBridge wildcard, which
+    escapes with backslashes and doesn't allow consecutive *s."""
+    pattern = pattern.replace("\\", "\\\\")
+    while "**" in pattern:
+        pattern = pattern.replace("**", "*")
+    return pattern
+
+
+def backfill_statements(bucket_arn: str, prefix: str) -> List[Dict]:
+    """Policy statements letting a backfill job read its manifest and write its
+    report, under the prefix's folder of BACKFILL_PREFIX."""
+    return [
+        {
+            "Sid": "BackfillManifests",
+            "Effect": "Allow",
+            "Resource": [bucket_arn, f"{bucket_arn}/{BACKFILL_PREFIX}/{prefix}/*"],
+            "Action": [
+                "s3:GetObject",
+                "s3:GetObjectVersion",
+                "s3:PutObject",
+                "s3:GetBucketLocation",
+            ],
+        }
+    ]
+
+
+def handler_code(routing_table: Optional[Dict] = None) -> AssetArchive:
+    """Package the export handler, and optionally a routing table, for Lambda."""
+    assets = {"export": FileArchive(path=str(Path(export.__file__).absolute().parent))}
+    if routing_table is not None:
+        assets[ROUTING_TABLE] = StringAsset(
+            json.dumps(routing_table, indent=2, sort_keys=True)
+        )
+    return AssetArchive(assets=assets)
+
+
+def allow_resume(
+    name: str,
+    function: Function,
+    role: Role,
+    qualifier: Optional[Output] = None,
+) -> Tuple[FunctionEventInvokeConfig, RolePolicy]:
+    """Let an export function invoke itself, to resume copies that run out of time,
+    and set how Lambda retries its asynchronous invocations rather than relying on
+    the defaults.
+
+    Parameters
+    ----------
+    name : str
+        The name of the function's component.
+    function : Function
+        The export function.
+    role : Role
+        The function's role.
+    qualifier : Optional[Output]
+        The alias S3 invokes, if not the function's latest version. By default, None.
+    """
+    invoke_config = FunctionEventInvokeConfig(
+        resource_name=f"{name}-invoke-config",
+        function_name=function.name,
+        qualifier=qualifier,
+        maximum_retry_attempts=ASYNC_RETRY_ATTEMPTS,
+        maximum_event_age_in_seconds=MAX_EVENT_AGE_S,
+        opts=ResourceOptions(parent=function),
+    )
+    policy = RolePolicy(
+        resource_name=f"{name}-resume-role-policy",
+        name="lambda-resume",
+        policy=function.arn.apply(
+            lambda arn: json.dumps(
+                {
+                    "Version": "2012-10-17",
+                    "Statement": [
+                        {
+                            "Sid": "InvokeSelf",
+                            "Effect": "Allow",
+                            "Resource": [arn, f"{arn}:*"],
+                            "Action": ["lambda:InvokeFunction"],
+                        }
+                    ],
+                }
+            )
+        ),
+        role=role.id,
+        opts=ResourceOptions(parent=role),
+    )
+    return invoke_config, policy
+
+
+class ExportObjectFunction(ComponentResource):
+    def __init__(
+        self,
+        destination_bucket: str,
+        name: str,
+        source_bucket: Bucket,
+        tagger: Tagger,
+        prefix: str,
+        keep_files: bool = False,
+        multipart_threshold: int = settings.DEFAULT_MULTIPART_THRESHOLD,
+        part_size: int = settings.DEFAULT_PART_SIZE,
+        max_concurrency: int = settings.DEFAULT_MAX_CONCURRENCY,
+        delivery: str = "direct",
+        batch_size: int = 100,
+        batching_window_s: int = 30,
+        bundle: Optional[str] = None,
+        bundle_max_mb: int = routing.DEFAULT_BUNDLE_MAX_MB,
+        memory_mb: int = FUNCTION_MEMORY,
+        timeout_s: int = FUNCTION_TIMEOUT,
+        architecture: str = FUNCTION_ARCHITECTURE,
+        reserved_concurrency: Optional[int] = None,
+        provisioned_concurrency: Optional[int] = None,
+        tracing: bool = False,
+        handler: str = "full",
+        compress: Optional[str] = None,
+        layers: Optional[List[str]] = None,
+        exclude_patterns: Optional[List[str]] = None,
+        event_filter: Optional[EventFilter] = None,
+        allow_backfill: bool = False,
+        opts: Optional[ResourceOptions] = None,
+    ) -> None:
+        """
+        Provides a Lambda function that copies objects from a prefix of the source
+        bucket to a destination bucket, and by default then deletes the original.
+
+        Replaces MoveObjectFunction and CopyObjectFunction from
+        data-engineering-pulumi-components. It keeps their role names, so target
+        bucket policies granting access to `<name>-move` or `<name>-copy` carry on
+        working, and aliases their resources so existing functions are updated in
+        place. Unlike those functions, objects larger than multipart_threshold are
+        copied in parallel parts, so files over the 5 GB CopyObject limit export too.
+        A copy that runs out of time is resumed by the function invoking itself.
+
+        With direct delivery, S3 invokes the function once per new object. With
+        batched delivery, S3 sends its notifications to an SQS queue instead, and the
+        function reads them in batches of up to batch_size, waiting up to
+        batching_window_s seconds to fill a batch. Each batch is copied concurrently
+        and its sources deleted in bulk. Messages that keep failing are moved to a
+        dead-letter queue. With bundle set, a batch's small objects are instead
+        written to the destination as bundles of up to bundle_max_mb, each with an
+        index.
+
+        Reserving concurrency guarantees the function that many concurrent
+        executions, and stops it using more, so a busy dataset can't starve the
+        others. With provisioned concurrency, the function is published and a `live`
+        alias kept warm with that many environments, and S3 or SQS invoke the alias.
+        With tracing, X-Ray active tracing is turned on and each object's HEAD, COPY
+        and DELETE requests are recorded as subsegments. The lean handler starts
+        faster, loading only what a single copy needs, but only takes direct
+        delivery and doesn't trace.
+
+        With allow_backfill, the function's role can also be assumed by S3 Batch
+        Operations, and read and write under the prefix's folder of
+        BACKFILL_PREFIX, so that backfill jobs can copy as the same role.
+
+        No BucketNotification is created - make a combined one for the source bucket
+        with make_combined_bucket_notification, which invokes invoke_arn. With an
+        event_filter, the function is instead sent its prefix's new objects by an
+        EventBridge rule, which drops objects the filter doesn't match before the
+        function runs. The combined notification then only needs to turn on
+        EventBridge for the bucket. Objects matching exclude_patterns are left alone
+        by the function whichever way it's invoked. If the filter has
+        exclude_patterns too, the rule forwards to an event bus of the function's
+        own, where a second rule drops the excluded keys, as EventBridge can't
+        require a key to both have the prefix and not match a pattern in one rule.
+
+        Parameters
+        ----------
+        destination_bucket : str
+            Name of the existing bucket to send data to.
+        name : str
+            The name of the resource.
+        source_bucket : Bucket
+            The bucket to send data from.
+        tagger : Tagger
+            A tagger resource.
+        prefix : str
+            Only send files from this 'folder'. Don't include the trailing slash:
+            'project-name', not 'project-name/'
+        keep_files : bool
+            If True, leave objects in the source bucket after copying them.
+        multipart_threshold : int
+            Objects larger than this many bytes are copied in parts.
+        part_size : int
+            Preferred size in bytes of each part in a multipart copy.
+        max_concurrency : int
+            How many parts of an object, or objects in a batch, to copy at once.
+        delivery : str
+            Either "direct" (the default) or "batched".
+        batch_size : int
+            With batched delivery, the most notifications to send the function at
+            once. Defaults to 100.
+        batching_window_s : int
+            With batched delivery, the longest to wait for a batch to fill, in
+            seconds. Defaults to 30.
+        bundle : Optional[str]
+            With batched delivery, either "tar" or "ndjson" to bundle small objects.
+            By default, None.
+        bundle_max_mb : int
+            Largest total size of the objects in a bundle, in MB. Defaults to 32.
+        memory_mb : int
+            Memory for the function in MB, which also sets its share of CPU and
+            network. Defaults to 128.
+        timeout_s : int
+            Longest the function can run, in seconds. Defaults to 300.
+        architecture : str
+            Either "x86_64" (the default) or "arm64".
+        reserved_concurrency : Optional[int]
+            Concurrent executions to reserve for the function. By default, None,
+            sharing the account's unreserved concurrency.
+        provisioned_concurrency : Optional[int]
+            Execution environments to keep initialised. By default, None.
+        tracing : bool
+            If True, trace invocations with X-Ray. By default, False.
+        handler : str
+            Either "full" (the default) or "lean", for the handler in
+            lambda_handlers/export/lean.py.
+        compress : Optional[str]
+            Either "gzip" or "zstd" to compress objects on the way, adding the
+            codec's suffix to their keys. By default, None.
+        layers : Optional[List[str]]
+            ARNs of Lambda layers to add to the function, such as one providing the
+            zstandard package for zstd compression. By default, None.
+        exclude_patterns : Optional[List[str]]
+            Wildcard patterns, like "*.tmp", of keys to leave in the source bucket.
+            By default, None.
+        event_filter : Optional[EventFilter]
+            If given, invoke the function from an EventBridge rule that only matches
+            objects passing this filter, rather than from S3 event notifications.
+            By default, None.
+        allow_backfill : bool
+            If True, let S3 Batch Operations jobs run as the function's role, to
+            backfill the prefix. By default, False.
+        opts : Optional[ResourceOptions]
+            Options for the resource. By default, None.
+        """
+        # Match the type of component this replaces, so Pulumi updates in place
+        action = "copy" if keep_files else "move"
+        replaces = "CopyObjectFunction" if keep_files else "MoveObjectFunction"
+        replaced_type = f"data-engineering-pulumi-components:aws:{replaces}"
+        super().__init__(
+            t="data-engineering-exports:aws:ExportObjectFunction",
+            name=name,
+            props=None,
+            opts=ResourceOptions.merge(
+                ResourceOptions(aliases=[Alias(type_=replaced_type)]),
+                opts,
+            ),
+        )
+
+        self._role = Role(
+            resource_name=f"{name}-role",
+            assume_role_policy=(
+                BACKFILL_ASSUME_ROLE_POLICY
+                if allow_backfill
+                else LAMBDA_ASSUME_ROLE_POLICY
+            ),
+            name=f"{name}-{action}",
+            path="/service-role/",
+            tags=tagger.create_tags(f"{name}-{action}"),
+            opts=ResourceOptions(parent=self),
+        )
+        if keep_files:
+            source_sid, source_actions = "GetSourceBucket", ["s3:GetObject*"]
+        else:
+            source_sid = "GetDeleteSourceBucket"
+            source_actions = ["s3:GetObject*", "s3:DeleteObject*"]
+        self._rolePolicy = RolePolicy(
+            resource_name=f"{name}-role-policy",
+            name="s3-access",
+            policy=Output.all(source_bucket.arn, prefix).apply(
+                lambda args: json.dumps(
+                    {
+                        "Version": "2012-10-17",
+                        "Statement": [
+                            {
+                                "Sid": source_sid,
+                                "Effect": "Allow",
+                                "Resource": [f"{args[0]}/{args[1]}/*"],
+                                "Action": source_actions,
+                            },
+                            {
+                                "Sid": "PutDestinationBucket",
+                                "Effect": "Allow",
+                                "Resource": [f"arn:aws:s3:::{destination_bucket}/*"],
+                                "Action": [
+                                    "s3:PutObject*",
+                                    "s3:AbortMultipartUpload",
+                                    "s3:DeleteObject",
+                                ],
+                            },
+                            {
+                                "Sid": "MultipartCheckpoints",
+                                "Effect": "Allow",
+                                "Resource": [
+                                    f"{args[0]}/{CHECKPOINT_PREFIX}/{args[1]}/*"
+                                ],
+                                "Action": [
+                                    "s3:GetObject",
+                                    "s3:PutObject",
+                                    "s3:DeleteObject",
+                                ],
+                            },
+                        ]
+                        + (backfill_statements(*args) if allow_backfill else []),
+                    }
+                )
+            ),
+            role=self._role.id,
+            opts=ResourceOptions(parent=self._role),
+        )
+        self._rolePolicyAttachment = RolePolicyAttachment(
+            resource_name=f"{name}-role-policy-attachment",
+            policy_arn=(
+                "arn:aws:iam::aws:policy/service-role/AWSLambdaBasicExecutionRole"
+            ),
+            role=self._role.name,
+            opts=ResourceOptions(parent=self._role),
+        )
+        if tracing:
+            self._tracingPolicyAttachment = RolePolicyAttachment(
+                resource_name=f"{name}-tracing-policy-attachment",
+                policy_arn=XRAY_WRITE_POLICY,
+                role=self._role.name,
+                opts=ResourceOptions(parent=self._role),
+            )
+        self._function = Function(
+            resource_name=f"{name}-function",
+            code=handler_code(),
+            description=Output.all(source_bucket.name).apply(
+                lambda args: f"Exports data from {args[0]} to {destination_bucket}"
+            ),
+            environment=FunctionEnvironmentArgs(
+                variables={
+                    "DESTINATION_BUCKET": destination_bucket,
+                    "KEEP_FILES": str(keep_files).lower(),
+                    "COMPRESS": compress or "",
+                    "BUNDLE": bundle or "",
+                    "BUNDLE_MAX_MB": str(bundle_max_mb),
+                    "MULTIPART_THRESHOLD": str(multipart_threshold),
+                    "PART_SIZE": str(part_size),
+                    "MAX_CONCURRENCY": str(max_concurrency),
+                    "CHECKPOINT_PREFIX": CHECKPOINT_PREFIX,
+                    "TRACING": str(tracing).lower(),
+                    "EXCLUDE_PATTERNS": json.dumps(exclude_patterns or []),
+                }
+            ),
+            handler=HANDLERS[handler],
+            name=f"{name}-{action}",
+            role=self._role.arn,
+            runtime="python3.10",
+            architectures=[architecture],
+            memory_size=memory_mb,
+            reserved_concurrent_executions=reserved_concurrency,
+            publish=bool(provisioned_concurrency),
+            layers=layers,
+            tracing_config=(
+                FunctionTracingConfigArgs(mode="Active") if tracing else None
+            ),
+            tags=tagger.create_tags(f"{name}-{action}"),
+            timeout=timeout_s,
+            opts=ResourceOptions(parent=self),
+        )
+        self.invoke_arn = self._function.arn
+        qualifier = None
+        if provisioned_concurrency:
+            self._build_provisioned_concurrency(name, provisioned_concurrency)
+            self.invoke_arn = self._alias.arn
+            qualifier = self._alias.name
+        self._invoke_config, self._resumeRolePolicy = allow_resume(
+            name, self._function, self._role, qualifier
+        )
+        self.event_rule = None
+        if event_filter is not None:
+            self._build_event_rule(name, source_bucket, tagger, prefix, event_filter)
+        self.queue = None
+        if delivery == "batched":
+            self._build_queue(
+                name, source_bucket, tagger, batch_size, batching_window_s, timeout_s
+            )
+            target = self.queue.arn
+        else:
+            self._permission = Permission(
+                resource_name=f"{name}-permission",
+                action="lambda:InvokeFunction",
+                function=self._function.arn,
+                qualifier=qualifier,
+                **self._sender(source_bucket),
+                opts=ResourceOptions(parent=self._function),
+            )
+            target = self.invoke_arn
+        if self.event_rule is not None:
+            self._event_target = EventTarget(
+                resource_name=f"{name}-event-target",
+                rule=self._delivering_rule.name,
+                event_bus_name=self._delivering_rule.event_bus_name,
+                arn=target,
+                opts=ResourceOptions(parent=self._delivering_rule),
+            )
+        self.register_outputs({})
+
+    def _sender(self, source_bucket: Bucket) -> Dict:
+        """The principal and source_arn of whatever sends the function its events:
+        the event rule if there is one, otherwise the source bucket."""
+        if self.event_rule is not None:
+            return dict(
+                principal="events.amazonaws.com",
+                source_arn=self._delivering_rule.arn,
+            )
+        return dict(principal="s3.amazonaws.com", source_arn=source_bucket.arn)
+
+    def _build_event_rule(
+        self,
+        name: str,
+        source_bucket: Bucket,
+        tagger: Tagger,
+        prefix: str,
+        event_filter: EventFilter,
+    ) -> None:
+        """Create an EventBridge rule matching the prefix's new objects that pass the
+        filter, in place of an S3 event notification."""
+        self.event_rule = EventRule(
+            resource_name=f"{name}-event-rule",
+            name=f"{name}-objects",
+            description=f"New objects in the {prefix} folder to export",
+            event_pattern=source_bucket.name.apply(
+                lambda bucket_name: json.dumps(
+                    event_filter.pattern(bucket_name, prefix)
+                )
+            ),
+            tags=tagger.create_tags(f"{name}-objects"),
+            opts=ResourceOptions(parent=self),
+        )
+        self._delivering_rule = self.event_rule
+        exclude_pattern = event_filter.exclude_pattern()
+        if exclude_pattern is not None:
+            self._build_exclude_rule(name, tagger, prefix, exclude_pattern)
+
+    def _build_exclude_rule(
+        self, name: str, tagger: Tagger, prefix: str, exclude_pattern: Dict
+    ) -> None:
+        """Forward the event rule's events to the function's own event bus, where a
+        second rule drops the excluded keys before they reach the function."""
+        self._event_bus = EventBus(
+            resource_name=f"{name}-event-bus",
+            name=f"{name}-objects",
+            tags=tagger.create_tags(f"{name}-objects"),
+            opts=ResourceOptions(parent=self.event_rule),
+        )
+        self._forward_role = Role(
+            resource_name=f"{name}-forward-role",
+            name=f"{name}-forward",
+            assume_role_policy=json.dumps(
+                {
+                    "Version": "2012-10-17",
+                    "Statement": [
+                        {
+                            "Effect": "Allow",
+                            "Principal": {"Service": "events.amazonaws.com"},
+                            "Action": "sts:AssumeRole",
+                        }
+                    ],
+                }
+            ),
+            tags=tagger.create_tags(f"{name}-forward"),
+            opts=ResourceOptions(parent=self._event_bus),
+        )
+        self._forward_role_policy = RolePolicy(
+            resource_name=f"{name}-forward-role-policy",
+            name="PutEvents",
+            role=self._forward_role.id,
+            policy=self._event_bus.arn.apply(
+                lambda arn: json.dumps(
+                    {
+                        "Version": "2012-10-17",
+                        "Statement": [
+                            {
+                                "Effect": "Allow",
+                                "Action": "events:PutEvents",
+                                "Resource": arn,
+                            }
+                        ],
+                    }
+                )
+            ),
+            opts=ResourceOptions(parent=self._forward_role),
+        )
+        self._forward_target = EventTarget(
+            resource_name=f"{name}-forward-target",
+            rule=self.event_rule.name,
+            arn=self._event_bus.arn,
+            role_arn=self._forward_role.arn,
+            opts=ResourceOptions(parent=self.event_rule),
+        )
+        self._delivering_rule = EventRule(
+            resource_name=f"{name}-exclude-rule",
+            name=f"{name}-not-excluded",
+            description=f"New objects in the {prefix} folder that aren't excluded",
+            event_bus_name=self._event_bus.name,
+            event_pattern=json.dumps(exclude_pattern),
+            tags=tagger.create_tags(f"{name}-not-excluded"),
+            opts=ResourceOptions(parent=self._event_bus),
+        )
+
+    def _build_provisioned_concurrency(self, name: str, executions: int) -> None:
+        """Point the live alias at the latest published version, and keep that
+        many environments of it initialised."""
+        self._alias = FunctionAlias(
+            resource_name=f"{name}-alias",
+            name=LIVE_ALIAS,
+            function_name=self._function.name,
+            function_version=self._function.version,
+            opts=ResourceOptions(parent=self._function),
+        )
+        self._provisioned_concurrency = ProvisionedConcurrencyConfig(
+            resource_name=f"{name}-provisioned-concurrency",
+            function_name=self._function.name,
+            qualifier=self._alias.name,
+            provisioned_concurrent_executions=executions,
+            opts=ResourceOptions(parent=self._alias),
+        )
+
+    def _build_queue(
+        self,
+        name: str,
+        source_bucket: Bucket,
+        tagger: Tagger,
+        batch_size: int,
+        batching_window_s: int,
+        timeout_s: int = FUNCTION_TIMEOUT,
+    ) -> None:
+        """Create an SQS queue for S3 or the event rule to send notifications to,
+        with a dead-letter queue, and have the function read from it in batches."""
+        self._dead_letter_queue = Queue(
+            resource_name=f"{name}-dead-letter-queue",
+            name=f"{name}-batch-dlq",
+            message_retention_seconds=14 * 24 * 60 * 60,
+            sqs_managed_sse_enabled=True,
+            tags=tagger.create_tags(f"{name}-batch-dlq"),
+            opts=ResourceOptions(parent=self),
+        )
+        self.queue = Queue(
+            resource_name=f"{name}-queue",
+            name=f"{name}-batch",
+            # AWS recommends six times the function timeout for Lambda sources
+            visibility_timeout_seconds=6 * timeout_s,
+            redrive_policy=self._dead_letter_queue.arn.apply(
+                lambda arn: json.dumps(
+                    {"deadLetterTargetArn": arn, "maxReceiveCount": MAX_RECEIVE_COUNT}
+                )
+            ),
+            sqs_managed_sse_enabled=True,
+            tags=tagger.create_tags(f"{name}-batch"),
+            opts=ResourceOptions(parent=self),
+        )
+        sender = self._sender(source_bucket)
+        self._queue_policy = QueuePolicy(
+            resource_name=f"{name}-queue-policy",
+            queue_url=self.queue.id,
+            policy=Output.all(self.queue.arn, sender["source_arn"]).apply(
+                lambda args: json.dumps(
+                    {
+                        "Version": "2012-10-17",
+                        "Statement": [
+                            {
+                                "Sid": "SendFromSourceBucket",
+                                "Effect": "Allow",
+                                "Principal": {"Service": sender["principal"]},
+                                "Action": "sqs:SendMessage",
+                                "Resource": args[0],
+                                "Condition": {"ArnEquals": {"aws:SourceArn": args[1]}},
+                            }
+                        ],
+                    }
+                )
+            ),
+            opts=ResourceOptions(parent=self.queue),
+        )
+        self._queueRolePolicy = RolePolicy(
+            resource_name=f"{name}-queue-role-policy",
+            name="sqs-access",
+            policy=self.queue.arn.apply(
+                lambda arn: json.dumps(
+                    {
+                        "Version": "2012-10-17",
+                        "Statement": [
+                            {
+                                "Sid": "ReadBatchQueue",
+                                "Effect": "Allow",
+                                "Resource": [arn],
+                                "Action": [
+                                    "sqs:ReceiveMessage",
+                                    "sqs:DeleteMessage",
+                                    "sqs:GetQueueAttributes",
+                                ],
+                            }
+                        ],
+                    }
+                )
+            ),
+            role=self._role.id,
+            opts=ResourceOptions(parent=self._role),
+        )
+        self._event_source_mapping = EventSourceMapping(
+            resource_name=f"{name}-event-source-mapping",
+            event_source_arn=self.queue.arn,
+            function_name=self.invoke_arn,
+            batch_size=batch_size,
+            maximum_batching_window_in_seconds=batching_window_s,
+            function_response_types=["ReportBatchItemFailures"],
+            opts=ResourceOptions(
+                parent=self._function, depends_on=[self._queueRolePolicy]
+            ),
+        )
+
+
+class ExportRouterFunction(ComponentResource):
+    def __init__(
+        self,
+        name: str,
+        source_bucket: Bucket,
+        tagger: Tagger,
+        routes: Dict[str, Dict[str, Union[str, bool]]],
+        multipart_threshold: int = settings.DEFAULT_MULTIPART_THRESHOLD,
+        part_size: int = settings.DEFAULT_PART_SIZE,
+        max_concurrency: int = settings.DEFAULT_MAX_CONCURRENCY,
+        layers: Optional[List[str]] = None,
+        opts: Optional[ResourceOptions] = None,
+    ) -> None:
+        """
+        Provides a single Lambda function that exports objects for many datasets,
+        looking up each object's destination in a routing table bundled with the
+        function. Adding a dataset changes the routing table and permissions rather
+        than adding resources, and every dataset shares one pool of warm containers.
+
+        Target bucket owners must grant put access to this function's role,
+        `<name>-router`, rather than the per-dataset `-move` and `-copy` roles.
+
+        No BucketNotification is created - make a combined one for the source bucket
+        with make_combined_bucket_notification.
+
+        Parameters
+        ----------
+        name : str
+            The name of the resource.
+        source_bucket : Bucket
+            The bucket to send data from.
+        tagger : Tagger
+            A tagger resource.
+        routes : Dict[str, Dict[str, Union[str, bool]]]
+            Maps each dataset prefix to a dictionary with keys target_bucket (str),
+            keep_files (bool) and optionally compress (str) and exclude (List[str]),
+            the patterns of keys to leave alone. As made by
+            PushExportDatasets.routing_table.
+        multipart_threshold : int
+            Objects larger than this many bytes are copied in parts.
+        part_size : int
+            Preferred size in bytes of each part in a multipart copy.
+        max_concurrency : int
+            How many parts of an object to copy at once.
+        layers : Optional[List[str]]
+            ARNs of Lambda layers to add to the function. By default, None.
+        opts : Optional[ResourceOptions]
+            Options for the resource. By default, None.
+        """
+        super().__init__(
+            t="data-engineering-exports:aws:ExportRouterFunction",
+            name=name,
+            props=None,
+            opts=opts,
+        )
+
+        self.queue = None
+        self.event_rule = None  # The router is always sent S3 event notifications
+        self._role = Role(
+            resource_name=f"{name}-role",
+            assume_role_policy=LAMBDA_ASSUME_ROLE_POLICY,
+            name=f"{name}-router",
+            path="/service-role/",
+            tags=tagger.create_tags(f"{name}-router"),
+            opts=ResourceOptions(parent=self),
+        )
+        self._rolePolicy = RolePolicy(
+            resource_name=f"{name}-role-policy",
+            name="s3-access",
+            policy=source_bucket.arn.apply(
+                lambda arn: json.dumps(router_role_policy(arn, routes))
+            ),
+            role=self._role.id,
+            opts=ResourceOptions(parent=self._role),
+        )
+        self._rolePolicyAttachment = RolePolicyAttachment(
+            resource_name=f"{name}-role-policy-attachment",
+            policy_arn=(
+                "arn:aws:iam::aws:policy/service-role/AWSLambdaBasicExecutionRole"
+            ),
+            role=self._role.name,
+            opts=ResourceOptions(parent=self._role),
+        )
+        self._function = Function(
+            resource_name=f"{name}-function",
+            code=handler_code(routes),
+            description=source_bucket.name.apply(
+                lambda bucket: f"Exports data from {bucket} to each dataset's target"
+            ),
+            environment=FunctionEnvironmentArgs(
+                variables={
+                    "ROUTING_TABLE": ROUTING_TABLE,
+                    "MULTIPART_THRESHOLD": str(multipart_threshold),
+                    "PART_SIZE": str(part_size),
+                    "MAX_CONCURRENCY": str(max_concurrency),
+                    "CHECKPOINT_PREFIX": CHECKPOINT_PREFIX,
+                }
+            ),
+            handler="export.export.handler",
+            name=f"{name}-router",
+            role=self._role.arn,
+            runtime="python3.10",
+            layers=layers,
+            tags=tagger.create_tags(f"{name}-router"),
+            timeout=FUNCTION_TIMEOUT,
+            opts=ResourceOptions(parent=self),
+        )
+        self.invoke_arn = self._function.arn
+        self._invoke_config, self._resumeRolePolicy = allow_resume(
+            name, self._function, self._role
+        )
+        self._permission = Permission(
+            resource_name=f"{name}-permission",
+            action="lambda:InvokeFunction",
+            function=self._function.arn,
+            principal="s3.amazonaws.com",
+            source_arn=source_bucket.arn,
+            opts=ResourceOptions(parent=self._function),
+        )
+        self.register_outputs({})
+
+
+def router_role_policy(
+    source_bucket_arn: str, routes: Dict[str, Dict[str, Union[str, bool]]]
+) -> Dict:
+    """Create the policy for a router function's role.
+
+    Statements are grouped by permission rather than by dataset, so the policy grows
+    by one ARN per dataset and target bucket, keeping it well within IAM's size limit.
+
+    Parameters
+    ----------
+    source_bucket_arn : str
+        ARN of the bucket the router sends data from.
+    routes : Dict[str, Dict[str, Union[str, bool]]]
+        The router's routing table.
+
+    Returns
+    -------
+    Dict
+        AWS IAM policy document.
+    """
+
+    def prefix_arns(keep_files: bool):
+        return [
+            f"{source_bucket_arn}/{prefix}/*"
+            for prefix, route in sorted(routes.items())
+            if route["keep_files"] == keep_files
+        ]
+
+    statements = []
+    for sid, keep_files, actions in [
+        ("GetDeleteSourceBucket", False, ["s3:GetObject*", "s3:DeleteObject*"]),
+        ("GetSourceBucket", True, ["s3:GetObject*"]),
+    ]:
+        resources = prefix_arns(keep_files)
+        if resources:
+            statements.append(
+                {
+                    "Sid": sid,
+                    "Effect": "Allow",
+                    "Resource": resources,
+                    "Action": actions,
+                }
+            )
+    targets = sorted({route["target_bucket"] for route in routes.values()})
+    statements += [
+        {
+            "Sid": "PutDestinationBuckets",
+            "Effect": "Allow",
+            "Resource": [f"arn:aws:s3:::{bucket}/*" for bucket in targets],
+            # Copies that fail their checksum check are deleted
+            "Action": ["s3:PutObject*", "s3:AbortMultipartUpload", "s3:DeleteObject"],
+        },
+        {
+            "Sid": "MultipartCheckpoints",
+            "Effect": "Allow",
+            "Resource": [f"{source_bucket_arn}/{CHECKPOINT_PREFIX}/*"],
+            "Action": ["s3:GetObject", "s3:PutObject", "s3:DeleteObject"],
+        },
+    ]
+    return {"Version": "2012-10-17", "Statement": statements}
@@ -0,0 +1,203 @@
+"""Export a batch of S3 event notifications delivered through SQS.
+
+Every object in the batch is copied concurrently, then the copied objects are
+removed from the export bucket with bulk DeleteObjects requests rather than one
+DeleteObject per file. Datasets with BUNDLE set instead have their small objects
+written to the target as a few bundles, and objects matching a dataset's exclude
+patterns are left alone. Messages whose objects failed to copy,
+bundle or delete are reported back to Lambda as batch item failures, so only they
+are retried. Each copy, bundle and failure is recorded in the dataset's metrics.
+"""
+import json
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from time import monotonic
+from typing import Dict, Iterator, List, Optional, Set, Tuple
+from urllib.parse import unquote_plus
+
+from . import metrics
+from .bundle import export_bundles
+from .events import records_of
+from .routing import Route, get_route, is_excluded
+from .tracing import subsegment
+from .transfer import copy_object, max_concurrency
+
+# The most keys a single DeleteObjects request accepts
+DELETE_BATCH_SIZE = 1000
+
+
+def _s3_event_records(records: List[Dict]) -> Iterator[Tuple[str, Dict]]:
+    """Each S3 event record in a batch of SQS records, with its message ID. Each
+    message is either an S3 event notification or an EventBridge event.
+
+    S3 test events, sent when a notification is first set up, contain no objects and
+    are skipped.
+    """
+    for record in records:
+        for s3_record in records_of(json.loads(record["body"])):
+            yield record["messageId"], s3_record
+
+
+def _s3_records(records: List[Dict]) -> Iterator[Tuple[str, Dict]]:
+    for message_id, s3_record in _s3_event_records(records):
+        yield message_id, s3_record["s3"]
+
+
+def _location(s3: Dict) -> Tuple[str, str]:
+    return s3["bucket"]["name"], unquote_plus(s3["object"]["key"])
+
+
+def parse_messages(records: List[Dict]) -> Dict[Tuple[str, str], Set[str]]:
+    """Map each (bucket, key) in a batch of SQS records to the IDs of the messages
+    that mentioned it. The same object can appear in more than one message if it was
+    overwritten, but only needs copying once.
+    """
+    objects = defaultdict(set)
+    for message_id, s3 in _s3_records(records):
+        objects[_location(s3)].add(message_id)
+    return objects
+
+
+def parse_sizes(records: List[Dict]) -> Dict[Tuple[str, str], int]:
+    """Map each (bucket, key) in a batch of SQS records to the object's size, as it
+    was when the notification was sent."""
+    return {
+        _location(s3): s3["object"].get("size", 0) for _, s3 in _s3_records(records)
+    }
+
+
+def parse_event_times(records: List[Dict]) -> Dict[Tuple[str, str], str]:
+    """Map each (bucket, key) in a batch of SQS records to the time of the earliest
+    event for it, so lag is measured from when the object was first written."""
+    times = {}
+    for _, s3_record in _s3_event_records(records):
+        location = _location(s3_record["s3"])
+        event_time = s3_record.get("eventTime")
+        if event_time and (location not in times or event_time < times[location]):
+            times[location] = event_time
+    return times
+
+
+def delete_objects(client, bucket: str, keys: List[str]) -> List[str]:
+    """Delete keys from a bucket in as few requests as possible.
+
+    Returns
+    -------
+    List[str]
+        The keys S3 reported it could not delete.
+    """
+    failed = []
+    for start in range(0, len(keys), DELETE_BATCH_SIZE):
+        end = start + DELETE_BATCH_SIZE
+        chunk = keys[start:end]
+        with subsegment("DELETE", chunk[0]) as segment:
+            segment.annotate("objects", len(chunk))
+            response = client.delete_objects(
+                Bucket=bucket,
+                Delete={"Objects": [{"Key": key} for key in chunk], "Quiet": True},
+            )
+        for error in response.get("Errors", []):
+            print(f"Could not delete {error['Key']}: {error['Message']}")
+            failed.append(error["Key"])
+    return failed
+
+
+def _bundle_route(key: str) -> Optional[Route]:
+    try:
+        route = get_route(key)
+    except Exception:
+        # Left for copy_object to report
+        return None
+    return route if route.bundle and not route.excludes(key) else None
+
+
+def bundle_batch(client, records: List[Dict]) -> Dict[Tuple[str, str], Optional[bool]]:
+    """Bundle the objects in a batch whose datasets bundle files.
+
+    Returns
+    -------
+    Dict[Tuple[str, str], Optional[bool]]
+        Whether to delete each object that was bundled, or None if its bundle
+        failed. Objects too large to bundle are left out, to be copied.
+    """
+    groups = defaultdict(dict)
+    for (bucket, key), size in parse_sizes(records).items():
+        route = _bundle_route(key)
+        if route and size <= route.bundle_max_mb * 1024**2:
+            groups[(bucket, route)][key] = size
+
+    results = {}
+    for (bucket, route), sizes in groups.items():
+        started = monotonic()
+        for keys, written in export_bundles(client, bucket, sizes, route):
+            if written:
+                size = sum(sizes[key] for key in keys)
+                metrics.record_copy(keys[0], size, monotonic() - started)
+            delete = not route.keep_files if written else None
+            results.update(((bucket, key), delete) for key in keys)
+            started = monotonic()
+    return results
+
+
+def export_batch(client, records: List[Dict], time_remaining=None) -> List[str]:
+    """Copy or bundle every object in a batch of SQS records, then bulk-delete the
+    sources of datasets that don't keep files.
+
+    Parameters
+    ----------
+    client
+        Boto3 S3 client, with a connection pool of at least MAX_CONCURRENCY.
+    records : List[Dict]
+        The Records of an SQS event, each with an S3 event notification as its body.
+    time_remaining : Callable[[], int], optional
+        Returns the milliseconds left in the invocation.
+
+    Returns
+    -------
+    List[str]
+        IDs of messages that should be retried.
+    """
+    objects = {
+        location: message_ids
+        for location, message_ids in parse_messages(records).items()
+        if not is_excluded(location[1])
+    }
+
+    def copy(location: Tuple[str, str]) -> Optional[bool]:
+        """Copy an object, returning whether to delete it, or None if it failed."""
+        started = monotonic()
+        try:
+            route = get_route(location[1])
+            size = copy_object(
+                client,
+                *location,
+                route.destination_bucket,
+                time_remaining,
+                route.compress,
+            )
+            metrics.record_copy(location[1], size, monotonic() - started)
+            return not route.keep_files
+        except Exception as e:
+            print(f"Could not copy {location[1]} from {location[0]}: {e!r}")
+            return None
+
+    results = bundle_batch(client, records)
+    to_copy = [location for location in objects if location not in results]
+    with ThreadPoolExecutor(max_workers=max_concurrency()) as pool:
+        results.update(zip(to_copy, pool.map(copy, to_copy)))
+
+    failed = {location for location, result in results.items() if result is None}
+    to_delete = defaultdict(list)
+    for (bucket, key), delete in results.items():
+        if delete:
+            to_delete[bucket].append(key)
+    for bucket, keys in to_delete.items():
+        failed.update((bucket, key) for key in delete_objects(client, bucket, keys))
+
+    event_times = parse_event_times(records)
+    for location in results:
+        if location in failed:
+            metrics.record_failure(location[1])
+        else:
+            metrics.record_lag(location[1], event_times.get(location))
+    return sorted({message for location in failed for message in objects[location]})
@@ -0,0 +1,207 @@
+"""Send a batch of small objects to the target bucket as a few large bundles.
+
+Datasets that write huge numbers of tiny files pay for a CopyObject and a
+DeleteObject per file, which adds up and brings them close to S3's per-prefix
+request limits. With bundling, each batch read from SQS is split into bundles of up
+to BUNDLE_MAX_MB, and each bundle is written to the target as one object, either a
+tar archive or the files' contents joined as newline-delimited JSON. The sources are
+then deleted with bulk DeleteObjects requests. So the batch size and batching window
+set how many files and how long to wait for each bundle, and BUNDLE_MAX_MB how large
+it can grow. Files larger than BUNDLE_MAX_MB are copied on their own as usual.
+
+Each bundle is written next to an index, `<bundle name>.index.json`, listing every
+file in it with its size, ETag and where its contents start in the bundle. The index
+is written after the bundle, so a bundle with an index is complete. Bundle names are
+made from a hash of their contents' keys and ETags, so a batch that is retried
+overwrites its own bundles rather than delivering the files twice.
+
+A bundle is built in memory, so BUNDLE_MAX_MB must leave room in the function's
+memory for the bundle and, if compressed, its compressed copy.
+"""
+import hashlib
+import io
+import json
+import tarfile
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from typing import Dict, Iterator, List, NamedTuple, Optional, Tuple
+
+from .compress import CODECS
+from .routing import Route
+from .transfer import max_concurrency
+
+TAR = "tar"
+NDJSON = "ndjson"
+SUFFIXES = {TAR: ".tar", NDJSON: ".ndjson"}
+CONTENT_TYPES = {TAR: "application/x-tar", NDJSON: "application/x-ndjson"}
+INDEX_SUFFIX = ".index.json"
+BUNDLE_NAME = "bundle-"
+
+
+class Member(NamedTuple):
+    """A file read from the export bucket to go into a bundle."""
+
+    key: str
+    body: bytes
+    etag: str
+    last_modified: Optional[datetime]
+
+
+def plan_bundles(sizes: Dict[str, int], max_bytes: int) -> List[List[str]]:
+    """Split keys, in order, into bundles whose sizes add up to at most max_bytes.
+
+    Parameters
+    ----------
+    sizes : Dict[str, int]
+        The size of each key to bundle. Each must be at most max_bytes.
+    max_bytes : int
+        Largest total size of a bundle's files.
+    """
+    bundles, total = [], 0
+    for key in sorted(sizes):
+        if not bundles or total + sizes[key] > max_bytes:
+            bundles.append([])
+            total = 0
+        bundles[-1].append(key)
+        total += sizes[key]
+    return bundles
+
+
+def _read(client, bucket: str, key: str) -> Member:
+    response = client.get_object(Bucket=bucket, Key=key)
+    return Member(
+        key, response["Body"].read(), response["ETag"], response.get("LastModified")
+    )
+
+
+def write_tar(members: List[Member]) -> Tuple[bytes, List[Dict]]:
+    """Archive the members as a tar file, named by their keys.
+
+    Returns
+    -------
+    Tuple[bytes, List[Dict]]
+        The archive, and for each member, the offset and length of its contents.
+    """
+    buffer = io.BytesIO()
+    entries = []
+    with tarfile.open(fileobj=buffer, mode="w", format=tarfile.PAX_FORMAT) as tar:
+        for member in members:
+            info = tarfile.TarInfo(member.key)
+            info.size = len(member.body)
+            if member.last_modified:
+                info.mtime = member.last_modified.timestamp()
+            tar.addfile(info, io.BytesIO(member.body))
+            # Contents are padded to a whole number of 512 byte blocks
+            padded = -(-info.size // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+            entries.append({"offset": buffer.tell() - padded, "length": info.size})
+    return buffer.getvalue(), entries
+
+
+def write_ndjson(members: List[Member]) -> Tuple[bytes, List[Dict]]:
+    """Join the members' lines, ending any member without a final newline.
+
+    Returns
+    -------
+    Tuple[bytes, List[Dict]]
+        The joined lines, and for each member, the offset and length of its lines.
+    """
+    parts, entries, offset = [], [], 0
+    for member in members:
+        body = member.body
+        if body and not body.endswith(b"\n"):
+            body += b"\n"
+        parts.append(body)
+        entries.append(
+            {"offset": offset, "length": len(body), "lines": body.count(b"\n")}
+        )
+        offset += len(body)
+    return b"".join(parts), entries
+
+
+WRITERS = {TAR: write_tar, NDJSON: write_ndjson}
+
+
+def bundle_name(members: List[Member]) -> str:
+    """`<dataset>/bundle-<newest file's time>-<hash of keys and ETags>`."""
+    digest = hashlib.sha256()
+    for member in members:
+        digest.update(f"{member.key}\n{member.etag}\n".encode())
+    times = [m.last_modified for m in members if m.last_modified]
+    newest = max(times) if times else datetime.now(timezone.utc)
+    dataset = members[0].key.split("/", 1)[0]
+    return f"{dataset}/{BUNDLE_NAME}{newest:%Y%m%dT%H%M%SZ}-{digest.hexdigest()[:16]}"
+
+
+def write_bundle(client, members: List[Member], route: Route) -> str:
+    """Write members to the route's destination bucket as one bundle, then its
+    index. Returns the bundle's key."""
+    body, entries = WRITERS[route.bundle](members)
+    name = bundle_name(members)
+    key = name + SUFFIXES[route.bundle]
+    extra_args = {"ContentType": CONTENT_TYPES[route.bundle]}
+    if route.compress:
+        codec = CODECS[route.compress]
+        compressor = codec.compressor()
+        body = compressor.compress(body) + compressor.flush()
+        key += codec.suffix
+        extra_args["ContentEncoding"] = codec.content_encoding
+    client.put_object(
+        Bucket=route.destination_bucket,
+        Key=key,
+        Body=body,
+        ServerSideEncryption="AES256",
+        ACL="bucket-owner-full-control",
+        **extra_args,
+    )
+    index = {
+        "bundle": key,
+        "format": route.bundle,
+        "compress": route.compress,
+        "objects": [
+            dict(key=member.key, size=len(member.body), etag=member.etag, **entry)
+            for member, entry in zip(members, entries)
+        ],
+    }
+    client.put_object(
+        Bucket=route.destination_bucket,
+        Key=name + INDEX_SUFFIX,
+        Body=json.dumps(index).encode(),
+        ServerSideEncryption="AES256",
+        ACL="bucket-owner-full-control",
+        ContentType="application/json",
+    )
+    print(f"Bundled {len(members)} files into {key}")
+    return key
+
+
+def export_bundles(
+    client, bucket: str, sizes: Dict[str, int], route: Route
+) -> Iterator[Tuple[List[str], bool]]:
+    """Bundle objects from the export bucket into the route's destination bucket.
+
+    Parameters
+    ----------
+    client
+        Boto3 S3 client.
+    bucket : str
+        Name of the export bucket.
+    sizes : Dict[str, int]
+        Size of each key to bundle, from its event notification.
+    route : Route
+        Where to send the keys, with bundle set.
+
+    Yields
+    ------
+    Tuple[List[str], bool]
+        The keys of each bundle, and whether it was written.
+    """
+    with ThreadPoolExecutor(max_workers=max_concurrency()) as pool:
+        for keys in plan_bundles(sizes, route.bundle_max_mb * 1024**2):
+            try:
+                members = list(pool.map(lambda key: _read(client, bucket, key), keys))
+                write_bundle(client, members, route)
+            except Exception as e:
+                print(f"Could not bundle {len(keys)} files from {bucket}: {e!r}")
+                yield keys, False
+            else:
+                yield keys, True
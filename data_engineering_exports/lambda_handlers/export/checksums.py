@@ -0,0 +1,207 @@
+"""Check a copy matches its source using the checksums S3 keeps, without reading
+either object back.
+
+Copies ask S3 to calculate an additional checksum of the data it writes. If the
+source already has a checksum, the copy uses the same algorithm, so the two can be
+compared directly. Otherwise CHECKSUM_ALGORITHM (CRC32C by default) is used, and a
+single-part copy is compared with its source's MD5 ETag instead.
+
+An object uploaded in parts has a checksum of its parts' checksums, ending in "-"
+and the number of parts. When a source like that is copied in parts, the parts are
+cut at the same byte ranges as the source's, so each part's checksum can be checked
+as it is copied, and the final checksums match.
+
+A copy that doesn't match is deleted from the destination, so consumers never read
+it, and raises ChecksumMismatchError, so the source isn't deleted and the copy is
+retried. If the delete fails, that's logged and ChecksumMismatchError is still
+raised. Copies that can't be checked either way are logged.
+"""
+import os
+from typing import Dict, Optional, Tuple
+
+# Algorithms S3 can keep for an object, in the order they're looked for
+ALGORITHMS = ("CRC64NVME", "CRC32C", "CRC32", "SHA256", "SHA1")
+DEFAULT_ALGORITHM = "CRC32C"
+# The most parts get_object_attributes lists at once
+PARTS_PAGE_SIZE = 1000
+
+
+class ChecksumMismatchError(Exception):
+    pass
+
+
+def field(algorithm: str) -> str:
+    """The name S3 gives the algorithm's checksum in responses and requests."""
+    return f"Checksum{algorithm}"
+
+
+def is_composite(value: str) -> bool:
+    """Whether a checksum or ETag is of an object uploaded in parts."""
+    return "-" in value
+
+
+def choose_algorithm(head: Dict) -> Tuple[str, Optional[str]]:
+    """The algorithm to copy an object with, and the source's checksum with it.
+
+    Parameters
+    ----------
+    head : Dict
+        The head_object response for the source, requested with ChecksumMode
+        ENABLED.
+    """
+    for algorithm in ALGORITHMS:
+        if head.get(field(algorithm)):
+            return algorithm, head[field(algorithm)]
+    return os.getenv("CHECKSUM_ALGORITHM", DEFAULT_ALGORITHM).upper(), None
+
+
+def source_parts(
+    client, bucket: str, key: str, head: Dict, algorithm: str
+) -> Optional[Tuple[int, Dict[int, str]]]:
+    """The part size and part checksums of a source uploaded in parts.
+
+    Returns
+    -------
+    Optional[Tuple[int, Dict[int, str]]]
+        The size of every part but the last, and the checksum of each part by part
+        number. None if the source wasn't uploaded in parts with checksums, or its
+        parts aren't all the same size, so can't be copied at the same ranges.
+    """
+    if not is_composite(head.get(field(algorithm)) or ""):
+        return None
+    sizes, checksums, marker = {}, {}, 0
+    while True:
+        response = client.get_object_attributes(
+            Bucket=bucket,
+            Key=key,
+            ObjectAttributes=["ObjectParts"],
+            MaxParts=PARTS_PAGE_SIZE,
+            PartNumberMarker=marker,
+        )
+        parts = response.get("ObjectParts", {})
+        for part in parts.get("Parts", []):
+            sizes[part["PartNumber"]] = part["Size"]
+            checksums[part["PartNumber"]] = part.get(field(algorithm))
+        if not parts.get("IsTruncated"):
+            break
+        marker = parts["NextPartNumberMarker"]
+
+    numbers = sorted(sizes)
+    if not numbers or None in checksums.values():
+        return None
+    part_size = sizes[numbers[0]]
+    if numbers != list(range(1, len(numbers) + 1)) or any(
+        sizes[n] != part_size for n in numbers[:-1]
+    ):
+        return None
+    return part_size, checksums
+
+
+def check_part(key: str, number: int, expected: Optional[str], actual: Optional[str]):
+    """Raise ChecksumMismatchError if a copied part's checksum isn't the source's."""
+    if expected and actual and expected != actual:
+        raise ChecksumMismatchError(
+            f"Part {number} of {key} was copied with checksum {actual}, but the "
+            f"source part's is {expected}"
+        )
+
+
+def _comparable(expected: Optional[str], actual: Optional[str], aligned: bool):
+    """Checksums of parts only match if the parts were cut at the same places."""
+    if not (expected and actual) or is_composite(expected) != is_composite(actual):
+        return False
+    return aligned or not is_composite(actual)
+
+
+def verify_copy(
+    key: str, head: Dict, algorithm: str, result: Dict, aligned: bool = False
+) -> bool:
+    """Compare a copy with its source using only their checksums and ETags.
+
+    Parameters
+    ----------
+    key : str
+        Key of the object, for messages.
+    head : Dict
+        The head_object response for the source, requested with ChecksumMode
+        ENABLED.
+    algorithm : str
+        The algorithm the copy was made with.
+    result : Dict
+        The copy's CopyObjectResult, or the complete_multipart_upload response.
+    aligned : bool
+        Whether a copy in parts used the same part ranges as its source.
+
+    Returns
+    -------
+    bool
+        True if the copy was checked, or False if there was nothing to compare.
+
+    Raises
+    ------
+    ChecksumMismatchError
+        If the copy's checksum or ETag doesn't match the source's.
+    """
+    expected = head.get(field(algorithm))
+    actual = result.get(field(algorithm))
+    if not _comparable(expected, actual, aligned):
+        # Without comparable checksums, fall back to the MD5 ETags of single parts
+        expected, actual = head["ETag"], result.get("ETag")
+        if not actual or is_composite(expected) or is_composite(actual):
+            print(f"Could not verify the copy of {key}: no comparable checksums")
+            return False
+    if expected != actual:
+        raise ChecksumMismatchError(
+            f"The copy of {key} doesn't match its source: expected {expected}, "
+            f"got {actual}. The source has been kept."
+        )
+    return True
+
+
+def verify_or_delete(
+    client,
+    bucket: str,
+    key: str,
+    head: Dict,
+    algorithm: str,
+    result: Dict,
+    aligned: bool = False,
+) -> bool:
+    """Check a finished copy with verify_copy, and if it doesn't match its source,
+    delete it before raising so the bad object is never left for consumers to read.
+
+    Parameters
+    ----------
+    client
+        Boto3 S3 client.
+    bucket : str
+        Bucket the copy was written to.
+    key : str
+        Key the copy was written to.
+    head, algorithm, result, aligned
+        As for verify_copy.
+
+    Returns
+    -------
+    bool
+        True if the copy was checked, or False if there was nothing to compare.
+
+    Raises
+    ------
+    ChecksumMismatchError
+        If the copy didn't match, once it has been deleted, or the delete has
+        failed.
+    """
+    try:
+        return verify_copy(key, head, algorithm, result, aligned)
+    except ChecksumMismatchError:
+        try:
+            client.delete_object(Bucket=bucket, Key=key)
+        except Exception as error:
+            # The mismatch matters more than the failed clean-up, so raise that
+            print(
+                f"Couldn't delete the mismatched copy of {key} from {bucket}: {error}"
+            )
+        else:
+            print(f"Deleted the mismatched copy of {key} from {bucket}")
+        raise
@@ -0,0 +1,396 @@
+"""Compress an object on its way to the destination bucket.
+
+The source is read as a stream and compressed a chunk at a time, and the output is
+uploaded in parts as soon as each part fills, so the whole object is never held in
+memory. At most UPLOAD_CONCURRENCY parts are uploaded at once, which bounds memory
+use at about (UPLOAD_CONCURRENCY + 1) * COMPRESSED_PART_SIZE. Output that fits in a
+single part is sent with one PutObject instead.
+
+Each part is a complete gzip member or zstd frame, which decompress one after
+another as a single stream. So, as for multipart copies, progress is kept in a
+checkpoint in the source bucket: the upload ID, the parts uploaded so far and how
+much of the source they cover. If the invocation runs low on time, the checkpoint
+is saved and CopyIncompleteError raised, and the next invocation carries on
+compressing from that point. Before it's uploaded, each part is decompressed again
+and compared with the source bytes it was made from, by length and CRC32.
+
+The destination key gets the codec's suffix, like `.gz`, and its Content-Encoding
+is set. gzip uses the standard library. zstd needs the zstandard package, which
+isn't in the Lambda runtime, so the function must be deployed with a layer that
+provides it.
+"""
+import gzip
+import io
+import zlib
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from itertools import chain
+from typing import Any, BinaryIO, Callable, Dict, Iterator, NamedTuple, Optional
+
+from botocore.exceptions import ClientError
+
+from .checksums import ChecksumMismatchError
+from .multipart import (
+    CHECKPOINT_INTERVAL,
+    SAFETY_MARGIN_MS,
+    CopyIncompleteError,
+    matching_checkpoint,
+    save_checkpoint,
+)
+
+READ_SIZE = 1024**2
+COMPRESSED_PART_SIZE = 8 * 1024**2
+UPLOAD_CONCURRENCY = 4
+GZIP_LEVEL = 6
+ZSTD_LEVEL = 3
+# Objects with these suffixes are already compressed, so are copied as they are
+COMPRESSED_SUFFIXES = (".gz", ".zst", ".zip", ".bz2", ".xz", ".parquet")
+
+
+class CompressionUnavailableError(Exception):
+    pass
+
+
+class Codec(NamedTuple):
+    suffix: str
+    content_encoding: str
+    compressor: Callable
+    reader: Callable[[BinaryIO], BinaryIO]
+
+
+class Part(NamedTuple):
+    """A compressed part, and the source offset just after the bytes it holds."""
+
+    body: bytes
+    end: int
+
+
+def _gzip_compressor():
+    # A window size of 31 writes a gzip header and trailer rather than raw zlib
+    return zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+
+
+def _gzip_reader(fileobj: BinaryIO) -> BinaryIO:
+    return gzip.GzipFile(fileobj=fileobj)
+
+
+def _zstandard():
+    try:
+        import zstandard
+    except ImportError:
+        raise CompressionUnavailableError(
+            "zstd compression needs the zstandard package - deploy the function "
+            "with a layer that provides it"
+        )
+    return zstandard
+
+
+def _zstd_compressor():
+    return _zstandard().ZstdCompressor(level=ZSTD_LEVEL).compressobj()
+
+
+def _zstd_reader(fileobj: BinaryIO) -> BinaryIO:
+    return _zstandard().ZstdDecompressor().stream_reader(fileobj)
+
+
+CODECS = {
+    "gzip": Codec(".gz", "gzip", _gzip_compressor, _gzip_reader),
+    "zstd": Codec(".zst", "zstd", _zstd_compressor, _zstd_reader),
+}
+
+
+def compressed_key(key: str, compress: str) -> str:
+    return key + CODECS[compress].suffix
+
+
+def is_compressed(key: str) -> bool:
+    return key.lower().endswith(COMPRESSED_SUFFIXES)
+
+
+def compressed_chunks(body, compressor, read_size: int = READ_SIZE) -> Iterator[bytes]:
+    """Compress a file-like body a chunk at a time."""
+    for chunk in iter(lambda: body.read(read_size), b""):
+        output = compressor.compress(chunk)
+        if output:
+            yield output
+    yield compressor.flush()
+
+
+def check_part(codec: Codec, part: bytes, length: int, checksum: int) -> None:
+    """Decompress a part a chunk at a time, and raise ChecksumMismatchError unless
+    it gives back length bytes with the given CRC32."""
+    reader = codec.reader(io.BytesIO(part))
+    actual_length, actual_checksum = 0, 0
+    for chunk in iter(lambda: reader.read(READ_SIZE), b""):
+        actual_length += len(chunk)
+        actual_checksum = zlib.crc32(chunk, actual_checksum)
+    if (actual_length, actual_checksum) != (length, checksum):
+        raise ChecksumMismatchError(
+            f"A compressed part decompressed to {actual_length} bytes with CRC32 "
+            f"{actual_checksum}, but was made from {length} bytes with CRC32 "
+            f"{checksum}"
+        )
+
+
+def compressed_parts(
+    body,
+    codec: Codec,
+    start: int,
+    part_size: int,
+    out_of_time: Callable[[], bool],
+) -> Iterator[Part]:
+    """Compress a file-like body into checked parts of at least part_size bytes,
+    except the last, each a complete gzip member or zstd frame.
+
+    Parameters
+    ----------
+    body
+        The source, read from offset start.
+    codec : Codec
+        How to compress and decompress the parts.
+    start : int
+        Offset in the source that body starts at.
+    part_size : int
+        The smallest a part can be, unless it's the last.
+    out_of_time : Callable[[], bool]
+        Checked before each read. Once it returns True, the part being compressed
+        is dropped and no more parts are made.
+    """
+    offset = start
+    while True:
+        compressor, output = codec.compressor(), bytearray()
+        length, checksum = 0, 0
+        while len(output) < part_size:
+            if out_of_time():
+                return
+            chunk = body.read(READ_SIZE)
+            if not chunk:
+                break
+            output += compressor.compress(chunk)
+            length += len(chunk)
+            checksum = zlib.crc32(chunk, checksum)
+        # An empty object still needs a part, to write an empty member
+        if length == 0 and offset > 0:
+            return
+        part = bytes(output + compressor.flush())
+        del output
+        check_part(codec, part, length, checksum)
+        offset += length
+        yield Part(part, offset)
+        if len(part) < part_size:
+            return
+
+
+class _CompressedUpload(NamedTuple):
+    """A multipart upload of compressed parts, recorded in a checkpoint."""
+
+    client: Any
+    source_bucket: str
+    checkpoint_key: str
+    upload: Dict
+    size: int
+
+    def send(self, checkpoint: Dict, parts: Iterator[Part]) -> Dict[str, int]:
+        """Upload parts after those already in the checkpoint, then complete the
+        upload if they reach the end of the source."""
+        try:
+            self._upload_parts(checkpoint, parts)
+        except Exception:
+            save_checkpoint(
+                self.client, self.source_bucket, self.checkpoint_key, checkpoint
+            )
+            raise
+        if checkpoint["offset"] < self.size:
+            save_checkpoint(
+                self.client, self.source_bucket, self.checkpoint_key, checkpoint
+            )
+            raise CopyIncompleteError(
+                f"Compressed {checkpoint['offset']} of {self.size} bytes of "
+                f"{self.upload['Key']} before running out of time; the rest will "
+                "resume on retry"
+            )
+        self.client.complete_multipart_upload(
+            MultipartUpload={
+                "Parts": [
+                    {"PartNumber": int(number), "ETag": etag}
+                    for number, etag in sorted(
+                        checkpoint["parts"].items(), key=lambda p: int(p[0])
+                    )
+                ]
+            },
+            **self.upload,
+        )
+        self.client.delete_object(Bucket=self.source_bucket, Key=self.checkpoint_key)
+        return {"size": self.size, "compressed_size": checkpoint["compressed_size"]}
+
+    def _upload_parts(self, checkpoint: Dict, parts: Iterator[Part]) -> None:
+        """Upload parts with at most UPLOAD_CONCURRENCY in flight, reading the next
+        part only when there's room for it. The checkpoint only moves past a part
+        once every part before it has been uploaded too."""
+        first = len(checkpoint["parts"]) + 1
+        finished, in_flight = {}, set()
+
+        def upload_part(number: int, part: Part):
+            response = self.client.upload_part(
+                PartNumber=number, Body=part.body, **self.upload
+            )
+            return number, response["ETag"], part
+
+        def record(done) -> None:
+            for future in done:
+                number, etag, part = future.result()
+                finished[number] = (etag, part)
+            number = len(checkpoint["parts"]) + 1
+            while number in finished:
+                etag, part = finished.pop(number)
+                checkpoint["parts"][str(number)] = etag
+                checkpoint["offset"] = part.end
+                checkpoint["compressed_size"] += len(part.body)
+                if number % CHECKPOINT_INTERVAL == 0:
+                    save_checkpoint(
+                        self.client, self.source_bucket, self.checkpoint_key, checkpoint
+                    )
+                number += 1
+
+        with ThreadPoolExecutor(max_workers=UPLOAD_CONCURRENCY) as pool:
+            for number, part in enumerate(parts, start=first):
+                if len(in_flight) >= UPLOAD_CONCURRENCY:
+                    done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                    record(done)
+                in_flight.add(pool.submit(upload_part, number, part))
+            record(wait(in_flight).done)
+
+
+def _out_of_time(time_remaining: Optional[Callable[[], int]]) -> Callable[[], bool]:
+    return lambda: time_remaining is not None and time_remaining() < SAFETY_MARGIN_MS
+
+
+def _upload_args(head: Dict, codec: Codec) -> Dict:
+    """Arguments for writing the compressed object, keeping the source's headers."""
+    extra_args = {
+        "ServerSideEncryption": "AES256",
+        "ACL": "bucket-owner-full-control",
+        "ContentEncoding": codec.content_encoding,
+    }
+    for arg in ("ContentType", "Metadata"):
+        if head.get(arg):
+            extra_args[arg] = head[arg]
+    return extra_args
+
+
+def _read_from(client, bucket: str, key: str, head: Dict, offset: int):
+    """Stream the version of the object checked with head_object, from offset."""
+    if offset and offset >= head["ContentLength"]:
+        return io.BytesIO()
+    kwargs = {"Range": f"bytes={offset}-"} if offset else {}
+    return client.get_object(Bucket=bucket, Key=key, IfMatch=head["ETag"], **kwargs)[
+        "Body"
+    ]
+
+
+def compress_object(
+    client,
+    source_bucket: str,
+    source_key: str,
+    destination_bucket: str,
+    head: Dict,
+    compress: str,
+    checkpoint_key: str,
+    time_remaining: Optional[Callable[[], int]] = None,
+) -> Dict[str, int]:
+    """Stream an object through a compressor into the destination bucket, resuming
+    from a checkpoint if one matches.
+
+    Parameters
+    ----------
+    client
+        Boto3 S3 client.
+    source_bucket, source_key : str
+        Location of the object to compress. The checkpoint is also kept in
+        source_bucket.
+    destination_bucket : str
+        Bucket to write the compressed object to, under the same key plus the
+        codec's suffix.
+    head : Dict
+        The head_object response for the source object.
+    compress : str
+        Either "gzip" or "zstd".
+    checkpoint_key : str
+        Key in source_bucket to record progress under.
+    time_remaining : Callable[[], int], optional
+        Returns the milliseconds left in the invocation. If None, never stop early.
+
+    Returns
+    -------
+    Dict[str, int]
+        The size of the object before and after compression.
+
+    Raises
+    ------
+    CopyIncompleteError
+        If the invocation ran low on time before the whole object was compressed.
+        The checkpoint has been saved, so retrying the same object resumes.
+    ChecksumMismatchError
+        If a compressed part doesn't decompress to the source bytes it was made
+        from. The part isn't uploaded.
+    """
+    codec = CODECS[compress]
+    destination_key = compressed_key(source_key, compress)
+    size = head["ContentLength"]
+    out_of_time = _out_of_time(time_remaining)
+
+    def parts_from(offset: int) -> Iterator[Part]:
+        body = _read_from(client, source_bucket, source_key, head, offset)
+        return compressed_parts(body, codec, offset, COMPRESSED_PART_SIZE, out_of_time)
+
+    def send(checkpoint: Dict, parts: Iterator[Part]) -> Dict[str, int]:
+        upload = {
+            "Bucket": destination_bucket,
+            "Key": destination_key,
+            "UploadId": checkpoint["upload_id"],
+        }
+        return _CompressedUpload(
+            client, source_bucket, checkpoint_key, upload, size
+        ).send(checkpoint, parts)
+
+    checkpoint = matching_checkpoint(
+        client, source_bucket, checkpoint_key, destination_bucket, destination_key, head
+    )
+    if checkpoint:
+        print(f"Resuming {source_key}: {checkpoint['offset']} bytes compressed")
+        try:
+            return send(checkpoint, parts_from(checkpoint["offset"]))
+        except ClientError as e:
+            # S3 aborts uploads left unfinished for too long, as can lifecycle rules
+            if e.response["Error"]["Code"] != "NoSuchUpload":
+                raise
+            print(f"The upload of {destination_key} no longer exists - starting again")
+            client.delete_object(Bucket=source_bucket, Key=checkpoint_key)
+
+    extra_args = _upload_args(head, codec)
+    parts = parts_from(0)
+    first = next(parts, None)
+    if first is None:
+        raise CopyIncompleteError(
+            f"Ran out of time before compressing the first part of {source_key}"
+        )
+    if first.end == size:
+        client.put_object(
+            Bucket=destination_bucket,
+            Key=destination_key,
+            Body=first.body,
+            **extra_args,
+        )
+        return {"size": size, "compressed_size": len(first.body)}
+
+    checkpoint = {
+        "upload_id": client.create_multipart_upload(
+            Bucket=destination_bucket, Key=destination_key, **extra_args
+        )["UploadId"],
+        "source_etag": head["ETag"],
+        "size": size,
+        "offset": 0,
+        "compressed_size": 0,
+        "parts": {},
+    }
+    save_checkpoint(client, source_bucket, checkpoint_key, checkpoint)
+    return send(checkpoint, chain([first], parts))
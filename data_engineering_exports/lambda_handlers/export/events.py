@@ -0,0 +1,44 @@
+"""Read S3 event records from either S3 event notifications or EventBridge.
+
+With S3 event notifications, the function (or its queue) is sent a notification
+holding a list of Records. With EventBridge, each dataset's rule sends the function
+(or its queue) one "Object Created" event per object instead. Those are turned into
+records of the same shape, so the rest of the handler only deals with one kind.
+"""
+from typing import Dict, List
+
+# The reason EventBridge gives for a new object, and the matching S3 event name
+EVENT_NAMES = {
+    "PutObject": "ObjectCreated:Put",
+    "POST Object": "ObjectCreated:Post",
+    "CopyObject": "ObjectCreated:Copy",
+    "CompleteMultipartUpload": "ObjectCreated:CompleteMultipartUpload",
+}
+
+
+def from_eventbridge(event: Dict) -> Dict:
+    """Turn an EventBridge "Object Created" event into an S3 event record."""
+    detail = event["detail"]
+    reason = detail.get("reason", "PutObject")
+    return {
+        "eventSource": "aws:s3",
+        "eventTime": event["time"],
+        "eventName": EVENT_NAMES.get(reason, "ObjectCreated:Put"),
+        "s3": {
+            "bucket": {"name": detail["bucket"]["name"]},
+            "object": {
+                "key": detail["object"]["key"],
+                "size": detail["object"].get("size", 0),
+                "eTag": detail["object"].get("etag"),
+                "sequencer": detail["object"].get("sequencer"),
+            },
+        },
+    }
+
+
+def records_of(message: Dict) -> List[Dict]:
+    """The records in a Lambda event or SQS message body. S3 test events, sent when
+    a notification is first set up, have none."""
+    if message.get("source") == "aws.s3":
+        return [from_eventbridge(message)]
+    return message.get("Records", [])
@@ -0,0 +1,148 @@
+"""Lambda handler that sends objects from the export bucket to a target bucket.
+
+Deployed by ExportObjectFunction. Objects up to MULTIPART_THRESHOLD bytes are sent
+with a single CopyObject request. Larger objects (including anything over the 5 GB
+CopyObject limit) are copied in parallel parts with UploadPartCopy, checkpointing
+progress in the export bucket so a timed-out invocation resumes where it stopped,
+in a new invocation of the function that it starts itself.
+Datasets with COMPRESS set have their objects compressed on the way instead.
+Copies are checked against the source's checksums, and unless KEEP_FILES is true,
+the source object is deleted once its copy has been checked.
+Requests that S3 throttles, or that fail with a server error or timeout, are
+retried with backoff, and requests to busy prefixes are slowed down.
+
+The function is triggered either directly by S3 event notifications or EventBridge
+events, or for datasets with batched delivery, by batches of those read from SQS.
+Objects matching the dataset's EXCLUDE_PATTERNS are left in the export bucket.
+Batches of datasets with BUNDLE set are sent as a few bundles of small files.
+It either serves a single dataset, or as the shared router, every dataset listed in
+its routing table. Bytes copied, copy duration, lag, retries and failures are
+written to the logs as metrics for each dataset at the end of every invocation.
+With TRACING set, each HEAD, COPY and DELETE step is traced in X-Ray.
+"""
+import os
+from time import monotonic
+from typing import Optional
+from urllib.parse import unquote_plus
+
+import boto3
+from botocore.config import Config
+
+from . import metrics, resume
+from .batch import export_batch
+from .events import records_of
+from .multipart import CopyIncompleteError
+from .routing import get_route
+from .throttle import ThrottledClient
+from .tracing import subsegment
+from .transfer import copy_object, max_concurrency
+
+_client = None
+
+
+def get_client():
+    """Create the S3 client on first use, then reuse it for the container's lifetime.
+
+    The connection pool is sized to the copy concurrency, so parallel requests don't
+    queue for a connection. Retries are left to ThrottledClient rather than botocore,
+    so that throttling also lowers the prefix's rate limit.
+    """
+    global _client
+    if _client is None:
+        config = Config(
+            max_pool_connections=max_concurrency(),
+            retries={"total_max_attempts": 1},
+        )
+        # Redirect to local AWS endpoints if running on Localstack
+        if "LOCALSTACK_HOSTNAME" in os.environ:
+            print("Localstack detected - redirecting to locally hosted AWS")
+            _client = boto3.client(
+                "s3",
+                endpoint_url=f"http://{os.getenv('LOCALSTACK_HOSTNAME')}:4566",
+                config=config,
+            )
+        else:
+            _client = boto3.client("s3", config=config)
+        _client = ThrottledClient(_client)
+    return _client
+
+
+def export_object(
+    client,
+    source_bucket: str,
+    source_key: str,
+    time_remaining=None,
+    event_time: Optional[str] = None,
+):
+    """Copy one object to its destination bucket, then delete it unless the dataset
+    keeps files.
+
+    Parameters
+    ----------
+    client
+        Boto3 S3 client.
+    source_bucket : str
+        Name of the export bucket the object was written to.
+    source_key : str
+        Key of the object. The same key is used in the destination bucket.
+    time_remaining : Callable[[], int], optional
+        Returns the milliseconds left in the invocation.
+    event_time : str, optional
+        When S3 sent the object's event, to measure how long delivery took.
+    """
+    route = get_route(source_key)
+    if route.excludes(source_key):
+        print(f"Leaving {source_key}, which matches an exclude pattern")
+        return
+    started = monotonic()
+    size = copy_object(
+        client,
+        source_bucket,
+        source_key,
+        route.destination_bucket,
+        time_remaining,
+        route.compress,
+    )
+    metrics.record_copy(source_key, size, monotonic() - started)
+    if not route.keep_files:
+        with subsegment("DELETE", source_key, size):
+            client.delete_object(Bucket=source_bucket, Key=source_key)
+    metrics.record_lag(source_key, event_time)
+
+
+def export_records(client, records, time_remaining=None) -> None:
+    """Export the objects in S3 event records sent straight to the function, either
+    by S3 or converted from an EventBridge event."""
+    for record in records:
+        source_bucket = record["s3"]["bucket"]["name"]
+        source_key = unquote_plus(record["s3"]["object"]["key"])
+        try:
+            export_object(
+                client,
+                source_bucket,
+                source_key,
+                time_remaining,
+                record.get("eventTime"),
+            )
+        except CopyIncompleteError:
+            # Not a failure - the copy carries on in the next invocation
+            raise
+        except Exception:
+            metrics.record_failure(source_key)
+            raise
+
+
+def handler(event, context):
+    client = get_client()
+    time_remaining = context.get_remaining_time_in_millis if context else None
+    records = records_of(event)
+    try:
+        if records and records[0].get("eventSource") == "aws:sqs":
+            failed = export_batch(client, records, time_remaining)
+            return {"batchItemFailures": [{"itemIdentifier": m} for m in failed]}
+        export_records(client, records, time_remaining)
+    except CopyIncompleteError:
+        if not resume.invoke_again(event, context):
+            raise
+    finally:
+        metrics.flush()
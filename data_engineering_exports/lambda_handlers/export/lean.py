@@ -0,0 +1,121 @@
+"""Lambda handler for push datasets that loads as little as it can, for faster cold
+starts.
+
+Deployed by ExportObjectFunction with handler "lean", in place of export.handler.
+Cold starts add straight to delivery latency for datasets that only see a few files
+a day. This module only imports botocore's session and config, and the modules of
+this package that need nothing but the standard library. Its S3 client is created
+while the module loads, so during Lambda's init phase rather than the first
+invocation, and is then kept for the container's lifetime. The client keeps its
+connections alive, with a pool of MAX_CONCURRENCY connections so parallel part
+copies never wait for one.
+
+Objects are sent straight to the function by S3 or EventBridge. Each object is
+copied by transfer.send, exactly as export.handler copies it, and the source is
+then deleted unless KEEP_FILES is true. The transfer module is only imported once
+the function is first invoked, so the init phase stays short. Batches read from SQS
+and X-Ray tracing aren't supported - use export.handler for those.
+
+Nothing here needs compiled packages, so the function deploys as a plain zip with no
+layers, on either architecture.
+"""
+import os
+from time import monotonic
+from typing import Optional
+from urllib.parse import unquote_plus
+
+from botocore.config import Config
+from botocore.session import get_session
+
+from . import metrics, resume
+from .events import records_of
+from .routing import get_route
+from .settings import max_concurrency
+from .throttle import ThrottledClient
+
+
+def new_client() -> ThrottledClient:
+    """Create a keep-alive S3 client straight from botocore, without boto3.
+
+    As in export.get_client, retries are left to ThrottledClient rather than
+    botocore, so that throttling also lowers the prefix's rate limit.
+    """
+    config = Config(
+        max_pool_connections=max_concurrency(),
+        tcp_keepalive=True,
+        retries={"total_max_attempts": 1},
+    )
+    endpoint_url = None
+    # Redirect to local AWS endpoints if running on Localstack
+    if "LOCALSTACK_HOSTNAME" in os.environ:
+        print("Localstack detected - redirecting to locally hosted AWS")
+        endpoint_url = f"http://{os.getenv('LOCALSTACK_HOSTNAME')}:4566"
+    return ThrottledClient(
+        get_session().create_client("s3", endpoint_url=endpoint_url, config=config)
+    )
+
+
+_client = new_client()
+
+
+def export_object(
+    client,
+    source_bucket: str,
+    source_key: str,
+    time_remaining=None,
+    event_time: Optional[str] = None,
+):
+    """Copy one object to its destination bucket, then delete it unless the dataset
+    keeps files. Takes the same arguments as export.export_object."""
+    route = get_route(source_key)
+    if route.excludes(source_key):
+        print(f"Leaving {source_key}, which matches an exclude pattern")
+        return
+    started = monotonic()
+    head = client.head_object(
+        Bucket=source_bucket, Key=source_key, ChecksumMode="ENABLED"
+    )
+    # Imported here so that it's loaded after the init phase
+    from .transfer import send
+
+    send(
+        client,
+        source_bucket,
+        source_key,
+        route.destination_bucket,
+        head,
+        time_remaining,
+        route.compress,
+    )
+    metrics.record_copy(source_key, head["ContentLength"], monotonic() - started)
+    if not route.keep_files:
+        client.delete_object(Bucket=source_bucket, Key=source_key)
+    metrics.record_lag(source_key, event_time)
+
+
+def handler(event, context):
+    time_remaining = context.get_remaining_time_in_millis if context else None
+    try:
+        for record in records_of(event):
+            source_key = unquote_plus(record["s3"]["object"]["key"])
+            try:
+                export_object(
+                    _client,
+                    record["s3"]["bucket"]["name"],
+                    source_key,
+                    time_remaining,
+                    record.get("eventTime"),
+                )
+            except Exception as error:
+                # Imported here so that only failures pay for it
+                from .multipart import CopyIncompleteError
+
+                # Not a failure - the copy carries on in the next invocation
+                if not isinstance(error, CopyIncompleteError):
+                    metrics.record_failure(source_key)
+                    raise
+                if not resume.invoke_again(event, context):
+                    raise
+                return
+    finally:
+        metrics.flush()
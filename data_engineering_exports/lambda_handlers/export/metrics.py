@@ -0,0 +1,139 @@
+"""Per-dataset metrics, written to the function's logs in CloudWatch embedded metric
+format (EMF), which CloudWatch turns into metrics without any API calls.
+
+Values are collected during an invocation, then flush() writes one log line for each
+dataset with every value recorded for it. Each metric has a Dataset dimension, the
+first folder of the object's key, which is the push dataset's name.
+
+The names, units and dimension here are what the dashboards use, so changing them
+breaks the dashboards. SCHEMA describes them, and is checked by the tests.
+"""
+import json
+import threading
+from collections import defaultdict
+from datetime import datetime, timezone
+from time import time
+from typing import Dict, List, Optional
+
+NAMESPACE = "DataEngineeringExports"
+DIMENSION = "Dataset"
+# Name and unit of every metric
+SCHEMA = {
+    "BytesCopied": "Bytes",
+    "CopyDuration": "Milliseconds",
+    "Lag": "Milliseconds",
+    "Retries": "Count",
+    "Failures": "Count",
+}
+# Counted once per invocation, so are written as 0 when nothing happened
+COUNTS = ("Retries", "Failures")
+# The most values EMF accepts for one metric in one log line
+MAX_VALUES = 100
+
+_values: Dict[str, Dict[str, List[float]]] = defaultdict(lambda: defaultdict(list))
+_lock = threading.Lock()
+
+
+def dataset_of(key: str) -> str:
+    return key.split("/", 1)[0]
+
+
+def _add(key: str, name: str, value: float) -> None:
+    with _lock:
+        _values[dataset_of(key)][name].append(value)
+
+
+def _count(key: str, name: str) -> None:
+    with _lock:
+        counts = _values[dataset_of(key)][name]
+        if counts:
+            counts[0] += 1
+        else:
+            counts.append(1)
+
+
+def record_copy(key: str, size: int, seconds: float) -> None:
+    """Record an object, or bundle of objects, sent to the target bucket."""
+    _add(key, "BytesCopied", size)
+    _add(key, "CopyDuration", round(seconds * 1000, 1))
+
+
+def record_lag(key: str, event_time: Optional[str]) -> None:
+    """Record the time from S3 sending an object's event to it being delivered.
+
+    Parameters
+    ----------
+    key : str
+        Key of the object.
+    event_time : str, optional
+        The event record's eventTime, like "2023-05-01T12:00:00.000Z". Nothing is
+        recorded without one.
+    """
+    if not event_time:
+        return
+    sent = datetime.fromisoformat(event_time.replace("Z", "+00:00"))
+    lag = datetime.now(timezone.utc) - sent
+    _add(key, "Lag", round(lag.total_seconds() * 1000, 1))
+
+
+def record_failure(key: str) -> None:
+    _count(key, "Failures")
+
+
+def record_retry(key: str) -> None:
+    _count(key, "Retries")
+
+
+def emf_documents(dataset: str, values: Dict[str, List[float]], timestamp: int):
+    """Build the EMF log lines for one dataset's values, splitting them so no line
+    has more than MAX_VALUES of any metric."""
+    values = dict(values)
+    for name in COUNTS:
+        values.setdefault(name, [0])
+    documents = []
+    start = 0
+    while any(len(v) > start for v in values.values()):
+        end = start + MAX_VALUES
+        chunk = {name: v[start:end] for name, v in values.items() if len(v) > start}
+        documents.append(
+            {
+                "_aws": {
+                    "Timestamp": timestamp,
+                    "CloudWatchMetrics": [
+                        {
+                            "Namespace": NAMESPACE,
+                            "Dimensions": [[DIMENSION]],
+                            "Metrics": [
+                                {"Name": name, "Unit": SCHEMA[name]} for name in chunk
+                            ],
+                        }
+                    ],
+                },
+                DIMENSION: dataset,
+                **chunk,
+            }
+        )
+        start = end
+    return documents
+
+
+def flush() -> List[Dict]:
+    """Write every value recorded since the last flush to the logs, and clear them.
+
+    Returns
+    -------
+    List[Dict]
+        The EMF documents written.
+    """
+    with _lock:
+        collected = {dataset: dict(values) for dataset, values in _values.items()}
+        _values.clear()
+    timestamp = int(time() * 1000)
+    documents = [
+        document
+        for dataset, values in sorted(collected.items())
+        for document in emf_documents(dataset, values, timestamp)
+    ]
+    for document in documents:
+        print(json.dumps(document))
+    return documents
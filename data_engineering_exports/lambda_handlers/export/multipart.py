@@ -0,0 +1,389 @@
+"""Parallel, resumable server-side copy of large objects using UploadPartCopy.
+
+Progress is recorded in a checkpoint object in the source bucket, holding the
+multipart upload ID and the ETag of each part copied so far. If the invocation runs
+out of time, the checkpoint is saved and CopyIncompleteError is raised, so the next
+invocation picks up the upload and copies only the parts still missing. If the
+upload has been aborted in the meantime, a new one is started.
+
+S3 calculates a checksum of each part as it's copied. If the source was uploaded in
+parts of the same size, the copy uses the same part ranges, so each part is checked
+against the source's as it completes and the finished copy against the whole source.
+"""
+import json
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from math import ceil
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Tuple
+
+from botocore.exceptions import ClientError
+
+from .checksums import (
+    check_part,
+    choose_algorithm,
+    field,
+    source_parts,
+    verify_or_delete,
+)
+
+MAX_PARTS = 10_000
+MIN_PART_SIZE = 5 * 1024**2
+# Stop starting new parts when the invocation has less than this many ms left
+SAFETY_MARGIN_MS = 30_000
+# Save the checkpoint after this many parts have completed
+CHECKPOINT_INTERVAL = 20
+
+
+class CopyIncompleteError(Exception):
+    pass
+
+
+def choose_part_size(size: int, part_size: int) -> int:
+    """Return the smallest part size that is at least part_size, at least the S3
+    minimum, and splits an object of the given size into no more than 10,000 parts.
+    """
+    return max(part_size, MIN_PART_SIZE, ceil(size / MAX_PARTS))
+
+
+def part_ranges(size: int, part_size: int) -> List[Tuple[int, int, int]]:
+    """Split an object into (part_number, first_byte, last_byte) tuples.
+
+    Part numbers start at 1 and byte ranges are inclusive, as S3 expects.
+    """
+    return [
+        (number, start, min(start + part_size, size) - 1)
+        for number, start in enumerate(range(0, size, part_size), start=1)
+    ]
+
+
+def load_checkpoint(client, bucket: str, key: str) -> Optional[Dict]:
+    """Read a checkpoint from S3, returning None if there isn't one."""
+    try:
+        response = client.get_object(Bucket=bucket, Key=key)
+    except ClientError as e:
+        if e.response["Error"]["Code"] in ("NoSuchKey", "404"):
+            return None
+        raise
+    return json.loads(response["Body"].read())
+
+
+def save_checkpoint(client, bucket: str, key: str, checkpoint: Dict) -> None:
+    client.put_object(
+        Bucket=bucket,
+        Key=key,
+        Body=json.dumps(checkpoint).encode(),
+        ServerSideEncryption="AES256",
+    )
+
+
+def _abort_stale_upload(client, bucket: str, key: str, upload_id: str) -> None:
+    """Try to abort an upload whose source has since changed. Failing to abort only
+    leaves orphaned parts for the destination's lifecycle rules to clear up, so
+    errors are logged rather than raised.
+    """
+    try:
+        client.abort_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id)
+    except ClientError as e:
+        print(f"Could not abort stale upload {upload_id} for {key}: {e}")
+
+
+def _start_upload(
+    client,
+    destination_bucket: str,
+    destination_key: str,
+    head: Dict,
+    part_size: int,
+    algorithm: str,
+) -> Dict:
+    """Create a multipart upload carrying over the source's content headers, with S3
+    calculating a checksum of each part."""
+    extra_args = {
+        arg: head[arg]
+        for arg in ("ContentType", "ContentEncoding", "Metadata")
+        if head.get(arg)
+    }
+    response = client.create_multipart_upload(
+        Bucket=destination_bucket,
+        Key=destination_key,
+        ServerSideEncryption="AES256",
+        ACL="bucket-owner-full-control",
+        ChecksumAlgorithm=algorithm,
+        **extra_args,
+    )
+    return {
+        "upload_id": response["UploadId"],
+        "source_etag": head["ETag"],
+        "size": head["ContentLength"],
+        "part_size": part_size,
+        "algorithm": algorithm,
+        "parts": {},
+        "checksums": {},
+    }
+
+
+def _completed_parts(checkpoint: Dict) -> List[Dict]:
+    """The Parts to complete an upload with, including checksums if it has them."""
+    algorithm = checkpoint.get("algorithm")
+    checksums = checkpoint.get("checksums", {})
+    parts = []
+    for number, etag in sorted(checkpoint["parts"].items(), key=lambda p: int(p[0])):
+        part = {"PartNumber": int(number), "ETag": etag}
+        if algorithm and checksums.get(number):
+            part[field(algorithm)] = checksums[number]
+        parts.append(part)
+    return parts
+
+
+def _copy_parts(
+    copy_part: Callable,
+    parts: List[Tuple[int, int, int]],
+    max_concurrency: int,
+    out_of_time: Callable[[], bool],
+    part_done: Callable[[int, str, Optional[str]], None],
+) -> int:
+    """Run copy_part over parts with at most max_concurrency in flight, calling
+    part_done on the main thread as each one finishes.
+
+    Stops handing out new parts once out_of_time returns True or a part fails.
+    Parts already running are allowed to finish, then the first error is re-raised.
+
+    Returns
+    -------
+    int
+        The number of parts that were never started.
+    """
+    pending = list(reversed(parts))  # So pop() hands out parts in ascending order
+    in_flight = set()
+    error = None
+    with ThreadPoolExecutor(max_workers=max_concurrency) as pool:
+        while True:
+            while pending and len(in_flight) < max_concurrency:
+                if error is not None or out_of_time():
+                    break
+                in_flight.add(pool.submit(copy_part, *pending.pop()))
+            if not in_flight:
+                break
+            done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                try:
+                    part_done(*future.result())
+                except Exception as e:
+                    error = error or e
+    if error is not None:
+        raise error
+    return len(pending)
+
+
+def matching_checkpoint(
+    client,
+    source_bucket: str,
+    checkpoint_key: str,
+    destination_bucket: str,
+    destination_key: str,
+    head: Dict,
+) -> Optional[Dict]:
+    """Load the checkpoint, unless it's missing or for an older version of the
+    source, in which case its upload is aborted."""
+    checkpoint = load_checkpoint(client, source_bucket, checkpoint_key)
+    if checkpoint and (checkpoint["source_etag"], checkpoint["size"]) != (
+        head["ETag"],
+        head["ContentLength"],
+    ):
+        # The object was overwritten since the last attempt - start again
+        _abort_stale_upload(
+            client, destination_bucket, destination_key, checkpoint["upload_id"]
+        )
+        return None
+    return checkpoint
+
+
+def _expected_checksums(
+    checkpoint: Dict,
+    algorithm: str,
+    aligned_parts: Optional[Tuple[int, Dict[int, str]]],
+) -> Optional[Dict[int, str]]:
+    """The source's part checksums, if the upload copies the same part ranges with
+    the same algorithm. Uploads started before checksums were added have neither."""
+    if (
+        aligned_parts
+        and checkpoint.get("algorithm") == algorithm
+        and checkpoint["part_size"] == aligned_parts[0]
+    ):
+        return aligned_parts[1]
+    return None
+
+
+def multipart_copy(
+    client,
+    source_bucket: str,
+    source_key: str,
+    destination_bucket: str,
+    destination_key: str,
+    head: Dict,
+    part_size: int,
+    max_concurrency: int,
+    checkpoint_key: str,
+    time_remaining: Optional[Callable[[], int]] = None,
+) -> None:
+    """Copy an object in parallel parts, resuming from a checkpoint if one matches.
+
+    Parameters
+    ----------
+    client
+        Boto3 S3 client, with a connection pool of at least max_concurrency.
+    source_bucket, source_key : str
+        Location of the object to copy. The checkpoint is also kept in source_bucket.
+    destination_bucket, destination_key : str
+        Where to copy the object to.
+    head : Dict
+        The head_object response for the source object, requested with ChecksumMode
+        ENABLED.
+    part_size : int
+        Preferred part size in bytes. Raised if needed to stay within S3's limits,
+        and replaced by the source's part size if it was uploaded in parts.
+    max_concurrency : int
+        How many parts to copy at once.
+    checkpoint_key : str
+        Key in source_bucket to record progress under.
+    time_remaining : Callable[[], int], optional
+        Returns the milliseconds left in the invocation. If None, never stop early.
+
+    Raises
+    ------
+    CopyIncompleteError
+        If the invocation ran low on time before every part was copied. The
+        checkpoint has been saved, so retrying the same object resumes the copy.
+        If the checkpoint's upload has since been aborted, the retry starts a new
+        one.
+    ChecksumMismatchError
+        If a part or the finished copy doesn't match the source.
+    """
+    algorithm, _ = choose_algorithm(head)
+    aligned_parts = source_parts(client, source_bucket, source_key, head, algorithm)
+    upload = _Upload(
+        client,
+        source_bucket,
+        source_key,
+        destination_bucket,
+        destination_key,
+        head,
+        checkpoint_key,
+    )
+
+    checkpoint = matching_checkpoint(
+        client, source_bucket, checkpoint_key, destination_bucket, destination_key, head
+    )
+    if checkpoint:
+        print(f"Resuming {source_key}: {len(checkpoint['parts'])} parts already copied")
+        try:
+            return upload.copy(
+                checkpoint, algorithm, aligned_parts, max_concurrency, time_remaining
+            )
+        except ClientError as e:
+            # S3 aborts uploads left unfinished for too long, as can lifecycle rules
+            if e.response["Error"]["Code"] != "NoSuchUpload":
+                raise
+            print(f"The upload of {source_key} no longer exists - starting again")
+            client.delete_object(Bucket=source_bucket, Key=checkpoint_key)
+    checkpoint = _start_upload(
+        client,
+        destination_bucket,
+        destination_key,
+        head,
+        aligned_parts[0]
+        if aligned_parts
+        else choose_part_size(head["ContentLength"], part_size),
+        algorithm,
+    )
+    save_checkpoint(client, source_bucket, checkpoint_key, checkpoint)
+    upload.copy(checkpoint, algorithm, aligned_parts, max_concurrency, time_remaining)
+
+
+class _Upload(NamedTuple):
+    """The object a multipart copy is copying, and where to."""
+
+    client: Any
+    source_bucket: str
+    source_key: str
+    destination_bucket: str
+    destination_key: str
+    head: Dict
+    checkpoint_key: str
+
+    def copy(
+        self,
+        checkpoint: Dict,
+        algorithm: str,
+        aligned_parts: Optional[Tuple[int, Dict[int, str]]],
+        max_concurrency: int,
+        time_remaining: Optional[Callable[[], int]],
+    ) -> None:
+        """Copy the parts the checkpoint's upload is missing, then complete it."""
+        client = self.client
+        expected = _expected_checksums(checkpoint, algorithm, aligned_parts)
+
+        def copy_part(number: int, first: int, last: int) -> Tuple[int, str, str]:
+            response = client.upload_part_copy(
+                Bucket=self.destination_bucket,
+                Key=self.destination_key,
+                UploadId=checkpoint["upload_id"],
+                PartNumber=number,
+                CopySource={"Bucket": self.source_bucket, "Key": self.source_key},
+                CopySourceIfMatch=checkpoint["source_etag"],
+                CopySourceRange=f"bytes={first}-{last}",
+            )
+            result = response["CopyPartResult"]
+            return number, result["ETag"], result.get(field(algorithm))
+
+        def out_of_time() -> bool:
+            return time_remaining is not None and time_remaining() < SAFETY_MARGIN_MS
+
+        def part_done(number: int, etag: str, checksum: Optional[str]) -> None:
+            check_part(self.source_key, number, (expected or {}).get(number), checksum)
+            # Uploads with checksums must be completed with each part's checksum
+            checkpoint.setdefault("checksums", {})[str(number)] = checksum
+            checkpoint["parts"][str(number)] = etag
+            if len(checkpoint["parts"]) % CHECKPOINT_INTERVAL == 0:
+                self.save(checkpoint)
+
+        pending = [
+            part
+            for part in part_ranges(self.head["ContentLength"], checkpoint["part_size"])
+            if str(part[0]) not in checkpoint["parts"]
+        ]
+        try:
+            remaining = _copy_parts(
+                copy_part, pending, max_concurrency, out_of_time, part_done
+            )
+        except Exception:
+            self.save(checkpoint)
+            raise
+        if remaining:
+            self.save(checkpoint)
+            raise CopyIncompleteError(
+                f"Copied {len(checkpoint['parts'])} parts of {self.source_key} before "
+                f"running out of time; {remaining} parts remain and will resume on "
+                "retry"
+            )
+
+        response = client.complete_multipart_upload(
+            Bucket=self.destination_bucket,
+            Key=self.destination_key,
+            UploadId=checkpoint["upload_id"],
+            MultipartUpload={"Parts": _completed_parts(checkpoint)},
+        )
+        # The upload is finished either way, so a retry must start a new one
+        client.delete_object(Bucket=self.source_bucket, Key=self.checkpoint_key)
+        verify_or_delete(
+            client,
+            self.destination_bucket,
+            self.destination_key,
+            self.head,
+            checkpoint.get("algorithm") or algorithm,
+            response,
+            aligned=expected is not None,
+        )
+
+    def save(self, checkpoint: Dict) -> None:
+        save_checkpoint(
+            self.client, self.source_bucket, self.checkpoint_key, checkpoint
+        )
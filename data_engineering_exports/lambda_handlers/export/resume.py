@@ -0,0 +1,61 @@
+"""Carry on a multipart copy that ran out of time in a fresh invocation.
+
+Lambda retries a failed asynchronous invocation at most twice, so leaving resumes to
+its retries would give a large copy only three invocations to finish in. Instead,
+when a copy stops with CopyIncompleteError, the handler invokes its own function
+again with the same event, counting how many times it has done so in the event's
+RESUMES_FIELD. Past MAX_RESUMES (20 by default), the error is raised as before and
+Lambda's own retries are the last resort.
+
+Only botocore is used, so the lean handler can share this without loading boto3.
+"""
+import json
+import os
+from typing import Dict
+
+from botocore.session import get_session
+
+DEFAULT_MAX_RESUMES = 20
+RESUMES_FIELD = "exportResumes"
+
+_client = None
+
+
+def get_client():
+    """Create the Lambda client on first use, as only large copies need it."""
+    global _client
+    if _client is None:
+        endpoint_url = None
+        # Redirect to local AWS endpoints if running on Localstack
+        if "LOCALSTACK_HOSTNAME" in os.environ:
+            endpoint_url = f"http://{os.getenv('LOCALSTACK_HOSTNAME')}:4566"
+        _client = get_session().create_client("lambda", endpoint_url=endpoint_url)
+    return _client
+
+
+def invoke_again(event: Dict, context) -> bool:
+    """Send the event to the function again, asynchronously, to resume its copy.
+
+    Parameters
+    ----------
+    event : Dict
+        The event the function was invoked with.
+    context
+        The invocation's Lambda context, or None when called outside Lambda.
+
+    Returns
+    -------
+    bool
+        True if the function was invoked again, or False if the event has already
+        been resumed MAX_RESUMES times, or there's no function to invoke.
+    """
+    resumes = event.get(RESUMES_FIELD, 0)
+    if context is None or resumes >= int(os.getenv("MAX_RESUMES", DEFAULT_MAX_RESUMES)):
+        return False
+    get_client().invoke(
+        FunctionName=context.invoked_function_arn,
+        InvocationType="Event",
+        Payload=json.dumps({**event, RESUMES_FIELD: resumes + 1}).encode(),
+    )
+    print(f"Invoked the function again to resume the copy ({resumes + 1} resumes)")
+    return True
@@ -0,0 +1,91 @@
+"""Work out where an object in the export bucket should be sent.
+
+A function deployed for one dataset is told its destination through environment
+variables. The shared router function is instead deployed with a routing table
+file, mapping each dataset prefix to its target bucket and whether to keep files.
+"""
+import json
+import os
+from fnmatch import fnmatchcase
+from typing import Dict, NamedTuple, Optional, Tuple
+
+DEFAULT_BUNDLE_MAX_MB = 32
+
+
+class UnknownPrefixError(Exception):
+    pass
+
+
+class Route(NamedTuple):
+    destination_bucket: str
+    keep_files: bool
+    compress: Optional[str] = None
+    bundle: Optional[str] = None
+    bundle_max_mb: int = DEFAULT_BUNDLE_MAX_MB
+    # Wildcard patterns of keys to leave alone, like "*.tmp"
+    exclude: Tuple[str, ...] = ()
+
+    def excludes(self, key: str) -> bool:
+        return any(fnmatchcase(key, pattern) for pattern in self.exclude)
+
+
+_routes: Optional[Dict[str, Route]] = None
+
+
+def load_routes(path: str) -> Dict[str, Route]:
+    """Read a routing table of {prefix: {"target_bucket": ..., "keep_files": ...}},
+    where each route can also have "compress" and "exclude".
+
+    Relative paths are read from the Lambda task root, where the table is bundled.
+    """
+    with open(os.path.join(os.getenv("LAMBDA_TASK_ROOT", ""), path)) as f:
+        return {
+            prefix: Route(
+                route["target_bucket"],
+                route["keep_files"],
+                route.get("compress"),
+                exclude=tuple(route.get("exclude", ())),
+            )
+            for prefix, route in json.load(f).items()
+        }
+
+
+def get_route(key: str) -> Route:
+    """Find the destination for a key.
+
+    Uses the routing table named by ROUTING_TABLE if there is one, matching on the
+    first 'folder' of the key, and otherwise the function's own DESTINATION_BUCKET,
+    KEEP_FILES, COMPRESS, BUNDLE, BUNDLE_MAX_MB and EXCLUDE_PATTERNS settings. Only
+    functions with batched delivery bundle files, so the routing table never does.
+
+    Raises
+    ------
+    UnknownPrefixError
+        If there is a routing table but no dataset for the key's prefix.
+    """
+    global _routes
+    if "ROUTING_TABLE" not in os.environ:
+        return Route(
+            os.environ["DESTINATION_BUCKET"],
+            os.getenv("KEEP_FILES", "false").lower() == "true",
+            os.getenv("COMPRESS") or None,
+            os.getenv("BUNDLE") or None,
+            int(os.getenv("BUNDLE_MAX_MB", DEFAULT_BUNDLE_MAX_MB)),
+            tuple(json.loads(os.getenv("EXCLUDE_PATTERNS") or "[]")),
+        )
+    if _routes is None:
+        _routes = load_routes(os.environ["ROUTING_TABLE"])
+    prefix = key.split("/", 1)[0]
+    try:
+        return _routes[prefix]
+    except KeyError:
+        raise UnknownPrefixError(f"No push dataset is routed for {key}")
+
+
+def is_excluded(key: str) -> bool:
+    """Whether the key's dataset leaves it alone. Keys with no route aren't, so that
+    copying them reports the problem."""
+    try:
+        return get_route(key).excludes(key)
+    except UnknownPrefixError:
+        return False
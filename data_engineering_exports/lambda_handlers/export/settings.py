@@ -0,0 +1,19 @@
+"""Copy settings read from the function's environment.
+
+Kept apart from transfer, which imports everything needed for multipart and
+compressed copies, so the lean handler can read them without importing the rest.
+"""
+import os
+
+DEFAULT_MULTIPART_THRESHOLD = 64 * 1024**2
+DEFAULT_PART_SIZE = 64 * 1024**2
+DEFAULT_MAX_CONCURRENCY = 16
+DEFAULT_CHECKPOINT_PREFIX = "_export_checkpoints"
+
+
+def max_concurrency() -> int:
+    return int(os.getenv("MAX_CONCURRENCY", DEFAULT_MAX_CONCURRENCY))
+
+
+def multipart_threshold() -> int:
+    return int(os.getenv("MULTIPART_THRESHOLD", DEFAULT_MULTIPART_THRESHOLD))
@@ -0,0 +1,252 @@
+"""Retry S3 requests that are throttled, and slow down for prefixes that are busy.
+
+S3 supports about 3,500 writes a second for each prefix, and past that it answers
+with 503 SlowDown. Each failed request is retried after a random delay that grows
+with every attempt (exponential backoff with full jitter), and the prefix's
+request rate is limited on the client. The limit halves each time the prefix is
+throttled and recovers by about RATE_INCREASE requests a second for every second
+of successful requests, so bursts slow down rather than fail.
+
+Limits are kept for each bucket and first folder of the key, which for the export
+and target buckets is the dataset. They last for the life of the Lambda container.
+"""
+import os
+import random
+import threading
+from time import monotonic, sleep
+from typing import Callable, Dict, Optional
+
+from botocore.exceptions import ClientError, ConnectionError, HTTPClientError
+
+from . import metrics
+
+DEFAULT_MAX_ATTEMPTS = 8
+DEFAULT_BASE_DELAY = 0.1
+DEFAULT_MAX_DELAY = 20.0
+# Requests a second for each prefix before any throttling, matching S3's limit
+DEFAULT_MAX_RATE = 3500.0
+DEFAULT_MIN_RATE = 1.0
+DEFAULT_RATE_INCREASE = 10.0
+RATE_DECREASE = 0.5
+
+# Errors S3 returns when it wants requests to slow down
+THROTTLE_CODES = {"SlowDown", "503", "ServiceUnavailable", "RequestLimitExceeded"}
+# Errors that are worth retrying, but don't mean the prefix is busy
+TRANSIENT_CODES = {
+    "InternalError",
+    "500",
+    "BadGateway",
+    "GatewayTimeout",
+    "RequestTimeout",
+}
+# HTTP statuses of the above, for errors with some other code or no code at all
+THROTTLE_STATUS = 503
+TRANSIENT_STATUSES = {500, 502, 504}
+# Timeouts and dropped connections, which botocore would have retried itself. Most
+# are HTTPClientErrors, but connection failures like EndpointConnectionError and
+# ConnectTimeoutError are ConnectionErrors instead.
+NETWORK_ERRORS = (HTTPClientError, ConnectionError)
+
+# Client methods that are retried and limited by their Bucket and Key arguments
+THROTTLED_OPERATIONS = {
+    "head_object",
+    "get_object",
+    "get_object_attributes",
+    "put_object",
+    "copy_object",
+    "delete_object",
+    "delete_objects",
+    "create_multipart_upload",
+    "upload_part",
+    "upload_part_copy",
+    "complete_multipart_upload",
+    "abort_multipart_upload",
+}
+
+
+class RetriesExhaustedError(Exception):
+    pass
+
+
+def error_code(error: Exception) -> Optional[str]:
+    if isinstance(error, ClientError):
+        return error.response.get("Error", {}).get("Code")
+    return None
+
+
+def status_code(error: Exception) -> Optional[int]:
+    if isinstance(error, ClientError):
+        return error.response.get("ResponseMetadata", {}).get("HTTPStatusCode")
+    return None
+
+
+def is_throttle(error: Exception) -> bool:
+    return error_code(error) in THROTTLE_CODES or status_code(error) == THROTTLE_STATUS
+
+
+def is_retryable(error: Exception) -> bool:
+    return (
+        is_throttle(error)
+        or error_code(error) in TRANSIENT_CODES
+        or status_code(error) in TRANSIENT_STATUSES
+        or isinstance(error, NETWORK_ERRORS)
+    )
+
+
+def prefix_of(bucket: str, key: str) -> str:
+    """The bucket and first folder of the key, which S3 limits requests for."""
+    return f"{bucket}/{key.split('/', 1)[0]}"
+
+
+class RateLimiter:
+    """Additive increase, multiplicative decrease limit on one prefix's requests.
+
+    Parameters
+    ----------
+    max_rate : float
+        Requests a second allowed before the prefix is throttled. At this rate,
+        requests aren't delayed at all.
+    min_rate : float
+        The rate never drops below this.
+    increase : float
+        How much the rate grows in a second of successful requests.
+    """
+
+    def __init__(self, max_rate: float, min_rate: float, increase: float):
+        self.max_rate = max_rate
+        self.min_rate = min_rate
+        self.increase = increase
+        self.rate = max_rate
+        self._next_slot = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self) -> float:
+        """Wait for the next request slot, and return how long was spent waiting."""
+        with self._lock:
+            if self.rate >= self.max_rate:
+                return 0.0
+            now = monotonic()
+            slot = max(now, self._next_slot)
+            self._next_slot = slot + 1 / self.rate
+        if slot > now:
+            sleep(slot - now)
+        return slot - now
+
+    def success(self) -> None:
+        # At a rate of r, r successes take about a second, so the rate grows by
+        # increase each second
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + self.increase / self.rate)
+
+    def throttled(self) -> None:
+        with self._lock:
+            self.rate = max(self.min_rate, self.rate * RATE_DECREASE)
+
+
+class AdaptiveThrottle:
+    """Retry throttled requests with backoff, and keep a RateLimiter for each prefix.
+
+    Settings are read from environment variables (MAX_ATTEMPTS, BASE_DELAY,
+    MAX_DELAY, MAX_RATE, MIN_RATE, RATE_INCREASE) unless given.
+    """
+
+    def __init__(
+        self,
+        max_attempts: Optional[int] = None,
+        base_delay: Optional[float] = None,
+        max_delay: Optional[float] = None,
+        max_rate: Optional[float] = None,
+        min_rate: Optional[float] = None,
+        increase: Optional[float] = None,
+        sleep: Callable[[float], None] = sleep,
+    ):
+        self.max_attempts = max_attempts or int(
+            os.getenv("MAX_ATTEMPTS", DEFAULT_MAX_ATTEMPTS)
+        )
+        self.base_delay = base_delay or float(
+            os.getenv("BASE_DELAY", DEFAULT_BASE_DELAY)
+        )
+        self.max_delay = max_delay or float(os.getenv("MAX_DELAY", DEFAULT_MAX_DELAY))
+        self.max_rate = max_rate or float(os.getenv("MAX_RATE", DEFAULT_MAX_RATE))
+        self.min_rate = min_rate or float(os.getenv("MIN_RATE", DEFAULT_MIN_RATE))
+        self.increase = increase or float(
+            os.getenv("RATE_INCREASE", DEFAULT_RATE_INCREASE)
+        )
+        self.limiters: Dict[str, RateLimiter] = {}
+        self._sleep = sleep
+        self._lock = threading.Lock()
+
+    def limiter(self, prefix: str) -> RateLimiter:
+        with self._lock:
+            if prefix not in self.limiters:
+                self.limiters[prefix] = RateLimiter(
+                    self.max_rate, self.min_rate, self.increase
+                )
+            return self.limiters[prefix]
+
+    def backoff(self, attempt: int) -> float:
+        """A random delay of up to base_delay * 2 ** attempt, capped at max_delay."""
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2**attempt))
+
+    def call(self, operation: str, bucket: str, key: str, function: Callable, **kwargs):
+        """Call function(**kwargs), retrying throttled and transient errors.
+
+        Raises
+        ------
+        RetriesExhaustedError
+            If the request still fails after max_attempts, with the reason.
+        """
+        limiter = self.limiter(prefix_of(bucket, key))
+        for attempt in range(self.max_attempts):
+            limiter.acquire()
+            try:
+                response = function(**kwargs)
+            except Exception as e:
+                if not is_retryable(e):
+                    raise
+                if is_throttle(e):
+                    limiter.throttled()
+                if attempt + 1 == self.max_attempts:
+                    reason = (
+                        f"S3 throttled the prefix {prefix_of(bucket, key)} ({e})"
+                        if is_throttle(e)
+                        else f"S3 kept failing ({e!r})"
+                    )
+                    message = (
+                        f"Gave up on {operation} for {bucket}/{key} after "
+                        f"{self.max_attempts} attempts: {reason}. The prefix's rate "
+                        f"limit is now {limiter.rate:.1f} requests a second."
+                    )
+                    print(message)
+                    raise RetriesExhaustedError(message) from e
+                metrics.record_retry(key)
+                self._sleep(self.backoff(attempt))
+            else:
+                limiter.success()
+                return response
+
+
+class ThrottledClient:
+    """Wraps a boto3 S3 client so its object requests go through an
+    AdaptiveThrottle. Other attributes are passed straight to the client."""
+
+    def __init__(self, client, throttle: Optional[AdaptiveThrottle] = None):
+        self._client = client
+        self.throttle = throttle or AdaptiveThrottle()
+
+    def __getattr__(self, name: str):
+        attribute = getattr(self._client, name)
+        if name not in THROTTLED_OPERATIONS:
+            return attribute
+
+        def throttled(**kwargs):
+            if "Key" in kwargs:
+                key = kwargs["Key"]
+            else:
+                objects = kwargs.get("Delete", {}).get("Objects", [])
+                key = objects[0]["Key"] if objects else ""
+            return self.throttle.call(
+                name, kwargs.get("Bucket", ""), key, attribute, **kwargs
+            )
+
+        return throttled
@@ -0,0 +1,118 @@
+"""Break an export down into X-Ray subsegments for the HEAD, COPY and DELETE steps.
+
+With active tracing, Lambda records a segment for each invocation, and passes its
+trace ID to the function in the _X_AMZN_TRACE_ID environment variable. Each step is
+recorded as a subsegment of it, annotated with the key prefix (the dataset) and the
+object's size, so slow exports can be found and broken down in the X-Ray console.
+
+Subsegments are sent straight to the X-Ray daemon over UDP, as the X-Ray SDK would,
+so the SDK doesn't need to be packaged with the function. Nothing is sent unless
+TRACING is true and the invocation was sampled, and failing to send a subsegment
+never stops an export.
+"""
+import json
+import os
+import secrets
+import socket
+from contextlib import contextmanager
+from time import time
+from typing import Dict, Iterator, Optional, Tuple
+
+DEFAULT_DAEMON_ADDRESS = "127.0.0.1:2000"
+HEADER = b'{"format": "json", "version": 1}\n'
+
+_socket: Optional[socket.socket] = None
+
+
+class Subsegment:
+    """A step of an export, sent to X-Ray when it ends."""
+
+    def __init__(self, name: str, key: str, size: Optional[int] = None):
+        self.name = name
+        self.annotations = {"key_prefix": key.split("/", 1)[0], "operation": name}
+        if size is not None:
+            self.annotations["size"] = size
+        self.start_time = time()
+        self.error: Optional[BaseException] = None
+
+    def annotate(self, name: str, value) -> None:
+        self.annotations[name] = value
+
+    def document(self, trace_id: str, parent_id: str) -> Dict:
+        document = {
+            "name": f"S3 {self.name}",
+            "id": secrets.token_hex(8),
+            "trace_id": trace_id,
+            "parent_id": parent_id,
+            "start_time": self.start_time,
+            "end_time": time(),
+            "type": "subsegment",
+            "namespace": "aws",
+            "annotations": self.annotations,
+        }
+        if self.error is not None:
+            document["fault"] = True
+            document["cause"] = {
+                "exceptions": [
+                    {"type": type(self.error).__name__, "message": str(self.error)}
+                ]
+            }
+        return document
+
+
+def trace_context() -> Optional[Dict[str, str]]:
+    """The Root and Parent of the current invocation's trace, or None if tracing is
+    off or the invocation wasn't sampled."""
+    if os.getenv("TRACING", "false").lower() != "true":
+        return None
+    header = os.getenv("_X_AMZN_TRACE_ID", "")
+    fields = dict(part.split("=", 1) for part in header.split(";") if "=" in part)
+    if fields.get("Sampled") != "1" or "Root" not in fields or "Parent" not in fields:
+        return None
+    return fields
+
+
+def daemon_address() -> Tuple[str, int]:
+    """AWS_XRAY_DAEMON_ADDRESS, which can also be written `udp:host:port`."""
+    address = os.getenv("AWS_XRAY_DAEMON_ADDRESS", DEFAULT_DAEMON_ADDRESS)
+    address = address.split()[0]
+    if address.startswith("udp:"):
+        address = address[4:]
+    host, port = address.rsplit(":", 1)
+    return host, int(port)
+
+
+def send(document: Dict) -> None:
+    global _socket
+    try:
+        if _socket is None:
+            _socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        _socket.sendto(HEADER + json.dumps(document).encode(), daemon_address())
+    except (OSError, ValueError) as e:
+        print(f"Could not send trace subsegment {document['name']}: {e!r}")
+
+
+@contextmanager
+def subsegment(name: str, key: str, size: Optional[int] = None) -> Iterator[Subsegment]:
+    """Record the code inside the block as a subsegment of the invocation.
+
+    Parameters
+    ----------
+    name : str
+        The step, such as "HEAD", "COPY" or "DELETE".
+    key : str
+        Key of the object, whose first folder is annotated as key_prefix.
+    size : int, optional
+        Size of the object in bytes. Can also be added inside the block with
+        annotate("size", ...).
+    """
+    segment = Subsegment(name, key, size)
+    try:
+        yield segment
+    except BaseException as e:
+        segment.error = e
+        raise
+    finally:
+        context = trace_context()
+        if context:
+            send(segment.document(context["Root"], context["Parent"]))
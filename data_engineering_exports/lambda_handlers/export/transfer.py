@@ -0,0 +1,146 @@
+"""Copy a single object from the export bucket to the destination bucket."""
+import os
+from typing import Dict, Optional
+
+from .checksums import choose_algorithm, verify_or_delete
+from .compress import compress_object, compressed_key, is_compressed
+from .multipart import multipart_copy
+from .settings import (
+    DEFAULT_CHECKPOINT_PREFIX,
+    DEFAULT_PART_SIZE,
+    max_concurrency,
+    multipart_threshold,
+)
+from .tracing import subsegment
+
+
+def copy_object(
+    client,
+    source_bucket: str,
+    source_key: str,
+    destination_bucket: str,
+    time_remaining=None,
+    compress: Optional[str] = None,
+) -> int:
+    """Copy one object to the destination bucket, using the same key.
+
+    Objects up to MULTIPART_THRESHOLD bytes are sent with a single CopyObject
+    request, and larger ones with a checkpointed multipart copy. Either way, the
+    copy's checksum is compared with the source's before returning. If compress is
+    set, objects that aren't already compressed are instead streamed through the
+    compressor, and sent with the codec's suffix added to the key.
+
+    Parameters
+    ----------
+    client
+        Boto3 S3 client.
+    source_bucket : str
+        Name of the export bucket the object was written to.
+    source_key : str
+        Key of the object.
+    destination_bucket : str
+        Name of the bucket to copy the object to.
+    time_remaining : Callable[[], int], optional
+        Returns the milliseconds left in the invocation. Used to stop a multipart
+        or compressed copy cleanly before the Lambda times out.
+    compress : str, optional
+        Either "gzip" or "zstd" to compress the object. By default, None.
+
+    Returns
+    -------
+    int
+        The size of the source object in bytes.
+
+    Raises
+    ------
+    ChecksumMismatchError
+        If the copy doesn't match the source, which must then be kept. The copy
+        is deleted from the destination bucket.
+    """
+    with subsegment("HEAD", source_key) as segment:
+        head = client.head_object(
+            Bucket=source_bucket, Key=source_key, ChecksumMode="ENABLED"
+        )
+        segment.annotate("size", head["ContentLength"])
+    with subsegment("COPY", source_key, head["ContentLength"]) as segment:
+        segment.annotate(
+            "method",
+            send(
+                client,
+                source_bucket,
+                source_key,
+                destination_bucket,
+                head,
+                time_remaining,
+                compress,
+            ),
+        )
+    return head["ContentLength"]
+
+
+def send(
+    client,
+    source_bucket: str,
+    source_key: str,
+    destination_bucket: str,
+    head: Dict,
+    time_remaining=None,
+    compress: Optional[str] = None,
+) -> str:
+    """Send the object by whichever method suits it, and return the method's name.
+
+    Takes the same arguments as copy_object, plus the source's HEAD response, for
+    callers that have already made the request. Raises ChecksumMismatchError in the
+    same way.
+    """
+    checkpoint_prefix = os.getenv("CHECKPOINT_PREFIX", DEFAULT_CHECKPOINT_PREFIX)
+    if compress and not is_compressed(source_key):
+        sizes = compress_object(
+            client,
+            source_bucket,
+            source_key,
+            destination_bucket,
+            head,
+            compress,
+            checkpoint_key=(
+                f"{checkpoint_prefix}/{compressed_key(source_key, compress)}.json"
+            ),
+            time_remaining=time_remaining,
+        )
+        print(
+            f"Compressed {source_key} with {compress} from {sizes['size']} to "
+            f"{sizes['compressed_size']} bytes"
+        )
+        return "compress"
+    if head["ContentLength"] <= multipart_threshold():
+        algorithm, _ = choose_algorithm(head)
+        response = client.copy_object(
+            Bucket=destination_bucket,
+            CopySource={"Bucket": source_bucket, "Key": source_key},
+            Key=source_key,
+            ServerSideEncryption="AES256",
+            ACL="bucket-owner-full-control",
+            ChecksumAlgorithm=algorithm,
+        )
+        verify_or_delete(
+            client,
+            destination_bucket,
+            source_key,
+            head,
+            algorithm,
+            response["CopyObjectResult"],
+        )
+        return "copy"
+    multipart_copy(
+        client,
+        source_bucket=source_bucket,
+        source_key=source_key,
+        destination_bucket=destination_bucket,
+        destination_key=source_key,
+        head=head,
+        part_size=int(os.getenv("PART_SIZE", DEFAULT_PART_SIZE)),
+        max_concurrency=max_concurrency(),
+        checkpoint_key=f"{checkpoint_prefix}/{source_key}.json",
+        time_remaining=time_remaining,
+    )
+    return "multipart"
@@ -0,0 +1,190 @@
+"""Lambda handler that keeps a manifest of every object in a pull bucket.
+
+Deployed by BucketManifestFunction. S3 sends the bucket's object created and removed
+notifications to an SQS queue, and the function reads them in batches, applies them
+to the manifest and writes it back, so consumers can read one object instead of
+listing the bucket. The queue is read by one invocation at a time, so updates never
+overwrite each other.
+
+The manifest is gzipped JSON lines, one object per line in key order, with its key,
+size, etag and last_modified. If it doesn't exist yet, it's built by listing the
+bucket once. Each line also records the S3 event sequencer of the last change to
+its object, so notifications that arrive out of order don't undo newer ones.
+Removed objects leave no line behind, so only a created notification delayed beyond
+a later batch's removal of the same key could bring an object back.
+"""
+import gzip
+import json
+import os
+from datetime import datetime
+from typing import Dict, Iterable, Iterator, List, Optional
+from urllib.parse import unquote_plus
+
+import boto3
+from botocore.exceptions import ClientError
+
+MANIFEST_KEY = "_manifest/manifest.jsonl.gz"
+
+_client = None
+
+
+def get_client():
+    """Create the S3 client on first use, then reuse it for the container's lifetime."""
+    global _client
+    if _client is None:
+        # Redirect to local AWS endpoints if running on Localstack
+        if "LOCALSTACK_HOSTNAME" in os.environ:
+            print("Localstack detected - redirecting to locally hosted AWS")
+            _client = boto3.client(
+                "s3", endpoint_url=f"http://{os.getenv('LOCALSTACK_HOSTNAME')}:4566"
+            )
+        else:
+            _client = boto3.client("s3")
+    return _client
+
+
+def manifest_key() -> str:
+    return os.getenv("MANIFEST_KEY", MANIFEST_KEY)
+
+
+def _order(sequencer: Optional[str]) -> int:
+    """Sequencers of events for the same key sort by their value in hex. Objects
+    found by listing the bucket have none, so sort before any event."""
+    return int(sequencer, 16) if sequencer else -1
+
+
+def _timestamp(value) -> str:
+    if isinstance(value, datetime):
+        return value.strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3] + "Z"
+    return value
+
+
+def entry(key: str, size: int, etag: str, last_modified, sequencer=None) -> Dict:
+    """One line of the manifest."""
+    return {
+        "key": key,
+        "size": size,
+        "etag": etag.strip('"'),
+        "last_modified": _timestamp(last_modified),
+        "sequencer": sequencer,
+    }
+
+
+def list_bucket(client, bucket: str) -> Dict[str, Dict]:
+    """Build a manifest from scratch by listing every object in the bucket."""
+    entries = {}
+    paginator = client.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=bucket):
+        for obj in page.get("Contents", []):
+            if obj["Key"] != manifest_key():
+                entries[obj["Key"]] = entry(
+                    obj["Key"], obj["Size"], obj["ETag"], obj["LastModified"]
+                )
+    return entries
+
+
+def read_manifest(client, bucket: str) -> Optional[Dict[str, Dict]]:
+    """Load the manifest, returning None if there isn't one."""
+    try:
+        response = client.get_object(Bucket=bucket, Key=manifest_key())
+    except ClientError as e:
+        if e.response["Error"]["Code"] in ("NoSuchKey", "404"):
+            return None
+        raise
+    lines = gzip.decompress(response["Body"].read()).decode().splitlines()
+    return {line["key"]: line for line in map(json.loads, lines) if line}
+
+
+def write_manifest(client, bucket: str, entries: Dict[str, Dict]) -> None:
+    lines = (json.dumps(entries[key]) + "\n" for key in sorted(entries))
+    client.put_object(
+        Bucket=bucket,
+        Key=manifest_key(),
+        Body=gzip.compress("".join(lines).encode()),
+        ContentType="application/gzip",
+        ServerSideEncryption="AES256",
+    )
+
+
+def s3_records(records: Iterable[Dict]) -> Iterator[Dict]:
+    """The S3 event records in a batch of SQS messages, skipping test events."""
+    for record in records:
+        for s3_record in json.loads(record["body"]).get("Records", []):
+            if unquote_plus(s3_record["s3"]["object"]["key"]) != manifest_key():
+                yield s3_record
+
+
+def _current_version(client, bucket: str, key: str, sequencer: str) -> Optional[Dict]:
+    """The manifest line for whichever version of an object is now current, or None
+    if there isn't one."""
+    try:
+        head = client.head_object(Bucket=bucket, Key=key)
+    except ClientError as e:
+        if e.response["Error"]["Code"] in ("NoSuchKey", "404"):
+            return None
+        raise
+    return entry(
+        key, head["ContentLength"], head["ETag"], head["LastModified"], sequencer
+    )
+
+
+def apply(client, bucket: str, entries: Dict[str, Dict], records: List[Dict]) -> bool:
+    """Apply created and removed events to the manifest, ignoring any older than
+    what the manifest already has for their key.
+
+    Deleting a specific version of an object in a versioned bucket may leave an
+    older version current, so the object is looked up again rather than removed.
+
+    Returns
+    -------
+    bool
+        Whether the manifest changed.
+    """
+    changed = False
+    ordered = sorted(
+        records,
+        key=lambda r: (
+            r["s3"]["object"]["key"],
+            _order(r["s3"]["object"]["sequencer"]),
+        ),
+    )
+    for record in ordered:
+        obj = record["s3"]["object"]
+        key = unquote_plus(obj["key"])
+        current = entries.get(key)
+        if current and _order(current["sequencer"]) >= _order(obj["sequencer"]):
+            continue
+        if record["eventName"].startswith("ObjectCreated:"):
+            new = entry(
+                key, obj["size"], obj["eTag"], record["eventTime"], obj["sequencer"]
+            )
+        elif record["eventName"] == "ObjectRemoved:Delete" and obj.get("versionId"):
+            new = _current_version(client, bucket, key, obj["sequencer"])
+        else:
+            new = None
+        if new:
+            entries[key] = new
+        elif current:
+            del entries[key]
+        changed = changed or new != current
+    return changed
+
+
+def update_manifest(client, bucket: str, records: List[Dict]) -> None:
+    """Apply a batch of a bucket's S3 event records to its manifest."""
+    entries = read_manifest(client, bucket)
+    if entries is None:
+        # The listing is newer than the events, so already includes them
+        print(f"No manifest in {bucket} - building one from a listing")
+        write_manifest(client, bucket, list_bucket(client, bucket))
+    elif apply(client, bucket, entries, records):
+        write_manifest(client, bucket, entries)
+
+
+def handler(event, context):
+    client = get_client()
+    by_bucket = {}
+    for record in s3_records(event["Records"]):
+        by_bucket.setdefault(record["s3"]["bucket"]["name"], []).append(record)
+    for bucket, records in by_bucket.items():
+        update_manifest(client, bucket, records)
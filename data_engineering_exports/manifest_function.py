@@ -0,0 +1,238 @@
+import json
+from pathlib import Path
+from typing import Dict, Optional
+
+from data_engineering_pulumi_components.aws import Bucket
+from data_engineering_pulumi_components.utils import Tagger
+from pulumi import AssetArchive, ComponentResource, FileArchive, Output, ResourceOptions
+from pulumi_aws.iam import Role, RolePolicy, RolePolicyAttachment
+from pulumi_aws.lambda_ import EventSourceMapping, Function, FunctionEnvironmentArgs
+from pulumi_aws.s3 import BucketNotification, BucketNotificationQueueArgs
+from pulumi_aws.sqs import Queue, QueuePolicy
+
+from data_engineering_exports.export_function import (
+    LAMBDA_ASSUME_ROLE_POLICY,
+    MAX_RECEIVE_COUNT,
+)
+from data_engineering_exports.lambda_handlers.manifest import manifest
+
+FUNCTION_TIMEOUT = 300
+FUNCTION_MEMORY = 512
+# Rewriting the manifest costs the same for one change as for many, so wait to
+# collect changes into fewer, larger batches
+BATCH_SIZE = 1000
+BATCHING_WINDOW_S = 60
+
+
+def handler_code() -> AssetArchive:
+    """Package the manifest handler for Lambda."""
+    path = Path(manifest.__file__).absolute().parent
+    return AssetArchive(assets={"manifest": FileArchive(path=str(path))})
+
+
+class BucketManifestFunction(ComponentResource):
+    def __init__(
+        self,
+        name: str,
+        bucket: Bucket,
+        tagger: Tagger,
+        memory_mb: int = FUNCTION_MEMORY,
+        opts: Optional[ResourceOptions] = None,
+    ) -> None:
+        """
+        Provides a Lambda function that keeps a manifest of every object in a bucket,
+        at manifest.MANIFEST_KEY, so its readers don't need to list it.
+
+        The bucket's object created and removed notifications are sent to an SQS
+        queue, and the function reads them in batches, rewriting the manifest once
+        per batch. Its concurrency is reserved at 1, so only one invocation updates
+        the manifest at a time.
+
+        Creates the bucket's BucketNotification, so the bucket can't have any other
+        notifications.
+
+        Parameters
+        ----------
+        name : str
+            The name of the resource.
+        bucket : Bucket
+            The bucket to keep a manifest of.
+        tagger : Tagger
+            A tagger resource.
+        memory_mb : int
+            Memory for the function in MB. The whole manifest is held in memory, so
+            very large buckets may need more. Defaults to 512.
+        opts : Optional[ResourceOptions]
+            Options for the resource. By default, None.
+        """
+        super().__init__(
+            t="data-engineering-exports:aws:BucketManifestFunction",
+            name=name,
+            props=None,
+            opts=opts,
+        )
+
+        self._role = Role(
+            resource_name=f"{name}-role",
+            assume_role_policy=LAMBDA_ASSUME_ROLE_POLICY,
+            name=f"{name}-manifest",
+            path="/service-role/",
+            tags=tagger.create_tags(f"{name}-manifest"),
+            opts=ResourceOptions(parent=self),
+        )
+        self._rolePolicyAttachment = RolePolicyAttachment(
+            resource_name=f"{name}-role-policy-attachment",
+            policy_arn=(
+                "arn:aws:iam::aws:policy/service-role/AWSLambdaBasicExecutionRole"
+            ),
+            role=self._role.name,
+            opts=ResourceOptions(parent=self._role),
+        )
+        self._build_queue(name, bucket, tagger)
+        self._rolePolicy = RolePolicy(
+            resource_name=f"{name}-role-policy",
+            name="manifest-access",
+            policy=Output.all(bucket.arn, self.queue.arn).apply(
+                lambda args: json.dumps(manifest_role_policy(*args))
+            ),
+            role=self._role.id,
+            opts=ResourceOptions(parent=self._role),
+        )
+        self._function = Function(
+            resource_name=f"{name}-function",
+            code=handler_code(),
+            description=bucket.name.apply(
+                lambda bucket_name: f"Keeps a manifest of the objects in {bucket_name}"
+            ),
+            environment=FunctionEnvironmentArgs(
+                variables={"MANIFEST_KEY": manifest.MANIFEST_KEY}
+            ),
+            handler="manifest.manifest.handler",
+            name=f"{name}-manifest",
+            role=self._role.arn,
+            runtime="python3.10",
+            memory_size=memory_mb,
+            reserved_concurrent_executions=1,
+            tags=tagger.create_tags(f"{name}-manifest"),
+            timeout=FUNCTION_TIMEOUT,
+            opts=ResourceOptions(parent=self),
+        )
+        self._event_source_mapping = EventSourceMapping(
+            resource_name=f"{name}-event-source-mapping",
+            event_source_arn=self.queue.arn,
+            function_name=self._function.arn,
+            batch_size=BATCH_SIZE,
+            maximum_batching_window_in_seconds=BATCHING_WINDOW_S,
+            opts=ResourceOptions(parent=self._function, depends_on=[self._rolePolicy]),
+        )
+        self._bucket_notification = BucketNotification(
+            resource_name=f"{name}-bucket-notification",
+            bucket=bucket.id,
+            queues=[
+                BucketNotificationQueueArgs(
+                    events=["s3:ObjectCreated:*", "s3:ObjectRemoved:*"],
+                    queue_arn=self.queue.arn,
+                )
+            ],
+            opts=ResourceOptions(parent=self, depends_on=[self._queue_policy]),
+        )
+        self.register_outputs({})
+
+    def _build_queue(self, name: str, bucket: Bucket, tagger: Tagger) -> None:
+        """Create an SQS queue for the bucket to send notifications to, with a
+        dead-letter queue."""
+        self._dead_letter_queue = Queue(
+            resource_name=f"{name}-dead-letter-queue",
+            name=f"{name}-manifest-dlq",
+            message_retention_seconds=14 * 24 * 60 * 60,
+            sqs_managed_sse_enabled=True,
+            tags=tagger.create_tags(f"{name}-manifest-dlq"),
+            opts=ResourceOptions(parent=self),
+        )
+        self.queue = Queue(
+            resource_name=f"{name}-queue",
+            name=f"{name}-manifest",
+            # AWS recommends six times the function timeout for Lambda sources
+            visibility_timeout_seconds=6 * FUNCTION_TIMEOUT,
+            redrive_policy=self._dead_letter_queue.arn.apply(
+                lambda arn: json.dumps(
+                    {"deadLetterTargetArn": arn, "maxReceiveCount": MAX_RECEIVE_COUNT}
+                )
+            ),
+            sqs_managed_sse_enabled=True,
+            tags=tagger.create_tags(f"{name}-manifest"),
+            opts=ResourceOptions(parent=self),
+        )
+        self._queue_policy = QueuePolicy(
+            resource_name=f"{name}-queue-policy",
+            queue_url=self.queue.id,
+            policy=Output.all(self.queue.arn, bucket.arn).apply(
+                lambda args: json.dumps(
+                    {
+                        "Version": "2012-10-17",
+                        "Statement": [
+                            {
+                                "Sid": "SendFromBucket",
+                                "Effect": "Allow",
+                                "Principal": {"Service": "s3.amazonaws.com"},
+                                "Action": "sqs:SendMessage",
+                                "Resource": args[0],
+                                "Condition": {"ArnEquals": {"aws:SourceArn": args[1]}},
+                            }
+                        ],
+                    }
+                )
+            ),
+            opts=ResourceOptions(parent=self.queue),
+        )
+
+
+def manifest_role_policy(bucket_arn: str, queue_arn: str) -> Dict:
+    """Create the policy for a manifest function's role, letting it list the bucket,
+    look up objects, rewrite the manifest and read the queue.
+
+    Parameters
+    ----------
+    bucket_arn : str
+        ARN of the bucket the manifest lists.
+    queue_arn : str
+        ARN of the queue of the bucket's notifications.
+
+    Returns
+    -------
+    Dict
+        AWS IAM policy document.
+    """
+    return {
+        "Version": "2012-10-17",
+        "Statement": [
+            {
+                "Sid": "ListBucket",
+                "Effect": "Allow",
+                "Resource": [bucket_arn],
+                "Action": ["s3:ListBucket"],
+            },
+            {
+                "Sid": "ReadObjects",
+                "Effect": "Allow",
+                "Resource": [f"{bucket_arn}/*"],
+                "Action": ["s3:GetObject"],
+            },
+            {
+                "Sid": "WriteManifest",
+                "Effect": "Allow",
+                "Resource": [f"{bucket_arn}/{manifest.MANIFEST_KEY}"],
+                "Action": ["s3:PutObject"],
+            },
+            {
+                "Sid": "ReadNotificationQueue",
+                "Effect": "Allow",
+                "Resource": [queue_arn],
+                "Action": [
+                    "sqs:ReceiveMessage",
+                    "sqs:DeleteMessage",
+                    "sqs:GetQueueAttributes",
+                ],
+            },
+        ],
+    }
@@ -0,0 +1,397 @@
+"""Plan deploys that only update the resources of datasets that have changed.
+
+Every deploy records a fingerprint of each dataset's normalised config, and of the
+program itself, as the deployed_datasets stack output. Before the next deploy, the
+planner compares the configs on disk with that output to find the datasets that
+were added, changed or removed, and works out the URNs of their resources:
+
+- a push dataset's ExportObjectFunction, and a pull dataset's bucket, along with
+  every resource below them, including its replicas
+- the region providers the replicas are created with, if a pull dataset changed
+- the combined bucket notification and any router function, if a push dataset
+  changed
+- the role policies of every user of a changed dataset, and of any user whose
+  policy is different from the one deployed (merging prefixes into wildcards means
+  a new dataset can change the policy of someone who isn't one of its users)
+
+URNs of resources that don't exist yet are found by running the program under
+mocks, and URNs of resources that are being removed come from the deployed state.
+If the program's code or any of the stack config it reads has changed, or there is
+no record of the last deploy, the plan is a full update.
+"""
+import hashlib
+import json
+import re
+import runpy
+from pathlib import Path
+from typing import Callable, Dict, Iterable, List, NamedTuple, Optional, Set, Union
+
+import pulumi
+from pulumi import automation as auto
+from pulumi.runtime.mocks import MockMonitor
+
+from data_engineering_exports import registry, utils
+
+DEPLOYED_DATASETS_OUTPUT = "deployed_datasets"
+PROGRAM_KEY = "program"
+# Files whose contents affect every resource, relative to the project folder
+PROGRAM_FILES = ["__main__.py", "requirements.txt", "data_engineering_exports/**/*"]
+# Stack config settings the program reads, which can change any resource. The
+# program reads them all with program_config, so none can be missed from the hash.
+PROGRAM_CONFIG = ("push_engine", "push_notifications", "zstd_layer_arn")
+
+STACK_TYPE = "pulumi:pulumi:Stack"
+PUSH_ROOT_TYPE = "data-engineering-exports:aws:ExportObjectFunction"
+PULL_ROOT_TYPE = "data-engineering-pulumi-components:aws:Bucket"
+ROUTER_TYPE = "data-engineering-exports:aws:ExportRouterFunction"
+PROVIDER_TYPE = "pulumi:providers:aws"
+NOTIFICATION_TYPE = "aws:s3/bucketNotification:BucketNotification"
+USER_POLICY_TYPES = {
+    "aws:iam/rolePolicy:RolePolicy",
+    "aws:iam/policy:Policy",
+    "aws:iam/rolePolicyAttachment:RolePolicyAttachment",
+}
+USER_POLICY_NAME = re.compile(r"^(?P<user>.+)_exports_(push(_\d+)?|pull)$")
+
+
+class Resource(NamedTuple):
+    """A resource in the program or in the deployed state."""
+
+    urn: str
+    type: str
+    name: str
+    parent: Optional[str] = None
+    policy: Optional[str] = None
+
+
+class DeployPlan(NamedTuple):
+    """What a deploy needs to do.
+
+    changed - keys of the datasets that were added, changed or removed
+    targets - URNs to update, or None if everything must be updated
+    """
+
+    changed: List[str]
+    targets: Optional[List[str]]
+
+    @property
+    def full(self) -> bool:
+        return self.targets is None
+
+
+def config_hash(config: Dict) -> str:
+    return hashlib.sha256(json.dumps(config, sort_keys=True).encode()).hexdigest()
+
+
+def program_config(get: Callable[[str], Optional[str]]) -> Dict[str, Optional[str]]:
+    """Read every setting in PROGRAM_CONFIG.
+
+    Parameters
+    ----------
+    get : Callable[[str], Optional[str]]
+        Returns the value of a setting, or None if it isn't set - like the get
+        method of pulumi.Config.
+    """
+    return {key: get(key) for key in PROGRAM_CONFIG}
+
+
+def program_hash(
+    project_folder: Union[str, Path], config: Dict[str, Optional[str]]
+) -> str:
+    """Hash the program's code, and the stack config that changes which resources
+    it creates, as read by program_config."""
+    project_folder = Path(project_folder)
+    digest = hashlib.sha256(json.dumps(config, sort_keys=True).encode() + b"\n")
+    paths = sorted(
+        path
+        for pattern in PROGRAM_FILES
+        for path in project_folder.glob(pattern)
+        if path.is_file() and "__pycache__" not in path.parts
+    )
+    for path in paths:
+        digest.update(path.relative_to(project_folder).as_posix().encode() + b"\0")
+        digest.update(path.read_bytes())
+    return digest.hexdigest()
+
+
+def dataset_fingerprints(
+    push_configs: Iterable[Dict], pull_configs: Iterable[Dict], program: str
+) -> Dict[str, Dict]:
+    """Record what was deployed, to compare with the next deploy.
+
+    Parameters
+    ----------
+    push_configs, pull_configs : Iterable[Dict]
+        Normalised dataset configs, as loaded by registry.load_configs.
+    program : str
+        The program's hash, from program_hash.
+
+    Returns
+    -------
+    Dict[str, Dict]
+        Maps "push/<name>" and "pull/<name>" to the hash of the dataset's config and
+        its users, and "program" to the program's hash.
+    """
+    fingerprints = {PROGRAM_KEY: {"hash": program}}
+    for kind, configs in (("push", push_configs), ("pull", pull_configs)):
+        for config in configs:
+            fingerprints[f"{kind}/{config['name']}"] = {
+                "hash": config_hash(config),
+                "users": sorted(config["users"]),
+            }
+    return fingerprints
+
+
+def changed_datasets(current: Dict[str, Dict], previous: Dict[str, Dict]) -> Set[str]:
+    """Keys of fingerprints that were added, removed, or have a different hash."""
+    return {
+        key
+        for key in set(current) | set(previous)
+        if current.get(key, {}).get("hash") != previous.get(key, {}).get("hash")
+    }
+
+
+def _descendants(resources: Iterable[Resource], roots: Set[str]) -> Set[str]:
+    """URNs of the roots and every resource below them."""
+    children = {}
+    for resource in resources:
+        children.setdefault(resource.parent, []).append(resource.urn)
+    found, waiting = set(), list(roots)
+    while waiting:
+        urn = waiting.pop()
+        if urn not in found:
+            found.add(urn)
+            waiting.extend(children.get(urn, []))
+    return found
+
+
+def _dataset_root(key: str) -> tuple:
+    kind, name = key.split("/", 1)
+    if kind == "push":
+        return PUSH_ROOT_TYPE, f"export_{name}"
+    return PULL_ROOT_TYPE, f"mojap-{name}"
+
+
+def _same_policy(first: Optional[str], second: Optional[str]) -> bool:
+    try:
+        return json.loads(first) == json.loads(second)
+    except (TypeError, ValueError):
+        return first == second
+
+
+def _changed_user_policies(
+    simulated: List[Resource], deployed: List[Resource]
+) -> Set[str]:
+    """Users whose policies in the program differ from the deployed ones."""
+    deployed_policies = {(r.type, r.name): r.policy for r in deployed}
+    simulated_policies = {(r.type, r.name): r.policy for r in simulated}
+    users = set()
+    for key in set(deployed_policies) | set(simulated_policies):
+        match = USER_POLICY_NAME.match(key[1])
+        if key[0] not in USER_POLICY_TYPES or not match:
+            continue
+        if (
+            key not in deployed_policies
+            or key not in simulated_policies
+            or not _same_policy(deployed_policies[key], simulated_policies[key])
+        ):
+            users.add(match["user"])
+    return users
+
+
+def select_targets(
+    simulated: List[Resource],
+    deployed: List[Resource],
+    current: Dict[str, Dict],
+    previous: Dict[str, Dict],
+) -> DeployPlan:
+    """Work out which resources a deploy needs to update.
+
+    Parameters
+    ----------
+    simulated : List[Resource]
+        Resources the program creates now, from simulate_program.
+    deployed : List[Resource]
+        Resources in the stack's state, from deployed_resources.
+    current, previous : Dict[str, Dict]
+        Fingerprints of the configs on disk, and of the last deploy.
+    """
+    changed = sorted(changed_datasets(current, previous))
+    if not previous or PROGRAM_KEY in changed:
+        return DeployPlan(changed, None)
+    if not changed:
+        return DeployPlan(changed, [])
+
+    everything = simulated + deployed
+    roots = {_dataset_root(key) for key in changed}
+    root_urns = {r.urn for r in everything if (r.type, r.name) in roots}
+
+    users = _changed_user_policies(simulated, deployed)
+    for key in changed:
+        for fingerprints in (current, previous):
+            users.update(fingerprints.get(key, {}).get("users", []))
+    for resource in everything:
+        match = USER_POLICY_NAME.match(resource.name)
+        if resource.type in USER_POLICY_TYPES and match and match["user"] in users:
+            root_urns.add(resource.urn)
+        elif resource.type == STACK_TYPE:
+            # Include the stack itself, so its deployed_datasets output is updated
+            root_urns.add(resource.urn)
+        elif resource.type in (NOTIFICATION_TYPE, ROUTER_TYPE) and any(
+            key.startswith("push/") for key in changed
+        ):
+            root_urns.add(resource.urn)
+        elif resource.type == PROVIDER_TYPE and any(
+            key.startswith("pull/") for key in changed
+        ):
+            # Shared by every dataset's replicas, so can't be below any one of them
+            root_urns.add(resource.urn)
+
+    return DeployPlan(changed, sorted(_descendants(everything, root_urns)))
+
+
+class _PlanningMocks(pulumi.runtime.Mocks):
+    """Give resources just enough state for the program to run, and record the
+    policy documents it creates."""
+
+    def __init__(self):
+        self.policies = {}
+
+    def new_resource(self, args: pulumi.runtime.MockResourceArgs):
+        self.policies[(args.typ, args.name)] = args.inputs.get("policy")
+        service = args.typ.split(":")[1].split("/")[0]
+        name = args.inputs.get("bucket") or args.inputs.get("name") or args.name
+        state = {"arn": f"arn:aws:{service}:::{name}"}
+        return [f"{args.name}_id", dict(args.inputs, **state)]
+
+    def call(self, args: pulumi.runtime.MockCallArgs):
+        return args.args
+
+
+class _RecordingMonitor(MockMonitor):
+    """Mock monitor that makes URNs the way the Pulumi engine does, with the full
+    chain of parent types, and records every resource registered."""
+
+    def __init__(self, mocks: pulumi.runtime.Mocks):
+        super().__init__(mocks)
+        self.registered = []
+
+    def make_urn(self, parent: str, type_: str, name: str) -> str:
+        if parent and parent.split("::")[2] != STACK_TYPE:
+            type_ = parent.split("::")[2] + "$" + type_
+        return "urn:pulumi:" + "::".join(
+            [pulumi.get_stack(), pulumi.get_project(), type_, name]
+        )
+
+    def RegisterResource(self, request):
+        response = super().RegisterResource(request)
+        self.registered.append(
+            (response.urn, request.type, request.name, request.parent)
+        )
+        return response
+
+
+def simulate_program(
+    program: Union[str, Path], project: str, stack: str, config: Dict[str, str]
+) -> List[Resource]:
+    """Run the Pulumi program under mocks, without contacting AWS or the backend,
+    and return every resource it would create.
+
+    Parameters
+    ----------
+    program : Union[str, Path]
+        Path of the program's __main__.py. It's run from the current folder.
+    project, stack : str
+        Names of the Pulumi project and stack, which are part of each URN.
+    config : Dict[str, str]
+        The stack's config, with keys like "project:key".
+    """
+    mocks = _PlanningMocks()
+    monitor = _RecordingMonitor(mocks)
+    pulumi.runtime.set_mocks(mocks, project=project, stack=stack, monitor=monitor)
+    pulumi.runtime.set_all_config(config)
+
+    @pulumi.runtime.test
+    def run():
+        runpy.run_path(str(program), run_name="__main__")
+
+    run()
+    return [
+        Resource(urn, type_, name, parent or None, mocks.policies.get((type_, name)))
+        for urn, type_, name, parent in monitor.registered
+    ]
+
+
+def deployed_resources(stack: auto.Stack) -> List[Resource]:
+    """Every resource in a stack's state."""
+    resources = stack.export_stack().deployment.get("resources") or []
+    return [
+        Resource(
+            resource["urn"],
+            resource["type"],
+            resource["urn"].split("::")[-1],
+            resource.get("parent"),
+            (resource.get("inputs") or {}).get("policy"),
+        )
+        for resource in resources
+    ]
+
+
+def current_fingerprints(
+    project_folder: Union[str, Path], config: Dict[str, Optional[str]]
+) -> Dict[str, Dict]:
+    """Fingerprints of the program and dataset configs on disk."""
+    project_folder = Path(project_folder)
+    push_configs = registry.load_configs(
+        utils.list_yaml_files(project_folder / "push_datasets"), "push"
+    )
+    pull_configs = registry.load_configs(
+        utils.list_yaml_files(project_folder / "pull_datasets"), "pull"
+    )
+    return dataset_fingerprints(
+        push_configs, pull_configs, program_hash(project_folder, config)
+    )
+
+
+def plan_deploy(stack: auto.Stack, project_folder: Union[str, Path]) -> DeployPlan:
+    """Compare the configs on disk with a stack's last deploy, and plan which
+    resources to update.
+
+    Parameters
+    ----------
+    stack : auto.Stack
+        The stack to deploy, selected with its work_dir set to project_folder.
+    project_folder : Union[str, Path]
+        The folder holding Pulumi.yaml and the program.
+    """
+    project = stack.workspace.project_settings().name
+    config = {key: value.value for key, value in stack.get_all_config().items()}
+    outputs = stack.outputs()
+    previous = (
+        outputs[DEPLOYED_DATASETS_OUTPUT].value
+        if (DEPLOYED_DATASETS_OUTPUT in outputs)
+        else {}
+    )
+    current = current_fingerprints(
+        project_folder, program_config(lambda key: config.get(f"{project}:{key}"))
+    )
+
+    plan = select_targets([], [], current, previous)
+    if plan.full or not plan.changed:
+        return plan
+    simulated = simulate_program(
+        Path(project_folder) / "__main__.py", project, stack.name, config
+    )
+    return select_targets(simulated, deployed_resources(stack), current, previous)
+
+
+def deploy(
+    stack: auto.Stack, plan: DeployPlan, parallel: Optional[int] = None
+) -> Optional[auto.UpResult]:
+    """Run the update described by a plan. Does nothing if nothing has changed."""
+    if plan.full:
+        return stack.up(parallel=parallel, on_output=print)
+    if plan.targets:
+        return stack.up(target=plan.targets, parallel=parallel, on_output=print)
+    print("No datasets have changed")
+    return None
@@ -0,0 +1,212 @@
+"""Build IAM policy documents, and keep them inside AWS size limits.
+
+policy_document builds documents locally as canonical JSON, rather than calling the
+provider plugin through get_policy_document for each one. Identical documents, like
+the policies of users who share the same datasets, are built only once.
+
+A user's push policy lists one export bucket resource per dataset. For users on a
+lot of datasets this can pass the 10,240 character limit on a role's inline
+policies, and the deploy fails. compact_prefixes shortens the list by replacing
+groups of prefixes with a wildcard, where the wildcard matches no other dataset.
+split_resources then predicts the size of the policy and shares the resources
+between several documents, each under the limit.
+
+IAM counts policy size without whitespace, so documents are built as compact JSON
+and their size is just their length.
+"""
+import json
+from functools import lru_cache
+from typing import Callable, Dict, Iterable, List, Optional, Tuple, Union
+
+# Total size of all the inline policies on one role
+INLINE_POLICY_LIMIT = 10_240
+# Size of a single customer managed policy
+MANAGED_POLICY_LIMIT = 6_144
+# Customer managed policies that can be attached to one role, by default
+MAX_MANAGED_POLICIES = 10
+# Stands in for a bucket ARN when predicting sizes, as the real ARN isn't known until
+# the bucket exists. Bucket names can be up to 63 characters.
+LONGEST_BUCKET_ARN = "arn:aws:s3:::" + "x" * 63
+
+POLICY_VERSION = "2012-10-17"
+# Statement keys whose values are lists where order and repeats don't matter
+_UNORDERED_KEYS = ("Action", "NotAction", "Resource", "NotResource")
+
+# Marks the end of a prefix in the trie, as no prefix contains an empty string
+_END = ""
+
+
+class PolicyTooLargeError(Exception):
+    pass
+
+
+def statement(
+    actions: Union[str, List[str]],
+    resources: Union[str, List[str]],
+    effect: str = "Allow",
+    **extra,
+) -> Dict:
+    """Make a policy statement.
+
+    Parameters
+    ----------
+    actions : Union[str, List[str]]
+        The actions the statement allows or denies.
+    resources : Union[str, List[str]]
+        ARNs of the resources the statement applies to.
+    effect : str
+        Either "Allow" (the default) or "Deny".
+    **extra
+        Any other keys of the statement, such as Principal or Condition.
+    """
+    return {"Effect": effect, "Action": actions, "Resource": resources, **extra}
+
+
+def _canonical_statement(statement: Dict) -> str:
+    """Serialise a statement with sorted keys, and its actions and resources sorted
+    with repeats removed, so equivalent statements serialise the same way."""
+    canonical = dict(statement)
+    for key in _UNORDERED_KEYS:
+        if isinstance(canonical.get(key), list):
+            canonical[key] = sorted(set(canonical[key]))
+    return json.dumps(canonical, sort_keys=True, separators=(",", ":"))
+
+
+@lru_cache(maxsize=None)
+def _serialise(statements: Tuple[str, ...]) -> str:
+    return f'{{"Statement":[{",".join(statements)}],"Version":"{POLICY_VERSION}"}}'
+
+
+def policy_document(statements: Iterable[Dict]) -> str:
+    """Build a policy document as canonical JSON.
+
+    Statements are sorted and deduplicated, as are the actions and resources within
+    them, so the same permissions always give the same document however they were
+    listed. Documents are cached, so building an identical document again returns
+    the string made the first time.
+
+    Parameters
+    ----------
+    statements : Iterable[Dict]
+        The policy statements, as made by statement.
+
+    Returns
+    -------
+    str
+        The document, as compact JSON with sorted keys.
+    """
+    return _serialise(tuple(sorted({_canonical_statement(s) for s in statements})))
+
+
+def _build_trie(prefixes: Iterable[str], owned: set) -> Dict:
+    """Build a character trie of prefixes. Where a prefix ends, the _END key records
+    whether it belongs to the user."""
+    trie = {}
+    for prefix in prefixes:
+        node = trie
+        for character in prefix:
+            node = node.setdefault(character, {})
+        node[_END] = prefix in owned
+    return trie
+
+
+def _compact_node(node: Dict, path: str) -> Tuple[bool, int, List[str]]:
+    """Compact the part of the trie below node.
+
+    Returns
+    -------
+    Tuple[bool, int, List[str]]
+        Whether every prefix below the node belongs to the user, how many of them
+        do, and the shortest list of patterns that matches exactly those prefixes.
+    """
+    all_owned = node.get(_END, True)
+    count = 1 if node.get(_END) else 0
+    patterns = [path] if node.get(_END) else []
+    for character in sorted(key for key in node if key != _END):
+        child_all_owned, child_count, child_patterns = _compact_node(
+            node[character], path + character
+        )
+        all_owned = all_owned and child_all_owned
+        count += child_count
+        patterns.extend(child_patterns)
+    # A wildcard only saves space if it replaces more than one prefix, and is never
+    # used at the root, where it would match the whole bucket
+    if all_owned and count > 1 and path:
+        patterns = [path + "*"]
+    return all_owned, count, patterns
+
+
+def compact_prefixes(
+    prefixes: Iterable[str], all_prefixes: Optional[Iterable[str]] = None
+) -> List[str]:
+    """Shorten a user's list of dataset prefixes by merging them into wildcards.
+
+    A group of prefixes that share a start, like `prisons_a` and `prisons_b`, becomes
+    `prisons_*` - but only if no other dataset in all_prefixes starts the same way,
+    so the wildcard grants no access to another dataset. Because the policies are
+    rebuilt on every deploy, a new dataset that would match a wildcard splits it up
+    again in the same deploy that creates the dataset.
+
+    Parameters
+    ----------
+    prefixes : Iterable[str]
+        The prefixes the user can write to.
+    all_prefixes : Iterable[str], optional
+        Every prefix in use in the bucket, including other users' datasets and any
+        prefixes the exporter keeps for itself. If None, nothing is merged.
+
+    Returns
+    -------
+    List[str]
+        Sorted prefixes and wildcards, matching every prefix in prefixes and nothing
+        else in all_prefixes.
+    """
+    owned = set(prefixes)
+    if all_prefixes is None:
+        return sorted(owned)
+    trie = _build_trie(owned.union(all_prefixes), owned)
+    return _compact_node(trie, "")[2]
+
+
+def split_resources(
+    build_document: Callable[[List[str]], str], resources: List[str], limit: int
+) -> List[List[str]]:
+    """Share resources between as few policy documents as possible, each no larger
+    than limit.
+
+    Parameters
+    ----------
+    build_document : Callable[[List[str]], str]
+        Makes a complete policy document, as made by policy_document, from part of
+        the list of resources.
+    resources : List[str]
+        Resources to share out, in order.
+    limit : int
+        Largest size allowed for each document.
+
+    Returns
+    -------
+    List[List[str]]
+        The resources for each document.
+
+    Raises
+    ------
+    PolicyTooLargeError
+        If a single resource doesn't fit in a document on its own.
+    """
+    # A document's size grows by the quoted length of each resource plus a comma,
+    # so it can be predicted without serialising it again for each resource
+    empty_size = len(build_document([])) - 1
+    chunks, chunk, size = [], [], empty_size
+    for resource in resources:
+        resource_size = len(json.dumps(resource)) + 1
+        if empty_size + resource_size > limit:
+            raise PolicyTooLargeError(f"{resource} is too long to fit in a policy")
+        if size + resource_size > limit:
+            chunks.append(chunk)
+            chunk, size = [], empty_size
+        chunk.append(resource)
+        size += resource_size
+    if chunk or not chunks:
+        chunks.append(chunk)
+    return chunks
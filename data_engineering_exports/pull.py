@@ -1,11 +1,316 @@
-from typing import Dict
+import json
+from collections import defaultdict
+from pathlib import Path
+from typing import Dict, List, Optional
 
-from pulumi_aws.iam import GetPolicyDocumentStatementArgs
-from pulumi_aws.iam.get_policy_document import (
-    get_policy_document,
-    AwaitableGetPolicyDocumentResult,
+from data_engineering_pulumi_components.aws import Bucket
+from data_engineering_pulumi_components.utils import Tagger
+from pulumi import ROOT_STACK_RESOURCE, Alias, Output, ResourceOptions, export
+from pulumi_aws import Provider
+from pulumi_aws.iam import Role, RolePolicy
+from pulumi_aws.s3 import (
+    BucketPolicy,
+    BucketReplicationConfig,
+    BucketReplicationConfigRuleArgs,
+    BucketReplicationConfigRuleDeleteMarkerReplicationArgs,
+    BucketReplicationConfigRuleDestinationArgs,
+    BucketReplicationConfigRuleFilterArgs,
 )
 
+from data_engineering_exports.manifest_function import BucketManifestFunction
+from data_engineering_exports.policy import policy_document, statement
+from data_engineering_exports.push import DatasetsNotLoadedError, UsersNotLoadedError
+from data_engineering_exports.registry import load_configs
+
+REPLICATION_ASSUME_ROLE_POLICY = json.dumps(
+    {
+        "Version": "2012-10-17",
+        "Statement": [
+            {
+                "Effect": "Allow",
+                "Principal": {"Service": "s3.amazonaws.com"},
+                "Action": "sts:AssumeRole",
+            }
+        ],
+    }
+)
+# One provider for each region that has replica buckets, shared by every dataset.
+# The deploy planner targets them whenever a pull dataset changes.
+_providers: Dict[str, Provider] = {}
+
+
+class PullExportDatasets:
+    """Hold information about pull datasets, starting from a list of yaml filepaths.
+    Use methods to load those files and create AWS resources based on their data:
+
+    - extract user and dataset information from yaml files using load_datasets_and_users
+    - create a bucket, with a policy letting the dataset's pull ARNs read from it, for
+      each dataset with build_buckets, plus a manifest function and replica buckets
+      for datasets that ask for them
+    - add a role policy to each user with build_role_policies - this gives read and
+      write access to the buckets of every dataset that includes their name, in a
+      single policy per user
+    """
+
+    def __init__(
+        self,
+        config_paths: List[Path],
+        tagger: Tagger,
+        index_path: Optional[Path] = None,
+    ):
+        """Store a list of relevant yaml files and a tagger. At this point, read no
+        config files and create no AWS resources.
+
+        Parameters
+        ----------
+        config_paths : list
+            List of Path objects pointing to yaml files (as created by list_yaml_files).
+        tagger : Tagger
+            A Tagger object from data-engineering-pulumi-components.utils
+        index_path : Path, optional
+            Where to cache validated configs between runs - see registry.load_configs.
+            If None, every config file is read each time.
+        """
+        self.config_paths = config_paths
+        self.index_path = index_path
+        self.tagger = tagger
+        self.datasets = None  # Added with load_datasets_and_users
+        self.users = None  # Added with load_datasets_and_users
+        self.role_policies = None  # Added with build_role_policies
+
+    def load_datasets_and_users(self):
+        """Read and validate the yaml config files and store:
+        - a list of PullExportDataset objects, one for each dataset
+        - a dictionary of usernames, each with a list of datasets they can access
+        """
+        self.datasets = []
+        self.users = defaultdict(list)
+
+        for config in load_configs(self.config_paths, "pull", self.index_path):
+            dataset = PullExportDataset(config, self.tagger)
+            self.datasets.append(dataset)
+
+            for user in dataset.users:
+                self.users[user].append(dataset)
+
+    def build_buckets(self):
+        """Create a bucket and bucket policy for each dataset, using the datasets'
+        build_bucket methods."""
+        if not self.datasets:
+            raise DatasetsNotLoadedError(
+                "Run load_datasets_and_users before building buckets"
+            )
+        for dataset in self.datasets:
+            dataset.build_bucket()
+
+    def build_role_policies(self):
+        """Create one role policy for each username mentioned in the datasets, giving
+        read and write access to all of their datasets' buckets."""
+        if not self.users:
+            raise UsersNotLoadedError(
+                "Run load_datasets_and_users before building role policies"
+            )
+        self.role_policies = []
+        for user, datasets in self.users.items():
+            if any(dataset.bucket is None for dataset in datasets):
+                raise DatasetsNotLoadedError(
+                    "Run build_buckets before building role policies"
+                )
+            document = Output.all(*[dataset.bucket.arn for dataset in datasets]).apply(
+                create_combined_read_write_role_policy
+            )
+            self.role_policies.append(
+                RolePolicy(
+                    resource_name=f"{user}_exports_pull",
+                    policy=document,
+                    role=user,
+                    name="hub-exports-pull",
+                )
+            )
+
+    def inline_policy_sizes(self) -> Dict[str, int]:
+        """Predict the size of each user's pull role policy, from the names their
+        datasets' buckets are given by build_bucket.
+
+        The pull policy shares its role's inline policy limit with the user's push
+        policy, so pass these to PushExportDatasets.build_role_policies.
+
+        Returns
+        -------
+        Dict[str, int]
+            Username to the size of their pull policy.
+        """
+        if not self.users:
+            raise UsersNotLoadedError(
+                "Run load_datasets_and_users before sizing role policies"
+            )
+        return {
+            user: len(
+                create_combined_read_write_role_policy(
+                    [f"arn:aws:s3:::mojap-{dataset.name}" for dataset in datasets]
+                )
+            )
+            for user, datasets in self.users.items()
+        }
+
+
+class PullExportDataset:
+    """Define a pull dataset: a bucket that roles in other accounts can read from,
+    and that its users can read from and write to.
+
+    Use the .build_bucket() method to create the bucket and its policy, and if the
+    config sets them, a function keeping a manifest of the bucket's objects and
+    read-only replicas of the bucket in other regions.
+    """
+
+    def __init__(self, config: Dict, tagger: Tagger):
+        """Set up the dataset from a config already loaded by registry.load_configs.
+
+        Parameters
+        ----------
+        config : Dict
+            Normalised pull dataset config.
+        tagger : Tagger
+            A Tagger object from data-engineering-pulumi-components.utils
+        """
+        self.config = config
+        self.name = config["name"]
+        self.pull_arns = config["pull_arns"]
+        self.users = config["users"]
+        self.allow_push = config["allow_push"]
+        self.bucket_versioning = config["bucket_versioning"]
+        self.manifest = config["manifest"]
+        self.replica_regions = config["replica_regions"]
+        self.tagger = tagger
+        self.bucket = None  # Added with build_bucket
+        self.bucket_policy = None  # Added with build_bucket
+        self.manifest_function = None  # Added with build_bucket, if manifest is set
+        self.replicas = {}  # Region to Bucket, added with build_bucket
+        self.replica_bucket_policies = {}  # Added with build_bucket
+        self.replication_role = None  # Added with build_bucket
+        self.replication_config = None  # Added with build_bucket
+
+    def build_bucket(self):
+        """Create the dataset's bucket, with a bucket policy allowing the pull ARNs to
+        read from it (and write to it, if allow_push is set). With manifest set, also
+        create a BucketManifestFunction to keep a manifest of the bucket's objects."""
+        if self.bucket_versioning:
+            self.bucket = Bucket(
+                name=f"mojap-{self.name}",
+                tagger=self.tagger,
+                versioning={"enabled": True},
+            )
+        else:
+            self.bucket = Bucket(name=f"mojap-{self.name}", tagger=self.tagger)
+
+        bucket_policy = Output.all(
+            bucket_arn=self.bucket.arn,
+            pull_arns=self.pull_arns,
+            allow_push=self.allow_push,
+        ).apply(lambda args: json.dumps(create_pull_bucket_policy(args)))
+        self.bucket_policy = BucketPolicy(
+            resource_name=f"{self.name}-bucket-policy",
+            bucket=self.bucket.id,
+            policy=bucket_policy,
+            opts=ResourceOptions(parent=self.bucket),
+        )
+        if self.manifest:
+            self.manifest_function = BucketManifestFunction(
+                name=self.name, bucket=self.bucket, tagger=self.tagger
+            )
+        if self.replica_regions:
+            self.build_replicas()
+
+    def build_replicas(self):
+        """Create a versioned bucket in each of the replica regions, readable by the
+        pull ARNs, and replicate the dataset's bucket to all of them.
+
+        Replicas are read-only, as changes made to them aren't copied back. Each
+        region's replica bucket name is exported as `<name>_replica_buckets`.
+
+        Replication only copies objects written after it's set up. Objects already
+        in the bucket when a replica region is added must be copied over once.
+        """
+        for region in self.replica_regions:
+            replica_name = f"mojap-{self.name}-{region}"
+            provider = region_provider(region)
+            # Parented under the dataset's bucket, so a deploy targeting the dataset
+            # includes them. The alias keeps replicas made before that in place.
+            replica = Bucket(
+                name=replica_name,
+                tagger=self.tagger,
+                versioning={"enabled": True},
+                opts=ResourceOptions(
+                    parent=self.bucket,
+                    provider=provider,
+                    aliases=[Alias(parent=ROOT_STACK_RESOURCE)],
+                ),
+            )
+            self.replica_bucket_policies[region] = BucketPolicy(
+                resource_name=f"{replica_name}-bucket-policy",
+                bucket=replica.id,
+                policy=Output.all(
+                    bucket_arn=replica.arn, pull_arns=self.pull_arns
+                ).apply(lambda args: json.dumps(create_pull_bucket_policy(args))),
+                opts=ResourceOptions(parent=replica, provider=provider),
+            )
+            self.replicas[region] = replica
+
+        replica_arns = [replica.arn for replica in self.replicas.values()]
+        self.replication_role = Role(
+            resource_name=f"{self.name}-replication-role",
+            name=f"{self.name}-replication",
+            assume_role_policy=REPLICATION_ASSUME_ROLE_POLICY,
+            tags=self.tagger.create_tags(f"{self.name}-replication"),
+            opts=ResourceOptions(parent=self.bucket),
+        )
+        self.replication_role_policy = RolePolicy(
+            resource_name=f"{self.name}-replication-role-policy",
+            name="replication",
+            role=self.replication_role.id,
+            policy=Output.all(self.bucket.arn, *replica_arns).apply(
+                lambda arns: create_replication_role_policy(arns[0], arns[1:])
+            ),
+            opts=ResourceOptions(parent=self.replication_role),
+        )
+        self.replication_config = BucketReplicationConfig(
+            resource_name=f"{self.name}-replication",
+            bucket=self.bucket.id,
+            role=self.replication_role.arn,
+            rules=[
+                BucketReplicationConfigRuleArgs(
+                    id=f"replicate-to-{region}",
+                    priority=priority,
+                    status="Enabled",
+                    # An empty filter replicates every object
+                    filter=BucketReplicationConfigRuleFilterArgs(),
+                    delete_marker_replication=(
+                        BucketReplicationConfigRuleDeleteMarkerReplicationArgs(
+                            status="Enabled"
+                        )
+                    ),
+                    destination=BucketReplicationConfigRuleDestinationArgs(
+                        bucket=replica.arn
+                    ),
+                )
+                for priority, (region, replica) in enumerate(self.replicas.items())
+            ],
+            opts=ResourceOptions(
+                parent=self.bucket, depends_on=[self.replication_role_policy]
+            ),
+        )
+        export(
+            name=f"{self.name}_replica_buckets",
+            value={region: replica.name for region, replica in self.replicas.items()},
+        )
+
+
+def region_provider(region: str) -> Provider:
+    """The AWS provider for a region, created the first time it's needed."""
+    if region not in _providers:
+        _providers[region] = Provider(resource_name=f"aws-{region}", region=region)
+    return _providers[region]
+
 
 def create_pull_bucket_policy(args: Dict[str, str]) -> Dict:
     """Create policy for a bucket to permit get access for a specific list of ARNs.
@@ -97,9 +402,7 @@ def create_pull_bucket_policy(args: Dict[str, str]) -> Dict:
     return bucket_policy
 
 
-def create_read_write_role_policy(
-    args: Dict[str, str]
-) -> AwaitableGetPolicyDocumentResult:
+def create_read_write_role_policy(args: Dict[str, str]) -> str:
     """Create role policy that gives get, put, delete and restore access to a bucket.
 
     Parameters
@@ -110,15 +413,31 @@ def create_read_write_role_policy(
 
     Returns
     -------
-    AwaitableGetPolicyDocumentResult
-        Pulumi output of the get_policy_document function.
+    str
+        The policy document as JSON, made by policy.policy_document.
     """
     bucket_arn = args.pop("bucket_arn")
+    return create_combined_read_write_role_policy([bucket_arn])
+
 
-    role_policy = get_policy_document(
-        statements=[
-            GetPolicyDocumentStatementArgs(
-                actions=[
+def create_combined_read_write_role_policy(bucket_arns: List[str]) -> str:
+    """Create role policy that gives get, put, delete and restore access to several
+    buckets at once, so each user needs only one policy for all their pull datasets.
+
+    Parameters
+    ----------
+    bucket_arns : list
+        ARNs of the buckets to give access to.
+
+    Returns
+    -------
+    str
+        The policy document as JSON, made by policy.policy_document.
+    """
+    return policy_document(
+        [
+            statement(
+                [
                     "s3:GetObject",
                     "s3:GetObjectAcl",
                     "s3:GetObjectVersion",
@@ -129,12 +448,45 @@ def create_read_write_role_policy(
                     "s3:PutObjectTagging",
                     "s3:RestoreObject",
                 ],
-                resources=[f"{bucket_arn}/*"],
+                [f"{bucket_arn}/*" for bucket_arn in bucket_arns],
+            ),
+            statement(["s3:ListBucket"], list(bucket_arns)),
+        ]
+    )
+
+
+def create_replication_role_policy(bucket_arn: str, replica_arns: List[str]) -> str:
+    """Create the policy letting S3 replicate a bucket's objects, and deletes, to its
+    replica buckets.
+
+    Parameters
+    ----------
+    bucket_arn : str
+        ARN of the bucket to replicate.
+    replica_arns : list
+        ARNs of the replica buckets.
+
+    Returns
+    -------
+    str
+        The policy document as JSON, made by policy.policy_document.
+    """
+    return policy_document(
+        [
+            statement(
+                ["s3:GetReplicationConfiguration", "s3:ListBucket"], [bucket_arn]
+            ),
+            statement(
+                [
+                    "s3:GetObjectVersionForReplication",
+                    "s3:GetObjectVersionAcl",
+                    "s3:GetObjectVersionTagging",
+                ],
+                [f"{bucket_arn}/*"],
             ),
-            GetPolicyDocumentStatementArgs(
-                actions=["s3:ListBucket"],
-                resources=[bucket_arn],
+            statement(
+                ["s3:ReplicateObject", "s3:ReplicateDelete", "s3:ReplicateTags"],
+                [f"{replica_arn}/*" for replica_arn in replica_arns],
             ),
         ]
     )
-    return role_policy
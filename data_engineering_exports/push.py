@@ -1,21 +1,45 @@
 from collections import defaultdict
 from pathlib import Path
-from typing import Dict, List, Union
+from typing import Dict, List, Optional, Union
 
 from data_engineering_pulumi_components.aws import Bucket
 from data_engineering_pulumi_components.utils import Tagger
-from data_engineering_pulumi_components.aws.lambdas.move_object_function import (
-    MoveObjectFunction,
+from pulumi import export, ResourceOptions
+from pulumi_aws.iam import Policy, RolePolicy, RolePolicyAttachment
+from pulumi_aws.s3 import (
+    BucketNotification,
+    BucketNotificationLambdaFunctionArgs,
+    BucketNotificationQueueArgs,
 )
-from data_engineering_pulumi_components.aws.lambdas.copy_object_function import (
-    CopyObjectFunction,
+
+from data_engineering_exports.export_function import (
+    BACKFILL_PREFIX,
+    CHECKPOINT_PREFIX,
+    EventFilter,
+    ExportObjectFunction,
+    ExportRouterFunction,
+)
+from data_engineering_exports.policy import (
+    INLINE_POLICY_LIMIT,
+    LONGEST_BUCKET_ARN,
+    MANAGED_POLICY_LIMIT,
+    MAX_MANAGED_POLICIES,
+    PolicyTooLargeError,
+    compact_prefixes,
+    policy_document,
+    split_resources,
+    statement,
+)
+from data_engineering_exports.registry import (
+    InvalidConfigError,
+    load_config,
+    load_configs,
+    validate_config,
 )
-from pulumi import Output, export, ResourceOptions
-from pulumi_aws.iam import GetPolicyDocumentStatementArgs, RolePolicy
-from pulumi_aws.iam.get_policy_document import get_policy_document
-from pulumi_aws.s3 import BucketNotificationLambdaFunctionArgs, BucketNotification
 
-from data_engineering_exports.utils import load_yaml
+PUT_ACTIONS = ["s3:PutObject", "s3:PutObjectAcl", "s3:PutObjectTagging"]
+# How the export bucket tells each dataset's function about new objects
+NOTIFICATIONS = ("s3", "eventbridge")
 
 
 class UsersNotLoadedError(Exception):
@@ -32,12 +56,21 @@ class PushExportDatasets:
 
     - extract user and dataset information from yaml files using load_datasets_and_users
     - create a Lambda function (and associated infrastructure) for each dataset with
-      build_lambda_functions
+      build_lambda_functions, or a single shared router function with
+      build_router_function
     - add a role policy to each user with build_role_policies - this gives permissions
       to write to the relevant prefix for each of the datasets that include their name
     """
 
-    def __init__(self, config_paths: List[Path], export_bucket: Bucket, tagger: Tagger):
+    def __init__(
+        self,
+        config_paths: List[Path],
+        export_bucket: Bucket,
+        tagger: Tagger,
+        index_path: Optional[Path] = None,
+        zstd_layer: Optional[str] = None,
+        notifications: str = "s3",
+    ):
         """Store a list of relevant yaml files, then set export_bucket and tagger.
         At this point, read no config files and create no AWS resources.
 
@@ -49,26 +82,49 @@ class PushExportDatasets:
             The bucket the data will be exported from.
         tagger : Tagger
             A Tagger object from data-engineering-pulumi-components.utils
+        index_path : Path, optional
+            Where to cache validated configs between runs - see registry.load_configs.
+            If None, every config file is read each time.
+        zstd_layer : str, optional
+            ARN of a Lambda layer providing the zstandard package, needed by
+            datasets with zstd compression.
+        notifications : str
+            Either "s3" (the default) to send each dataset's function S3 event
+            notifications, or "eventbridge" to give each its own EventBridge rule,
+            filtering out objects it doesn't want. The shared router always uses S3
+            event notifications.
         """
+        if notifications not in NOTIFICATIONS:
+            raise InvalidConfigError(
+                f"notifications must be one of {', '.join(NOTIFICATIONS)}"
+            )
         self.config_paths = config_paths
+        self.notifications = notifications
+        self.zstd_layer = zstd_layer
+        self.index_path = index_path
         self.export_bucket = export_bucket
         self.tagger = tagger
         self.datasets = None  # Added with load_datasets_and_users
         self.lambdas = None  # Added with build_lambda_functions
+        self.router = None  # Added with build_router_function
         self.users = None  # Added with load_datasets_and_users
         self.role_policies = None  # Added with build_role_policies
 
     def load_datasets_and_users(self):
-        """Read the yaml config files and store:
+        """Read and validate the yaml config files and store:
         - a list of PushExportDataset objects, one for each dataset
         - a dictionary of usernames, each with a list of datasets they can access
         """
         self.datasets = []
         self.users = defaultdict(list)
 
-        for config in self.config_paths:
-            dataset = PushExportDataset.from_filepath(
-                config, self.export_bucket, self.tagger
+        for config in load_configs(self.config_paths, "push", self.index_path):
+            dataset = PushExportDataset(
+                config,
+                self.export_bucket,
+                self.tagger,
+                self.zstd_layer,
+                self.notifications,
             )
             self.datasets.append(dataset)
 
@@ -92,13 +148,92 @@ class PushExportDatasets:
                 "Run load_datasets_and_users before building Lambda functions"
             )
 
-    def build_role_policies(self):
+    def routing_table(self) -> Dict[str, Dict[str, Union[str, bool]]]:
+        """Map the prefix of each dataset with direct delivery to its target bucket,
+        whether to keep files, how to compress them and which to leave alone, for the
+        router function to look up."""
+        if not self.datasets:
+            raise DatasetsNotLoadedError(
+                "Run load_datasets_and_users before building a routing table"
+            )
+        routes = {}
+        for dataset in self.datasets:
+            if dataset.delivery != "direct":
+                continue
+            route = {
+                "target_bucket": dataset.target_bucket,
+                "keep_files": dataset.keep_files,
+            }
+            # Only listed when set, so other datasets' routes don't change
+            if dataset.compress:
+                route["compress"] = dataset.compress
+            if dataset.exclude_patterns:
+                route["exclude"] = dataset.exclude_patterns
+            routes[dataset.name] = route
+        return routes
+
+    def build_router_function(self):
+        """Create one router Lambda function that exports every dataset with direct
+        delivery, as an alternative to build_lambda_functions. Datasets with batched
+        delivery still get their own functions, as each reads its own queue.
+
+        Each routed dataset's lambda_function is set to the router, so
+        make_combined_bucket_notification sends all their prefixes to it.
+        """
+        routes = self.routing_table()
+        self.lambdas = []
+        if routes:
+            self.router = ExportRouterFunction(
+                name="hub-exports",
+                source_bucket=self.export_bucket,
+                tagger=self.tagger,
+                routes=routes,
+                layers=self._router_layers(routes),
+            )
+            self.lambdas.append(self.router)
+            export(name="router_lambda_role_arn", value=self.router._role.arn)
+        for dataset in self.datasets:
+            if dataset.name in routes:
+                dataset.lambda_function = self.router
+            else:
+                dataset.build_lambda_function()
+                self.lambdas.append(dataset.lambda_function)
+                export(
+                    name=f"{dataset.name}_lambda_role_arn",
+                    value=dataset.lambda_function._role.arn,
+                )
+
+    def _router_layers(self, routes: Dict[str, Dict]) -> Optional[List[str]]:
+        if any(route.get("compress") == "zstd" for route in routes.values()):
+            return [self.zstd_layer]
+        return None
+
+    def build_role_policies(self, other_inline_sizes: Optional[Dict[str, int]] = None):
         """Create a role policy for each username mentioned in the datasets. For each
         dataset that mentions a user, they will get permission to write to a specific
-        prefix of the export bucket."""
+        prefix of the export bucket.
+
+        Parameters
+        ----------
+        other_inline_sizes : Dict[str, int], optional
+            Size of the other inline policies on each user's role, such as their pull
+            policy from PullExportDatasets.inline_policy_sizes. These share the
+            role's inline policy limit with the push policy.
+        """
         if self.users:
+            other_inline_sizes = other_inline_sizes or {}
+            # Wildcards in a user's policy must not match anyone else's dataset, or
+            # the prefixes the export functions keep checkpoints and backfills in
+            all_prefixes = [dataset.name for dataset in self.datasets]
+            all_prefixes.extend([CHECKPOINT_PREFIX, BACKFILL_PREFIX])
             self.role_policies = [
-                WriteToExportBucketRolePolicy(user, self.export_bucket, prefixes)
+                WriteToExportBucketRolePolicy(
+                    user,
+                    self.export_bucket,
+                    prefixes,
+                    all_prefixes,
+                    other_inline_sizes.get(user, 0),
+                )
                 for user, prefixes in self.users.items()
             ]
         else:
@@ -121,6 +256,8 @@ class PushExportDataset:
         config: Dict[str, Union[str, List[str]]],
         export_bucket: Bucket,
         tagger: Tagger,
+        zstd_layer: Optional[str] = None,
+        notifications: str = "s3",
     ):
         """Load the details of a push dataset from its config.
 
@@ -131,6 +268,45 @@ class PushExportDataset:
                 copying them to the target bucket
             - users - list of Analytical Platform usernames that work with the dataset
 
+        And can optionally contain:
+            - delivery - "direct" (the default) to run the Lambda function for each
+                new file, or "batched" to queue notifications in SQS and export
+                them in batches
+            - batch_size - for batched delivery, the most files per batch
+                (default 100)
+            - batching_window_s - for batched delivery, the longest to wait for a
+                batch to fill, in seconds (default 30, at most 300)
+            - memory_mb - memory for the Lambda function (default 128)
+            - timeout_s - the function's timeout in seconds (default 300)
+            - architecture - "x86_64" (the default) or "arm64"
+            - reserved_concurrency - concurrent executions kept for this dataset's
+                function, and the most it can use
+            - provisioned_concurrency - function environments to keep warm
+            - tracing - true to trace each export with X-Ray
+            - handler - "full" (the default), or "lean" for a handler that starts
+                faster, but only takes direct delivery without tracing
+            - compress - "gzip" or "zstd" to compress files on the way to the target
+                bucket, adding .gz or .zst to their names
+            - bundle - "tar" or "ndjson" to send each batch's small files as a few
+                bundles, each with an index - needs batched delivery
+            - bundle_max_mb - the largest a bundle can grow (default 32)
+            - exclude_patterns - wildcard patterns of keys not to export, like
+                "*.tmp" - with EventBridge notifications, patterns using only *
+                stop excluded keys invoking the function at all
+            - include_suffixes - with EventBridge notifications, only export keys
+                ending with one of these
+            - min_size_bytes - with EventBridge notifications, only export objects
+                at least this large
+            - event_types - with EventBridge notifications, only export objects
+                created by these of "put", "post", "copy" and "multipart"
+            - allow_backfill - true to let backfill jobs run as the export role
+
+        The Lambda settings only apply to datasets with their own function, not
+        those sent by the shared router.
+
+        The config is validated against registry.PUSH_SCHEMA, raising an
+        InvalidConfigError if there are any problems.
+
         Parameters
         ----------
         config : Dict[str, Union[str, List[str]]]
@@ -139,12 +315,45 @@ class PushExportDataset:
             The bucket the data will be exported from.
         tagger : Tagger
             A Tagger object from data-engineering-pulumi-components.utils
+        zstd_layer : str, optional
+            ARN of a Lambda layer providing the zstandard package. Required if the
+            dataset uses zstd compression.
+        notifications : str
+            Either "s3" (the default) or "eventbridge", for an EventBridge rule to
+            send the dataset's function its new objects.
         """
+        config = validate_config(config, "push", config.get("name", "config"))
+        if config["compress"] == "zstd" and not zstd_layer:
+            raise InvalidConfigError(
+                f"{config['name']}: zstd compression needs the zstd_layer_arn "
+                "config setting"
+            )
+        self.config = config
         self.name = config["name"]
         self.export_bucket = export_bucket
         self.target_bucket = config["target_bucket"]
         self.users = config["users"]
-        self.keep_files = config.get("keep_files", False)  # optional - default to False
+        self.keep_files = config["keep_files"]
+        self.delivery = config["delivery"]
+        self.batch_size = config["batch_size"]
+        self.batching_window_s = config["batching_window_s"]
+        self.memory_mb = config["memory_mb"]
+        self.timeout_s = config["timeout_s"]
+        self.architecture = config["architecture"]
+        self.reserved_concurrency = config["reserved_concurrency"]
+        self.provisioned_concurrency = config["provisioned_concurrency"]
+        self.tracing = config["tracing"]
+        self.handler = config["handler"]
+        self.allow_backfill = config["allow_backfill"]
+        self.compress = config["compress"]
+        self.bundle = config["bundle"]
+        self.bundle_max_mb = config["bundle_max_mb"]
+        self.exclude_patterns = config["exclude_patterns"]
+        self.include_suffixes = config["include_suffixes"]
+        self.min_size_bytes = config["min_size_bytes"]
+        self.event_types = config["event_types"]
+        self.notifications = notifications
+        self.zstd_layer = zstd_layer
         self.tagger = tagger
         self.lambda_function = None
 
@@ -163,12 +372,12 @@ class PushExportDataset:
         tagger : Tagger
             A Tagger object from data-engineering-pulumi-components.utils
         """
-        config = load_yaml(filepath)
+        config = load_config(filepath, "push")
         return PushExportDataset(config, export_bucket, tagger)
 
     def build_lambda_function(self):
-        """Create either a MoveObjectFunction or a CopyObjectFunction (depending on
-        the value of self.keep_files) and store it as self.lambda_function.
+        """Create an ExportObjectFunction that either moves or copies files (depending
+        on the value of self.keep_files) and store it as self.lambda_function.
         """
         if self.keep_files:
             self.lambda_function = self._build_copy_object_function()
@@ -176,34 +385,90 @@ class PushExportDataset:
             self.lambda_function = self._build_move_object_function()
 
     def _build_move_object_function(self):
-        """Create a MoveObjectFunction based on the dataset's name and target bucket."""
-        return MoveObjectFunction(
+        """Create an ExportObjectFunction that deletes files after copying them."""
+        return ExportObjectFunction(
             destination_bucket=self.target_bucket,
             name=f"export_{self.name}",
             source_bucket=self.export_bucket,
             tagger=self.tagger,
             prefix=self.name,
-            create_notification=False,
+            **self._delivery_args(),
+            **self._performance_args(),
         )
 
     def _build_copy_object_function(self):
-        """Create a CopyObjectFunction based on the dataset's name and target bucket."""
-        return CopyObjectFunction(
+        """Create an ExportObjectFunction that keeps files after copying them."""
+        return ExportObjectFunction(
             destination_bucket=self.target_bucket,
             name=f"export_{self.name}",
             source_bucket=self.export_bucket,
             tagger=self.tagger,
             prefix=self.name,
-            create_notification=False,
+            keep_files=True,
+            **self._delivery_args(),
+            **self._performance_args(),
+        )
+
+    def _delivery_args(self) -> Dict:
+        """Arguments for ExportObjectFunction describing how files are delivered."""
+        return dict(
+            delivery=self.delivery,
+            batch_size=self.batch_size,
+            batching_window_s=self.batching_window_s,
+            bundle=self.bundle,
+            bundle_max_mb=self.bundle_max_mb,
+            exclude_patterns=self.exclude_patterns,
+            event_filter=self.event_filter(),
+            allow_backfill=self.allow_backfill,
+        )
+
+    def event_filter(self) -> Optional[EventFilter]:
+        """The filter for the dataset's EventBridge rule, or None if the dataset is
+        sent S3 event notifications instead."""
+        if self.notifications != "eventbridge":
+            return None
+        return EventFilter(
+            tuple(self.include_suffixes),
+            self.min_size_bytes,
+            tuple(self.event_types),
+            tuple(self.exclude_patterns),
+        )
+
+    def _performance_args(self) -> Dict:
+        """Arguments for ExportObjectFunction setting the Lambda function's size,
+        concurrency, handler, tracing and compression."""
+        return dict(
+            memory_mb=self.memory_mb,
+            timeout_s=self.timeout_s,
+            architecture=self.architecture,
+            reserved_concurrency=self.reserved_concurrency,
+            provisioned_concurrency=self.provisioned_concurrency,
+            tracing=self.tracing,
+            handler=self.handler,
+            compress=self.compress,
+            layers=[self.zstd_layer] if self.compress == "zstd" else None,
         )
 
 
 class WriteToExportBucketRolePolicy:
     """Create a role policy to allow an existing role to write to part of an export
     bucket. An export bucket is a bucket whose contents will be sent to other platforms.
+
+    Users on many datasets can have more prefixes than fit in an inline role policy.
+    Their prefixes are merged into wildcards where possible, and if the policy would
+    still be too large it is split across several managed policies attached to the
+    role instead. The limit applies to all the role's inline policies together, so
+    the size of any others, like the user's pull policy, counts against it too.
     """
 
-    def __init__(self, username: str, export_bucket: Bucket, prefixes: List[str]):
+    def __init__(
+        self,
+        username: str,
+        export_bucket: Bucket,
+        prefixes: List[str],
+        all_prefixes: Optional[List[str]] = None,
+        other_inline_size: int = 0,
+    ):
         """Create a role policy on AWS to let a user put items in specific parts of the
         export bucket.
 
@@ -216,32 +481,102 @@ class WriteToExportBucketRolePolicy:
             The bucket the user should be allowed to write to.
         prefixes : list
             List of the subfolders in the bucket the user can write to.
+        all_prefixes : list, optional
+            Every subfolder in use in the bucket. Prefixes are only merged into
+            wildcards if this is given - see policy.compact_prefixes.
+        other_inline_size : int
+            Total size of the role's other inline policies. The push policy is only
+            made inline if it fits in what's left of the limit.
         """
-        self._policy_document = Output.all(export_bucket.arn, prefixes).apply(
-            lambda args: get_policy_document(
-                statements=[
-                    GetPolicyDocumentStatementArgs(
-                        actions=[
-                            "s3:PutObject",
-                            "s3:PutObjectAcl",
-                            "s3:PutObjectTagging",
-                        ],
-                        resources=[f"{args[0]}/{prefix}/*" for prefix in args[1]],
-                    ),
-                    GetPolicyDocumentStatementArgs(
-                        actions=["s3:ListBucket"],
-                        resources=[args[0]],
-                    ),
-                ]
+        self.patterns = compact_prefixes(prefixes, all_prefixes)
+        self._role_policy = None
+        self._policies = []
+        self._attachments = []
+
+        # Predict the size using the longest possible ARN, since the real one isn't
+        # known yet
+        resources = [f"{LONGEST_BUCKET_ARN}/{pattern}/*" for pattern in self.patterns]
+        inline_size = len(write_policy_document(LONGEST_BUCKET_ARN, resources))
+        if inline_size + other_inline_size <= INLINE_POLICY_LIMIT:
+            self._build_inline_policy(username, export_bucket)
+        else:
+            chunks = split_resources(
+                lambda chunk: write_policy_document(LONGEST_BUCKET_ARN, chunk),
+                resources,
+                MANAGED_POLICY_LIMIT,
+            )
+            if len(chunks) > MAX_MANAGED_POLICIES:
+                raise PolicyTooLargeError(
+                    f"{username} needs {len(chunks)} policies to cover their "
+                    f"datasets, but only {MAX_MANAGED_POLICIES} can be attached"
+                )
+            start = 0
+            for number, chunk in enumerate(chunks):
+                end = start + len(chunk)
+                patterns = self.patterns[start:end]
+                start = end
+                self._build_managed_policy(username, export_bucket, patterns, number)
+
+    def _build_inline_policy(self, username: str, export_bucket: Bucket):
+        """Create a single inline policy covering all the user's prefixes."""
+        self._policy_document = export_bucket.arn.apply(
+            lambda arn: write_policy_document(
+                arn, [f"{arn}/{pattern}/*" for pattern in self.patterns]
             )
         )
         self._role_policy = RolePolicy(
             resource_name=username + "_exports_push",
-            policy=self._policy_document.json,
+            policy=self._policy_document,
             role=username,
             name="hub_exports",
         )
 
+    def _build_managed_policy(
+        self, username: str, export_bucket: Bucket, patterns: List[str], number: int
+    ):
+        """Create a managed policy covering some of the user's prefixes, and attach it
+        to their role."""
+        policy = Policy(
+            resource_name=f"{username}_exports_push_{number}",
+            name=f"{username}-hub-exports-{number}",
+            policy=export_bucket.arn.apply(
+                lambda arn: write_policy_document(
+                    arn, [f"{arn}/{pattern}/*" for pattern in patterns]
+                )
+            ),
+        )
+        self._policies.append(policy)
+        self._attachments.append(
+            RolePolicyAttachment(
+                resource_name=f"{username}_exports_push_{number}",
+                role=username,
+                policy_arn=policy.arn,
+            )
+        )
+
+
+def write_policy_document(bucket_arn: str, resources: List[str]) -> str:
+    """Policy document letting a user write to resources in the export bucket.
+
+    Parameters
+    ----------
+    bucket_arn : str
+        ARN of the export bucket.
+    resources : List[str]
+        ARNs of the parts of the bucket the user can write to.
+
+    Returns
+    -------
+    str
+        The document as JSON, made by policy.policy_document.
+    """
+    return policy_document(
+        [
+            statement(PUT_ACTIONS, resources),
+            statement(["s3:ListBucket"], [bucket_arn]),
+        ]
+    )
+
 
 def make_notification_lambda_args(
     dataset: PushExportDataset,
@@ -263,7 +598,30 @@ def make_notification_lambda_args(
     BucketNotificationLambdaFunctionArgs
     """
     return BucketNotificationLambdaFunctionArgs(
-        lambda_function_arn=dataset.lambda_function._function.arn,
+        lambda_function_arn=dataset.lambda_function.invoke_arn,
+        events=["s3:ObjectCreated:*"],
+        filter_prefix=f"{dataset.name}/",
+    )
+
+
+def make_notification_queue_args(
+    dataset: PushExportDataset,
+) -> BucketNotificationQueueArgs:
+    """Turn dataset name and SQS queue ARN into a BucketNotificationQueueArgs, for
+    datasets with batched delivery.
+
+    Parameters
+    ----------
+    dataset : push.PushExportDataset
+        A push dataset with batched delivery - must have already run the
+        build_lambda_functions method.
+
+    Returns
+    -------
+    BucketNotificationQueueArgs
+    """
+    return BucketNotificationQueueArgs(
+        queue_arn=dataset.lambda_function.queue.arn,
         events=["s3:ObjectCreated:*"],
         filter_prefix=f"{dataset.name}/",
     )
@@ -290,16 +648,25 @@ def make_combined_bucket_notification(
     BucketNotification
         A single BucketNotification for the export bucket, containing a
         BucketNotificationLambdaFunctionArgs for each of the Lambda functions that use
-        the export bucket.
+        the export bucket, and a BucketNotificationQueueArgs for each dataset with
+        batched delivery. Datasets with EventBridge rules are left out, and instead
+        the bucket sends all its events to EventBridge.
     """
+    # Datasets with an EventBridge rule only need EventBridge turned on
+    notified = [d for d in datasets.datasets if d.lambda_function.event_rule is None]
+    direct = [d for d in notified if d.delivery == "direct"]
+    batched = [d for d in notified if d.delivery == "batched"]
     return BucketNotification(
         resource_name=name,
         bucket=export_bucket.id,
-        lambda_functions=[make_notification_lambda_args(d) for d in datasets.datasets],
+        eventbridge=len(notified) < len(datasets.datasets),
+        lambda_functions=[make_notification_lambda_args(d) for d in direct],
+        queues=[make_notification_queue_args(d) for d in batched],
         opts=ResourceOptions(
             depends_on=[
                 lambda_function._function for lambda_function in datasets.lambdas
             ]
+            + [d.lambda_function._queue_policy for d in batched]
             + [export_bucket]
         ),
     )
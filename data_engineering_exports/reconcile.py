@@ -0,0 +1,324 @@
+"""Find push exports that didn't reach their target bucket.
+
+When a move fails part way, an object can be left in the export bucket after it was
+copied, or never copied at all. reconcile lists each dataset's prefix in the export
+bucket and in the dataset's target bucket, and compares the two listings.
+
+S3 lists keys in order, so the two listings are streamed side by side and merged,
+one page of each at a time, instead of being loaded into memory. Each dataset is
+listed in its own thread, and problems are passed back through a bounded queue, so
+memory use stays the same however large the buckets are. The exception is bundled
+datasets, whose bundle indexes are read into memory to find which files they hold.
+"""
+import json
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Iterable, Iterator, List, NamedTuple, Optional, Tuple
+
+from botocore.exceptions import ClientError
+
+from data_engineering_exports.lambda_handlers.export.bundle import (
+    BUNDLE_NAME,
+    INDEX_SUFFIX,
+)
+from data_engineering_exports.lambda_handlers.export.compress import (
+    compressed_key,
+    is_compressed,
+)
+
+# Objects newer than this may still be on their way to the target bucket
+DEFAULT_MIN_AGE = timedelta(minutes=15)
+DEFAULT_WORKERS = 16
+# Most problems waiting to be read before the listing threads pause
+QUEUE_SIZE = 1000
+
+STUCK = "stuck"
+MISSING = "missing"
+DIFFERS = "differs"
+
+
+class ObjectInfo(NamedTuple):
+    key: str
+    size: int
+    etag: str
+    last_modified: Optional[datetime] = None
+
+
+class Problem(NamedTuple):
+    dataset: str
+    status: str
+    key: str
+    export_object: ObjectInfo
+    target_object: Optional[ObjectInfo]
+
+
+def list_objects(s3_client, bucket: str, prefix: str = "") -> Iterator[ObjectInfo]:
+    """Stream every object in a bucket under a prefix, in key order, a page at a
+    time.
+
+    Parameters
+    ----------
+    s3_client
+        Boto3 S3 client.
+    bucket : str
+        Name of the bucket to list.
+    prefix : str
+        Only list keys starting with this - defaults to the whole bucket.
+    """
+    paginator = s3_client.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        for item in page.get("Contents", []):
+            yield ObjectInfo(
+                item["Key"], item["Size"], item["ETag"], item.get("LastModified")
+            )
+
+
+def merge_listings(
+    left: Iterable[ObjectInfo], right: Iterable[ObjectInfo]
+) -> Iterator[Tuple[Optional[ObjectInfo], Optional[ObjectInfo]]]:
+    """Pair up objects with the same key from two listings sorted by key.
+
+    Yields
+    ------
+    Tuple[Optional[ObjectInfo], Optional[ObjectInfo]]
+        The object from each listing, with None for a listing that doesn't have
+        the key.
+    """
+    left, right = iter(left), iter(right)
+    left_object, right_object = next(left, None), next(right, None)
+    while left_object or right_object:
+        if right_object is None or (left_object and left_object.key < right_object.key):
+            yield left_object, None
+            left_object = next(left, None)
+        elif left_object is None or right_object.key < left_object.key:
+            yield None, right_object
+            right_object = next(right, None)
+        else:
+            yield left_object, right_object
+            left_object, right_object = next(left, None), next(right, None)
+
+
+def same_contents(export_object: ObjectInfo, target_object: ObjectInfo) -> bool:
+    """Whether two objects look the same from their listings.
+
+    Large objects are copied in parts, which gives the copy a different ETag to the
+    original even when the contents are the same. Multipart ETags end in "-" and
+    the number of parts, so those are compared by size alone.
+    """
+    if export_object.size != target_object.size:
+        return False
+    if "-" in export_object.etag or "-" in target_object.etag:
+        return True
+    return export_object.etag == target_object.etag
+
+
+def compare_dataset(
+    s3_client,
+    dataset: Dict,
+    export_bucket: str,
+    cutoff: Optional[datetime] = None,
+) -> Iterator[Problem]:
+    """Compare a dataset's objects in the export bucket with its target bucket.
+
+    Parameters
+    ----------
+    s3_client
+        Boto3 S3 client.
+    dataset : Dict
+        The dataset's push config.
+    export_bucket : str
+        Name of the export bucket.
+    cutoff : datetime, optional
+        Ignore export bucket objects modified after this, as they may still be
+        moving.
+
+    Yields
+    ------
+    Problem
+        Each object left in the export bucket that is missing from the target
+        bucket, differs from the copy there, or was copied but not deleted.
+    """
+    if dataset.get("bundle"):
+        yield from _compare_bundled_dataset(s3_client, dataset, export_bucket, cutoff)
+        return
+    if dataset.get("compress"):
+        yield from _compare_compressed_dataset(
+            s3_client, dataset, export_bucket, cutoff
+        )
+        return
+    prefix = f"{dataset['name']}/"
+    pairs = merge_listings(
+        list_objects(s3_client, export_bucket, prefix),
+        list_objects(s3_client, dataset["target_bucket"], prefix),
+    )
+    for export_object, target_object in pairs:
+        if export_object is None:
+            continue
+        if (
+            cutoff
+            and export_object.last_modified
+            and export_object.last_modified > cutoff
+        ):
+            continue
+        if target_object is None:
+            status = MISSING
+        elif not same_contents(export_object, target_object):
+            status = DIFFERS
+        elif not dataset.get("keep_files"):
+            status = STUCK
+        else:
+            continue
+        yield Problem(
+            dataset["name"], status, export_object.key, export_object, target_object
+        )
+
+
+def _head(s3_client, bucket: str, key: str) -> Optional[ObjectInfo]:
+    try:
+        head = s3_client.head_object(Bucket=bucket, Key=key)
+    except ClientError as e:
+        if e.response["Error"]["Code"] in ("NoSuchKey", "404"):
+            return None
+        raise
+    return ObjectInfo(key, head["ContentLength"], head["ETag"])
+
+
+def _compare_compressed_dataset(
+    s3_client, dataset: Dict, export_bucket: str, cutoff: Optional[datetime]
+) -> Iterator[Problem]:
+    """Compressed copies have different keys, sizes and ETags to the originals, and
+    their keys don't sort in the same order, so look up each object left in the
+    export bucket individually, and only check that its copy exists."""
+    for export_object in list_objects(s3_client, export_bucket, f"{dataset['name']}/"):
+        if (
+            cutoff
+            and export_object.last_modified
+            and export_object.last_modified > cutoff
+        ):
+            continue
+        target_key = export_object.key
+        if not is_compressed(target_key):
+            target_key = compressed_key(target_key, dataset["compress"])
+        target_object = _head(s3_client, dataset["target_bucket"], target_key)
+        if target_object is None:
+            status = MISSING
+        elif not dataset.get("keep_files"):
+            status = STUCK
+        else:
+            continue
+        yield Problem(
+            dataset["name"], status, export_object.key, export_object, target_object
+        )
+
+
+def bundled_keys(s3_client, dataset: Dict) -> Dict[str, str]:
+    """Read the indexes of a dataset's bundles in its target bucket.
+
+    Returns
+    -------
+    Dict[str, str]
+        The ETag of every file that has been bundled, by key.
+    """
+    keys = {}
+    prefix = f"{dataset['name']}/{BUNDLE_NAME}"
+    for target_object in list_objects(s3_client, dataset["target_bucket"], prefix):
+        if not target_object.key.endswith(INDEX_SUFFIX):
+            continue
+        body = s3_client.get_object(
+            Bucket=dataset["target_bucket"], Key=target_object.key
+        )["Body"]
+        for entry in json.load(body)["objects"]:
+            keys[entry["key"]] = entry["etag"]
+    return keys
+
+
+def _compare_bundled_dataset(
+    s3_client, dataset: Dict, export_bucket: str, cutoff: Optional[datetime]
+) -> Iterator[Problem]:
+    """Bundled files are only found in their bundle's index, so every index is read
+    first, and each object left in the export bucket looked up in them."""
+    bundled = bundled_keys(s3_client, dataset)
+    for export_object in list_objects(s3_client, export_bucket, f"{dataset['name']}/"):
+        if (
+            cutoff
+            and export_object.last_modified
+            and export_object.last_modified > cutoff
+        ):
+            continue
+        etag = bundled.get(export_object.key)
+        if etag is None:
+            status = MISSING
+        elif etag != export_object.etag:
+            status = DIFFERS
+        elif not dataset.get("keep_files"):
+            status = STUCK
+        else:
+            continue
+        yield Problem(dataset["name"], status, export_object.key, export_object, None)
+
+
+def reconcile(
+    s3_client,
+    datasets: List[Dict],
+    export_bucket: str,
+    min_age: timedelta = DEFAULT_MIN_AGE,
+    workers: int = DEFAULT_WORKERS,
+) -> Iterator[Problem]:
+    """Compare every dataset's export and target prefixes, several at once.
+
+    Parameters
+    ----------
+    s3_client
+        Boto3 S3 client - clients are safe to share between threads.
+    datasets : List[Dict]
+        Push configs, as loaded by registry.load_configs.
+    export_bucket : str
+        Name of the export bucket.
+    min_age : timedelta
+        Ignore objects uploaded more recently than this - defaults to 15 minutes.
+    workers : int
+        Datasets to list at once - defaults to 16.
+
+    Yields
+    ------
+    Problem
+        Each problem found, as soon as it is found. The order between datasets
+        isn't fixed.
+    """
+    cutoff = datetime.now(timezone.utc) - min_age
+    problems = queue.Queue(maxsize=QUEUE_SIZE)
+    finished = object()
+    stop = threading.Event()
+
+    def check(dataset: Dict):
+        try:
+            for problem in compare_dataset(s3_client, dataset, export_bucket, cutoff):
+                if stop.is_set():
+                    return
+                problems.put(problem)
+        finally:
+            problems.put(finished)
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(check, dataset) for dataset in datasets]
+        try:
+            remaining = len(futures)
+            while remaining:
+                problem = problems.get()
+                if problem is finished:
+                    remaining -= 1
+                else:
+                    yield problem
+        finally:
+            # If the caller stops early, let the threads finish without blocking
+            stop.set()
+            while any(not future.done() for future in futures):
+                try:
+                    problems.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+        # Raise any error from listing a bucket
+        for future in futures:
+            future.result()
@@ -0,0 +1,420 @@
+"""Load and validate push and pull dataset config files.
+
+Each config is checked against a schema for its kind of dataset, then normalised:
+optional keys get their defaults and single-item lists like `allow_push: [True]`
+become plain values. Problems are reported together, naming the file, before any
+AWS resources are created.
+
+Normalised configs can be cached in an index file keyed by a hash of each file's
+contents, so on later runs only new or changed files are parsed and validated.
+"""
+import hashlib
+import json
+import os
+import re
+import warnings
+from pathlib import Path
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Iterable,
+    List,
+    NamedTuple,
+    Optional,
+    Tuple,
+    Union,
+)
+
+import yaml
+
+try:  # The C loader is many times faster, but needs PyYAML built with libyaml
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:  # pragma: no cover
+    from yaml import SafeLoader
+
+DEFAULT_INDEX_PATH = Path(".dataset_index.json")
+# Change this whenever the schemas or normalisation change, to invalidate the index
+SCHEMA_VERSION = 9
+
+
+class InvalidConfigError(Exception):
+    pass
+
+
+class Field(NamedTuple):
+    """Describes one key of a config file.
+
+    types - the allowed Python types of the value
+    required - whether the key must be present
+    default - the value to use when an optional key is missing
+    check - returns an error message for a bad value, or None if it's fine
+    normalise - converts a valid value to its normalised form
+    """
+
+    types: Tuple[type, ...]
+    required: bool = False
+    default: Any = None
+    check: Optional[Callable[[Any], Optional[str]]] = None
+    normalise: Optional[Callable[[Any], Any]] = None
+
+
+def _matches(pattern: str, description: str) -> Callable[[Any], Optional[str]]:
+    compiled = re.compile(pattern)
+
+    def check(value):
+        values = value if isinstance(value, list) else [value]
+        bad = [v for v in values if not isinstance(v, str) or not compiled.match(v)]
+        if bad:
+            return f"must be {description}, not {', '.join(map(repr, bad))}"
+
+    return check
+
+
+def _between(low: int, high: int) -> Callable[[Any], Optional[str]]:
+    def check(value):
+        if isinstance(value, bool) or not low <= value <= high:
+            return f"must be a whole number from {low} to {high}"
+
+    return check
+
+
+def _one_of(*choices: str) -> Callable[[Any], Optional[str]]:
+    def check(value):
+        if value not in choices:
+            return f"must be one of {', '.join(choices)}"
+
+    return check
+
+
+def _flag(value: Union[bool, List[bool]]) -> bool:
+    """Turn `True` or the older `[True]` style into a single boolean."""
+    if isinstance(value, list):
+        return all(value) if value else False
+    return value
+
+
+def _check_flag(value) -> Optional[str]:
+    values = value if isinstance(value, list) else [value]
+    if not all(isinstance(v, bool) for v in values):
+        return "must be true or false"
+
+
+def _as_list(value: Union[str, List[str]]) -> List[str]:
+    return value if isinstance(value, list) else [value]
+
+
+_USERS = Field((list,), required=True, check=_matches(r"^\S+$", "a list of usernames"))
+_PAPERWORK = Field((str, list), default=[], normalise=_as_list)
+
+PUSH_SCHEMA = {
+    "name": Field(
+        (str,),
+        required=True,
+        check=_matches(r"^[a-z0-9_]+$", "lower case letters, numbers and underscores"),
+    ),
+    "target_bucket": Field(
+        (str,),
+        required=True,
+        check=_matches(r"^[a-z0-9][a-z0-9.-]{1,61}[a-z0-9]$", "an S3 bucket name"),
+    ),
+    "users": _USERS,
+    "keep_files": Field((bool,), default=False),
+    "delivery": Field((str,), default="direct", check=_one_of("direct", "batched")),
+    "batch_size": Field((int,), default=100, check=_between(1, 10_000)),
+    "batching_window_s": Field((int,), default=30, check=_between(0, 300)),
+    # Lambda settings, defaulting to those every function had before they were added
+    "memory_mb": Field((int,), default=128, check=_between(128, 10_240)),
+    "timeout_s": Field((int,), default=300, check=_between(1, 900)),
+    "architecture": Field((str,), default="x86_64", check=_one_of("x86_64", "arm64")),
+    "reserved_concurrency": Field((int,), check=_between(1, 10_000)),
+    "provisioned_concurrency": Field((int,), check=_between(1, 10_000)),
+    "tracing": Field((bool,), default=False),
+    # Let S3 Batch Operations run as the dataset's export role, for backfill
+    "allow_backfill": Field((bool,), default=False),
+    "handler": Field((str,), default="full", check=_one_of("full", "lean")),
+    "compress": Field((str,), check=_one_of("gzip", "zstd")),
+    "bundle": Field((str,), check=_one_of("tar", "ndjson")),
+    "bundle_max_mb": Field((int,), default=32, check=_between(1, 1024)),
+    # Which new objects to export. Only exclude_patterns applies with S3 event
+    # notifications - the others need EventBridge notifications
+    "include_suffixes": Field(
+        (str, list),
+        default=[],
+        check=_matches(r"^\S+$", "a list of suffixes"),
+        normalise=_as_list,
+    ),
+    "exclude_patterns": Field(
+        (str, list),
+        default=[],
+        check=_matches(r"^\S+$", "a list of patterns"),
+        normalise=_as_list,
+    ),
+    "min_size_bytes": Field((int,), default=0, check=_between(0, 5 * 1024**4)),
+    "event_types": Field(
+        (str, list),
+        default=["put", "post", "copy", "multipart"],
+        check=_matches(r"^(put|post|copy|multipart)$", "put, post, copy or multipart"),
+        normalise=_as_list,
+    ),
+    "paperwork": _PAPERWORK,
+}
+
+PULL_SCHEMA = {
+    "name": Field(
+        (str,),
+        required=True,
+        check=_matches(r"^[a-z0-9][a-z0-9-]*$", "lower case letters, numbers and -"),
+    ),
+    "pull_arns": Field(
+        (list,),
+        required=True,
+        check=_matches(r"^arn:aws:iam::\d{12}:\S+$", "a list of IAM ARNs"),
+    ),
+    "users": _USERS,
+    "allow_push": Field(
+        (bool, list), default=False, check=_check_flag, normalise=_flag
+    ),
+    "bucket_versioning": Field(
+        (bool, list), default=False, check=_check_flag, normalise=_flag
+    ),
+    "manifest": Field((bool,), default=False),
+    "replica_regions": Field(
+        (str, list),
+        default=[],
+        check=_matches(r"^[a-z]{2}(-gov)?-[a-z]+-\d$", "a list of AWS regions"),
+        normalise=_as_list,
+    ),
+    "paperwork": _PAPERWORK,
+}
+
+
+def _provisioned_within_reserved(config: Dict) -> Optional[str]:
+    provisioned = config.get("provisioned_concurrency")
+    reserved = config.get("reserved_concurrency")
+    if provisioned and reserved and provisioned > reserved:
+        return "provisioned_concurrency can't be more than reserved_concurrency"
+
+
+def _bundle_needs_batching(config: Dict) -> Optional[str]:
+    if config.get("bundle") and config.get("delivery") != "batched":
+        return "bundle needs delivery: batched"
+
+
+def _bundle_fits_in_memory(config: Dict) -> Optional[str]:
+    # The bundle is built in memory, and compressing it makes a second copy
+    if config.get("bundle") and config["bundle_max_mb"] * 2 > config["memory_mb"]:
+        return "bundle_max_mb can't be more than half of memory_mb"
+
+
+def _lean_handler_is_direct(config: Dict) -> Optional[str]:
+    # The lean handler doesn't read batches from SQS or trace with X-Ray
+    if config.get("handler") == "lean" and config.get("delivery") == "batched":
+        return "handler: lean needs delivery: direct"
+    if config.get("handler") == "lean" and config.get("tracing"):
+        return "handler: lean can't be used with tracing"
+
+
+def _replicas_need_versioning(config: Dict) -> Optional[str]:
+    # S3 only replicates from versioned buckets
+    if config.get("replica_regions") and not config.get("bucket_versioning"):
+        return "replica_regions needs bucket_versioning: true"
+
+
+def _replica_names_fit(config: Dict) -> Optional[str]:
+    for region in config.get("replica_regions") or []:
+        if len(f"mojap-{config['name']}-{region}") > 63:
+            return f"name is too long for a replica bucket in {region}"
+
+
+SCHEMAS = {"push": PUSH_SCHEMA, "pull": PULL_SCHEMA}
+# Checks that involve more than one key, run once every key is valid
+RULES = {
+    "push": [
+        _provisioned_within_reserved,
+        _bundle_needs_batching,
+        _bundle_fits_in_memory,
+        _lean_handler_is_direct,
+    ],
+    "pull": [_replicas_need_versioning, _replica_names_fit],
+}
+
+
+def _compile_field(key: str, field: Field) -> Callable[[Dict, List[str]], Any]:
+    """Build the validation step for one key of a schema. The step returns the
+    normalised value, adding any problems to the list of errors it's given."""
+    type_names = " or ".join(t.__name__ for t in field.types)
+
+    def step(config: Dict, errors: List[str]) -> Any:
+        if config.get(key) is None:
+            if field.required:
+                errors.append(f"{key} is required")
+            return field.default
+        value = config[key]
+        if not isinstance(value, field.types):
+            errors.append(f"{key} must be of type {type_names}")
+            return None
+        message = field.check(value) if field.check else None
+        if message:
+            errors.append(f"{key} {message}")
+            return None
+        return field.normalise(value) if field.normalise else value
+
+    return step
+
+
+def compile_schema(
+    schema: Dict[str, Field], rules: Iterable[Callable[[Dict], Optional[str]]] = ()
+) -> Callable[[Dict, str], Dict]:
+    """Build a validator function for a schema.
+
+    The work of inspecting the schema is done once here, leaving the returned
+    function a flat loop of prepared steps to run against each config.
+
+    Parameters
+    ----------
+    schema : Dict[str, Field]
+        Maps each allowed key to its Field.
+    rules : Iterable[Callable[[Dict], Optional[str]]]
+        Checks of the whole normalised config, each returning an error message or
+        None.
+
+    Returns
+    -------
+    Callable[[Dict, str], Dict]
+        Takes a config and a description of where it came from, and returns the
+        normalised config. Raises InvalidConfigError listing every problem found.
+    """
+    steps = [(key, _compile_field(key, field)) for key, field in schema.items()]
+    known_keys = set(schema)
+    rules = list(rules)
+
+    def validate(config: Dict, source: str) -> Dict:
+        if not isinstance(config, dict):
+            raise InvalidConfigError(f"{source}: expected a mapping of keys to values")
+        errors = []
+        normalised = {key: step(config, errors) for key, step in steps}
+        if not errors:
+            errors = [m for m in (rule(normalised) for rule in rules) if m]
+        if errors:
+            raise InvalidConfigError(f"{source}: " + "; ".join(errors))
+        unknown = sorted(set(config) - known_keys)
+        if unknown:
+            warnings.warn(f"{source}: ignoring unknown keys {', '.join(unknown)}")
+        return normalised
+
+    return validate
+
+
+VALIDATORS = {
+    kind: compile_schema(schema, RULES[kind]) for kind, schema in SCHEMAS.items()
+}
+
+
+def validate_config(config: Dict, kind: str, source: str = "config") -> Dict:
+    """Check a config already loaded into a dictionary, and return it normalised.
+
+    Parameters
+    ----------
+    config : Dict
+        The dataset config.
+    kind : str
+        Either "push" or "pull".
+    source : str
+        Where the config came from, for error messages.
+    """
+    return VALIDATORS[kind](config, str(source))
+
+
+def load_config(filepath: Union[str, Path], kind: str) -> Dict:
+    """Read, validate and normalise a single config file, without using the index."""
+    with open(filepath, mode="rb") as f:
+        return validate_config(yaml.load(f, Loader=SafeLoader), kind, str(filepath))
+
+
+def content_hash(content: bytes, kind: str) -> str:
+    """Key for a config in the index. Includes the kind of dataset and the schema
+    version, as both affect how the same file is normalised."""
+    return hashlib.sha256(f"{kind}:{SCHEMA_VERSION}:".encode() + content).hexdigest()
+
+
+def _read_index(index_path: Path) -> Dict[str, Dict]:
+    """Read the index as {content hash: {"kind": ..., "config": ...}}, or an empty
+    dictionary if it's missing, unreadable or from another schema version."""
+    try:
+        with open(index_path) as f:
+            index = json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+    if index.get("schema_version") != SCHEMA_VERSION:
+        return {}
+    return index["configs"]
+
+
+def _write_index(index_path: Path, configs: Dict[str, Dict]) -> None:
+    """Write the index to a temporary file first, so an interrupted run can't leave
+    a half-written index behind."""
+    temporary_path = index_path.with_name(index_path.name + ".tmp")
+    with open(temporary_path, "w") as f:
+        json.dump({"schema_version": SCHEMA_VERSION, "configs": configs}, f)
+    os.replace(temporary_path, index_path)
+
+
+def load_configs(
+    config_paths: List[Union[str, Path]],
+    kind: str,
+    index_path: Optional[Union[str, Path]] = None,
+) -> List[Dict]:
+    """Read, validate and normalise a list of config files.
+
+    With an index_path, files whose contents are already in the index are not parsed
+    again, and the index is updated to hold exactly the configs loaded this time.
+    Entries for other kinds of dataset are left alone, so push and pull configs can
+    share one index.
+
+    Parameters
+    ----------
+    config_paths : List[Union[str, Path]]
+        The config files to load, as made by list_yaml_files.
+    kind : str
+        Either "push" or "pull".
+    index_path : Union[str, Path], optional
+        Where to keep the index. If None, every file is parsed.
+
+    Returns
+    -------
+    List[Dict]
+        The normalised configs, in the same order as config_paths.
+
+    Raises
+    ------
+    InvalidConfigError
+        Listing the problems in every invalid file.
+    """
+    index = _read_index(Path(index_path)) if index_path else {}
+    configs, used, errors = [], {}, []
+    for path in config_paths:
+        with open(path, mode="rb") as f:
+            content = f.read()
+        key = content_hash(content, kind)
+        if key not in index:
+            try:
+                config = yaml.load(content, Loader=SafeLoader)
+                entry = {"kind": kind, "config": validate_config(config, kind, path)}
+            except InvalidConfigError as e:
+                errors.append(str(e))
+                continue
+        else:
+            entry = index[key]
+        used[key] = entry
+        configs.append(entry["config"])
+    if errors:
+        raise InvalidConfigError("\n".join(errors))
+
+    if index_path:
+        # Keep entries for the other kind of dataset, drop stale ones of this kind
+        updated = {k: v for k, v in index.items() if v["kind"] != kind}
+        updated.update(used)
+        if updated != index:
+            _write_index(Path(index_path), updated)
+    return configs
@@ -1,16 +1,31 @@
 import json
+import os
 import pkg_resources
-from typing import Callable, List
+from time import monotonic, sleep
+from typing import Callable, Iterable, List, Optional
+from urllib.request import urlopen
 
 from pulumi import automation as auto
 from pulumi_aws.iam import Role
 import yaml
 
+from data_engineering_exports.reconcile import list_objects
+
+
+LOCALSTACK_ENDPOINT = "http://localhost:4566"
+# Older versions of Localstack report service health at /health
+LOCALSTACK_HEALTH_PATHS = ["/_localstack/health", "/health"]
+LOCALSTACK_SERVICES = ["iam", "lambda", "s3", "sqs", "sts"]
+
 
 class PackageNotFoundError(Exception):
     pass
 
 
+class LocalstackNotReadyError(Exception):
+    pass
+
+
 def get_pulumi_version(aws: bool = False) -> str:
     """Check what version of either pulumi or pulumi-aws is installed.
 
@@ -36,16 +51,121 @@ def get_pulumi_version(aws: bool = False) -> str:
         raise PackageNotFoundError(f"{package_to_find} is not installed")
 
 
+def worker_id() -> str:
+    """Name of the pytest-xdist worker running this process, like "gw0", or an empty
+    string when tests aren't being run in parallel."""
+    return os.environ.get("PYTEST_XDIST_WORKER", "")
+
+
+def worker_name(name: str, separator: str = "-") -> str:
+    """Prefix a resource name with the xdist worker's name, so workers sharing one
+    Localstack don't create resources with the same names. Use separator="_" for
+    dataset names, which can't contain hyphens."""
+    worker = worker_id()
+    return f"{worker}{separator}{name}" if worker else name
+
+
+def wait_for_localstack(
+    endpoint: str = LOCALSTACK_ENDPOINT,
+    services: Iterable[str] = LOCALSTACK_SERVICES,
+    timeout: float = 120,
+    interval: float = 1,
+) -> float:
+    """Wait until Localstack reports that all the given services are ready.
+
+    Parameters
+    ----------
+    endpoint : str
+        Localstack's edge URL - defaults to http://localhost:4566
+    services : Iterable[str]
+        Services the tests need.
+    timeout : float
+        Longest to wait, in seconds - defaults to 120.
+    interval : float
+        Time between checks, in seconds - defaults to 1.
+
+    Returns
+    -------
+    float
+        Seconds spent waiting.
+
+    Raises
+    ------
+    LocalstackNotReadyError
+        If the services aren't all ready in time.
+    """
+    start = monotonic()
+    waiting_for = set(services)
+    while True:
+        for path in LOCALSTACK_HEALTH_PATHS:
+            try:
+                with urlopen(endpoint + path, timeout=interval) as response:
+                    health = json.load(response).get("services", {})
+            except (OSError, ValueError):
+                continue
+            waiting_for = {
+                service
+                for service in services
+                if health.get(service) not in ("available", "running")
+            }
+            if not waiting_for:
+                return monotonic() - start
+            break
+        if monotonic() - start > timeout:
+            raise LocalstackNotReadyError(
+                f"Localstack at {endpoint} not ready after {timeout}s - "
+                f"waiting for {', '.join(sorted(waiting_for))}"
+            )
+        sleep(interval)
+
+
+def install_plugin_once(workspace: auto.Workspace, name: str, version: str) -> None:
+    """Install a Pulumi plugin, unless the same version is already installed."""
+    installed = {
+        (plugin.name, plugin.version.lstrip("v"))
+        for plugin in workspace.list_plugins()
+        if plugin.version
+    }
+    if (name, version.lstrip("v")) not in installed:
+        print(f"Installing {name} plugin {version}")
+        workspace.install_plugin(name, version)
+
+
+def empty_buckets(bucket_names: Iterable[str], s3_client) -> None:
+    """Delete every object in each bucket, as a cheap reset between tests that share
+    a stack."""
+    paginator = s3_client.get_paginator("list_objects_v2")
+    for bucket_name in bucket_names:
+        for page in paginator.paginate(Bucket=bucket_name):
+            objects = [{"Key": item["Key"]} for item in page.get("Contents", [])]
+            if objects:
+                s3_client.delete_objects(
+                    Bucket=bucket_name, Delete={"Objects": objects, "Quiet": True}
+                )
+
+
 class PulumiTestInfrastructure:
     def __init__(
         self,
         pulumi_program: Callable,
         region: str = "eu-west-1",
         stack_name: str = "localstack",
+        parallel: Optional[int] = None,
+        endpoint: str = LOCALSTACK_ENDPOINT,
+        config_stack: Optional[str] = None,
     ) -> None:
         """
         Test infrastructure for end-to-end pipeline testing.
 
+        Use as a context manager to create the resources on entry and destroy them on
+        exit. To share one stack between many tests, call up once (for example in a
+        session-scoped fixture), use empty_buckets between tests, and call destroy
+        at the end.
+
+        When running under pytest-xdist, each worker gets its own stack, named after
+        the worker. Programs should name their AWS resources with worker_name so the
+        stacks don't clash.
+
         Parameters
         ----------
         pulumi_program : Callable
@@ -56,21 +176,38 @@ class PulumiTestInfrastructure:
         stack_name : str
             Name for the test stack - should have a matching config file.
             Defaults to localstack.
+        parallel : int, optional
+            How many resources Pulumi should create at once. Defaults to the
+            PULUMI_TEST_PARALLEL environment variable if set, or Pulumi's default.
+        endpoint : str
+            Localstack's edge URL - defaults to http://localhost:4566
+        config_stack : str, optional
+            Name of the stack whose config file to use, so a stack can have its own
+            name and state but share the localstack config. Defaults to stack_name.
         """
         # Get the Pulumi config for localstack
-        with open(f"Pulumi.{stack_name}.yaml", "r") as localstack_config:
+        config_stack = config_stack or stack_name
+        with open(f"Pulumi.{config_stack}.yaml", "r") as localstack_config:
             config = yaml.safe_load(localstack_config)["config"]
 
-        self.stack_name = stack_name
+        self.stack_name = worker_name(stack_name)
         self.region = region
+        if parallel is None and os.environ.get("PULUMI_TEST_PARALLEL"):
+            parallel = int(os.environ["PULUMI_TEST_PARALLEL"])
+        self.parallel = parallel
+        self.up_results = None
+
+        waited = wait_for_localstack(endpoint)
+        print(f"Localstack ready after {waited:.1f}s")
+
         # Define the stack using settings from the localstack config
         self.stack = auto.create_or_select_stack(
             stack_name=self.stack_name,
-            project_name=self.stack_name,
+            project_name=stack_name,
             program=pulumi_program,
             opts=auto.LocalWorkspaceOptions(
                 project_settings=auto.ProjectSettings(
-                    name=self.stack_name,
+                    name=stack_name,
                     runtime="python",
                 ),
                 env_vars={
@@ -80,40 +217,50 @@ class PulumiTestInfrastructure:
                     "AWS_ACCOUNT_ID": "000000000000",
                 },
                 stack_settings={
-                    "localstack": auto._stack_settings.StackSettings(config=config)
+                    self.stack_name: auto._stack_settings.StackSettings(config=config)
                 },
             ),
         )
-        print("Installing plugins")
-        pulumi_aws_version = get_pulumi_version(aws=True)
-        self.stack.workspace.install_plugin("aws", pulumi_aws_version)
-        print("Plugins installed")
-        print("Refreshing stack")
-        self.stack.refresh(on_output=print)
-        print("Refresh complete")
-
-    def _pulumi_up(self):
+        install_plugin_once(self.stack.workspace, "aws", get_pulumi_version(aws=True))
+        # Only refresh if an earlier run left resources behind, as Localstack may
+        # have been restarted since
+        if self.stack.export_stack().deployment.get("resources"):
+            print("Refreshing stack")
+            self.stack.refresh(on_output=print)
+            print("Refresh complete")
+
+    def up(self) -> auto.UpResult:
         print("Updating stack")
         try:
-            up_results = self.stack.up(parallel=4, on_output=print)
+            up_results = self.stack.up(parallel=self.parallel, on_output=print)
             print(
                 f"Update summary: "
                 f"\n{json.dumps(up_results.summary.resource_changes, indent=4)}"
             )
+            self.up_results = up_results
             return up_results
 
-        except Exception as e:
+        except Exception:
+            # Raise the real error, rather than carry on with a half-deployed stack
             print("There was an error updating the stack")
-            print(e)
+            raise
+
+    def destroy(self):
+        # Destroy the stack's resources
+        self.stack.destroy(parallel=self.parallel)
+        print("Tests complete - exiting Pulumi test infrastructure")
 
     def __enter__(self):
-        self.up_results = self._pulumi_up()
+        try:
+            self.up()
+        except Exception:
+            # __exit__ isn't called if __enter__ fails, so clean up here
+            self.destroy()
+            raise
         return self
 
     def __exit__(self, type, value, traceback):
-        # Destroy the stack's resources
-        self.stack.destroy()
-        print("Tests complete - exiting Pulumi test infrastructure")
+        self.destroy()
 
 
 def mock_alpha_user(username: str, account: str = "000000000000") -> Role:
@@ -173,14 +320,45 @@ def check_bucket_contents(
     -------
     None, but asserts whether expected and actual contents match.
     """
-    bucket_response = s3_client.list_objects_v2(Bucket=bucket_name)
-    bucket_contents = [item["Key"] for item in bucket_response.get("Contents", [])]
+    bucket_contents = [item.key for item in list_objects(s3_client, bucket_name)]
     if print_contents:
         print(f"Contents of bucket {bucket_name}:")
         print(bucket_contents)
     if expected_keys:
         assert bucket_contents == sorted(
             expected_keys
-        )  # list_objects_v2 already sorted
+        )  # list_objects is already sorted
     else:
         assert not bucket_contents
+
+
+def wait_for_object(
+    bucket_name: str, key: str, s3_client, timeout: float = 120, interval: float = 1
+) -> float:
+    """Poll a bucket until an object appears, and return how long it took.
+
+    Parameters
+    ----------
+    bucket_name : str
+        Name of the bucket to look in.
+    key : str
+        Key of the object to wait for.
+    s3_client
+        Boto3 s3 client object
+    timeout : float
+        Seconds to wait before failing - defaults to 120.
+    interval : float
+        Seconds between checks - defaults to 1.
+
+    Returns
+    -------
+    float
+        Seconds waited before the object appeared. Asserts if it never did.
+    """
+    start = monotonic()
+    while monotonic() - start < timeout:
+        response = s3_client.list_objects_v2(Bucket=bucket_name, Prefix=key)
+        if any(item["Key"] == key for item in response.get("Contents", [])):
+            return monotonic() - start
+        sleep(interval)
+    raise AssertionError(f"{key} did not reach {bucket_name} within {timeout}s")
@@ -1,8 +1,20 @@
+import base64
+from collections import defaultdict
+import hashlib
+import io
+import itertools
+import json
+import threading
+import zlib
 from typing import List, Dict, Union
 
+from botocore.exceptions import ClientError
 import pulumi
 import pytest
 
+from data_engineering_exports.lambda_handlers.export import resume
+from data_engineering_exports.utils_for_tests import PulumiTestInfrastructure
+
 
 class Mocks(pulumi.runtime.Mocks):
     def new_resource(
@@ -11,6 +23,35 @@ class Mocks(pulumi.runtime.Mocks):
         if args.typ == "aws:s3/bucket:Bucket":
             state = {"arn": f"arn:aws:s3:::{args.inputs['bucket']}"}
             return [args.name, dict(args.inputs, **state)]
+        elif args.typ == "aws:sqs/queue:Queue":
+            state = {"arn": f"arn:aws:sqs:eu-west-1:000000000000:{args.inputs['name']}"}
+            return [args.name, dict(args.inputs, **state)]
+        elif args.typ == "aws:iam/role:Role":
+            state = {"arn": f"arn:aws:iam::000000000000:role/{args.inputs['name']}"}
+            return [args.name, dict(args.inputs, **state)]
+        elif args.typ == "aws:cloudwatch/eventRule:EventRule":
+            state = {"arn": f"arn:aws:events:eu-west-1:000000000000:rule/{args.name}"}
+            return [args.name, dict(args.inputs, **state)]
+        elif args.typ == "aws:cloudwatch/eventBus:EventBus":
+            name = args.inputs["name"]
+            state = {"arn": f"arn:aws:events:eu-west-1:000000000000:event-bus/{name}"}
+            return [args.name, dict(args.inputs, **state)]
+        elif args.typ == "aws:iam/policy:Policy":
+            state = {"arn": f"arn:aws:iam::000000000000:policy/{args.inputs['name']}"}
+            return [args.name, dict(args.inputs, **state)]
+        elif args.typ == "aws:lambda/function:Function":
+            state = {
+                "arn": "arn:aws:lambda:eu-west-1:000000000000:function:"
+                + args.inputs["name"],
+                "version": "1" if args.inputs.get("publish") else "$LATEST",
+            }
+            return [args.name, dict(args.inputs, **state)]
+        elif args.typ == "aws:lambda/alias:Alias":
+            state = {
+                "arn": "arn:aws:lambda:eu-west-1:000000000000:function:"
+                f"{args.inputs['functionName']}:{args.inputs['name']}"
+            }
+            return [args.name, dict(args.inputs, **state)]
         else:
             return [args.name, args.inputs]
 
@@ -21,6 +62,359 @@ class Mocks(pulumi.runtime.Mocks):
             return {}
 
 
+def _crc32c_table() -> List[int]:
+    table = []
+    for byte in range(256):
+        crc = byte
+        for _ in range(8):
+            crc = (crc >> 1) ^ 0x82F63B78 if crc & 1 else crc >> 1
+        table.append(crc)
+    return table
+
+
+_CRC32C_TABLE = _crc32c_table()
+
+
+def _crc32c(data: bytes) -> int:
+    crc = 0xFFFFFFFF
+    for byte in data:
+        crc = _CRC32C_TABLE[(crc ^ byte) & 0xFF] ^ (crc >> 8)
+    return crc ^ 0xFFFFFFFF
+
+
+def _raw_checksum(algorithm: str, data: bytes) -> bytes:
+    """The checksum S3 calculates for an additional checksum algorithm."""
+    if algorithm == "CRC32C":
+        return _crc32c(data).to_bytes(4, "big")
+    if algorithm == "CRC32":
+        return zlib.crc32(data).to_bytes(4, "big")
+    return hashlib.new(algorithm.lower(), data).digest()
+
+
+def checksum(algorithm: str, data: bytes) -> str:
+    return base64.b64encode(_raw_checksum(algorithm, data)).decode()
+
+
+def _composite_checksum(algorithm: str, part_checksums: List[str]) -> str:
+    """S3's checksum of an object uploaded in parts: the checksum of its parts'
+    checksums, then the number of parts."""
+    joined = b"".join(base64.b64decode(c) for c in part_checksums)
+    return f"{checksum(algorithm, joined)}-{len(part_checksums)}"
+
+
+def _content_headers(kwargs: Dict) -> Dict:
+    return {
+        key: value
+        for key, value in kwargs.items()
+        if key in ("ContentType", "ContentEncoding", "Metadata")
+    }
+
+
+class FakeS3Client:
+    """In-memory stand-in for the parts of a boto3 S3 client the export handler uses.
+
+    Objects are stored as {bucket: {key: {"Body": bytes, **headers}}}. Every call is
+    recorded in self.calls as (operation, kwargs), so tests can check what was sent.
+    Additional checksums are calculated when asked for, and setting corrupt_copies
+    flips the last byte of every copy, to check that mismatches are caught.
+    """
+
+    def __init__(self):
+        self.buckets = defaultdict(dict)
+        self.uploads = {}
+        self._upload_numbers = itertools.count(1)
+        self.calls = []
+        # Keys in each page of a listing
+        self.page_size = 1000
+        # {(bucket, key): [(size, checksum)]} for objects uploaded in parts
+        self.parts = {}
+        self.corrupt_copies = False
+        self._lock = threading.Lock()
+
+    def _record(self, operation, kwargs):
+        with self._lock:
+            self.calls.append((operation, kwargs))
+
+    def operations(self, name):
+        return [kwargs for operation, kwargs in self.calls if operation == name]
+
+    def put(self, bucket, key, body, ChecksumAlgorithm=None, ETag=None, **headers):
+        if ChecksumAlgorithm:
+            headers[f"Checksum{ChecksumAlgorithm}"] = checksum(ChecksumAlgorithm, body)
+        self.parts.pop((bucket, key), None)
+        self.buckets[bucket][key] = dict(
+            Body=body, ETag=ETag or f'"{hashlib.md5(body).hexdigest()}"', **headers
+        )
+
+    def put_in_parts(self, bucket, key, body, part_size, algorithm):
+        """Store an object as if it had been uploaded in parts with checksums."""
+        parts = [body[i:][:part_size] for i in range(0, len(body), part_size)]
+        checksums = [checksum(algorithm, part) for part in parts]
+        md5s = b"".join(hashlib.md5(part).digest() for part in parts)
+        self.put(
+            bucket,
+            key,
+            body,
+            ETag=f'"{hashlib.md5(md5s).hexdigest()}-{len(parts)}"',
+            **{f"Checksum{algorithm}": _composite_checksum(algorithm, checksums)},
+        )
+        self.parts[(bucket, key)] = [(len(p), c) for p, c in zip(parts, checksums)]
+
+    def _copied(self, body):
+        if self.corrupt_copies and body:
+            return body[:-1] + bytes([body[-1] ^ 1])
+        return body
+
+    def _get(self, bucket, key):
+        try:
+            return self.buckets[bucket][key]
+        except KeyError:
+            raise ClientError(
+                {"Error": {"Code": "NoSuchKey", "Message": key}}, "GetObject"
+            )
+
+    def head_object(self, Bucket, Key, ChecksumMode=None):
+        self._record("head_object", dict(Bucket=Bucket, Key=Key))
+        obj = self._get(Bucket, Key)
+        head = {
+            k: v
+            for k, v in obj.items()
+            if k != "Body" and (ChecksumMode or not k.startswith("Checksum"))
+        }
+        return dict(head, ContentLength=len(obj["Body"]))
+
+    def get_object(self, Bucket, Key, IfMatch=None, Range=None):
+        self._record("get_object", dict(Bucket=Bucket, Key=Key, Range=Range))
+        obj = self._get(Bucket, Key)
+        if IfMatch not in (None, obj["ETag"]):
+            raise ClientError(
+                {"Error": {"Code": "PreconditionFailed", "Message": Key}}, "GetObject"
+            )
+        head = {k: v for k, v in obj.items() if k != "Body"}
+        body = obj["Body"]
+        if Range:
+            # Only the open-ended ranges the handlers ask for, like bytes=100-
+            start = int(Range[6:-1])
+            body = body[start:]
+        return dict(head, Body=io.BytesIO(body), ContentLength=len(body))
+
+    def put_object(self, Bucket, Key, Body, ChecksumAlgorithm=None, **kwargs):
+        self._record("put_object", dict(Bucket=Bucket, Key=Key, **kwargs))
+        if hasattr(Body, "read"):
+            Body = Body.read()
+        self.put(Bucket, Key, Body, ChecksumAlgorithm, **_content_headers(kwargs))
+        return {"ETag": self.buckets[Bucket][Key]["ETag"]}
+
+    def delete_object(self, Bucket, Key):
+        self._record("delete_object", dict(Bucket=Bucket, Key=Key))
+        self.buckets[Bucket].pop(Key, None)
+
+    def delete_objects(self, Bucket, Delete):
+        self._record("delete_objects", dict(Bucket=Bucket, Delete=Delete))
+        for obj in Delete["Objects"]:
+            self.buckets[Bucket].pop(obj["Key"], None)
+        return {}
+
+    def copy_object(self, Bucket, Key, CopySource, ChecksumAlgorithm=None, **kwargs):
+        self._record("copy_object", dict(Bucket=Bucket, Key=Key, **kwargs))
+        source = self._get(CopySource["Bucket"], CopySource["Key"])
+        self.put(Bucket, Key, self._copied(source["Body"]), ChecksumAlgorithm)
+        copy = self.buckets[Bucket][Key]
+        return {
+            "CopyObjectResult": {
+                k: v for k, v in copy.items() if k == "ETag" or k.startswith("Checksum")
+            }
+        }
+
+    def copy(self, CopySource, Bucket, Key, ExtraArgs=None, Config=None):
+        """boto3's managed copy, which copies in parts over Config's threshold."""
+        self._record("copy", dict(Bucket=Bucket, Key=Key, ExtraArgs=ExtraArgs))
+        self.copy_object(Bucket, Key, CopySource, **(ExtraArgs or {}))
+
+    def create_multipart_upload(self, Bucket, Key, **kwargs):
+        self._record("create_multipart_upload", dict(Bucket=Bucket, Key=Key, **kwargs))
+        upload_id = f"upload-{next(self._upload_numbers)}"
+        self.uploads[upload_id] = {
+            "Bucket": Bucket,
+            "Key": Key,
+            "Parts": {},
+            "Headers": _content_headers(kwargs),
+            "ChecksumAlgorithm": kwargs.get("ChecksumAlgorithm"),
+        }
+        return {"UploadId": upload_id}
+
+    def _upload(self, upload_id):
+        try:
+            return self.uploads[upload_id]
+        except KeyError:
+            raise ClientError(
+                {"Error": {"Code": "NoSuchUpload", "Message": upload_id}},
+                "UploadPartCopy",
+            )
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body):
+        self._record("upload_part", dict(Bucket=Bucket, Key=Key, PartNumber=PartNumber))
+        etag = f'"{hashlib.md5(Body).hexdigest()}"'
+        with self._lock:
+            self._upload(UploadId)["Parts"][PartNumber] = (etag, Body)
+        return {"ETag": etag}
+
+    def upload_part_copy(
+        self, Bucket, Key, UploadId, PartNumber, CopySource, CopySourceRange, **kwargs
+    ):
+        self._record(
+            "upload_part_copy",
+            dict(Bucket=Bucket, Key=Key, PartNumber=PartNumber, **kwargs),
+        )
+        upload = self._upload(UploadId)
+        source = self._get(CopySource["Bucket"], CopySource["Key"])
+        if kwargs.get("CopySourceIfMatch", source["ETag"]) != source["ETag"]:
+            raise ClientError(
+                {"Error": {"Code": "PreconditionFailed", "Message": Key}},
+                "UploadPartCopy",
+            )
+        first, last = (int(b) for b in CopySourceRange[6:].split("-"))
+        end = last + 1
+        body = self._copied(source["Body"][first:end])
+        etag = f'"{hashlib.md5(body).hexdigest()}"'
+        result = {"ETag": etag}
+        algorithm = upload["ChecksumAlgorithm"]
+        if algorithm:
+            result[f"Checksum{algorithm}"] = checksum(algorithm, body)
+        with self._lock:
+            upload["Parts"][PartNumber] = (etag, body)
+        return {"CopyPartResult": result}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        self._record("complete_multipart_upload", dict(Bucket=Bucket, Key=Key))
+        upload = self._upload(UploadId)
+        del self.uploads[UploadId]
+        parts = [upload["Parts"][p["PartNumber"]] for p in MultipartUpload["Parts"]]
+        assert [p["ETag"] for p in MultipartUpload["Parts"]] == [e for e, _ in parts]
+        self.put(Bucket, Key, b"".join(body for _, body in parts), **upload["Headers"])
+        algorithm = upload.get("ChecksumAlgorithm")
+        if not algorithm:
+            return {}
+        # S3 checks the part checksums it's sent against the ones it calculated
+        checksums = [checksum(algorithm, body) for _, body in parts]
+        assert [
+            p[f"Checksum{algorithm}"] for p in MultipartUpload["Parts"]
+        ] == checksums
+        composite = _composite_checksum(algorithm, checksums)
+        self.buckets[Bucket][Key][f"Checksum{algorithm}"] = composite
+        self.parts[(Bucket, Key)] = [(len(b), c) for (_, b), c in zip(parts, checksums)]
+        return {f"Checksum{algorithm}": composite}
+
+    def get_object_attributes(
+        self, Bucket, Key, ObjectAttributes, MaxParts=1000, PartNumberMarker=0
+    ):
+        self._record("get_object_attributes", dict(Bucket=Bucket, Key=Key))
+        obj = self._get(Bucket, Key)
+        if (Bucket, Key) not in self.parts:
+            return {}
+        algorithm = next(k for k in obj if k.startswith("Checksum"))
+        parts = [
+            {"PartNumber": number, "Size": size, algorithm: part_checksum}
+            for number, (size, part_checksum) in enumerate(
+                self.parts[(Bucket, Key)], start=1
+            )
+            if number > PartNumberMarker
+        ]
+        page = parts[:MaxParts]
+        response = {"Parts": page, "IsTruncated": len(parts) > MaxParts}
+        if response["IsTruncated"]:
+            response["NextPartNumberMarker"] = page[-1]["PartNumber"]
+        return {"ObjectParts": response}
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        self._record("abort_multipart_upload", dict(Bucket=Bucket, Key=Key))
+        self.uploads.pop(UploadId, None)
+
+    def list_objects_v2(
+        self, Bucket, Prefix="", StartAfter="", MaxKeys=1000, Delimiter=None
+    ):
+        self._record("list_objects_v2", dict(Bucket=Bucket, Prefix=Prefix))
+        # Keys, or with a delimiter, the folders they're in, as S3 groups them
+        entries = set()
+        for key in self.buckets[Bucket]:
+            if not key.startswith(Prefix) or key <= StartAfter:
+                continue
+            # Pages after a folder carry on after everything in it
+            if (
+                Delimiter
+                and StartAfter.endswith(Delimiter)
+                and key.startswith(StartAfter)
+            ):
+                continue
+            rest = key.removeprefix(Prefix)
+            if Delimiter and Delimiter in rest:
+                entries.add(Prefix + rest.split(Delimiter, 1)[0] + Delimiter)
+            else:
+                entries.add(key)
+        page = sorted(entries)[:MaxKeys]
+        contents = [
+            {
+                "Key": key,
+                "Size": len(self.buckets[Bucket][key]["Body"]),
+                "ETag": self.buckets[Bucket][key]["ETag"],
+                "LastModified": self.buckets[Bucket][key].get("LastModified"),
+            }
+            for key in page
+            if key in self.buckets[Bucket]
+        ]
+        folders = [{"Prefix": p} for p in page if p not in self.buckets[Bucket]]
+        response = {"IsTruncated": len(entries) > MaxKeys, "KeyCount": len(page)}
+        if contents:
+            response["Contents"] = contents
+        if folders:
+            response["CommonPrefixes"] = folders
+        if response["IsTruncated"]:
+            response["NextStartAfter"] = page[-1]
+        return response
+
+    def get_paginator(self, operation):
+        """A paginator for list_objects_v2, with page_size keys in each page."""
+        assert operation == "list_objects_v2"
+        client = self
+
+        class Paginator:
+            def paginate(self, Bucket, Prefix="", StartAfter="", Delimiter=None):
+                while True:
+                    page = client.list_objects_v2(
+                        Bucket, Prefix, StartAfter, client.page_size, Delimiter
+                    )
+                    yield page
+                    if not page["IsTruncated"]:
+                        return
+                    StartAfter = page.pop("NextStartAfter")
+
+        return Paginator()
+
+
+class FakeLambdaClient:
+    """Records asynchronous invocations, as the export handler makes to resume."""
+
+    def __init__(self):
+        self.invocations = []
+
+    def invoke(self, FunctionName, InvocationType, Payload):
+        assert InvocationType == "Event"
+        self.invocations.append((FunctionName, json.loads(Payload)))
+        return {"StatusCode": 202}
+
+
+@pytest.fixture
+def fake_s3():
+    return FakeS3Client()
+
+
+@pytest.fixture
+def fake_lambda(monkeypatch):
+    client = FakeLambdaClient()
+    monkeypatch.setattr(resume, "_client", client)
+    return client
+
+
 @pytest.fixture(scope="session")
 def yaml_file_list():
     return [
@@ -29,6 +423,47 @@ def yaml_file_list():
     ]
 
 
+@pytest.fixture(scope="session")
+def localstack_stacks():
+    """Create each end-to-end test program's stack on Localstack once per session,
+    rather than once per test, and destroy them all at the end.
+
+    Returns a function taking a Pulumi program and any other arguments for
+    PulumiTestInfrastructure, which gives back the deployed infrastructure. If a
+    stack fails to deploy, the first test using it gets the error and later ones
+    fail straight away.
+    """
+    stacks = {}
+    failed = set()
+
+    def get_stack(pulumi_program, **kwargs) -> PulumiTestInfrastructure:
+        if pulumi_program in failed:
+            pytest.fail("The stack for this test failed to deploy in an earlier test")
+        if pulumi_program not in stacks:
+            infrastructure = PulumiTestInfrastructure(pulumi_program, **kwargs)
+            try:
+                infrastructure.up()
+            except Exception:
+                # Don't keep a half-deployed stack for later tests to fail against
+                failed.add(pulumi_program)
+                infrastructure.destroy()
+                raise
+            stacks[pulumi_program] = infrastructure
+        return stacks[pulumi_program]
+
+    yield get_stack
+    for infrastructure in stacks.values():
+        infrastructure.destroy()
+
+
+@pytest.fixture(scope="session")
+def pull_yaml_file_list():
+    return [
+        "tests/data/pull/test_pull.yaml",
+        "tests/data/pull/test_pull_2.yaml",
+    ]
+
+
 @pytest.fixture(scope="session")
 def test_config_1():
     return {
@@ -38,12 +473,39 @@ def test_config_1():
     }
 
 
+@pytest.fixture(scope="session")
+def test_config_batched():
+    return {
+        "name": "test_dataset_batched",
+        "target_bucket": "test-bucket",
+        "users": ["alpha_user_test_person"],
+        "delivery": "batched",
+        "batch_size": 500,
+        "batching_window_s": 60,
+    }
+
+
+@pytest.fixture(scope="session")
+def test_config_tuned():
+    return {
+        "name": "test_dataset_tuned",
+        "target_bucket": "test-bucket",
+        "users": ["alpha_user_test_person"],
+        "memory_mb": 1024,
+        "timeout_s": 60,
+        "architecture": "arm64",
+        "handler": "lean",
+        "reserved_concurrency": 50,
+        "provisioned_concurrency": 5,
+    }
+
+
 @pytest.fixture(scope="session")
 def test_config_2():
     return {
         "name": "test_dataset_2",
         "keep_files": True,
-        "target_bucket": "test-bucket_2",
+        "target_bucket": "test-bucket-2",
         "users": ["alpha_user_test_person", "alpha_user_test_person_2"],
     }
 
@@ -0,0 +1,151 @@
+from datetime import datetime, timezone
+
+import pytest
+
+from data_engineering_exports import backfill, cli
+from data_engineering_exports.reconcile import ObjectInfo
+
+EXPORT_BUCKET = "mojap-hub-exports"
+ACCOUNT_ID = "123456789012"
+DATASET = {
+    "name": "history",
+    "target_bucket": "target-1",
+    "keep_files": False,
+    "exclude_patterns": ["*.tmp"],
+    "allow_backfill": True,
+}
+
+
+class FakeS3ControlClient:
+    """Accepts one job, whose status moves through statuses on each describe_job."""
+
+    def __init__(self, statuses):
+        self.statuses = list(statuses)
+        self.jobs = []
+
+    def create_job(self, **kwargs):
+        self.jobs.append(kwargs)
+        return {"JobId": "job-1"}
+
+    def describe_job(self, AccountId, JobId):
+        status, succeeded, failed, elapsed = self.statuses.pop(0)
+        return {
+            "Job": {
+                "Status": status,
+                "ProgressSummary": {
+                    "TotalNumberOfTasks": 3,
+                    "NumberOfTasksSucceeded": succeeded,
+                    "NumberOfTasksFailed": failed,
+                    "Timers": {"ElapsedTimeInActiveSeconds": elapsed},
+                },
+            }
+        }
+
+
+class FakeSTSClient:
+    def get_caller_identity(self):
+        return {"Account": ACCOUNT_ID}
+
+
+def test_manifest_lists_keys_to_copy(fake_s3):
+    objects = [
+        ObjectInfo("history/2019/a b.csv", 10, '"a"'),
+        ObjectInfo("history/2019/skip.tmp", 10, '"b"'),
+        ObjectInfo("history/huge.csv", backfill.MAX_COPY_SIZE + 1, '"c"'),
+        ObjectInfo("history/2020/ü.csv", 5, '"d"'),
+    ]
+    manifest = backfill.write_manifest(
+        fake_s3,
+        objects,
+        EXPORT_BUCKET,
+        EXPORT_BUCKET,
+        "m.csv",
+        DATASET["exclude_patterns"],
+    )
+
+    body = fake_s3.buckets[EXPORT_BUCKET]["m.csv"]["Body"]
+    assert body.decode().splitlines() == [
+        "mojap-hub-exports,history/2019/a%20b.csv",
+        "mojap-hub-exports,history/2020/%C3%BC.csv",
+    ]
+    assert manifest.etag == fake_s3.buckets[EXPORT_BUCKET]["m.csv"]["ETag"]
+    assert (manifest.objects, manifest.size) == (2, 15)
+    assert [obj.key for obj in manifest.skipped] == ["history/huge.csv"]
+
+
+def test_datasets_that_change_objects_cant_backfill():
+    with pytest.raises(backfill.BackfillError, match="compress set"):
+        backfill.check_dataset(dict(DATASET, compress="gzip"))
+    backfill.check_dataset(DATASET)
+
+
+def test_datasets_must_allow_backfill():
+    """Check the export role is only used if the dataset lets jobs assume it."""
+    closed = dict(DATASET, allow_backfill=False)
+    with pytest.raises(backfill.BackfillError, match="allow_backfill"):
+        backfill.check_dataset(closed)
+    backfill.check_dataset(closed, "arn:aws:iam::123456789012:role/backfill")
+
+
+def test_job_runs_as_the_export_role():
+    assert backfill.export_role_arn(ACCOUNT_ID, DATASET) == (
+        "arn:aws:iam::123456789012:role/service-role/export_history-move"
+    )
+    kept = dict(DATASET, keep_files=True)
+    assert backfill.export_role_arn(ACCOUNT_ID, kept).endswith("export_history-copy")
+    started = datetime(2024, 1, 2, 3, 4, 5, tzinfo=timezone.utc)
+    assert backfill.run_prefix(DATASET, started) == "_backfill/history/20240102T030405Z"
+
+
+def test_progress_reports_throughput():
+    manifest = backfill.Manifest(EXPORT_BUCKET, "m.csv", "e", 4, 8 * 1024**2, [])
+    progress = backfill.JobProgress("Active", 4, 2, 1, 2)
+    assert backfill.describe_progress(progress, manifest) == (
+        "Active: 3 of 4 objects done (1 failed) in 2s, 1.5 objects/s, about 2.0 MiB/s"
+    )
+
+
+def test_backfill_command(fake_s3, monkeypatch, capsys):
+    for key in ("history/1.csv", "history/2.csv", "history/3.tmp", "other/4.csv"):
+        fake_s3.put(EXPORT_BUCKET, key, b"data")
+    s3control = FakeS3ControlClient(
+        [("Preparing", 0, 0, 0), ("Active", 1, 0, 1), ("Complete", 2, 0, 2)]
+    )
+    clients = {"s3": fake_s3, "s3control": s3control, "sts": FakeSTSClient()}
+    monkeypatch.setattr(cli.registry, "load_configs", lambda *args: [DATASET])
+    monkeypatch.setattr(cli.boto3, "client", clients.get)
+    args = cli.build_parser().parse_args(
+        ["backfill", "--dataset", "history", "--interval", "0"]
+    )
+    args.function(args)
+
+    [job] = s3control.jobs
+    assert job["RoleArn"].endswith("role/service-role/export_history-move")
+    copy = job["Operation"]["S3PutObjectCopy"]
+    assert copy["TargetResource"] == "arn:aws:s3:::target-1"
+    manifest_arn = job["Manifest"]["Location"]["ObjectArn"]
+    manifest_key = manifest_arn.split(f"{EXPORT_BUCKET}/", 1)[1]
+    assert manifest_key.startswith("_backfill/history/")
+    assert fake_s3.buckets[EXPORT_BUCKET][manifest_key]["Body"].splitlines() == [
+        b"mojap-hub-exports,history/1.csv",
+        b"mojap-hub-exports,history/2.csv",
+    ]
+    assert job["Report"]["Prefix"] == manifest_key.rsplit("/", 1)[0]
+
+    output = capsys.readouterr()
+    assert output.out == "job-1\n"
+    assert "Complete: 2 of 3 objects done in 2s" in output.err.splitlines()[-1]
+
+
+def test_failed_backfill_exits_with_error(fake_s3, monkeypatch):
+    fake_s3.put(EXPORT_BUCKET, "history/1.csv", b"data")
+    clients = {
+        "s3": fake_s3,
+        "s3control": FakeS3ControlClient([("Failed", 0, 1, 1)]),
+        "sts": FakeSTSClient(),
+    }
+    monkeypatch.setattr(cli.registry, "load_configs", lambda *args: [DATASET])
+    monkeypatch.setattr(cli.boto3, "client", clients.get)
+    args = cli.build_parser().parse_args(["backfill", "--dataset", "history"])
+    with pytest.raises(SystemExit):
+        args.function(args)
@@ -0,0 +1,96 @@
+import pytest
+
+from benchmarks import cold_start_benchmark, load_test, program_benchmark
+
+
+def test_program_benchmark_records_every_phase():
+    """Run the program benchmark at a tiny size, to check it still matches the
+    program's phases."""
+    results = program_benchmark.run(push_count=3, pull_count=2)
+
+    assert results["push_datasets"] == 3
+    phases = results["phases"]
+    assert list(phases) == [
+        "load",
+        "build_lambda_functions",
+        "build_role_policies",
+        "bucket_notification",
+        "pull",
+        "total",
+    ]
+    assert all(phase["seconds"] >= 0 for phase in phases.values())
+    assert phases["bucket_notification"]["resources"] == 1
+    assert phases["total"]["resources"] == sum(
+        phase["resources"] for name, phase in phases.items() if name != "total"
+    )
+
+
+def test_load_test_size_distribution():
+    assert load_test.parse_size("100KiB") == 102_400
+    assert load_test.parse_size("1.5MiB") == 1_572_864
+    assert load_test.parse_size("42") == 42
+    assert load_test.parse_size_distribution("1KiB=9,1MiB=1") == [
+        (1024, 9.0),
+        (1_048_576, 1.0),
+    ]
+    with pytest.raises(ValueError):
+        load_test.parse_size_distribution("1KiB=0")
+
+
+def test_load_test_plans_uploads_across_datasets():
+    uploads = load_test.plan_uploads(["a", "b"], 5, [(10, 1), (20, 1)])
+    assert [upload.dataset for upload in uploads] == ["a", "b", "a", "b", "a"]
+    assert all(upload.key.startswith(upload.dataset + "/") for upload in uploads)
+    assert {upload.size for upload in uploads} <= {10, 20}
+
+
+def test_load_test_summary():
+    uploads = [load_test.Upload("a", f"a/{i}", 100) for i in range(100)] + [
+        load_test.Upload("b", "b/0", 50)
+    ]
+    uploaded = {upload.key: 0.0 for upload in uploads}
+    # Object i in dataset a takes i + 1 seconds, and b's object never arrives
+    delivered = {f"a/{i}": i + 1.0 for i in range(100)}
+
+    results = load_test.summarise(uploads, 0.0, uploaded, delivered)
+    assert results["a"]["p50"] == 50
+    assert results["a"]["p95"] == 95
+    assert results["a"]["p99"] == 99
+    assert results["a"]["objects_per_second"] == 1
+    assert results["a"]["bytes_per_second"] == 100
+    assert results["b"] == {
+        "objects": 1,
+        "delivered": 0,
+        "p50": None,
+        "p95": None,
+        "p99": None,
+        "objects_per_second": 0,
+        "bytes_per_second": 0,
+    }
+    assert results["all"]["delivered"] == 100
+
+
+def test_cold_start_summary():
+    runs = [
+        {"init": 0.2, "calls": [0.1, 0.01, 0.03], "boto3": False},
+        {"init": 0.4, "calls": [0.3, 0.02, 0.04], "boto3": False},
+    ]
+    assert cold_start_benchmark.summarise(runs) == {
+        "init_ms": 300.0,
+        "first_call_ms": 200.0,
+        "cold_start_ms": 500.0,
+        "warm_p50_ms": 20.0,
+        "warm_p95_ms": 40.0,
+        "loads_boto3": False,
+    }
+
+
+@pytest.mark.parametrize("name, loads_boto3", [("export", True), ("lean", False)])
+def test_cold_start_of_each_handler(name, loads_boto3):
+    """Start each handler without calling it, which needs no Localstack."""
+    result = cold_start_benchmark.cold_start(
+        cold_start_benchmark.HANDLERS[name], [], {"AWS_DEFAULT_REGION": "eu-west-1"}
+    )
+    assert result["init"] > 0
+    assert result["calls"] == []
+    assert result["boto3"] == loads_boto3
@@ -0,0 +1,222 @@
+import json
+
+import pytest
+
+from data_engineering_exports import bulk_copy, cli
+
+SOURCE = "old-target"
+DESTINATION = "new-target"
+JOB = {"source": SOURCE, "destination": DESTINATION, "prefix": "history/"}
+KEYS = [
+    "history/2019-notes.csv",
+    "history/2019/01/a.csv",
+    "history/2019/02/b.csv",
+    "history/2019/03/c.csv",
+    "history/2020/01/d.csv",
+    "history/x.csv",
+]
+
+
+@pytest.fixture
+def source(fake_s3):
+    fake_s3.page_size = 2
+    for key in KEYS + ["other/y.csv"]:
+        fake_s3.put(SOURCE, key, key.encode())
+    return fake_s3
+
+
+def run_copy(fake_s3, journal_path, **kwargs):
+    journal = bulk_copy.Journal(journal_path, JOB)
+    try:
+        return bulk_copy.BulkCopy(
+            fake_s3, SOURCE, DESTINATION, "history/", journal, workers=3, **kwargs
+        ).run()
+    finally:
+        journal.close()
+
+
+def read_journal(path):
+    return [json.loads(line) for line in path.read_text().splitlines()]
+
+
+def test_listing_is_split_at_folders(source):
+    assert bulk_copy.split_points(source, SOURCE, "history/", 2) == [
+        "history/2019/",
+        "history/2020/",
+    ]
+    assert bulk_copy.split_points(source, SOURCE, "history/", 3) == [
+        "history/2019/01/",
+        "history/2019/02/",
+        "history/2019/03/",
+        "history/2020/01/",
+    ]
+
+
+def test_ranges_list_every_key_once(source):
+    points = bulk_copy.split_points(source, SOURCE, "history/", 3)
+    listed = [
+        obj.key
+        for start, end in zip(["history/"] + points, points + [None])
+        for obj in bulk_copy.list_range(source, SOURCE, "history/", start, end)
+    ]
+    assert listed == KEYS
+    resumed = bulk_copy.list_range(
+        source, SOURCE, "history/", "history/", None, after="history/2019/03/c.csv"
+    )
+    assert [obj.key for obj in resumed] == ["history/2020/01/d.csv", "history/x.csv"]
+
+
+def test_copies_everything_once(source, tmp_path):
+    journal_path = tmp_path / "copy.jsonl"
+    stats = run_copy(source, journal_path, list_workers=2)
+
+    assert (stats.listed, stats.copied, stats.failed) == (6, 6, 0)
+    assert stats.bytes == sum(len(key) for key in KEYS)
+    assert sorted(source.buckets[DESTINATION]) == KEYS
+    assert source.operations("copy_object")[0]["ACL"] == "bucket-owner-full-control"
+    assert sum("done" in line for line in read_journal(journal_path)) == 3
+
+    stats = run_copy(source, journal_path, list_workers=2)
+    assert stats.listed == 0
+    assert len(source.operations("copy_object")) == 6
+
+
+def test_resumes_from_the_journal(source, tmp_path):
+    journal_path = tmp_path / "copy.jsonl"
+    lines = [
+        {"job": JOB},
+        {"range": "history/2019/", "after": "history/2019/02/b.csv"},
+        {"range": "history/2020/", "done": True},
+        {"failed": "history/x.csv", "size": 13, "etag": None, "error": "Timeout"},
+        {"failed": "history/2019/01/a.csv", "size": 21, "etag": None, "error": "x"},
+        {"retried": "history/2019/01/a.csv"},
+    ]
+    journal_path.write_text("".join(json.dumps(line) + "\n" for line in lines))
+    run_copy(source, journal_path, list_workers=1)
+
+    assert sorted(source.buckets[DESTINATION]) == [
+        "history/2019-notes.csv",
+        "history/2019/03/c.csv",
+        "history/x.csv",
+    ]
+    assert bulk_copy.Journal(journal_path, JOB).failed == {}
+
+
+def test_failures_are_journalled_and_retried(source, tmp_path):
+    journal_path = tmp_path / "copy.jsonl"
+    source.corrupt_copies = True
+    stats = run_copy(source, journal_path)
+    assert stats.failed == 6
+    journal = bulk_copy.Journal(journal_path, JOB)
+    assert sorted(journal.failed) == KEYS
+    assert journal.failed["history/x.csv"].size == 13
+    journal.close()
+
+    source.corrupt_copies = False
+    stats = run_copy(source, journal_path)
+    assert (stats.listed, stats.copied, stats.failed) == (6, 6, 0)
+    assert bulk_copy.Journal(journal_path, JOB).failed == {}
+
+
+def test_large_objects_are_copied_in_parts(source, tmp_path):
+    run_copy(source, tmp_path / "copy.jsonl", multipart_threshold=16)
+    copied = {call["Key"] for call in source.operations("copy")}
+    assert copied == set(KEYS) - {"history/x.csv"}
+    assert sorted(source.buckets[DESTINATION]) == KEYS
+
+
+def test_progress_waits_for_earlier_keys(tmp_path, monkeypatch):
+    monkeypatch.setattr(bulk_copy, "JOURNAL_INTERVAL_S", -1)
+    journal_path = tmp_path / "copy.jsonl"
+    journal = bulk_copy.Journal(journal_path, JOB)
+    progress = bulk_copy.RangeProgress(journal, "history/")
+    for key in ("a", "b", "c"):
+        progress.listed(key)
+    progress.finished("b")
+    progress.finished("a")
+    progress.listing_finished()
+    progress.finished("c")
+    journal.close()
+
+    assert read_journal(journal_path)[1:] == [
+        {"range": "history/", "after": "b"},
+        {"range": "history/", "done": True},
+    ]
+
+
+def test_flushed_progress_isnt_journalled_again(tmp_path, monkeypatch):
+    journal_path = tmp_path / "copy.jsonl"
+    journal = bulk_copy.Journal(journal_path, JOB)
+    progress = bulk_copy.RangeProgress(journal, "history/")
+    progress.listed("a")
+    progress.finished("a")
+    progress.flush()
+    monkeypatch.setattr(bulk_copy, "JOURNAL_INTERVAL_S", -1)
+    progress.flush()
+    progress.finished("a")
+    journal.close()
+
+    assert read_journal(journal_path)[1:] == [{"range": "history/", "after": "a"}]
+
+
+def test_journal_of_another_copy_is_refused(tmp_path):
+    journal_path = tmp_path / "copy.jsonl"
+    bulk_copy.Journal(journal_path, JOB).close()
+    with pytest.raises(bulk_copy.BulkCopyError, match="different copy"):
+        bulk_copy.Journal(journal_path, dict(JOB, destination="elsewhere"))
+
+
+def test_pacer_spaces_out_work(monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(bulk_copy, "monotonic", lambda: 0.0)
+    monkeypatch.setattr(bulk_copy, "sleep", sleeps.append)
+    pacer = bulk_copy.Pacer(10)
+    for _ in range(3):
+        pacer.wait()
+    pacer.wait(5)
+    assert sleeps == pytest.approx([0.1, 0.2, 0.3])
+    bulk_copy.Pacer(None).wait(10**9)
+    assert len(sleeps) == 3
+
+
+def test_copy_command(source, monkeypatch, tmp_path, capsys):
+    dataset = {"name": "history", "target_bucket": DESTINATION}
+    monkeypatch.setattr(cli.registry, "load_configs", lambda *args: [dataset])
+    monkeypatch.setattr(cli.boto3, "client", lambda *args, **kwargs: source)
+    journal_path = tmp_path / "copy.jsonl"
+    args = cli.build_parser().parse_args(
+        ["copy", "--dataset", "history", "--source-bucket", SOURCE]
+        + ["--journal", str(journal_path), "--max-objects-per-second", "1000"]
+    )
+    args.function(args)
+
+    assert sorted(source.buckets[DESTINATION]) == KEYS
+    assert read_journal(journal_path)[0] == {"job": JOB}
+    assert "6 of 6 objects copied" in capsys.readouterr().err
+
+    source.corrupt_copies = True
+    args.journal = str(tmp_path / "again.jsonl")
+    with pytest.raises(SystemExit):
+        args.function(args)
+
+
+def test_copy_command_for_pull_dataset(source, monkeypatch, tmp_path):
+    """Check a pull dataset's objects are copied to the whole of its bucket."""
+    configs = {"push": [], "pull": [{"name": "history-pull", "pull_arns": []}]}
+    monkeypatch.setattr(cli.registry, "load_configs", lambda files, kind: configs[kind])
+    monkeypatch.setattr(cli.boto3, "client", lambda *args, **kwargs: source)
+    journal_path = tmp_path / "copy.jsonl"
+    args = cli.build_parser().parse_args(
+        ["copy", "--dataset", "history-pull", "--source-bucket", SOURCE]
+        + ["--journal", str(journal_path)]
+    )
+    args.function(args)
+
+    assert sorted(source.buckets["mojap-history-pull"]) == KEYS + ["other/y.csv"]
+    assert read_journal(journal_path)[0] == {
+        "job": {"source": SOURCE, "destination": "mojap-history-pull", "prefix": ""}
+    }
+
+    args.dataset = "missing"
+    with pytest.raises(SystemExit, match="or pull dataset"):
+        args.function(args)
@@ -0,0 +1,89 @@
+from data_engineering_exports.export_function import EventFilter, router_role_policy
+
+
+def test_router_role_policy():
+    """Check router permissions are grouped by action, not repeated per dataset."""
+    routes = {
+        "dataset_a": {"target_bucket": "bucket-1", "keep_files": False},
+        "dataset_b": {"target_bucket": "bucket-1", "keep_files": False},
+        "dataset_c": {"target_bucket": "bucket-2", "keep_files": True},
+    }
+    policy = router_role_policy("arn:aws:s3:::export-bucket", routes)
+    assert policy["Statement"] == [
+        {
+            "Sid": "GetDeleteSourceBucket",
+            "Effect": "Allow",
+            "Resource": [
+                "arn:aws:s3:::export-bucket/dataset_a/*",
+                "arn:aws:s3:::export-bucket/dataset_b/*",
+            ],
+            "Action": ["s3:GetObject*", "s3:DeleteObject*"],
+        },
+        {
+            "Sid": "GetSourceBucket",
+            "Effect": "Allow",
+            "Resource": ["arn:aws:s3:::export-bucket/dataset_c/*"],
+            "Action": ["s3:GetObject*"],
+        },
+        {
+            "Sid": "PutDestinationBuckets",
+            "Effect": "Allow",
+            "Resource": ["arn:aws:s3:::bucket-1/*", "arn:aws:s3:::bucket-2/*"],
+            "Action": [
+                "s3:PutObject*",
+                "s3:AbortMultipartUpload",
+                "s3:DeleteObject",
+            ],
+        },
+        {
+            "Sid": "MultipartCheckpoints",
+            "Effect": "Allow",
+            "Resource": ["arn:aws:s3:::export-bucket/_export_checkpoints/*"],
+            "Action": ["s3:GetObject", "s3:PutObject", "s3:DeleteObject"],
+        },
+    ]
+
+
+def test_router_role_policy_copy_only():
+    """Check no delete statement is made when every dataset keeps its files."""
+    routes = {"dataset_c": {"target_bucket": "bucket-2", "keep_files": True}}
+    policy = router_role_policy("arn:aws:s3:::export-bucket", routes)
+    assert [s["Sid"] for s in policy["Statement"]] == [
+        "GetSourceBucket",
+        "PutDestinationBuckets",
+        "MultipartCheckpoints",
+    ]
+
+
+def test_event_pattern_defaults_to_the_prefix():
+    assert EventFilter().pattern("export-bucket", "dataset_a") == {
+        "source": ["aws.s3"],
+        "detail-type": ["Object Created"],
+        "detail": {
+            "bucket": {"name": ["export-bucket"]},
+            "object": {"key": [{"prefix": "dataset_a/"}]},
+        },
+    }
+
+
+def test_event_pattern_filters():
+    event_filter = EventFilter((".csv", ".json"), 1, ("put", "multipart"))
+    detail = event_filter.pattern("export-bucket", "dataset_a")["detail"]
+    assert detail["object"] == {
+        "key": [{"wildcard": "dataset_a/*.csv"}, {"wildcard": "dataset_a/*.json"}],
+        "size": [{"numeric": [">=", 1]}],
+    }
+    assert detail["reason"] == ["PutObject", "CompleteMultipartUpload"]
+
+
+def test_exclude_pattern_drops_excluded_keys():
+    event_filter = EventFilter(exclude_patterns=("*_tmp*", "*/", "a**b", "*.v?"))
+    assert event_filter.exclude_pattern() == {
+        "source": ["aws.s3"],
+        "detail-type": ["Object Created"],
+        "detail": {
+            "object": {"key": [{"anything-but": {"wildcard": ["*_tmp*", "*/", "a*b"]}}]}
+        },
+    }
+    assert EventFilter(exclude_patterns=("*.v[12]",)).exclude_pattern() is None
+    assert EventFilter().exclude_pattern() is None
@@ -0,0 +1,861 @@
+from collections import defaultdict
+import gzip
+import io
+import json
+import random
+import socket
+import sys
+import tarfile
+from datetime import datetime, timezone
+
+from botocore.exceptions import (
+    ClientError,
+    ConnectionClosedError,
+    ConnectTimeoutError,
+    EndpointConnectionError,
+    ReadTimeoutError,
+)
+import pytest
+
+from tests.conftest import checksum
+
+from data_engineering_exports.lambda_handlers.export import (
+    bundle,
+    compress,
+    export,
+    metrics,
+    multipart,
+    routing,
+    throttle,
+    tracing,
+)
+from data_engineering_exports.lambda_handlers.export.checksums import (
+    ChecksumMismatchError,
+)
+from data_engineering_exports.lambda_handlers.export.multipart import (
+    CopyIncompleteError,
+    choose_part_size,
+    part_ranges,
+)
+
+SOURCE = "test-export-bucket"
+TARGET = "test-target-bucket"
+CHECKPOINT_KEY = "_export_checkpoints/test_dataset/big.csv.json"
+FUNCTION_ARN = "arn:aws:lambda:eu-west-1:000000000000:function:test_dataset-move"
+
+
+def s3_event(*keys, sizes=None):
+    sizes = sizes or {}
+    return {
+        "Records": [
+            {
+                "s3": {
+                    "bucket": {"name": SOURCE},
+                    "object": {"key": key, "size": sizes.get(key, 0)},
+                }
+            }
+            for key in keys
+        ]
+    }
+
+
+def sqs_event(*messages, sizes=None):
+    """SQS records, each wrapping an S3 notification for a list of keys."""
+    return {
+        "Records": [
+            {
+                "messageId": message_id,
+                "eventSource": "aws:sqs",
+                "body": json.dumps(s3_event(*keys, sizes=sizes)),
+            }
+            for message_id, keys in messages
+        ]
+    }
+
+
+class FakeContext:
+    """Lambda context whose remaining time drops to zero after a number of checks."""
+
+    invoked_function_arn = FUNCTION_ARN
+
+    def __init__(self, checks_before_timeout):
+        self.checks = checks_before_timeout
+
+    def get_remaining_time_in_millis(self):
+        self.checks -= 1
+        return 300_000 if self.checks >= 0 else 0
+
+
+@pytest.fixture(autouse=True)
+def export_environment(monkeypatch, fake_s3, fake_lambda):
+    monkeypatch.setenv("DESTINATION_BUCKET", TARGET)
+    monkeypatch.setenv("MULTIPART_THRESHOLD", "100")
+    monkeypatch.setenv("PART_SIZE", "10")
+    monkeypatch.setenv("MAX_CONCURRENCY", "1")
+    monkeypatch.setattr(multipart, "MIN_PART_SIZE", 1)
+    monkeypatch.setattr(export, "_client", fake_s3)
+    monkeypatch.setattr(routing, "_routes", None)
+    monkeypatch.setattr(metrics, "_values", defaultdict(lambda: defaultdict(list)))
+
+
+@pytest.fixture
+def routing_table(monkeypatch, tmp_path):
+    """Deploy the handler as a router for two datasets."""
+    table = tmp_path / "routes.json"
+    table.write_text(
+        json.dumps(
+            {
+                "dataset_a": {
+                    "target_bucket": "bucket-a",
+                    "keep_files": False,
+                    "exclude": ["*.tmp"],
+                },
+                "dataset_b": {"target_bucket": "bucket-b", "keep_files": True},
+            }
+        )
+    )
+    monkeypatch.delenv("DESTINATION_BUCKET")
+    monkeypatch.setenv("ROUTING_TABLE", str(table))
+
+
+def test_part_ranges():
+    assert part_ranges(25, 10) == [(1, 0, 9), (2, 10, 19), (3, 20, 24)]
+    assert part_ranges(20, 10) == [(1, 0, 9), (2, 10, 19)]
+
+
+def test_choose_part_size():
+    assert choose_part_size(100, 10) == 10
+    # Never more than 10,000 parts
+    assert choose_part_size(200_000, 10) == 20
+
+
+def test_small_object_is_moved(fake_s3):
+    fake_s3.put(SOURCE, "test_dataset/small.csv", b"a,b\n1,2\n")
+    export.handler(s3_event("test_dataset/small.csv"), None)
+
+    assert fake_s3.buckets[TARGET]["test_dataset/small.csv"]["Body"] == b"a,b\n1,2\n"
+    assert "test_dataset/small.csv" not in fake_s3.buckets[SOURCE]
+    assert len(fake_s3.operations("copy_object")) == 1
+    assert not fake_s3.operations("upload_part_copy")
+
+
+def test_keep_files(fake_s3, monkeypatch):
+    monkeypatch.setenv("KEEP_FILES", "true")
+    fake_s3.put(SOURCE, "test_dataset/small.csv", b"a,b\n1,2\n")
+    export.handler(s3_event("test_dataset/small.csv"), None)
+
+    assert "test_dataset/small.csv" in fake_s3.buckets[TARGET]
+    assert "test_dataset/small.csv" in fake_s3.buckets[SOURCE]
+
+
+def test_large_object_is_copied_in_parts(fake_s3, monkeypatch):
+    monkeypatch.setenv("MAX_CONCURRENCY", "4")
+    body = bytes(range(256)) * 4
+    fake_s3.put(SOURCE, "test_dataset/big.csv", body, ContentType="text/csv")
+    export.handler(s3_event("test_dataset/big.csv"), None)
+
+    assert fake_s3.buckets[TARGET]["test_dataset/big.csv"]["Body"] == body
+    assert len(fake_s3.operations("upload_part_copy")) == 103
+    assert fake_s3.operations("create_multipart_upload")[0]["ContentType"] == "text/csv"
+    # Source and checkpoint are both cleared up
+    assert fake_s3.buckets[SOURCE] == {}
+
+
+def test_timed_out_copy_resumes_from_checkpoint(fake_s3, fake_lambda):
+    body = b"x" * 250
+    fake_s3.put(SOURCE, "test_dataset/big.csv", body)
+    event = s3_event("test_dataset/big.csv")
+    export.handler(event, FakeContext(10))
+
+    # The source is kept and the checkpoint records the parts copied so far
+    assert "test_dataset/big.csv" in fake_s3.buckets[SOURCE]
+    checkpoint = json.loads(fake_s3.buckets[SOURCE][CHECKPOINT_KEY]["Body"])
+    copied = len(fake_s3.operations("upload_part_copy"))
+    assert 0 < copied < 25
+    assert len(checkpoint["parts"]) == copied
+    # The function invokes itself again with the same event to carry on
+    [(function, resumed)] = fake_lambda.invocations
+    assert function == FUNCTION_ARN
+    assert resumed == dict(event, exportResumes=1)
+
+    # The next invocation copies only the missing parts, reusing the same upload
+    export.handler(resumed, FakeContext(1000))
+    assert len(fake_s3.operations("upload_part_copy")) == 25
+    assert len(fake_s3.operations("create_multipart_upload")) == 1
+    assert fake_s3.buckets[TARGET]["test_dataset/big.csv"]["Body"] == body
+    assert fake_s3.buckets[SOURCE] == {}
+    assert len(fake_lambda.invocations) == 1
+
+
+def test_resumes_are_limited(fake_s3, fake_lambda, monkeypatch):
+    monkeypatch.setenv("MAX_RESUMES", "3")
+    fake_s3.put(SOURCE, "test_dataset/big.csv", b"x" * 250)
+    event = dict(s3_event("test_dataset/big.csv"), exportResumes=3)
+    # Lambda's own retries are the last resort
+    with pytest.raises(CopyIncompleteError):
+        export.handler(event, FakeContext(10))
+    assert fake_lambda.invocations == []
+
+
+def test_aborted_upload_starts_again(fake_s3, fake_lambda):
+    body = b"x" * 250
+    fake_s3.put(SOURCE, "test_dataset/big.csv", body)
+    export.handler(s3_event("test_dataset/big.csv"), FakeContext(10))
+
+    # S3 aborts the upload before the copy resumes
+    fake_s3.uploads.clear()
+    export.handler(fake_lambda.invocations[0][1], FakeContext(1000))
+
+    assert len(fake_s3.operations("create_multipart_upload")) == 2
+    assert fake_s3.buckets[TARGET]["test_dataset/big.csv"]["Body"] == body
+    assert fake_s3.buckets[SOURCE] == {}
+
+
+def test_overwritten_source_restarts_copy(fake_s3):
+    fake_s3.put(SOURCE, "test_dataset/big.csv", b"x" * 250)
+    export.handler(s3_event("test_dataset/big.csv"), FakeContext(10))
+
+    # The user replaces the file before the retry, so the old parts can't be reused
+    fake_s3.put(SOURCE, "test_dataset/big.csv", b"y" * 250)
+    export.handler(s3_event("test_dataset/big.csv"), None)
+
+    assert len(fake_s3.operations("abort_multipart_upload")) == 1
+    assert len(fake_s3.operations("create_multipart_upload")) == 2
+    assert fake_s3.buckets[TARGET]["test_dataset/big.csv"]["Body"] == b"y" * 250
+
+
+def test_copy_is_checked_with_the_source_checksum(fake_s3):
+    fake_s3.put(SOURCE, "test_dataset/small.csv", b"a,b\n", ChecksumAlgorithm="SHA256")
+    export.handler(s3_event("test_dataset/small.csv"), None)
+
+    source_checksum = checksum("SHA256", b"a,b\n")
+    copy = fake_s3.buckets[TARGET]["test_dataset/small.csv"]
+    assert copy["ChecksumSHA256"] == source_checksum
+    assert "test_dataset/small.csv" not in fake_s3.buckets[SOURCE]
+
+
+@pytest.mark.parametrize("algorithm", ["CRC32C", None])
+def test_corrupt_copy_keeps_the_source(fake_s3, algorithm):
+    """With no source checksum, the copy is compared with the source's ETag."""
+    fake_s3.put(SOURCE, "test_dataset/small.csv", b"a,b\n", algorithm)
+    fake_s3.corrupt_copies = True
+    with pytest.raises(ChecksumMismatchError, match="doesn't match its source"):
+        export.handler(s3_event("test_dataset/small.csv"), None)
+    assert "test_dataset/small.csv" in fake_s3.buckets[SOURCE]
+    # The bad copy isn't left for consumers to read
+    assert "test_dataset/small.csv" not in fake_s3.buckets[TARGET]
+
+
+def test_failed_delete_still_raises_the_mismatch(fake_s3, monkeypatch, capsys):
+    """Check a copy the role can't delete doesn't hide why the export failed."""
+    fake_s3.put(SOURCE, "test_dataset/small.csv", b"a,b\n")
+    fake_s3.corrupt_copies = True
+
+    def delete_object(Bucket, Key):
+        raise ClientError({"Error": {"Code": "AccessDenied"}}, "DeleteObject")
+
+    monkeypatch.setattr(fake_s3, "delete_object", delete_object)
+    with pytest.raises(ChecksumMismatchError):
+        export.handler(s3_event("test_dataset/small.csv"), None)
+    assert "Couldn't delete the mismatched copy" in capsys.readouterr().out
+
+
+def test_mismatched_multipart_copy_is_deleted(fake_s3, monkeypatch):
+    fake_s3.put_in_parts(SOURCE, "test_dataset/big.csv", b"x" * 250, 30, "CRC32C")
+    complete = fake_s3.complete_multipart_upload
+
+    def complete_wrongly(**kwargs):
+        complete(**kwargs)
+        return {"ChecksumCRC32C": "AAAAAA==-9"}
+
+    monkeypatch.setattr(fake_s3, "complete_multipart_upload", complete_wrongly)
+    with pytest.raises(ChecksumMismatchError, match="doesn't match its source"):
+        export.handler(s3_event("test_dataset/big.csv"), None)
+
+    assert "test_dataset/big.csv" not in fake_s3.buckets[TARGET]
+    assert "test_dataset/big.csv" in fake_s3.buckets[SOURCE]
+
+
+def test_parts_are_copied_at_the_source_part_ranges(fake_s3):
+    body = bytes(range(250))
+    fake_s3.put_in_parts(SOURCE, "test_dataset/big.csv", body, 30, "CRC32C")
+    source = fake_s3.buckets[SOURCE]["test_dataset/big.csv"]["ChecksumCRC32C"]
+    export.handler(s3_event("test_dataset/big.csv"), None)
+
+    # Each of the 9 parts is checked against the source's, then the whole object
+    assert len(fake_s3.operations("upload_part_copy")) == 9
+    copy = fake_s3.buckets[TARGET]["test_dataset/big.csv"]
+    assert copy["Body"] == body
+    assert copy["ChecksumCRC32C"] == source
+    assert fake_s3.buckets[SOURCE] == {}
+
+
+def test_corrupt_part_stops_the_copy(fake_s3):
+    fake_s3.put_in_parts(SOURCE, "test_dataset/big.csv", b"x" * 250, 30, "CRC32C")
+    fake_s3.corrupt_copies = True
+    with pytest.raises(ChecksumMismatchError, match="source part's"):
+        export.handler(s3_event("test_dataset/big.csv"), None)
+
+    assert "test_dataset/big.csv" not in fake_s3.buckets[TARGET]
+    assert "test_dataset/big.csv" in fake_s3.buckets[SOURCE]
+    # The checkpoint is kept, without the bad part, so the retry copies it again
+    checkpoint = json.loads(fake_s3.buckets[SOURCE][CHECKPOINT_KEY]["Body"])
+    assert checkpoint["parts"] == {}
+
+
+def test_unaligned_copy_is_logged(fake_s3, capsys):
+    fake_s3.put(SOURCE, "test_dataset/big.csv", b"x" * 250)
+    export.handler(s3_event("test_dataset/big.csv"), None)
+
+    assert (
+        "Could not verify the copy of test_dataset/big.csv" in capsys.readouterr().out
+    )
+    assert "ChecksumCRC32C" in fake_s3.buckets[TARGET]["test_dataset/big.csv"]
+
+
+def test_corrupt_copy_in_batch_is_retried(fake_s3):
+    fake_s3.put(SOURCE, "test_dataset/ok.csv", b"ok", ChecksumAlgorithm="CRC32C")
+    fake_s3.corrupt_copies = True
+    response = export.handler(sqs_event(("message", ["test_dataset/ok.csv"])), None)
+
+    assert response == {"batchItemFailures": [{"itemIdentifier": "message"}]}
+    assert "test_dataset/ok.csv" in fake_s3.buckets[SOURCE]
+    assert not fake_s3.operations("delete_objects")
+
+
+def test_batch_is_copied_then_deleted_in_bulk(fake_s3, monkeypatch):
+    monkeypatch.setenv("MAX_CONCURRENCY", "8")
+    keys = [f"test_dataset/file_{i}.csv" for i in range(30)]
+    for key in keys:
+        fake_s3.put(SOURCE, key, key.encode())
+    messages = [(f"message-{i}", [key]) for i, key in enumerate(keys)]
+    # S3 sends a test event with no records when the notification is created
+    messages.append(("test-event", []))
+
+    response = export.handler(sqs_event(*messages), None)
+
+    assert response == {"batchItemFailures": []}
+    assert sorted(fake_s3.buckets[TARGET]) == sorted(keys)
+    assert fake_s3.buckets[SOURCE] == {}
+    assert not fake_s3.operations("delete_object")
+    assert len(fake_s3.operations("delete_objects")) == 1
+
+
+def test_batch_reports_failed_messages(fake_s3):
+    fake_s3.put(SOURCE, "test_dataset/ok.csv", b"ok")
+    # missing.csv was never written, so copying it fails
+    response = export.handler(
+        sqs_event(
+            ("message-ok", ["test_dataset/ok.csv"]),
+            ("message-missing", ["test_dataset/missing.csv"]),
+        ),
+        None,
+    )
+
+    assert response == {"batchItemFailures": [{"itemIdentifier": "message-missing"}]}
+    assert "test_dataset/ok.csv" in fake_s3.buckets[TARGET]
+    # Only the object that was copied is deleted
+    deleted = fake_s3.operations("delete_objects")[0]["Delete"]["Objects"]
+    assert deleted == [{"Key": "test_dataset/ok.csv"}]
+
+
+def test_batch_keep_files(fake_s3, monkeypatch):
+    monkeypatch.setenv("KEEP_FILES", "true")
+    fake_s3.put(SOURCE, "test_dataset/ok.csv", b"ok")
+    export.handler(sqs_event(("message-ok", ["test_dataset/ok.csv"])), None)
+
+    assert "test_dataset/ok.csv" in fake_s3.buckets[TARGET]
+    assert "test_dataset/ok.csv" in fake_s3.buckets[SOURCE]
+    assert not fake_s3.operations("delete_objects")
+
+
+def bundle_objects(fake_s3, count):
+    keys = [f"test_dataset/record_{i:03d}.json" for i in range(count)]
+    for i, key in enumerate(keys):
+        fake_s3.put(
+            SOURCE,
+            key,
+            json.dumps({"id": i}).encode(),
+            LastModified=datetime(2023, 5, 1, 12, i % 60, tzinfo=timezone.utc),
+        )
+    return keys
+
+
+def read_index(fake_s3):
+    [index_key] = [key for key in fake_s3.buckets[TARGET] if key.endswith(".json")]
+    return json.loads(fake_s3.buckets[TARGET][index_key]["Body"])
+
+
+def test_batch_is_bundled_as_tar(fake_s3, monkeypatch):
+    monkeypatch.setenv("BUNDLE", "tar")
+    keys = bundle_objects(fake_s3, 120)
+
+    response = export.handler(
+        sqs_event(*[(f"message-{i}", [key]) for i, key in enumerate(keys)]), None
+    )
+
+    assert response == {"batchItemFailures": []}
+    assert fake_s3.buckets[SOURCE] == {}
+    assert not fake_s3.operations("copy_object")
+    assert len(fake_s3.operations("delete_objects")) == 1
+    index = read_index(fake_s3)
+    assert index["bundle"].startswith("test_dataset/bundle-20230501T1259")
+    assert index["bundle"].endswith(".tar")
+    bundled = fake_s3.buckets[TARGET][index["bundle"]]["Body"]
+    with tarfile.open(fileobj=io.BytesIO(bundled)) as tar:
+        assert tar.getnames() == keys
+        assert tar.extractfile(keys[7]).read() == b'{"id": 7}'
+    # The index says where to find each file's contents
+    entry = index["objects"][7]
+    assert entry["key"] == keys[7]
+    start, end = entry["offset"], entry["offset"] + entry["length"]
+    assert bundled[start:end] == b'{"id": 7}'
+
+
+def test_batch_is_bundled_as_ndjson_up_to_max_size(fake_s3, monkeypatch):
+    monkeypatch.setenv("BUNDLE", "ndjson")
+    monkeypatch.setenv("BUNDLE_MAX_MB", "1")
+    keys = bundle_objects(fake_s3, 3)
+    fake_s3.put(SOURCE, "test_dataset/big.json", b"x" * 50)
+    sizes = {key: 600 * 1024 for key in keys}
+    sizes["test_dataset/big.json"] = 2 * 1024**2
+
+    export.handler(
+        sqs_event(("message", keys + ["test_dataset/big.json"]), sizes=sizes), None
+    )
+
+    # 600 KiB files don't fit two to a 1 MB bundle
+    bundles = [key for key in fake_s3.buckets[TARGET] if key.endswith(".ndjson")]
+    assert len(bundles) == 3
+    for key in bundles:
+        assert fake_s3.buckets[TARGET][key]["Body"].count(b"\n") == 1
+    # Files too large to bundle are copied as they are
+    assert fake_s3.buckets[TARGET]["test_dataset/big.json"]["Body"] == b"x" * 50
+    assert fake_s3.buckets[SOURCE] == {}
+
+
+def test_failed_bundle_is_retried(fake_s3, monkeypatch):
+    monkeypatch.setenv("BUNDLE", "ndjson")
+    keys = bundle_objects(fake_s3, 2)
+    response = export.handler(
+        sqs_event(("message-ok", keys), ("message-missing", ["test_dataset/gone"])),
+        None,
+    )
+
+    # Both messages have files in the failed bundle
+    assert response == {
+        "batchItemFailures": [
+            {"itemIdentifier": "message-missing"},
+            {"itemIdentifier": "message-ok"},
+        ]
+    }
+    assert sorted(fake_s3.buckets[SOURCE]) == keys
+    assert not fake_s3.operations("delete_objects")
+
+
+def test_retried_batch_overwrites_its_bundle(fake_s3, monkeypatch):
+    monkeypatch.setenv("BUNDLE", "tar")
+    monkeypatch.setenv("KEEP_FILES", "true")
+    monkeypatch.setenv("COMPRESS", "gzip")
+    keys = bundle_objects(fake_s3, 5)
+    event = sqs_event(("message", keys))
+    export.handler(event, None)
+    export.handler(event, None)
+
+    [bundle_key] = [k for k in fake_s3.buckets[TARGET] if k.endswith(".tar.gz")]
+    assert len(fake_s3.buckets[TARGET]) == 2
+    bundled = fake_s3.buckets[TARGET][bundle_key]
+    assert bundled["ContentEncoding"] == "gzip"
+    with tarfile.open(fileobj=io.BytesIO(gzip.decompress(bundled["Body"]))) as tar:
+        assert tar.getnames() == keys
+    assert sorted(fake_s3.buckets[SOURCE]) == keys
+
+
+def test_plan_bundles():
+    sizes = {"a": 4, "b": 4, "c": 3, "d": 10}
+    assert bundle.plan_bundles(sizes, 10) == [["a", "b"], ["c"], ["d"]]
+
+
+def test_router_sends_each_prefix_to_its_target(fake_s3, routing_table):
+    fake_s3.put(SOURCE, "dataset_a/1.csv", b"a")
+    fake_s3.put(SOURCE, "dataset_b/1.csv", b"b")
+    export.handler(s3_event("dataset_a/1.csv", "dataset_b/1.csv"), None)
+
+    assert list(fake_s3.buckets["bucket-a"]) == ["dataset_a/1.csv"]
+    assert list(fake_s3.buckets["bucket-b"]) == ["dataset_b/1.csv"]
+    # dataset_b keeps its files
+    assert list(fake_s3.buckets[SOURCE]) == ["dataset_b/1.csv"]
+
+
+def test_router_rejects_unknown_prefix(fake_s3, routing_table):
+    fake_s3.put(SOURCE, "dataset_z/1.csv", b"z")
+    with pytest.raises(routing.UnknownPrefixError):
+        export.handler(s3_event("dataset_z/1.csv"), None)
+    assert "dataset_z/1.csv" in fake_s3.buckets[SOURCE]
+
+
+def eventbridge_event(key, size=0, reason="PutObject"):
+    """An EventBridge "Object Created" event, as sent by a dataset's rule."""
+    return {
+        "version": "0",
+        "source": "aws.s3",
+        "detail-type": "Object Created",
+        "time": "2023-05-01T12:00:00Z",
+        "detail": {
+            "bucket": {"name": SOURCE},
+            "object": {"key": key, "size": size, "etag": "abc", "sequencer": "01"},
+            "reason": reason,
+        },
+    }
+
+
+def test_eventbridge_event_is_exported(fake_s3):
+    fake_s3.put(SOURCE, "test_dataset/small.csv", b"a,b\n1,2\n")
+    export.handler(eventbridge_event("test_dataset/small.csv", 8), None)
+
+    assert "test_dataset/small.csv" in fake_s3.buckets[TARGET]
+    assert "test_dataset/small.csv" not in fake_s3.buckets[SOURCE]
+
+
+def test_eventbridge_events_are_batched(fake_s3):
+    keys = ["test_dataset/1.csv", "test_dataset/2.csv"]
+    for key in keys:
+        fake_s3.put(SOURCE, key, b"1")
+    event = {
+        "Records": [
+            {
+                "messageId": f"message-{key}",
+                "eventSource": "aws:sqs",
+                "body": json.dumps(eventbridge_event(key, 1)),
+            }
+            for key in keys
+        ]
+    }
+    assert export.handler(event, None) == {"batchItemFailures": []}
+    assert sorted(fake_s3.buckets[TARGET]) == keys
+    assert fake_s3.buckets[SOURCE] == {}
+
+
+def test_excluded_keys_are_left_alone(fake_s3, monkeypatch):
+    monkeypatch.setenv("EXCLUDE_PATTERNS", json.dumps(["*_tmp*", "*/"]))
+    keys = ["test_dataset/part_tmp.csv", "test_dataset/folder/", "test_dataset/1.csv"]
+    for key in keys:
+        fake_s3.put(SOURCE, key, b"")
+    export.handler(s3_event(*keys), None)
+    fake_s3.put(SOURCE, "test_dataset/1.csv", b"")
+    assert export.handler(sqs_event(("message-1", keys)), None) == {
+        "batchItemFailures": []
+    }
+
+    assert list(fake_s3.buckets[TARGET]) == ["test_dataset/1.csv"]
+    assert sorted(fake_s3.buckets[SOURCE]) == sorted(keys[:2])
+
+
+def test_router_excludes_keys(fake_s3, routing_table):
+    fake_s3.put(SOURCE, "dataset_a/1.tmp", b"a")
+    export.handler(s3_event("dataset_a/1.tmp"), None)
+    assert list(fake_s3.buckets[SOURCE]) == ["dataset_a/1.tmp"]
+    assert not fake_s3.operations("copy_object")
+
+
+def slow_down(operation):
+    return ClientError(
+        {"Error": {"Code": "SlowDown", "Message": "Please reduce your request rate."}},
+        operation,
+    )
+
+
+class FlakyS3Client:
+    """Raises SlowDown for the first failures calls of each copy_object."""
+
+    def __init__(self, client, failures):
+        self.client = client
+        self.failures = failures
+
+    def copy_object(self, **kwargs):
+        if self.failures:
+            self.failures -= 1
+            raise slow_down("CopyObject")
+        return self.client.copy_object(**kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+
+def test_throttled_copy_is_retried_and_slows_the_prefix(fake_s3, monkeypatch):
+    delays = []
+    client = throttle.ThrottledClient(
+        FlakyS3Client(fake_s3, failures=3),
+        throttle.AdaptiveThrottle(max_rate=100, sleep=delays.append),
+    )
+    monkeypatch.setattr(export, "_client", client)
+    fake_s3.put(SOURCE, "test_dataset/small.csv", b"a,b\n1,2\n")
+    export.handler(s3_event("test_dataset/small.csv"), None)
+
+    assert "test_dataset/small.csv" in fake_s3.buckets[TARGET]
+    assert "test_dataset/small.csv" not in fake_s3.buckets[SOURCE]
+    # Full jitter backoff never waits longer than the exponential cap
+    assert [delay <= 0.1 * 2**i for i, delay in enumerate(delays)] == [True] * 3
+    # The target prefix was halved three times, then grew after the success
+    target_limiter = client.throttle.limiters[f"{TARGET}/test_dataset"]
+    assert target_limiter.rate == pytest.approx(12.5 + 10 / 12.5)
+    # The source prefix was never throttled
+    assert client.throttle.limiters[f"{SOURCE}/test_dataset"].rate == 100
+
+
+def test_gives_up_with_reason(fake_s3, capsys):
+    client = throttle.ThrottledClient(
+        FlakyS3Client(fake_s3, failures=10),
+        throttle.AdaptiveThrottle(max_attempts=3, sleep=lambda delay: None),
+    )
+    fake_s3.put(SOURCE, "test_dataset/small.csv", b"a,b\n1,2\n")
+    with pytest.raises(throttle.RetriesExhaustedError):
+        export.export_object(client, SOURCE, "test_dataset/small.csv")
+
+    log = capsys.readouterr().out
+    assert "Gave up on copy_object" in log
+    assert f"S3 throttled the prefix {TARGET}/test_dataset" in log
+    assert "test_dataset/small.csv" in fake_s3.buckets[SOURCE]
+
+
+@pytest.mark.parametrize(
+    "error",
+    [
+        ReadTimeoutError(endpoint_url="https://s3.amazonaws.com"),
+        ConnectTimeoutError(endpoint_url="https://s3.amazonaws.com"),
+        EndpointConnectionError(endpoint_url="https://s3.amazonaws.com"),
+        ConnectionClosedError(endpoint_url="https://s3.amazonaws.com"),
+        ClientError(
+            {
+                "Error": {"Code": "InternalError"},
+                "ResponseMetadata": {"HTTPStatusCode": 500},
+            },
+            "CopyObject",
+        ),
+        ClientError(
+            {"Error": {}, "ResponseMetadata": {"HTTPStatusCode": 503}}, "CopyObject"
+        ),
+        ClientError(
+            {"Error": {}, "ResponseMetadata": {"HTTPStatusCode": 504}}, "CopyObject"
+        ),
+    ],
+)
+def test_timeouts_and_server_errors_are_retried(fake_s3, error):
+    class FailsOnce(FlakyS3Client):
+        def copy_object(self, **kwargs):
+            if self.failures:
+                self.failures -= 1
+                raise error
+            return self.client.copy_object(**kwargs)
+
+    client = throttle.ThrottledClient(
+        FailsOnce(fake_s3, failures=1),
+        throttle.AdaptiveThrottle(sleep=lambda delay: None),
+    )
+    fake_s3.put(SOURCE, "test_dataset/small.csv", b"a,b\n1,2\n")
+    export.export_object(client, SOURCE, "test_dataset/small.csv")
+    assert "test_dataset/small.csv" in fake_s3.buckets[TARGET]
+
+
+def test_other_errors_are_not_retried(fake_s3):
+    client = throttle.ThrottledClient(fake_s3)
+    with pytest.raises(ClientError):
+        client.head_object(Bucket=SOURCE, Key="test_dataset/missing.csv")
+    assert len(fake_s3.operations("head_object")) == 1
+
+
+def test_rate_limiter_spaces_requests(monkeypatch):
+    limiter = throttle.RateLimiter(max_rate=100, min_rate=1, increase=10)
+    assert limiter.acquire() == 0
+    limiter.throttled()
+    limiter.throttled()
+    assert limiter.rate == 25
+    waits = [limiter.acquire() for _ in range(3)]
+    assert waits[0] == 0
+    assert waits[1:] == pytest.approx([1 / 25, 1 / 25], abs=0.01)
+
+
+def test_object_is_compressed_on_the_way(fake_s3, monkeypatch):
+    monkeypatch.setenv("COMPRESS", "gzip")
+    body = b"a,b\n1,2\n" * 1000
+    fake_s3.put(SOURCE, "test_dataset/data.csv", body, ContentType="text/csv")
+    export.handler(s3_event("test_dataset/data.csv"), None)
+
+    delivered = fake_s3.buckets[TARGET]["test_dataset/data.csv.gz"]
+    assert gzip.decompress(delivered["Body"]) == body
+    assert delivered["ContentEncoding"] == "gzip"
+    assert delivered["ContentType"] == "text/csv"
+    assert fake_s3.buckets[SOURCE] == {}
+
+
+def test_large_object_is_compressed_in_parts(fake_s3, monkeypatch):
+    monkeypatch.setenv("COMPRESS", "gzip")
+    monkeypatch.setattr(compress, "COMPRESSED_PART_SIZE", 10_000)
+    monkeypatch.setattr(compress, "READ_SIZE", 1000)
+    # Random bytes barely compress, so the output needs several parts
+    body = random.Random(0).randbytes(200_000)
+    fake_s3.put(SOURCE, "test_dataset/random.bin", body)
+    export.handler(s3_event("test_dataset/random.bin"), None)
+
+    delivered = fake_s3.buckets[TARGET]["test_dataset/random.bin.gz"]["Body"]
+    assert gzip.decompress(delivered) == body
+    assert len(fake_s3.operations("upload_part")) >= 10
+    assert not fake_s3.operations("copy_object")
+
+
+def test_timed_out_compression_resumes(fake_s3, fake_lambda, monkeypatch):
+    monkeypatch.setenv("COMPRESS", "gzip")
+    monkeypatch.setattr(compress, "COMPRESSED_PART_SIZE", 10_000)
+    monkeypatch.setattr(compress, "READ_SIZE", 1000)
+    body = random.Random(0).randbytes(200_000)
+    fake_s3.put(SOURCE, "test_dataset/random.bin", body)
+    export.handler(s3_event("test_dataset/random.bin"), FakeContext(50))
+
+    checkpoint_key = "_export_checkpoints/test_dataset/random.bin.gz.json"
+    checkpoint = json.loads(fake_s3.buckets[SOURCE][checkpoint_key]["Body"])
+    assert 0 < checkpoint["offset"] < len(body)
+    assert len(checkpoint["parts"]) == len(fake_s3.operations("upload_part"))
+    assert "test_dataset/random.bin.gz" not in fake_s3.buckets[TARGET]
+
+    # The next invocation reads the source from where the last part ended
+    export.handler(fake_lambda.invocations[0][1], FakeContext(1000))
+    assert fake_s3.operations("get_object")[-1]["Range"] == (
+        f"bytes={checkpoint['offset']}-"
+    )
+    assert len(fake_s3.operations("create_multipart_upload")) == 1
+    delivered = fake_s3.buckets[TARGET]["test_dataset/random.bin.gz"]["Body"]
+    assert gzip.decompress(delivered) == body
+    assert fake_s3.buckets[SOURCE] == {}
+
+
+def test_aborted_compression_starts_again(fake_s3, fake_lambda, monkeypatch):
+    monkeypatch.setenv("COMPRESS", "gzip")
+    monkeypatch.setattr(compress, "COMPRESSED_PART_SIZE", 10_000)
+    monkeypatch.setattr(compress, "READ_SIZE", 1000)
+    body = random.Random(0).randbytes(200_000)
+    fake_s3.put(SOURCE, "test_dataset/random.bin", body)
+    export.handler(s3_event("test_dataset/random.bin"), FakeContext(50))
+
+    fake_s3.uploads.clear()
+    export.handler(fake_lambda.invocations[0][1], FakeContext(1000))
+    assert len(fake_s3.operations("create_multipart_upload")) == 2
+    delivered = fake_s3.buckets[TARGET]["test_dataset/random.bin.gz"]["Body"]
+    assert gzip.decompress(delivered) == body
+
+
+def test_bad_compression_is_never_sent(fake_s3, monkeypatch):
+    class Lossy:
+        """Drops every other chunk it's given."""
+
+        def __init__(self):
+            self.compressor = compress._gzip_compressor()
+            self.chunks = 0
+
+        def compress(self, chunk):
+            self.chunks += 1
+            return self.compressor.compress(chunk) if self.chunks % 2 else b""
+
+        def flush(self):
+            return self.compressor.flush()
+
+    monkeypatch.setenv("COMPRESS", "gzip")
+    monkeypatch.setattr(compress, "READ_SIZE", 1000)
+    monkeypatch.setitem(
+        compress.CODECS, "gzip", compress.CODECS["gzip"]._replace(compressor=Lossy)
+    )
+    fake_s3.put(SOURCE, "test_dataset/data.csv", b"a,b\n1,2\n" * 1000)
+    with pytest.raises(ChecksumMismatchError, match="decompressed to"):
+        export.handler(s3_event("test_dataset/data.csv"), None)
+    assert fake_s3.buckets[TARGET] == {}
+    assert "test_dataset/data.csv" in fake_s3.buckets[SOURCE]
+
+
+def test_compressed_files_are_copied_as_they_are(fake_s3, monkeypatch):
+    monkeypatch.setenv("COMPRESS", "gzip")
+    fake_s3.put(SOURCE, "test_dataset/data.csv.gz", b"already compressed")
+    export.handler(s3_event("test_dataset/data.csv.gz"), None)
+
+    assert list(fake_s3.buckets[TARGET]) == ["test_dataset/data.csv.gz"]
+    assert len(fake_s3.operations("copy_object")) == 1
+
+
+def test_zstd_round_trip(fake_s3, monkeypatch):
+    zstandard = pytest.importorskip("zstandard")
+    monkeypatch.setenv("COMPRESS", "zstd")
+    fake_s3.put(SOURCE, "test_dataset/data.csv", b"a,b\n1,2\n" * 1000)
+    export.handler(s3_event("test_dataset/data.csv"), None)
+
+    delivered = fake_s3.buckets[TARGET]["test_dataset/data.csv.zst"]
+    assert delivered["ContentEncoding"] == "zstd"
+    decompressed = (
+        zstandard.ZstdDecompressor().decompressobj().decompress(delivered["Body"])
+    )
+    assert decompressed == b"a,b\n1,2\n" * 1000
+
+
+def test_zstd_without_package(fake_s3, monkeypatch):
+    monkeypatch.setenv("COMPRESS", "zstd")
+    monkeypatch.setitem(sys.modules, "zstandard", None)
+    fake_s3.put(SOURCE, "test_dataset/data.csv", b"a,b\n1,2\n")
+    with pytest.raises(compress.CompressionUnavailableError):
+        export.handler(s3_event("test_dataset/data.csv"), None)
+    assert "test_dataset/data.csv" in fake_s3.buckets[SOURCE]
+
+
+@pytest.fixture
+def traced(monkeypatch):
+    """Turn tracing on for a sampled invocation, and collect what's sent."""
+    sent = []
+    monkeypatch.setenv("TRACING", "true")
+    monkeypatch.setenv(
+        "_X_AMZN_TRACE_ID",
+        "Root=1-5759e988-bd862e3fe1be46a994272793;Parent=53995c3f42cd8ad8;Sampled=1",
+    )
+    monkeypatch.setattr(tracing, "send", sent.append)
+    return sent
+
+
+def test_export_is_traced(fake_s3, traced):
+    fake_s3.put(SOURCE, "test_dataset/small.csv", b"a,b\n1,2\n")
+    export.handler(s3_event("test_dataset/small.csv"), None)
+
+    assert [s["name"] for s in traced] == ["S3 HEAD", "S3 COPY", "S3 DELETE"]
+    for subsegment in traced:
+        assert subsegment["trace_id"] == "1-5759e988-bd862e3fe1be46a994272793"
+        assert subsegment["parent_id"] == "53995c3f42cd8ad8"
+        assert subsegment["type"] == "subsegment"
+        assert subsegment["annotations"]["key_prefix"] == "test_dataset"
+        assert subsegment["annotations"]["size"] == 8
+        assert subsegment["end_time"] >= subsegment["start_time"]
+    assert traced[1]["annotations"]["method"] == "copy"
+
+
+def test_failed_step_is_traced_as_fault(fake_s3, traced):
+    with pytest.raises(ClientError):
+        export.handler(s3_event("test_dataset/missing.csv"), None)
+    [subsegment] = traced
+    assert subsegment["name"] == "S3 HEAD"
+    assert subsegment["fault"] is True
+    assert subsegment["cause"]["exceptions"][0]["type"] == "ClientError"
+
+
+def test_unsampled_invocation_is_not_traced(fake_s3, traced, monkeypatch):
+    monkeypatch.setenv("_X_AMZN_TRACE_ID", "Root=1-5759e988;Parent=5399;Sampled=0")
+    fake_s3.put(SOURCE, "test_dataset/small.csv", b"a,b\n1,2\n")
+    export.handler(s3_event("test_dataset/small.csv"), None)
+    assert traced == []
+
+
+def test_subsegments_are_sent_to_the_daemon(monkeypatch):
+    daemon = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    daemon.bind(("127.0.0.1", 0))
+    daemon.settimeout(5)
+    monkeypatch.setenv(
+        "AWS_XRAY_DAEMON_ADDRESS", f"127.0.0.1:{daemon.getsockname()[1]}"
+    )
+    tracing.send({"name": "S3 HEAD"})
+
+    header, document = daemon.recv(4096).split(b"\n", 1)
+    daemon.close()
+    assert json.loads(header) == {"format": "json", "version": 1}
+    assert json.loads(document) == {"name": "S3 HEAD"}
@@ -0,0 +1,108 @@
+from collections import defaultdict
+import subprocess
+import sys
+
+import pytest
+
+from tests.conftest import checksum
+from tests.test_export_handler import (
+    SOURCE,
+    TARGET,
+    FakeContext,
+    eventbridge_event,
+    s3_event,
+)
+
+from data_engineering_exports.lambda_handlers.export import (
+    lean,
+    metrics,
+    multipart,
+    routing,
+)
+from data_engineering_exports.lambda_handlers.export.checksums import (
+    ChecksumMismatchError,
+)
+
+
+@pytest.fixture(autouse=True)
+def lean_environment(monkeypatch, fake_s3, fake_lambda):
+    monkeypatch.setenv("DESTINATION_BUCKET", TARGET)
+    monkeypatch.setenv("MULTIPART_THRESHOLD", "100")
+    monkeypatch.setenv("PART_SIZE", "10")
+    monkeypatch.setenv("MAX_CONCURRENCY", "1")
+    monkeypatch.setattr(multipart, "MIN_PART_SIZE", 1)
+    monkeypatch.setattr(lean, "_client", fake_s3)
+    monkeypatch.setattr(routing, "_routes", None)
+    monkeypatch.setattr(metrics, "_values", defaultdict(lambda: defaultdict(list)))
+
+
+def test_only_botocore_is_loaded():
+    code = (
+        "import sys; "
+        "from data_engineering_exports.lambda_handlers.export import lean; "
+        "print(sorted(m for m in ('boto3', 'data_engineering_exports.lambda_handlers"
+        ".export.transfer') if m in sys.modules))"
+    )
+    result = subprocess.run(
+        [sys.executable, "-c", code], capture_output=True, check=True, text=True
+    )
+    assert result.stdout.strip() == "[]"
+
+
+def test_client_keeps_connections_alive(monkeypatch):
+    monkeypatch.setenv("MAX_CONCURRENCY", "24")
+    client = lean.new_client()
+    assert client.meta.config.tcp_keepalive
+    assert client.meta.config.max_pool_connections == 24
+
+
+def test_small_object_is_moved_and_checked(fake_s3):
+    fake_s3.put(SOURCE, "test_dataset/small.csv", b"a,b\n", ChecksumAlgorithm="SHA256")
+    lean.handler(s3_event("test_dataset/small.csv"), None)
+
+    copy = fake_s3.buckets[TARGET]["test_dataset/small.csv"]
+    assert copy["ChecksumSHA256"] == checksum("SHA256", b"a,b\n")
+    assert "test_dataset/small.csv" not in fake_s3.buckets[SOURCE]
+    assert len(fake_s3.operations("copy_object")) == 1
+
+
+def test_corrupt_copy_keeps_the_source(fake_s3, capsys):
+    fake_s3.put(SOURCE, "test_dataset/small.csv", b"a,b\n")
+    fake_s3.corrupt_copies = True
+    with pytest.raises(ChecksumMismatchError):
+        lean.handler(s3_event("test_dataset/small.csv"), None)
+    assert "test_dataset/small.csv" in fake_s3.buckets[SOURCE]
+    assert "test_dataset/small.csv" not in fake_s3.buckets[TARGET]
+    assert '"Failures": [1]' in capsys.readouterr().out
+
+
+def test_keep_files_and_exclude_patterns(fake_s3, monkeypatch):
+    monkeypatch.setenv("KEEP_FILES", "true")
+    monkeypatch.setenv("EXCLUDE_PATTERNS", '["*.tmp"]')
+    fake_s3.put(SOURCE, "test_dataset/1.csv", b"1")
+    fake_s3.put(SOURCE, "test_dataset/2.tmp", b"2")
+    lean.handler(eventbridge_event("test_dataset/1.csv", 1), None)
+    lean.handler(eventbridge_event("test_dataset/2.tmp", 1), None)
+
+    assert list(fake_s3.buckets[TARGET]) == ["test_dataset/1.csv"]
+    assert sorted(fake_s3.buckets[SOURCE]) == [
+        "test_dataset/1.csv",
+        "test_dataset/2.tmp",
+    ]
+
+
+def test_large_object_falls_back_to_multipart_copy(fake_s3, fake_lambda, capsys):
+    body = b"x" * 250
+    fake_s3.put(SOURCE, "test_dataset/big.csv", body)
+    lean.handler(s3_event("test_dataset/big.csv"), FakeContext(10))
+    # Resuming isn't a failure
+    assert "Failures" not in capsys.readouterr().out
+    [(_, resumed)] = fake_lambda.invocations
+
+    lean.handler(resumed, FakeContext(1000))
+    assert fake_s3.buckets[TARGET]["test_dataset/big.csv"]["Body"] == body
+    assert len(fake_s3.operations("upload_part_copy")) == 25
+    assert fake_s3.buckets[SOURCE] == {}
+    # The HEAD made to choose how to copy is reused by the copy
+    heads = [h for h in fake_s3.operations("head_object") if h["Bucket"] == SOURCE]
+    assert len(heads) == 2
@@ -0,0 +1,134 @@
+from datetime import datetime, timezone
+import gzip
+import json
+
+import pytest
+
+from data_engineering_exports.lambda_handlers.manifest import manifest
+
+BUCKET = "mojap-test-pull-dataset"
+MODIFIED = datetime(2023, 5, 1, 12, 0, tzinfo=timezone.utc)
+
+
+@pytest.fixture(autouse=True)
+def manifest_environment(monkeypatch, fake_s3):
+    monkeypatch.setattr(manifest, "_client", fake_s3)
+
+
+def record(event_name, key, sequencer, size=3, version_id=None):
+    obj = {"key": key, "size": size, "eTag": "abc", "sequencer": sequencer}
+    if version_id:
+        obj["versionId"] = version_id
+    return {
+        "eventName": event_name,
+        "eventTime": "2023-05-02T09:30:00.000Z",
+        "s3": {"bucket": {"name": BUCKET}, "object": obj},
+    }
+
+
+def sqs_event(*records):
+    """An SQS event with one message for each S3 event record."""
+    return {
+        "Records": [
+            {"messageId": str(n), "body": json.dumps({"Records": [r]})}
+            for n, r in enumerate(records)
+        ]
+    }
+
+
+def read(fake_s3):
+    body = fake_s3.buckets[BUCKET][manifest.MANIFEST_KEY]["Body"]
+    return [json.loads(line) for line in gzip.decompress(body).splitlines()]
+
+
+def test_first_run_lists_the_bucket(fake_s3):
+    fake_s3.put(BUCKET, "b.csv", b"bb", LastModified=MODIFIED)
+    fake_s3.put(BUCKET, "a.csv", b"a", LastModified=MODIFIED)
+    manifest.handler(sqs_event(record("ObjectCreated:Put", "a.csv", "01")), None)
+
+    assert read(fake_s3) == [
+        {
+            "key": "a.csv",
+            "size": 1,
+            "etag": fake_s3.buckets[BUCKET]["a.csv"]["ETag"].strip('"'),
+            "last_modified": "2023-05-01T12:00:00.000Z",
+            "sequencer": None,
+        },
+        {
+            "key": "b.csv",
+            "size": 2,
+            "etag": fake_s3.buckets[BUCKET]["b.csv"]["ETag"].strip('"'),
+            "last_modified": "2023-05-01T12:00:00.000Z",
+            "sequencer": None,
+        },
+    ]
+
+
+def test_events_update_the_manifest_without_listing(fake_s3):
+    manifest.write_manifest(fake_s3, BUCKET, {})
+    manifest.handler(
+        sqs_event(
+            record("ObjectCreated:Put", "data/new+file.csv", "0A", size=10),
+            record("ObjectCreated:Put", "data/gone.csv", "0B"),
+            record("ObjectRemoved:Delete", "data/gone.csv", "0C"),
+        ),
+        None,
+    )
+
+    assert read(fake_s3) == [
+        {
+            "key": "data/new file.csv",
+            "size": 10,
+            "etag": "abc",
+            "last_modified": "2023-05-02T09:30:00.000Z",
+            "sequencer": "0A",
+        }
+    ]
+    assert fake_s3.operations("list_objects_v2") == []
+
+
+def test_older_events_are_ignored(fake_s3):
+    manifest.write_manifest(fake_s3, BUCKET, {})
+    # Removed after it was created, but the notifications arrive the other way round
+    manifest.handler(
+        sqs_event(
+            record("ObjectRemoved:Delete", "a.csv", "0000B"),
+            record("ObjectCreated:Put", "a.csv", "0A"),
+        ),
+        None,
+    )
+    assert read(fake_s3) == []
+
+    manifest.handler(sqs_event(record("ObjectCreated:Put", "b.csv", "0F")), None)
+    manifest.handler(sqs_event(record("ObjectRemoved:Delete", "b.csv", "0E")), None)
+    assert [line["key"] for line in read(fake_s3)] == ["b.csv"]
+
+
+def test_unchanged_manifest_is_not_rewritten(fake_s3):
+    manifest.write_manifest(fake_s3, BUCKET, {})
+    manifest.handler(
+        sqs_event(
+            record("ObjectRemoved:Delete", "never-listed.csv", "01"),
+            record("ObjectCreated:Put", manifest.MANIFEST_KEY, "02"),
+        ),
+        None,
+    )
+    assert len(fake_s3.operations("put_object")) == 1
+
+
+def test_deleting_an_old_version_keeps_the_object(fake_s3):
+    manifest.write_manifest(fake_s3, BUCKET, {})
+    manifest.handler(sqs_event(record("ObjectCreated:Put", "a.csv", "01")), None)
+    fake_s3.put(BUCKET, "a.csv", b"current", LastModified=MODIFIED)
+    manifest.handler(
+        sqs_event(record("ObjectRemoved:Delete", "a.csv", "02", version_id="v1")),
+        None,
+    )
+    [line] = read(fake_s3)
+    assert (line["size"], line["sequencer"]) == (7, "02")
+
+    # A delete marker hides the object
+    manifest.handler(
+        sqs_event(record("ObjectRemoved:DeleteMarkerCreated", "a.csv", "03")), None
+    )
+    assert read(fake_s3) == []
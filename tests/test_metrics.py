@@ -0,0 +1,130 @@
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone
+import json
+
+import pytest
+
+from data_engineering_exports.lambda_handlers.export import (
+    export,
+    metrics,
+    routing,
+    throttle,
+)
+from tests.test_export_handler import (
+    SOURCE,
+    FlakyS3Client,
+    s3_event,
+    sqs_event,
+)
+
+
+@pytest.fixture(autouse=True)
+def export_environment(monkeypatch, fake_s3):
+    monkeypatch.setenv("DESTINATION_BUCKET", "test-target-bucket")
+    monkeypatch.setenv("MAX_CONCURRENCY", "1")
+    monkeypatch.setattr(export, "_client", fake_s3)
+    monkeypatch.setattr(routing, "_routes", None)
+    monkeypatch.setattr(metrics, "_values", defaultdict(lambda: defaultdict(list)))
+
+
+def emitted(capsys):
+    """The EMF documents written to the logs."""
+    lines = capsys.readouterr().out.splitlines()
+    return [json.loads(line) for line in lines if line.startswith('{"_aws"')]
+
+
+def test_schema():
+    """Dashboards and alarms use these names, so changing them breaks them."""
+    assert metrics.NAMESPACE == "DataEngineeringExports"
+    assert metrics.DIMENSION == "Dataset"
+    assert metrics.SCHEMA == {
+        "BytesCopied": "Bytes",
+        "CopyDuration": "Milliseconds",
+        "Lag": "Milliseconds",
+        "Retries": "Count",
+        "Failures": "Count",
+    }
+
+
+def test_documents_are_valid_emf():
+    values = {"BytesCopied": [10, 20], "CopyDuration": [1.5, 2.5], "Lag": [100.0]}
+    [document] = metrics.emf_documents("p1_nomis", values, 1_700_000_000_000)
+
+    assert document["_aws"] == {
+        "Timestamp": 1_700_000_000_000,
+        "CloudWatchMetrics": [
+            {
+                "Namespace": "DataEngineeringExports",
+                "Dimensions": [["Dataset"]],
+                "Metrics": [
+                    {"Name": "BytesCopied", "Unit": "Bytes"},
+                    {"Name": "CopyDuration", "Unit": "Milliseconds"},
+                    {"Name": "Lag", "Unit": "Milliseconds"},
+                    {"Name": "Retries", "Unit": "Count"},
+                    {"Name": "Failures", "Unit": "Count"},
+                ],
+            }
+        ],
+    }
+    assert document["Dataset"] == "p1_nomis"
+    assert document["BytesCopied"] == [10, 20]
+    # Counts are written even when nothing happened
+    assert document["Retries"] == [0]
+    assert document["Failures"] == [0]
+
+
+def test_many_values_are_split_between_documents():
+    documents = metrics.emf_documents("p1_nomis", {"Lag": list(range(250))}, 0)
+
+    assert [len(d["Lag"]) for d in documents] == [100, 100, 50]
+    # Counts are only in the first, so aren't added up more than once
+    assert ["Retries" in d for d in documents] == [True, False, False]
+    for document in documents:
+        names = [m["Name"] for m in document["_aws"]["CloudWatchMetrics"][0]["Metrics"]]
+        assert all(name in document for name in names)
+
+
+def test_direct_export_records_metrics(fake_s3, capsys):
+    fake_s3.put(SOURCE, "test_dataset/small.csv", b"a,b\n1,2\n")
+    event = s3_event("test_dataset/small.csv")
+    sent = datetime.now(timezone.utc) - timedelta(minutes=1)
+    event["Records"][0]["eventTime"] = sent.strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+    export.handler(event, None)
+
+    [document] = emitted(capsys)
+    assert document["Dataset"] == "test_dataset"
+    assert document["BytesCopied"] == [8]
+    assert len(document["CopyDuration"]) == 1
+    assert 60_000 <= document["Lag"][0] < 120_000
+    assert document["Failures"] == [0]
+
+
+def test_batch_records_each_dataset_and_failures(fake_s3, capsys):
+    fake_s3.put(SOURCE, "test_dataset/ok.csv", b"ok")
+    fake_s3.put(SOURCE, "other_dataset/ok.csv", b"other")
+    export.handler(
+        sqs_event(
+            ("message-1", ["test_dataset/ok.csv", "other_dataset/ok.csv"]),
+            ("message-2", ["test_dataset/missing.csv"]),
+        ),
+        None,
+    )
+
+    documents = {d["Dataset"]: d for d in emitted(capsys)}
+    assert documents["other_dataset"]["BytesCopied"] == [5]
+    assert documents["test_dataset"]["BytesCopied"] == [2]
+    assert documents["test_dataset"]["Failures"] == [1]
+    assert documents["other_dataset"]["Failures"] == [0]
+
+
+def test_retries_are_counted(fake_s3, monkeypatch, capsys):
+    client = throttle.ThrottledClient(
+        FlakyS3Client(fake_s3, failures=3),
+        throttle.AdaptiveThrottle(sleep=lambda delay: None),
+    )
+    monkeypatch.setattr(export, "_client", client)
+    fake_s3.put(SOURCE, "test_dataset/small.csv", b"a,b\n1,2\n")
+    export.handler(s3_event("test_dataset/small.csv"), None)
+
+    [document] = emitted(capsys)
+    assert document["Retries"] == [3]
@@ -0,0 +1,194 @@
+import os
+from pathlib import Path
+from types import SimpleNamespace
+
+import pulumi
+import pytest
+
+from benchmarks.synthetic import write_synthetic_configs
+from data_engineering_exports import planner, registry, utils
+from data_engineering_exports.planner import Resource, select_targets
+from tests.conftest import Mocks
+
+PROGRAM = Path(__file__).parents[1] / "__main__.py"
+STACK_URN = "urn:pulumi:test::exports::pulumi:pulumi:Stack::exports-test"
+
+
+@pytest.fixture(scope="module")
+def simulated_project(tmp_path_factory):
+    """Simulate the program for a small synthetic set of datasets, then put the
+    unit test mocks back."""
+    folder = tmp_path_factory.mktemp("project")
+    write_synthetic_configs(folder, 4, 2, users=3, users_per_dataset=2)
+    # Give one pull dataset a replica
+    with open(folder / "pull_datasets" / "synthetic_pull_1.yaml", "a") as f:
+        f.write("bucket_versioning: true\nreplica_regions: [us-east-1]\n")
+    original_folder = os.getcwd()
+    os.chdir(folder)
+    try:
+        resources = planner.simulate_program(PROGRAM, "exports", "test", {})
+        push_configs = registry.load_configs(
+            utils.list_yaml_files("push_datasets"), "push"
+        )
+        pull_configs = registry.load_configs(
+            utils.list_yaml_files("pull_datasets"), "pull"
+        )
+    finally:
+        os.chdir(original_folder)
+        pulumi.runtime.set_mocks(Mocks())
+        pulumi.runtime.set_all_config({})
+    fingerprints = planner.dataset_fingerprints(push_configs, pull_configs, "code")
+    return resources, fingerprints
+
+
+def urns(resources, name):
+    return {r.urn for r in resources if r.name == name}
+
+
+def test_simulated_urns_include_every_parent_type(simulated_project):
+    resources, _ = simulated_project
+    assert urns(resources, "export_synthetic_push_0-role-policy") == {
+        "urn:pulumi:test::exports::data-engineering-exports:aws:ExportObjectFunction"
+        "$aws:iam/role:Role$aws:iam/rolePolicy:RolePolicy"
+        "::export_synthetic_push_0-role-policy"
+    }
+
+
+def test_nothing_changed(simulated_project):
+    resources, fingerprints = simulated_project
+    plan = select_targets(resources, resources, fingerprints, fingerprints)
+    assert plan.changed == []
+    assert plan.targets == []
+
+
+def test_program_change_needs_full_update(simulated_project):
+    resources, fingerprints = simulated_project
+    previous = dict(fingerprints, program={"hash": "old code"})
+    plan = select_targets(resources, resources, fingerprints, previous)
+    assert plan.full
+
+
+def test_no_record_of_last_deploy_needs_full_update(simulated_project):
+    resources, fingerprints = simulated_project
+    assert select_targets(resources, [], fingerprints, {}).full
+
+
+def test_new_push_dataset_targets_its_resources(simulated_project):
+    resources, fingerprints = simulated_project
+    new = "export_synthetic_push_1"
+    # The last deploy was before the dataset was added
+    previous = {k: v for k, v in fingerprints.items() if k != "push/synthetic_push_1"}
+    deployed = [r for r in resources if not r.name.startswith(new)]
+    deployed.append(Resource(STACK_URN, planner.STACK_TYPE, "exports-test"))
+
+    plan = select_targets(resources, deployed, fingerprints, previous)
+
+    assert plan.changed == ["push/synthetic_push_1"]
+    targets = set(plan.targets)
+    assert {r.urn for r in resources if r.name.startswith(new)} <= targets
+    assert STACK_URN in targets
+    assert urns(resources, "export-bucket-notification") <= targets
+    for user in fingerprints["push/synthetic_push_1"]["users"]:
+        assert urns(resources, f"{user}_exports_push") <= targets
+    # Other datasets and the pull buckets are left alone
+    assert not urns(resources, "export_synthetic_push_0") & targets
+    assert not urns(resources, "mojap-synthetic-pull-0") & targets
+
+
+def test_removed_pull_dataset_targets_deployed_resources(simulated_project):
+    resources, fingerprints = simulated_project
+    current = {k: v for k, v in fingerprints.items() if k != "pull/synthetic-pull-1"}
+    simulated = [r for r in resources if "synthetic-pull-1" not in r.name]
+
+    plan = select_targets(simulated, resources, current, fingerprints)
+
+    targets = set(plan.targets)
+    assert {r.urn for r in resources if "synthetic-pull-1" in r.name} <= targets
+    assert not urns(resources, "export-bucket-notification") & targets
+
+
+def test_changed_pull_dataset_targets_its_replicas(simulated_project):
+    resources, fingerprints = simulated_project
+    previous = dict(fingerprints)
+    previous["pull/synthetic-pull-1"] = dict(previous["pull/synthetic-pull-1"])
+    previous["pull/synthetic-pull-1"]["hash"] = "old"
+
+    plan = select_targets(resources, resources, fingerprints, previous)
+
+    targets = set(plan.targets)
+    replica = urns(resources, "mojap-synthetic-pull-1-us-east-1")
+    assert replica and replica <= targets
+    for name in (
+        "mojap-synthetic-pull-1-us-east-1-bucket",
+        "mojap-synthetic-pull-1-us-east-1-bucket-policy",
+        "synthetic-pull-1-replication-role",
+        "synthetic-pull-1-replication",
+        "aws-us-east-1",
+    ):
+        assert urns(resources, name) and urns(resources, name) <= targets, name
+    assert not urns(resources, "mojap-synthetic-pull-0") & targets
+
+
+def test_changed_policy_of_another_user_is_targeted(simulated_project):
+    """A user whose push policy is different from the deployed one is updated, even
+    if they don't use the changed dataset."""
+    resources, fingerprints = simulated_project
+    previous = dict(fingerprints)
+    previous["pull/synthetic-pull-0"] = {"hash": "old", "users": []}
+    pull_users = set(fingerprints["pull/synthetic-pull-0"]["users"])
+    other_policy = next(
+        r
+        for r in resources
+        if r.name.endswith("_exports_push")
+        and r.name[: -len("_exports_push")] not in pull_users
+    )
+    deployed = [
+        r._replace(policy='{"Statement": []}') if r == other_policy else r
+        for r in resources
+    ]
+
+    plan = select_targets(resources, deployed, fingerprints, previous)
+
+    assert other_policy.urn in plan.targets
+    # Unchanged push policies of users not on the dataset are left alone
+    assert not any(
+        r.name.endswith("_exports_push")
+        and r != other_policy
+        and r.name[: -len("_exports_push")] not in pull_users
+        and r.urn in plan.targets
+        for r in resources
+    )
+
+
+def test_program_hash_follows_code_and_config(tmp_path):
+    (tmp_path / "__main__.py").write_text("print('hello')\n")
+    config = planner.program_config({}.get)
+    first = planner.program_hash(tmp_path, config)
+    for key in planner.PROGRAM_CONFIG:
+        changed = dict(config, **{key: "something"})
+        assert planner.program_hash(tmp_path, changed) != first, key
+    (tmp_path / "__main__.py").write_text("print('goodbye')\n")
+    assert planner.program_hash(tmp_path, config) != first
+
+
+def test_config_change_needs_full_update(tmp_path):
+    """Turning on EventBridge notifications changes no dataset, but must deploy."""
+    deployed = planner.current_fingerprints(tmp_path, planner.program_config({}.get))
+
+    def stack(config):
+        return SimpleNamespace(
+            name="test",
+            workspace=SimpleNamespace(
+                project_settings=lambda: SimpleNamespace(name="exports")
+            ),
+            get_all_config=lambda: {
+                key: SimpleNamespace(value=value) for key, value in config.items()
+            },
+            outputs=lambda: {
+                planner.DEPLOYED_DATASETS_OUTPUT: SimpleNamespace(value=deployed)
+            },
+        )
+
+    assert not planner.plan_deploy(stack({}), tmp_path).full
+    changed = stack({"exports:push_notifications": "eventbridge"})
+    assert planner.plan_deploy(changed, tmp_path).full
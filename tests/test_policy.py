@@ -0,0 +1,127 @@
+import json
+import random
+from fnmatch import fnmatchcase
+
+import pytest
+
+from data_engineering_exports.policy import (
+    LONGEST_BUCKET_ARN,
+    MANAGED_POLICY_LIMIT,
+    PolicyTooLargeError,
+    compact_prefixes,
+    policy_document,
+    split_resources,
+    statement,
+)
+from data_engineering_exports.push import write_policy_document
+
+
+def synthetic_prefixes(count, seed=0):
+    """Dataset names grouped by team and system, like the real ones."""
+    rng = random.Random(seed)
+    teams = [f"team{t}" for t in range(20)]
+    return sorted(
+        {
+            f"{rng.choice(teams)}_system{rng.randrange(30)}_dataset_{i}"
+            for i in range(count)
+        }
+    )
+
+
+def matches(pattern, prefix):
+    return fnmatchcase(prefix, pattern)
+
+
+def test_policy_document_is_canonical():
+    document = policy_document(
+        [
+            statement(["s3:PutObject", "s3:GetObject", "s3:PutObject"], "arn:b"),
+            statement("s3:ListBucket", ["arn:b", "arn:a"]),
+            statement(["s3:GetObject", "s3:PutObject"], "arn:b"),
+        ]
+    )
+    assert document == (
+        '{"Statement":['
+        '{"Action":"s3:ListBucket","Effect":"Allow","Resource":["arn:a","arn:b"]},'
+        '{"Action":["s3:GetObject","s3:PutObject"],"Effect":"Allow",'
+        '"Resource":"arn:b"}'
+        '],"Version":"2012-10-17"}'
+    )
+    assert json.loads(document)["Version"] == "2012-10-17"
+
+
+def test_identical_policy_documents_are_shared():
+    first = policy_document([statement(["s3:GetObject"], ["arn:a/*"])])
+    # Built separately, and listed differently, but with the same permissions
+    second = policy_document(
+        [statement(["s3:GetObject", "s3:GetObject"], ["arn:a/*"], effect="Allow")]
+    )
+    assert first is second
+
+
+def test_compact_without_other_prefixes_changes_nothing():
+    assert compact_prefixes(["b", "a", "a"]) == ["a", "b"]
+
+
+def test_siblings_are_merged_only_when_nothing_else_matches():
+    all_prefixes = ["prisons_a", "prisons_b", "probation_a", "probation_b", "courts"]
+    assert compact_prefixes(["prisons_a", "prisons_b"], all_prefixes) == ["pri*"]
+    # probation_b belongs to someone else, so probation_a can't become a wildcard
+    assert compact_prefixes(["prisons_a", "probation_a"], all_prefixes) == [
+        "prisons_a",
+        "probation_a",
+    ]
+    # A single prefix is never replaced, as the wildcard would be no shorter
+    assert compact_prefixes(["courts"], all_prefixes) == ["courts"]
+
+
+def test_wildcards_never_match_the_whole_bucket():
+    assert compact_prefixes(["a", "b"], ["a", "b"]) == ["a", "b"]
+
+
+def test_thousands_of_prefixes_are_compacted_without_extra_access():
+    all_prefixes = synthetic_prefixes(5000)
+    rng = random.Random(1)
+    owned = [p for p in all_prefixes if p.startswith("team3_") or rng.random() < 0.3]
+
+    patterns = compact_prefixes(owned, all_prefixes)
+
+    assert len(patterns) < len(owned)
+    owned_set = set(owned)
+    for prefix in all_prefixes:
+        matched = any(matches(pattern, prefix) for pattern in patterns)
+        assert matched == (prefix in owned_set), prefix
+
+
+def test_split_resources_keeps_every_document_under_the_limit():
+    all_prefixes = synthetic_prefixes(5000)
+    owned = all_prefixes[::2]
+    resources = [
+        f"{LONGEST_BUCKET_ARN}/{p}/*" for p in compact_prefixes(owned, all_prefixes)
+    ]
+
+    chunks = split_resources(
+        lambda chunk: write_policy_document(LONGEST_BUCKET_ARN, chunk),
+        resources,
+        MANAGED_POLICY_LIMIT,
+    )
+
+    assert len(chunks) > 1
+    assert [r for chunk in chunks for r in chunk] == resources
+    for chunk in chunks:
+        assert len(write_policy_document(LONGEST_BUCKET_ARN, chunk)) <= (
+            MANAGED_POLICY_LIMIT
+        )
+    # The prediction is exact, so no chunk but the last has room for another resource
+    for chunk, next_chunk in zip(chunks, chunks[1:]):
+        document = write_policy_document(LONGEST_BUCKET_ARN, chunk + next_chunk[:1])
+        assert len(document) > MANAGED_POLICY_LIMIT
+
+
+def test_split_resources_rejects_a_resource_too_long_for_any_document():
+    with pytest.raises(PolicyTooLargeError):
+        split_resources(
+            lambda chunk: write_policy_document(LONGEST_BUCKET_ARN, chunk),
+            ["x" * MANAGED_POLICY_LIMIT],
+            MANAGED_POLICY_LIMIT,
+        )
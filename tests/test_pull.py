@@ -1,10 +1,19 @@
+import json
+
+from data_engineering_pulumi_components.utils import Tagger
 from pulumi import Output
 import pulumi.runtime
+import pytest
 
 from data_engineering_exports.pull import (
+    PullExportDataset,
+    PullExportDatasets,
+    create_combined_read_write_role_policy,
     create_pull_bucket_policy,
     create_read_write_role_policy,
+    create_replication_role_policy,
 )
+from data_engineering_exports.push import DatasetsNotLoadedError, UsersNotLoadedError
 
 
 def assert_pulumi_output_equals_expected(args):
@@ -47,29 +56,204 @@ def test_create_pull_bucket_policy():
     )
 
 
-@pulumi.runtime.test
 def test_create_read_write_role_policy():
     policy = create_read_write_role_policy({"bucket_arn": "arn:aws:s3:::test-bucket"})
-    expected = [
+    assert json.loads(policy)["Statement"] == [
         {
-            "actions": [
+            "Action": [
+                "s3:DeleteObject",
+                "s3:DeleteObjectVersion",
                 "s3:GetObject",
                 "s3:GetObjectAcl",
                 "s3:GetObjectVersion",
-                "s3:DeleteObject",
-                "s3:DeleteObjectVersion",
                 "s3:PutObject",
                 "s3:PutObjectAcl",
                 "s3:PutObjectTagging",
                 "s3:RestoreObject",
             ],
-            "resources": ["arn:aws:s3:::test-bucket/*"],
+            "Effect": "Allow",
+            "Resource": ["arn:aws:s3:::test-bucket/*"],
         },
         {
-            "actions": ["s3:ListBucket"],
-            "resources": ["arn:aws:s3:::test-bucket"],
+            "Action": ["s3:ListBucket"],
+            "Effect": "Allow",
+            "Resource": ["arn:aws:s3:::test-bucket"],
         },
     ]
-    return Output.all(policy.statements, expected).apply(
-        assert_pulumi_output_equals_expected
+
+
+def test_create_replication_role_policy():
+    policy = create_replication_role_policy(
+        "arn:aws:s3:::test-bucket", ["arn:aws:s3:::test-bucket-us-east-1"]
     )
+    assert json.loads(policy)["Statement"] == [
+        {
+            "Action": [
+                "s3:GetObjectVersionAcl",
+                "s3:GetObjectVersionForReplication",
+                "s3:GetObjectVersionTagging",
+            ],
+            "Effect": "Allow",
+            "Resource": ["arn:aws:s3:::test-bucket/*"],
+        },
+        {
+            "Action": ["s3:GetReplicationConfiguration", "s3:ListBucket"],
+            "Effect": "Allow",
+            "Resource": ["arn:aws:s3:::test-bucket"],
+        },
+        {
+            "Action": ["s3:ReplicateDelete", "s3:ReplicateObject", "s3:ReplicateTags"],
+            "Effect": "Allow",
+            "Resource": ["arn:aws:s3:::test-bucket-us-east-1/*"],
+        },
+    ]
+
+
+class TestPullExportDatasets:
+    @pytest.fixture(autouse=True, scope="class")
+    def make_test_datasets(self, pull_yaml_file_list):
+        self.__class__.test_datasets = PullExportDatasets(
+            pull_yaml_file_list, Tagger(environment_name="unit-tests")
+        )
+
+    def test_errors(self):
+        """Check the build methods fail if run before data is loaded."""
+        with pytest.raises(DatasetsNotLoadedError):
+            self.test_datasets.build_buckets()
+        with pytest.raises(UsersNotLoadedError):
+            self.test_datasets.build_role_policies()
+
+    def test_load_datasets_and_users(self):
+        """Check each user is linked to every dataset that names them."""
+        self.test_datasets.load_datasets_and_users()
+
+        assert len(self.test_datasets.datasets) == 2
+        assert all(
+            isinstance(dataset, PullExportDataset)
+            for dataset in self.test_datasets.datasets
+        )
+        assert {
+            user: [dataset.name for dataset in datasets]
+            for user, datasets in self.test_datasets.users.items()
+        } == {
+            "alpha_user_test_person": ["test-pull-dataset", "test-pull-dataset-2"],
+            "alpha_user_test_person_2": ["test-pull-dataset"],
+        }
+
+    def test_inline_policy_sizes(self):
+        """Check the predicted sizes match the policies build_role_policies makes."""
+        sizes = self.test_datasets.inline_policy_sizes()
+        assert sizes["alpha_user_test_person_2"] == len(
+            create_combined_read_write_role_policy(
+                ["arn:aws:s3:::mojap-test-pull-dataset"]
+            )
+        )
+        assert sizes["alpha_user_test_person"] > sizes["alpha_user_test_person_2"]
+
+    def test_role_policies_need_buckets(self):
+        with pytest.raises(DatasetsNotLoadedError):
+            self.test_datasets.build_role_policies()
+
+    @pulumi.runtime.test
+    def test_build_buckets(self):
+        """Check each bucket is created once, with a policy for its pull ARNs."""
+        self.test_datasets.build_buckets()
+        dataset_1, dataset_2 = self.test_datasets.datasets
+
+        def validate_policies(args):
+            policy_1, policy_2 = map(json.loads, args)
+            assert policy_1["Statement"][0]["Principal"] == {
+                "AWS": ["arn:aws:iam::123456789012:role/test-reader"]
+            }
+            assert "s3:PutObject" not in policy_1["Statement"][0]["Action"]
+            # The second dataset allows push
+            assert "s3:PutObject" in policy_2["Statement"][0]["Action"]
+
+        return Output.all(
+            dataset_1.bucket_policy.policy, dataset_2.bucket_policy.policy
+        ).apply(validate_policies)
+
+    @pulumi.runtime.test
+    def test_build_replicas(self):
+        """Check the dataset with replica regions gets a read-only replica in each,
+        with one replication rule per replica."""
+        dataset_1, dataset_2 = self.test_datasets.datasets
+        assert dataset_1.replicas == {}
+        assert list(dataset_2.replicas) == ["us-east-1", "eu-west-2"]
+
+        def validate(args):
+            names, policy, rules, role = args
+            assert names == [
+                "mojap-test-pull-dataset-2-us-east-1",
+                "mojap-test-pull-dataset-2-eu-west-2",
+            ]
+            statements = json.loads(policy)["Statement"]
+            assert statements[0]["Principal"] == {
+                "AWS": ["arn:aws:iam::123456789012:role/test-reader-2"]
+            }
+            assert "s3:PutObject" not in statements[0]["Action"]
+            assert [
+                (rule["priority"], rule["destination"]["bucket"]) for rule in rules
+            ] == [
+                (0, "arn:aws:s3:::mojap-test-pull-dataset-2-us-east-1"),
+                (1, "arn:aws:s3:::mojap-test-pull-dataset-2-eu-west-2"),
+            ]
+            assert role == (
+                "arn:aws:iam::000000000000:role/test-pull-dataset-2-replication"
+            )
+
+        return Output.all(
+            [replica.name for replica in dataset_2.replicas.values()],
+            dataset_2.replica_bucket_policies["us-east-1"].policy,
+            dataset_2.replication_config.rules,
+            dataset_2.replication_config.role,
+        ).apply(validate)
+
+    @pulumi.runtime.test
+    def test_build_manifest_function(self):
+        """Check only the dataset asking for a manifest gets a manifest function,
+        sent its bucket's notifications."""
+        dataset_1, dataset_2 = self.test_datasets.datasets
+        assert dataset_1.manifest_function is None
+        manifest_function = dataset_2.manifest_function
+
+        def validate(args):
+            events, concurrency, policy = args
+            assert events == ["s3:ObjectCreated:*", "s3:ObjectRemoved:*"]
+            assert concurrency == 1
+            write_manifest = json.loads(policy)["Statement"][2]
+            assert write_manifest["Resource"] == [
+                "arn:aws:s3:::mojap-test-pull-dataset-2/_manifest/manifest.jsonl.gz"
+            ]
+
+        return Output.all(
+            manifest_function._bucket_notification.queues[0]["events"],
+            manifest_function._function.reserved_concurrent_executions,
+            manifest_function._rolePolicy.policy,
+        ).apply(validate)
+
+    @pulumi.runtime.test
+    def test_build_role_policies(self):
+        """Check each user gets one policy covering all of their buckets."""
+        self.test_datasets.build_role_policies()
+        assert len(self.test_datasets.role_policies) == 2
+        both, one = self.test_datasets.role_policies
+
+        def validate_policies(args):
+            both_role, both_policy, one_role, one_policy = args
+            assert both_role == "alpha_user_test_person"
+            assert json.loads(both_policy)["Statement"][1]["Resource"] == [
+                "arn:aws:s3:::mojap-test-pull-dataset",
+                "arn:aws:s3:::mojap-test-pull-dataset-2",
+            ]
+            assert one_role == "alpha_user_test_person_2"
+            assert json.loads(one_policy)["Statement"][0]["Resource"] == [
+                "arn:aws:s3:::mojap-test-pull-dataset/*"
+            ]
+
+        return Output.all(
+            both.role,
+            both.policy,
+            one.role,
+            one.policy,
+        ).apply(validate_policies)
@@ -1,23 +1,26 @@
+import json
 from ast import literal_eval
 
 from data_engineering_pulumi_components.utils import Tagger
 from data_engineering_pulumi_components.aws import Bucket
-from data_engineering_pulumi_components.aws.lambdas.move_object_function import (
-    MoveObjectFunction,
-)
-from data_engineering_pulumi_components.aws.lambdas.copy_object_function import (
-    CopyObjectFunction,
-)
 
 import pulumi
 import pytest
 
+from data_engineering_exports.export_function import (
+    ExportObjectFunction,
+    ExportRouterFunction,
+)
+from data_engineering_exports.registry import InvalidConfigError
 from data_engineering_exports.push import (
     PushExportDatasets,
     PushExportDataset,
     WriteToExportBucketRolePolicy,
     DatasetsNotLoadedError,
     UsersNotLoadedError,
+    make_combined_bucket_notification,
+    make_notification_lambda_args,
+    make_notification_queue_args,
 )
 
 
@@ -50,6 +53,7 @@ class TestPushExportDatasets:
         assert self.test_datasets.tagger == test_tagger
         assert self.test_datasets.datasets is None
         assert self.test_datasets.lambdas is None
+        assert self.test_datasets.router is None
 
     def test_errors(self):
         """Check the build methods fail if run before data is loaded."""
@@ -76,8 +80,10 @@ class TestPushExportDatasets:
 
         # Check Lambdas now part of datasets - check their details separately
         assert len(self.test_datasets.lambdas) == 2
-        assert isinstance(self.test_datasets.lambdas[0], MoveObjectFunction)
-        assert isinstance(self.test_datasets.lambdas[1], CopyObjectFunction)
+        assert all(
+            isinstance(function, ExportObjectFunction)
+            for function in self.test_datasets.lambdas
+        )
 
     def test_build_role_policies(self):
         """Check Pulumi will create the right role policies for the users."""
@@ -95,6 +101,150 @@ class TestPushExportDatasets:
         )
 
 
+class TestPushExportDatasetsRouter:
+    @pytest.fixture(autouse=True, scope="class")
+    def make_test_datasets(self, yaml_file_list, export_bucket, test_tagger):
+        self.__class__.test_datasets = PushExportDatasets(
+            yaml_file_list, export_bucket, test_tagger
+        )
+
+    def test_errors(self):
+        with pytest.raises(DatasetsNotLoadedError):
+            self.test_datasets.build_router_function()
+
+    def test_routing_table(self):
+        """Check each dataset prefix is routed to its target bucket."""
+        self.test_datasets.load_datasets_and_users()
+        assert self.test_datasets.routing_table() == {
+            "test_dataset": {"target_bucket": "test-bucket", "keep_files": False},
+            "test_dataset_2": {"target_bucket": "test-bucket-2", "keep_files": True},
+        }
+
+    def test_build_router_function(self):
+        """Check one router function is shared by every dataset."""
+        self.test_datasets.build_router_function()
+        router = self.test_datasets.router
+        assert isinstance(router, ExportRouterFunction)
+        assert self.test_datasets.lambdas == [router]
+        assert all(d.lambda_function is router for d in self.test_datasets.datasets)
+
+    @pulumi.runtime.test
+    def test_router_function_name(self):
+        def validate_properties(args):
+            role_name, function_name, environment = args
+            assert role_name == "hub-exports-router"
+            assert function_name == "hub-exports-router"
+            assert environment["variables"]["ROUTING_TABLE"] == "routes.json"
+
+        router = self.test_datasets.router
+        return pulumi.Output.all(
+            router._role.name, router._function.name, router._function.environment
+        ).apply(validate_properties)
+
+
+class TestPushExportDatasetsEventBridge:
+    @pytest.fixture(autouse=True, scope="class")
+    def make_test_datasets(self, yaml_file_list, export_bucket, test_tagger):
+        self.__class__.test_datasets = PushExportDatasets(
+            yaml_file_list, export_bucket, test_tagger, notifications="eventbridge"
+        )
+        self.test_datasets.load_datasets_and_users()
+        self.test_datasets.build_lambda_functions()
+
+    def test_invalid_notifications(self, yaml_file_list, export_bucket, test_tagger):
+        with pytest.raises(InvalidConfigError):
+            PushExportDatasets(
+                yaml_file_list, export_bucket, test_tagger, notifications="sns"
+            )
+
+    @pulumi.runtime.test
+    def test_event_rule(self):
+        """Check the dataset's rule matches its prefix and invokes its function."""
+        function = self.test_datasets.datasets[0].lambda_function
+
+        def validate_properties(args):
+            pattern, target, principal, source_arn = args
+            assert json.loads(pattern)["detail"]["object"]["key"] == [
+                {"prefix": "test_dataset/"}
+            ]
+            assert target.endswith(":function:export_test_dataset-move")
+            assert principal == "events.amazonaws.com"
+            assert source_arn.endswith(":rule/export_test_dataset-event-rule")
+
+        return pulumi.Output.all(
+            function.event_rule.event_pattern,
+            function._event_target.arn,
+            function._permission.principal,
+            function._permission.source_arn,
+        ).apply(validate_properties)
+
+    @pulumi.runtime.test
+    def test_bucket_notification_turns_on_eventbridge(self, export_bucket):
+        notification = make_combined_bucket_notification(
+            "eventbridge-notification", export_bucket, self.test_datasets
+        )
+
+        def validate_properties(args):
+            eventbridge, lambda_functions = args
+            assert eventbridge is True
+            assert not lambda_functions
+
+        return pulumi.Output.all(
+            notification.eventbridge, notification.lambda_functions
+        ).apply(validate_properties)
+
+    @pulumi.runtime.test
+    def test_batched_rule_sends_to_queue(
+        self, test_config_batched, export_bucket, test_tagger
+    ):
+        dataset = PushExportDataset(
+            dict(
+                test_config_batched,
+                name="test_dataset_rule_batched",
+                include_suffixes=".csv",
+                min_size_bytes=1,
+                exclude_patterns=["*_tmp*"],
+            ),
+            export_bucket,
+            test_tagger,
+            notifications="eventbridge",
+        )
+        dataset.build_lambda_function()
+        function = dataset.lambda_function
+
+        def validate_properties(args):
+            pattern, forward_to, exclude_pattern, bus, target, queue_policy = args[:6]
+            assert json.loads(pattern)["detail"]["object"] == {
+                "key": [{"wildcard": "test_dataset_rule_batched/*.csv"}],
+                "size": [{"numeric": [">=", 1]}],
+            }
+            # Excluded keys are dropped by a second rule, on the function's own bus
+            assert forward_to.endswith(
+                ":event-bus/export_test_dataset_rule_batched-objects"
+            )
+            assert json.loads(exclude_pattern)["detail"] == {
+                "object": {"key": [{"anything-but": {"wildcard": ["*_tmp*"]}}]}
+            }
+            assert bus == "export_test_dataset_rule_batched-objects"
+            assert target.endswith(":export_test_dataset_rule_batched-batch")
+            [statement] = json.loads(queue_policy)["Statement"]
+            assert statement["Principal"] == {"Service": "events.amazonaws.com"}
+            assert statement["Condition"]["ArnEquals"]["aws:SourceArn"].endswith(
+                ":rule/export_test_dataset_rule_batched-exclude-rule"
+            )
+            assert json.loads(args[6]["EXCLUDE_PATTERNS"]) == ["*_tmp*"]
+
+        return pulumi.Output.all(
+            function.event_rule.event_pattern,
+            function._forward_target.arn,
+            function._delivering_rule.event_pattern,
+            function._event_target.event_bus_name,
+            function._event_target.arn,
+            function._queue_policy.policy,
+            function._function.environment.variables,
+        ).apply(validate_properties)
+
+
 class TestPushExportDataset:
     @pytest.fixture(autouse=True, scope="class")
     @pulumi.runtime.test
@@ -169,16 +319,20 @@ class TestPushExportDataset:
         """Check both datasets build the correct type of Lambda function."""
         self.dataset_1.build_lambda_function()
         self.dataset_2.build_lambda_function()
-        assert isinstance(self.dataset_1.lambda_function, MoveObjectFunction)
-        assert isinstance(self.dataset_2.lambda_function, CopyObjectFunction)
+        assert isinstance(self.dataset_1.lambda_function, ExportObjectFunction)
+        assert isinstance(self.dataset_2.lambda_function, ExportObjectFunction)
 
     @pulumi.runtime.test
     def test_build_move_object_function(self):
-        """Check the right details are passed to a MoveObjectFunction."""
+        """Check the right details are passed to a moving ExportObjectFunction."""
         # Checking the role policy makes sure the source_bucket and prefix are correct
         def validate_properties(args):
-            name, role_policy = args
+            name, role_policy, assume_role_policy = args
             assert name == "export_test_dataset-move"
+            # Only datasets that allow backfills trust S3 Batch Operations
+            assert json.loads(assume_role_policy)["Statement"][0]["Principal"] == {
+                "Service": "lambda.amazonaws.com"
+            }
             assert literal_eval(role_policy) == {
                 "Version": "2012-10-17",
                 "Statement": [
@@ -192,7 +346,20 @@ class TestPushExportDataset:
                         "Sid": "PutDestinationBucket",
                         "Effect": "Allow",
                         "Resource": ["arn:aws:s3:::test-bucket/*"],
-                        "Action": ["s3:PutObject*"],
+                        "Action": [
+                            "s3:PutObject*",
+                            "s3:AbortMultipartUpload",
+                            "s3:DeleteObject",
+                        ],
+                    },
+                    {
+                        "Sid": "MultipartCheckpoints",
+                        "Effect": "Allow",
+                        "Resource": [
+                            "arn:aws:s3:::test-export-bucket/"
+                            "_export_checkpoints/test_dataset/*"
+                        ],
+                        "Action": ["s3:GetObject", "s3:PutObject", "s3:DeleteObject"],
                     },
                 ],
             }
@@ -200,11 +367,12 @@ class TestPushExportDataset:
         return pulumi.Output.all(
             self.dataset_1.lambda_function._role.name,
             self.dataset_1.lambda_function._rolePolicy.policy,
+            self.dataset_1.lambda_function._role.assume_role_policy,
         ).apply(validate_properties)
 
     @pulumi.runtime.test
     def test_build_copy_object_function(self):
-        """Check the right details are passed to a CopyObjectFunction."""
+        """Check the right details are passed to a copying ExportObjectFunction."""
         # Checking the role policy makes sure the source_bucket and prefix are correct
         def validate_properties(args):
             name, role_policy = args
@@ -224,7 +392,20 @@ class TestPushExportDataset:
                         "Sid": "PutDestinationBucket",
                         "Effect": "Allow",
                         "Resource": ["arn:aws:s3:::test-bucket-2/*"],
-                        "Action": ["s3:PutObject*"],
+                        "Action": [
+                            "s3:PutObject*",
+                            "s3:AbortMultipartUpload",
+                            "s3:DeleteObject",
+                        ],
+                    },
+                    {
+                        "Sid": "MultipartCheckpoints",
+                        "Effect": "Allow",
+                        "Resource": [
+                            "arn:aws:s3:::test-export-bucket/"
+                            "_export_checkpoints/test_dataset_2/*"
+                        ],
+                        "Action": ["s3:GetObject", "s3:PutObject", "s3:DeleteObject"],
                     },
                 ],
             }
@@ -234,6 +415,275 @@ class TestPushExportDataset:
             self.dataset_2.lambda_function._rolePolicy.policy,
         ).apply(validate_properties)
 
+    @pulumi.runtime.test
+    def test_allow_backfill(self, test_config_1, export_bucket, test_tagger):
+        """Check backfill jobs can run as the role of a dataset that allows them."""
+        dataset = PushExportDataset(
+            dict(test_config_1, name="test_dataset_backfill", allow_backfill=True),
+            export_bucket,
+            test_tagger,
+        )
+        dataset.build_lambda_function()
+
+        def validate_properties(args):
+            role_policy, assume_role_policy = args
+            assert json.loads(assume_role_policy)["Statement"][0]["Principal"] == {
+                "Service": ["lambda.amazonaws.com", "batchoperations.s3.amazonaws.com"]
+            }
+            assert json.loads(role_policy)["Statement"][-1] == {
+                "Sid": "BackfillManifests",
+                "Effect": "Allow",
+                "Resource": [
+                    "arn:aws:s3:::test-export-bucket",
+                    "arn:aws:s3:::test-export-bucket/_backfill/test_dataset_backfill/*",
+                ],
+                "Action": [
+                    "s3:GetObject",
+                    "s3:GetObjectVersion",
+                    "s3:PutObject",
+                    "s3:GetBucketLocation",
+                ],
+            }
+
+        return pulumi.Output.all(
+            dataset.lambda_function._rolePolicy.policy,
+            dataset.lambda_function._role.assume_role_policy,
+        ).apply(validate_properties)
+
+
+class TestBatchedPushExportDataset:
+    @pytest.fixture(autouse=True, scope="class")
+    def make_test_dataset(self, test_config_batched, export_bucket, test_tagger):
+        self.__class__.dataset = PushExportDataset(
+            test_config_batched, export_bucket, test_tagger
+        )
+        self.dataset.build_lambda_function()
+
+    def test_init(self):
+        assert self.dataset.delivery == "batched"
+        assert self.dataset.batch_size == 500
+        assert self.dataset.batching_window_s == 60
+
+    def test_invalid_delivery(self, test_config_1, export_bucket, test_tagger):
+        with pytest.raises(InvalidConfigError):
+            PushExportDataset(
+                dict(test_config_1, delivery="sometimes"), export_bucket, test_tagger
+            )
+
+    @pulumi.runtime.test
+    def test_event_source_mapping(self):
+        """Check the function reads from the dataset's queue in batches."""
+
+        def validate_properties(args):
+            queue_name, batch_size, window, response_types = args
+            assert queue_name == "export_test_dataset_batched-batch"
+            assert batch_size == 500
+            assert window == 60
+            assert response_types == ["ReportBatchItemFailures"]
+
+        mapping = self.dataset.lambda_function._event_source_mapping
+        return pulumi.Output.all(
+            self.dataset.lambda_function.queue.name,
+            mapping.batch_size,
+            mapping.maximum_batching_window_in_seconds,
+            mapping.function_response_types,
+        ).apply(validate_properties)
+
+    @pulumi.runtime.test
+    def test_bundle_setting(self, test_config_batched, export_bucket, test_tagger):
+        dataset = PushExportDataset(
+            dict(
+                test_config_batched,
+                name="test_dataset_bundled",
+                bundle="ndjson",
+                bundle_max_mb=16,
+            ),
+            export_bucket,
+            test_tagger,
+        )
+        dataset.build_lambda_function()
+
+        def validate_properties(variables):
+            assert variables["BUNDLE"] == "ndjson"
+            assert variables["BUNDLE_MAX_MB"] == "16"
+
+        function = dataset.lambda_function._function
+        return function.environment.variables.apply(validate_properties)
+
+    @pulumi.runtime.test
+    def test_make_notification_queue_args(self):
+        """Check S3 notifications for the dataset's prefix are sent to its queue."""
+        args = make_notification_queue_args(self.dataset)
+
+        def validate_properties(values):
+            queue_arn, filter_prefix = values
+            assert queue_arn == (
+                "arn:aws:sqs:eu-west-1:000000000000:export_test_dataset_batched-batch"
+            )
+            assert filter_prefix == "test_dataset_batched/"
+
+        return pulumi.Output.all(args.queue_arn, args.filter_prefix).apply(
+            validate_properties
+        )
+
+
+class TestTunedPushExportDataset:
+    @pytest.fixture(autouse=True, scope="class")
+    def make_test_dataset(self, test_config_tuned, export_bucket, test_tagger):
+        self.__class__.dataset = PushExportDataset(
+            test_config_tuned, export_bucket, test_tagger
+        )
+        self.dataset.build_lambda_function()
+
+    @pulumi.runtime.test
+    def test_function_settings(self):
+        def validate_properties(args):
+            memory, timeout, architectures, reserved, publish, handler = args
+            assert memory == 1024
+            assert timeout == 60
+            assert architectures == ["arm64"]
+            assert reserved == 50
+            assert publish
+            assert handler == "export.lean.handler"
+
+        function = self.dataset.lambda_function._function
+        return pulumi.Output.all(
+            function.memory_size,
+            function.timeout,
+            function.architectures,
+            function.reserved_concurrent_executions,
+            function.publish,
+            function.handler,
+        ).apply(validate_properties)
+
+    @pulumi.runtime.test
+    def test_provisioned_concurrency(self):
+        """Check the live alias is kept warm, and is what S3 invokes."""
+        lambda_function = self.dataset.lambda_function
+        notification = make_notification_lambda_args(self.dataset)
+
+        def validate_properties(args):
+            version, qualifier, executions, permission_qualifier, arn = args
+            assert version == "1"
+            assert qualifier == "live"
+            assert executions == 5
+            assert permission_qualifier == "live"
+            assert arn.endswith("function:export_test_dataset_tuned-move:live")
+
+        return pulumi.Output.all(
+            lambda_function._alias.function_version,
+            lambda_function._provisioned_concurrency.qualifier,
+            lambda_function._provisioned_concurrency.provisioned_concurrent_executions,
+            lambda_function._permission.qualifier,
+            notification.lambda_function_arn,
+        ).apply(validate_properties)
+
+    @pulumi.runtime.test
+    def test_function_can_resume_its_copies(self):
+        """Check the function can invoke itself, and its asynchronous retries are
+        set on the alias S3 invokes."""
+        lambda_function = self.dataset.lambda_function
+
+        def validate_properties(args):
+            qualifier, retries, max_age, policy = args
+            assert qualifier == "live"
+            assert retries == 2
+            assert max_age == 6 * 60 * 60
+            arn = "arn:aws:lambda:eu-west-1:000000000000:function:"
+            arn += "export_test_dataset_tuned-move"
+            assert json.loads(policy)["Statement"][0]["Resource"] == [arn, f"{arn}:*"]
+
+        return pulumi.Output.all(
+            lambda_function._invoke_config.qualifier,
+            lambda_function._invoke_config.maximum_retry_attempts,
+            lambda_function._invoke_config.maximum_event_age_in_seconds,
+            lambda_function._resumeRolePolicy.policy,
+        ).apply(validate_properties)
+
+    @pulumi.runtime.test
+    def test_tracing(self, test_config_1, export_bucket, test_tagger):
+        dataset = PushExportDataset(
+            dict(test_config_1, name="test_dataset_traced", tracing=True),
+            export_bucket,
+            test_tagger,
+        )
+        dataset.build_lambda_function()
+        lambda_function = dataset.lambda_function
+
+        def validate_properties(args):
+            tracing_config, variables, policy_arn = args
+            assert tracing_config["mode"] == "Active"
+            assert variables["TRACING"] == "true"
+            assert policy_arn == "arn:aws:iam::aws:policy/AWSXRayDaemonWriteAccess"
+
+        return pulumi.Output.all(
+            lambda_function._function.tracing_config,
+            lambda_function._function.environment.variables,
+            lambda_function._tracingPolicyAttachment.policy_arn,
+        ).apply(validate_properties)
+
+    def test_defaults(self, test_config_1, export_bucket, test_tagger):
+        dataset = PushExportDataset(test_config_1, export_bucket, test_tagger)
+        assert dataset.tracing is False
+        assert dataset.memory_mb == 128
+        assert dataset.timeout_s == 300
+        assert dataset.architecture == "x86_64"
+        assert dataset.reserved_concurrency is None
+        assert dataset.provisioned_concurrency is None
+
+    def test_provisioned_more_than_reserved(
+        self, test_config_tuned, export_bucket, test_tagger
+    ):
+        with pytest.raises(InvalidConfigError, match="can't be more than reserved"):
+            PushExportDataset(
+                dict(test_config_tuned, provisioned_concurrency=51),
+                export_bucket,
+                test_tagger,
+            )
+
+
+class TestCompressedPushExportDataset:
+    @pulumi.runtime.test
+    def test_compress_setting(self, test_config_1, export_bucket, test_tagger):
+        dataset = PushExportDataset(
+            dict(test_config_1, name="test_dataset_gzip", compress="gzip"),
+            export_bucket,
+            test_tagger,
+        )
+        dataset.build_lambda_function()
+
+        def validate_properties(args):
+            variables, layers = args
+            assert variables["COMPRESS"] == "gzip"
+            assert layers is None
+
+        function = dataset.lambda_function._function
+        return pulumi.Output.all(function.environment.variables, function.layers).apply(
+            validate_properties
+        )
+
+    @pulumi.runtime.test
+    def test_zstd_uses_layer(self, test_config_1, export_bucket, test_tagger):
+        layer = "arn:aws:lambda:eu-west-1:000000000000:layer:zstandard:1"
+        dataset = PushExportDataset(
+            dict(test_config_1, name="test_dataset_zstd", compress="zstd"),
+            export_bucket,
+            test_tagger,
+            zstd_layer=layer,
+        )
+        dataset.build_lambda_function()
+
+        def validate_properties(layers):
+            assert layers == [layer]
+
+        return dataset.lambda_function._function.layers.apply(validate_properties)
+
+    def test_zstd_needs_layer(self, test_config_1, export_bucket, test_tagger):
+        with pytest.raises(InvalidConfigError, match="zstd_layer_arn"):
+            PushExportDataset(
+                dict(test_config_1, compress="zstd"), export_bucket, test_tagger
+            )
+
 
 @pulumi.runtime.test
 def test_write_to_export_bucket_role_policy(export_bucket):
@@ -243,26 +693,28 @@ def test_write_to_export_bucket_role_policy(export_bucket):
         (
             name,
             user,
-            policy_statements,
+            policy,
         ) = args
         assert name == "hub_exports"
         assert user == "alpha_test_user"
-        assert policy_statements == [
+        assert json.loads(policy)["Statement"] == [
+            {
+                "Action": ["s3:ListBucket"],
+                "Effect": "Allow",
+                "Resource": ["arn:aws:s3:::test-export-bucket"],
+            },
             {
-                "actions": [
+                "Action": [
                     "s3:PutObject",
                     "s3:PutObjectAcl",
                     "s3:PutObjectTagging",
                 ],
-                "resources": [
+                "Effect": "Allow",
+                "Resource": [
                     "arn:aws:s3:::test-export-bucket/prefix_1/*",
                     "arn:aws:s3:::test-export-bucket/prefix_2/*",
                 ],
             },
-            {
-                "actions": ["s3:ListBucket"],
-                "resources": ["arn:aws:s3:::test-export-bucket"],
-            },
         ]
 
     test_role_policy = WriteToExportBucketRolePolicy(
@@ -271,5 +723,77 @@ def test_write_to_export_bucket_role_policy(export_bucket):
     return pulumi.Output.all(
         test_role_policy._role_policy.name,
         test_role_policy._role_policy.role,
-        test_role_policy._policy_document.statements,
+        test_role_policy._role_policy.policy,
     ).apply(validate_properties)
+
+
+def test_other_inline_policies_count_against_the_limit(export_bucket):
+    """A push policy that would fit inline on its own is made managed if the role's
+    other inline policies leave too little room for it."""
+    all_prefixes = [f"dataset_{i}" for i in range(100)]
+    prefixes = all_prefixes[::2]
+    alone = WriteToExportBucketRolePolicy(
+        "alpha_test_user", export_bucket, prefixes, all_prefixes
+    )
+    assert alone._role_policy is not None
+    shared = WriteToExportBucketRolePolicy(
+        "alpha_test_user_2", export_bucket, prefixes, all_prefixes, 8_000
+    )
+    assert shared._role_policy is None
+    assert len(shared._policies) == 1
+
+
+def test_wildcards_skip_backfill_prefix(yaml_file_list, export_bucket, test_tagger):
+    """A wildcard in a user's policy can't reach the backfill manifests and reports."""
+    datasets = PushExportDatasets(yaml_file_list, export_bucket, test_tagger)
+    datasets.datasets = [
+        PushExportDataset(
+            {"name": name, "target_bucket": "target", "users": ["alpha_test_user"]},
+            export_bucket,
+            test_tagger,
+        )
+        for name in ("_b1", "_b2")
+    ]
+    datasets.users = {"alpha_test_user": ["_b1", "_b2"]}
+    datasets.build_role_policies()
+    assert datasets.role_policies[0].patterns == ["_b1", "_b2"]
+
+
+@pulumi.runtime.test
+def test_large_role_policy_is_split_into_managed_policies(export_bucket):
+    """A user on hundreds of datasets gets several managed policies that between
+    them cover every dataset, rather than one inline policy that's too large."""
+    all_prefixes = [f"dataset_{i}" for i in range(600)]
+    prefixes = all_prefixes[::2]
+    test_role_policy = WriteToExportBucketRolePolicy(
+        "alpha_test_user", export_bucket, prefixes, all_prefixes
+    )
+    assert test_role_policy._role_policy is None
+    assert 1 < len(test_role_policy._policies) <= 10
+
+    def validate_documents(documents):
+        resources = []
+        for document in documents:
+            assert len(document) <= 6_144
+            resources.extend(json.loads(document)["Statement"][1]["Resource"])
+        assert resources == sorted(
+            f"arn:aws:s3:::test-export-bucket/{prefix}/*" for prefix in prefixes
+        )
+
+    def validate_attachments(args):
+        policy_arns, roles = args[::2], args[1::2]
+        assert set(roles) == {"alpha_test_user"}
+        assert all(arn.startswith("arn:aws:iam::") for arn in policy_arns)
+
+    return pulumi.Output.all(
+        pulumi.Output.all(*[p.policy for p in test_role_policy._policies]).apply(
+            validate_documents
+        ),
+        pulumi.Output.all(
+            *[
+                value
+                for a in test_role_policy._attachments
+                for value in (a.policy_arn, a.role)
+            ]
+        ).apply(validate_attachments),
+    )
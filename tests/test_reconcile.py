@@ -0,0 +1,150 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from data_engineering_exports import cli, reconcile
+from data_engineering_exports.lambda_handlers.export import bundle
+from data_engineering_exports.lambda_handlers.export.routing import Route
+from data_engineering_exports.reconcile import ObjectInfo
+from data_engineering_exports.utils_for_tests import check_bucket_contents
+
+EXPORT_BUCKET = "mojap-hub-exports"
+DATASETS = [
+    {"name": "moved", "target_bucket": "target-1", "keep_files": False},
+    {"name": "kept", "target_bucket": "target-2", "keep_files": True},
+]
+
+
+@pytest.fixture
+def buckets(fake_s3):
+    # Lists two keys a page, to check listings carry on past the first page
+    fake_s3.page_size = 2
+    # Moved properly
+    fake_s3.put("target-1", "moved/done.csv", b"done")
+    # Copied but not deleted
+    fake_s3.put(EXPORT_BUCKET, "moved/stuck.csv", b"stuck")
+    fake_s3.put("target-1", "moved/stuck.csv", b"stuck")
+    # Never copied
+    fake_s3.put(EXPORT_BUCKET, "moved/missing.csv", b"missing")
+    # Copied, but the copy doesn't match
+    fake_s3.put(EXPORT_BUCKET, "moved/differs.csv", b"new version")
+    fake_s3.put("target-1", "moved/differs.csv", b"old")
+    # Kept files are expected in both buckets
+    for i in range(5):
+        fake_s3.put(EXPORT_BUCKET, f"kept/{i}.csv", b"kept")
+        fake_s3.put("target-2", f"kept/{i}.csv", b"kept")
+    fake_s3.put(EXPORT_BUCKET, "kept/missing.csv", b"missing")
+    return fake_s3
+
+
+def test_merge_listings_pairs_keys():
+    left = [ObjectInfo("a", 1, "x"), ObjectInfo("c", 1, "x")]
+    right = [ObjectInfo("b", 1, "x"), ObjectInfo("c", 2, "y"), ObjectInfo("d", 1, "x")]
+    pairs = list(reconcile.merge_listings(left, right))
+    assert [(a and a.key, b and b.key) for a, b in pairs] == [
+        ("a", None),
+        (None, "b"),
+        ("c", "c"),
+        (None, "d"),
+    ]
+
+
+def test_multipart_etags_are_compared_by_size():
+    original = ObjectInfo("a", 10, '"abc"')
+    assert reconcile.same_contents(original, ObjectInfo("a", 10, '"def-2"'))
+    assert not reconcile.same_contents(original, ObjectInfo("a", 10, '"def"'))
+    assert not reconcile.same_contents(original, ObjectInfo("a", 11, '"def-2"'))
+
+
+def test_reconcile_finds_every_problem(buckets):
+    problems = reconcile.reconcile(buckets, DATASETS, EXPORT_BUCKET, workers=2)
+    found = sorted((p.status, p.key) for p in problems)
+    assert found == [
+        ("differs", "moved/differs.csv"),
+        ("missing", "kept/missing.csv"),
+        ("missing", "moved/missing.csv"),
+        ("stuck", "moved/stuck.csv"),
+    ]
+
+
+def test_recent_objects_are_ignored(buckets):
+    buckets.buckets[EXPORT_BUCKET]["moved/missing.csv"]["LastModified"] = datetime.now(
+        timezone.utc
+    )
+    buckets.buckets[EXPORT_BUCKET]["moved/stuck.csv"]["LastModified"] = datetime.now(
+        timezone.utc
+    ) - timedelta(hours=1)
+    problems = reconcile.reconcile(buckets, DATASETS[:1], EXPORT_BUCKET)
+    assert sorted(p.key for p in problems) == ["moved/differs.csv", "moved/stuck.csv"]
+
+
+def test_stopping_early_doesnt_hang(buckets):
+    buckets.page_size = 1
+    datasets = DATASETS * 20
+    problems = reconcile.reconcile(buckets, datasets, EXPORT_BUCKET, workers=4)
+    next(problems)
+    problems.close()
+
+
+def test_reconcile_command_writes_problems(buckets, monkeypatch, tmp_path):
+    monkeypatch.setattr(cli.registry, "load_configs", lambda *args: DATASETS)
+    monkeypatch.setattr(cli.boto3, "client", lambda service: buckets)
+    output = tmp_path / "problems.jsonl"
+    args = cli.build_parser().parse_args(
+        ["reconcile", "--dataset", "moved", "--output", str(output)]
+    )
+    with pytest.raises(SystemExit):
+        args.function(args)
+    assert len(output.read_text().splitlines()) == 3
+
+
+def test_check_bucket_contents_reads_every_page(fake_s3):
+    fake_s3.page_size = 10
+    keys = [f"dataset/{i:03d}.csv" for i in range(25)]
+    for key in keys:
+        fake_s3.put("bucket", key, b"")
+    check_bucket_contents("bucket", keys, fake_s3)
+    with pytest.raises(AssertionError):
+        check_bucket_contents("bucket", keys[:-1], fake_s3)
+
+
+def test_cli_parses_reconcile_defaults():
+    args = cli.build_parser().parse_args(["reconcile"])
+    assert args.export_bucket == EXPORT_BUCKET
+    assert args.min_age == 15
+    assert args.dataset is None
+
+
+def test_compressed_dataset_is_checked_by_key(fake_s3):
+    dataset = {"name": "squashed", "target_bucket": "target-3", "compress": "gzip"}
+    fake_s3.put(EXPORT_BUCKET, "squashed/stuck.csv", b"stuck")
+    fake_s3.put("target-3", "squashed/stuck.csv.gz", b"compressed")
+    fake_s3.put(EXPORT_BUCKET, "squashed/missing.csv", b"missing")
+    fake_s3.put(EXPORT_BUCKET, "squashed/already.csv.gz", b"already")
+    fake_s3.put("target-3", "squashed/already.csv.gz", b"already")
+
+    problems = reconcile.reconcile(fake_s3, [dataset], EXPORT_BUCKET)
+    assert sorted((p.status, p.key) for p in problems) == [
+        ("missing", "squashed/missing.csv"),
+        ("stuck", "squashed/already.csv.gz"),
+        ("stuck", "squashed/stuck.csv"),
+    ]
+
+
+def test_bundled_dataset_is_checked_against_indexes(fake_s3):
+    dataset = {"name": "bundled", "target_bucket": "target-4", "bundle": "tar"}
+    for key in ("bundled/stuck.json", "bundled/changed.json", "bundled/missing.json"):
+        fake_s3.put(EXPORT_BUCKET, key, b"{}")
+    etag = fake_s3.buckets[EXPORT_BUCKET]["bundled/stuck.json"]["ETag"]
+    members = [
+        bundle.Member("bundled/stuck.json", b"{}", etag, None),
+        bundle.Member("bundled/changed.json", b"[]", '"old"', None),
+    ]
+    bundle.write_bundle(fake_s3, members, Route("target-4", False, bundle="tar"))
+
+    problems = reconcile.reconcile(fake_s3, [dataset], EXPORT_BUCKET)
+    assert sorted((p.status, p.key) for p in problems) == [
+        ("differs", "bundled/changed.json"),
+        ("missing", "bundled/missing.json"),
+        ("stuck", "bundled/stuck.json"),
+    ]
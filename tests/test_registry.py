@@ -0,0 +1,222 @@
+import json
+
+import pytest
+
+from data_engineering_exports import registry
+from data_engineering_exports.registry import (
+    InvalidConfigError,
+    load_config,
+    load_configs,
+    validate_config,
+)
+
+
+def write_config(folder, filename, content):
+    path = folder / filename
+    path.write_text(content)
+    return path
+
+
+@pytest.fixture
+def config_folder(tmp_path):
+    write_config(
+        tmp_path,
+        "push_1.yaml",
+        "name: push_1\ntarget_bucket: bucket-1\nusers:\n  - alpha_user_one\n",
+    )
+    write_config(
+        tmp_path,
+        "push_2.yaml",
+        "name: push_2\ntarget_bucket: bucket-2\nkeep_files: true\n"
+        "users:\n  - alpha_user_two\n",
+    )
+    return tmp_path
+
+
+def test_load_config_fills_defaults():
+    config = load_config("tests/data/test.yaml", "push")
+    assert config == {
+        "name": "test_dataset",
+        "target_bucket": "test-bucket",
+        "users": ["alpha_user_test_person"],
+        "keep_files": False,
+        "delivery": "direct",
+        "batch_size": 100,
+        "batching_window_s": 30,
+        "memory_mb": 128,
+        "timeout_s": 300,
+        "architecture": "x86_64",
+        "reserved_concurrency": None,
+        "provisioned_concurrency": None,
+        "tracing": False,
+        "allow_backfill": False,
+        "handler": "full",
+        "compress": None,
+        "bundle": None,
+        "bundle_max_mb": 32,
+        "include_suffixes": [],
+        "exclude_patterns": [],
+        "min_size_bytes": 0,
+        "event_types": ["put", "post", "copy", "multipart"],
+        "paperwork": [],
+    }
+
+
+def test_pull_flags_are_normalised():
+    """Check the older `allow_push: [True]` style becomes a plain boolean."""
+    config = validate_config(
+        {
+            "name": "pull-one",
+            "pull_arns": ["arn:aws:iam::123456789012:role/a-role"],
+            "users": ["alpha_user_one"],
+            "allow_push": [True],
+            "paperwork": "DPIA 123",
+        },
+        "pull",
+    )
+    assert config["allow_push"] is True
+    assert config["bucket_versioning"] is False
+    assert config["manifest"] is False
+    assert config["replica_regions"] == []
+    assert config["paperwork"] == ["DPIA 123"]
+
+
+def test_every_problem_is_reported():
+    with pytest.raises(InvalidConfigError) as e:
+        validate_config(
+            {"name": "Bad Name", "users": "alpha_user_one", "delivery": "sometimes"},
+            "push",
+            "bad.yaml",
+        )
+    message = str(e.value)
+    assert message.startswith("bad.yaml: ")
+    assert "name must be lower case letters, numbers and underscores" in message
+    assert "target_bucket is required" in message
+    assert "users must be of type list" in message
+    assert "delivery must be one of direct, batched" in message
+
+
+def test_bundle_rules():
+    config = {
+        "name": "push_1",
+        "target_bucket": "bucket-1",
+        "users": ["alpha_user_one"],
+        "bundle": "tar",
+    }
+    with pytest.raises(InvalidConfigError, match="bundle needs delivery: batched"):
+        validate_config(config, "push")
+    with pytest.raises(InvalidConfigError, match="more than half of memory_mb"):
+        validate_config(dict(config, delivery="batched", bundle_max_mb=100), "push")
+    assert validate_config(dict(config, delivery="batched"), "push")["bundle"] == "tar"
+
+
+def test_lean_handler_rules():
+    config = {
+        "name": "push_1",
+        "target_bucket": "bucket-1",
+        "users": ["alpha_user_one"],
+        "handler": "lean",
+    }
+    with pytest.raises(InvalidConfigError, match="needs delivery: direct"):
+        validate_config(dict(config, delivery="batched"), "push")
+    with pytest.raises(InvalidConfigError, match="can't be used with tracing"):
+        validate_config(dict(config, tracing=True), "push")
+    assert validate_config(config, "push")["handler"] == "lean"
+
+
+def test_replica_rules():
+    config = {
+        "name": "pull-one",
+        "pull_arns": ["arn:aws:iam::123456789012:role/a-role"],
+        "users": ["alpha_user_one"],
+        "replica_regions": "us-east-1",
+    }
+    with pytest.raises(InvalidConfigError, match="needs bucket_versioning: true"):
+        validate_config(config, "pull")
+    with pytest.raises(InvalidConfigError, match="must be a list of AWS regions"):
+        validate_config(dict(config, replica_regions=["US East"]), "pull")
+    with pytest.raises(InvalidConfigError, match="too long for a replica bucket"):
+        validate_config(dict(config, name="x" * 50, bucket_versioning=True), "pull")
+    config = validate_config(dict(config, bucket_versioning=True), "pull")
+    assert config["replica_regions"] == ["us-east-1"]
+
+
+def test_unknown_keys_warn():
+    with pytest.warns(UserWarning, match="ignoring unknown keys keep_file"):
+        validate_config(
+            {
+                "name": "push_1",
+                "target_bucket": "bucket-1",
+                "users": ["alpha_user_one"],
+                "keep_file": True,
+            },
+            "push",
+        )
+
+
+def test_load_configs_reports_every_bad_file(config_folder):
+    write_config(config_folder, "bad_1.yaml", "name: bad_1\n")
+    write_config(config_folder, "bad_2.yaml", "- not a mapping\n")
+    with pytest.raises(InvalidConfigError) as e:
+        load_configs(sorted(config_folder.glob("*.yaml")), "push")
+    assert "bad_1.yaml" in str(e.value)
+    assert "bad_2.yaml" in str(e.value)
+
+
+def test_index_only_parses_changed_files(config_folder, monkeypatch):
+    index_path = config_folder / "index.json"
+    paths = sorted(config_folder.glob("*.yaml"))
+    first = load_configs(paths, "push", index_path)
+    assert [c["name"] for c in first] == ["push_1", "push_2"]
+
+    parsed = []
+    original = registry.validate_config
+    monkeypatch.setattr(
+        registry,
+        "validate_config",
+        lambda config, *args: parsed.append(config["name"]) or original(config, *args),
+    )
+    # Nothing has changed, so nothing is parsed
+    assert load_configs(paths, "push", index_path) == first
+    assert parsed == []
+
+    # Only the edited file is parsed again
+    write_config(
+        config_folder,
+        "push_2.yaml",
+        "name: push_2\ntarget_bucket: bucket-3\nusers:\n  - alpha_user_two\n",
+    )
+    second = load_configs(paths, "push", index_path)
+    assert parsed == ["push_2"]
+    assert second[1]["target_bucket"] == "bucket-3"
+
+    # The stale entry for the old version of push_2 is dropped
+    index = json.loads(index_path.read_text())
+    assert len(index["configs"]) == 2
+
+
+def test_index_is_shared_by_push_and_pull(config_folder):
+    index_path = config_folder / "index.json"
+    pull_path = write_config(
+        config_folder,
+        "pull.yml",
+        "name: pull-one\npull_arns:\n  - arn:aws:iam::123456789012:role/a-role\n"
+        "users:\n  - alpha_user_one\n",
+    )
+    load_configs(sorted(config_folder.glob("*.yaml")), "push", index_path)
+    load_configs([pull_path], "pull", index_path)
+
+    index = json.loads(index_path.read_text())
+    kinds = sorted(entry["kind"] for entry in index["configs"].values())
+    assert kinds == ["pull", "push", "push"]
+
+
+def test_index_from_old_schema_is_ignored(config_folder, monkeypatch):
+    index_path = config_folder / "index.json"
+    paths = sorted(config_folder.glob("*.yaml"))
+    load_configs(paths, "push", index_path)
+
+    monkeypatch.setattr(registry, "SCHEMA_VERSION", registry.SCHEMA_VERSION + 1)
+    load_configs(paths, "push", index_path)
+    index = json.loads(index_path.read_text())
+    assert index["schema_version"] == registry.SCHEMA_VERSION